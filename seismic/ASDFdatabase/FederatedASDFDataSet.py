@@ -16,20 +16,33 @@ from collections import defaultdict
 
 # from mpi4py import MPI
 import numpy as np
-from scipy.spatial import cKDTree
 
 from seismic.ASDFdatabase._FederatedASDFDataSetImpl import _FederatedASDFDataSetImpl
-from seismic.ASDFdatabase.utils import rtp2xyz
 
 
 class FederatedASDFDataSet():
-    def __init__(self, asdf_source, logger=None, single_item_read_limit_in_mb=1024):
+    def __init__(self, asdf_source, logger=None, single_item_read_limit_in_mb=1024,
+                 cache_size_in_mb=0, prefetch=False, max_open_files=64, build_daily_stats=False):
         """
         Initializer for FederatedASDFDataSet.
 
         :param asdf_source: Path to a text file containing a list of ASDF files. \
                Entries can be commented out with '#'
         :param logger: logger instance
+        :param single_item_read_limit_in_mb: buffer size (MB) for reading a single waveform
+        :param cache_size_in_mb: capacity (MB) of the least-recently-used cache of decoded traces, which \
+               avoids decoding the same waveform data repeatedly; 0 (default) disables caching. Note that \
+               whole traces are decoded on cache misses, which only pays off for repeated or sequential \
+               reads of the same traces, e.g. day-by-day scans of a station's data
+        :param prefetch: when True, the time window following each call to get_waveforms is loaded into \
+               the cache on a background thread. This speeds up sequential scans, e.g. day-by-day \
+               processing of a station's data; has no effect unless the cache is enabled
+        :param max_open_files: maximum number of ASDF files held open at a time. Files are opened lazily on \
+               first access and the least recently used file is closed once this limit is reached, which \
+               keeps startup time, file descriptors and memory usage in check for federations of many files
+        :param build_daily_stats: when True, per-channel daily summaries (sample count, coverage, mean, std, min \
+               and max) are recorded while the index is built, which can then be queried through get_daily_stats \
+               without reading waveform data. Note that building these requires reading all waveform data once
         """
         self.logger = logger
         self.asdf_source = asdf_source
@@ -38,31 +51,14 @@ class FederatedASDFDataSet():
 
         # Instantiate implementation class
         self.fds = _FederatedASDFDataSetImpl(asdf_source, logger=logger,
-                                             single_item_read_limit_in_mb=single_item_read_limit_in_mb)
+                                             single_item_read_limit_in_mb=single_item_read_limit_in_mb,
+                                             cache_size_in_mb=cache_size_in_mb,
+                                             prefetch=prefetch,
+                                             max_open_files=max_open_files,
+                                             build_daily_stats=build_daily_stats)
 
-        # Populate coordinates
-        self._unique_coordinates = defaultdict(list)
-
-        rtps_dict = defaultdict()
-        for ds_dict in self.fds.asdf_station_coordinates:
-            for key in list(ds_dict.keys()):
-                self._unique_coordinates[key] = [ds_dict[key][0], ds_dict[key][1]]
-
-                rtps_dict[key] = [self._earth_radius,
-                                  np.radians(90 - ds_dict[key][1]),
-                                  np.radians(ds_dict[key][0])]
-            # end for
-        # end for
-
-        rtps_list = []
-        for k in list(rtps_dict.keys()):
-            rtps_list.append(rtps_dict[k])
-        # end for
-        rtps = np.array(rtps_list)
-        xyzs = rtp2xyz(rtps[:, 0], rtps[:, 1], rtps[:, 2])
-
-        self._tree = cKDTree(xyzs)
-        self._key_list = np.array(list(rtps_dict.keys()))
+        # Station coordinates and KD-tree, persisted alongside the index
+        self._station_index = self.fds.station_index
 
     # end func
 
@@ -72,6 +68,11 @@ class FederatedASDFDataSet():
 
         :return: dictionary containing [lon, lat] coordinates indexed by 'net.sta'
         """
+        if self._unique_coordinates is None:
+            si = self._station_index
+            self._unique_coordinates = defaultdict(list, zip(si.keys, [[lon, lat] for lon, lat in zip(si.lon, si.lat)]))
+        # end if
+
         return self._unique_coordinates
 
     # end func
@@ -79,31 +80,23 @@ class FederatedASDFDataSet():
     def get_closest_stations(self, lon, lat, nn=1):
         """
 
-        :param lon: longitude (degree)
-        :param lat: latitude (degrees)
+        :param lon: longitude (degree); can also be an array of longitudes
+        :param lat: latitude (degrees); can also be an array of latitudes
         :param nn: number of closest stations to fetch
         :return: A tuple containing a list of closest 'network.station' names and a list of distances
-                 (in ascending order) in kms
+                 (in ascending order) in kms. When arrays of coordinates are provided, a tuple of 2D arrays of
+                 names and distances is returned instead, with a row for each point; queries for many points are
+                 considerably faster in a single call
         """
         assert nn > 0, 'nn must be > 0'
 
-        xyz = rtp2xyz(np.array([self._earth_radius]),
-                      np.array([np.radians(90 - lat)]),
-                      np.array([np.radians(lon)]))
-        d, l = self._tree.query(xyz, nn)
+        names, d = self._station_index.query(lon, lat, nn)
 
-        if isinstance(l, int):
-            l = [l]
+        if np.ndim(lon) == 0 and np.ndim(lat) == 0:
+            return (list(names[0]), d[0])
+        # end if
 
-        if (len(d.shape) == 1):
-            d = np.expand_dims(d, axis=0)
-
-        l = l[l < len(self.unique_coordinates)]
-
-        if isinstance(l, int):
-            l = [l]
-
-        return (list(self._key_list[l]), d[0, :len(l)])
+        return names, d
 
     # end func
 
@@ -137,6 +130,24 @@ class FederatedASDFDataSet():
 
     # end func
 
+    def get_stations_bulk(self, starttimes, endtimes, network=None, station=None, location=None, channel=None):
+        """
+        Equivalent to calling get_stations for each pair of start- and end-times, in a single vectorized query
+
+        :param starttimes: list of start times, as strings in UTCDateTime format or instances of obspy.UTCDateTime
+        :param endtimes: list of end times, as strings in UTCDateTime format or instances of obspy.UTCDateTime
+        :param network: network code (optional)
+        :param station: station code (optional)
+        :param location: location code (optional)
+        :param channel: channel code (optional)
+
+        :return: a list, for each pair of start- and end-times, of lists containing [net, sta, loc, cha, lon, lat]
+                 in each row
+        """
+        return self.fds.get_stations_bulk(starttimes, endtimes, network, station, location, channel)
+
+    # end func
+
     def get_waveform_count(self, network, station, location, channel, starttime,
                            endtime):
         """
@@ -157,6 +168,25 @@ class FederatedASDFDataSet():
 
     # end func
 
+    def get_daily_stats(self, network, station, location, channel, starttime, endtime):
+        """
+        Fetches daily summaries of waveform data, recorded in the index when FederatedASDFDataSet is instantiated
+        with build_daily_stats=True, without reading any waveform data. Summaries are computed over UTC days.
+
+        :param network: network code
+        :param station: station code
+        :param location: location code
+        :param channel: channel code
+        :param starttime: start time string in UTCDateTime format; can also be an instance of obspy.UTCDateTime
+        :param endtime: end time string in UTCDateTime format; can also be an instance of obspy.UTCDateTime
+        :return: a dictionary of numpy arrays keyed by 'day' (timestamps marking the start of each day), 'count' \
+                 (number of samples), 'coverage' (fraction of the day covered by data), 'mean', 'std', 'min' and \
+                 'max', for days containing data; None if daily summaries are not available
+        """
+        return self.fds.get_daily_stats(network, station, location, channel, starttime, endtime)
+
+    # end func
+
     def get_waveforms(self, network, station, location, channel, starttime,
                       endtime, trace_count_threshold=200):
         """
@@ -166,9 +196,10 @@ class FederatedASDFDataSet():
         :param channel: channel code
         :param starttime: start time string in UTCDateTime format; can also be an instance of obspy.UTCDateTime
         :param endtime: end time string in UTCDateTime format; can also be an instance of obspy.UTCDateTime
-        :param trace_count_threshold: returns an empty Stream if the number of traces within the time-range provided
-                                      exceeds the threshold (default 200). This is particularly useful for filtering
-                                      out data from bad stations, e.g. those from the AU.Schools network
+        :param trace_count_threshold: if the number of traces within the time-range provided exceeds the threshold
+                                      (default 200), e.g. for stations with heavily fragmented data, traces are
+                                      read in batches of this size and merged incrementally, without filling gaps,
+                                      which bounds memory usage. Traces are returned unmerged otherwise
         :return: an obspy.Stream containing waveform data over the time-rage provided
         """
         s = self.fds.get_waveforms(network, station, location, channel, starttime,
@@ -177,17 +208,69 @@ class FederatedASDFDataSet():
 
     # end func
 
-    def local_net_sta_list(self):
+    def get_waveform_arrays(self, network, station, location, channel, starttime, endtime):
+        """
+        Fetches waveform samples as numpy arrays, without constructing obspy Traces, which is considerably faster
+        and leaner than get_waveforms for extracting short windows out of long continuous traces. Only the samples
+        requested are read from the underlying ASDF files.
+
+        :param network: network code
+        :param station: station code
+        :param location: location code
+        :param channel: channel code
+        :param starttime: start time string in UTCDateTime format; can also be an instance of obspy.UTCDateTime
+        :param endtime: end time string in UTCDateTime format; can also be an instance of obspy.UTCDateTime
+        :return: a list of (data, stats) tuples, one for each matching waveform, where stats is a dictionary
+                 containing network, station, location, channel, starttime, sampling_rate and npts. Arrays for
+                 uncompressed data are read-only views into memory-mapped files and must be copied before being
+                 altered
+        """
+        return self.fds.get_waveform_arrays(network, station, location, channel, starttime, endtime)
+
+    # end func
+
+    def get_waveforms_bulk(self, requests, trace_count_threshold=200):
+        """
+        Fetches waveforms for many requests at once, e.g. all channels of several stations around an
+        event's origin time. Data for each waveform tag are read from the underlying ASDF files only once
+        over the requested time-ranges, which is considerably faster than repeated calls to get_waveforms.
+
+        :param requests: list of tuples containing (net, sta, loc, cha, starttime, endtime); start- and \
+               end-times can be strings in UTCDateTime format or instances of obspy.UTCDateTime
+        :param trace_count_threshold: requests where the number of traces within the time-range exceeds the \
+               threshold (default 200) are assembled incrementally, as in get_waveforms
+        :return: a list of obspy.Streams, one for each request
+        """
+        return self.fds.get_waveforms_bulk(requests, trace_count_threshold)
+
+    # end func
+
+    def get_cache_stats(self):
+        """
+        :return: dictionary containing hit, miss, eviction and prefetch counters, along with the current \
+                 occupancy of the decoded-trace cache; None if caching is disabled
+        """
+        return self.fds.get_cache_stats()
+
+    # end func
+
+    def local_net_sta_list(self, dynamic=False, chunk_size_in_days=30):
         """
         This function provides an iterator over the entire data volume contained in all the ASDF files listed in the
         text file during instantiation. When FederatedASDFDataSet is instantiated in an MPI-parallel environment,
-        meta-data for the entire data volume are equally partitioned over all processors -- in such instances, this
+        meta-data for the entire data volume are partitioned over all processors -- in such instances, this
         function provides an iterator over the data allocated to a given processor. This functionality underpins
         parallel operations, e.g. picking arrivals.
 
+        :param dynamic: when False (default), data for each station are split into contiguous time-ranges that
+               contain equal amounts of data (by duration) and allocated to processors up front. When True, data are
+               split into chunks of chunk_size_in_days, which processors claim one at a time as they become idle.
+               The dynamic mode balances workloads better, but the allocation varies between runs and all
+               processors must call this function together and exhaust the iterator.
+        :param chunk_size_in_days: length of work units in dynamic mode
         :return: tuples containing [net, sta, start_time, end_time]; start- and end-times are instances of obspy.UTCDateTime
         """
-        for item in self.fds.local_net_sta_list():
+        for item in self.fds.local_net_sta_list(dynamic=dynamic, chunk_size_in_days=chunk_size_in_days):
             yield item
         # end for
     # end func
@@ -11,7 +11,6 @@ Revision History:
     LastUpdate:     03/19/18   RH
     LastUpdate:     dd/mm/yyyy  Who     Optional description
 """
-from future.utils import iteritems
 from builtins import range
 
 from mpi4py import MPI
@@ -20,12 +19,11 @@ import glob
 import atexit
 import logging
 import pickle
-from ordered_set import OrderedSet as set
 import numpy as np
 
 from obspy.core import Stream, UTCDateTime
 from obspy import read, Trace
-import pyasdf
+from obspy.core.util.attribdict import AttribDict
 from pyasdf import ASDFDataSet
 from pyasdf.exceptions import ASDFValueError
 import ujson as json
@@ -33,8 +31,9 @@ from collections import defaultdict
 import sqlite3
 import psutil
 import hashlib
-from functools import partial
-from seismic.ASDFdatabase.utils import MIN_DATE, MAX_DATE
+from seismic.ASDFdatabase.utils import MIN_DATE, MAX_DATE, SharedCounter, compute_daily_stats
+from seismic.ASDFdatabase.cache import WaveformCache, WaveformPrefetcher, ASDFHandlePool
+from seismic.ASDFdatabase.index import IntervalIndex, StationIndex
 
 logging.basicConfig()
 
@@ -77,12 +76,52 @@ def split_list_by_timespan(l, n):
     return result
 # end func
 
+def split_list_by_duration(st, et, npartitions):
+    """
+    Splits a set of time-intervals into contiguous, non-overlapping time-ranges, each spanning an
+    approximately equal share of the total duration of the intervals
+
+    :param st: array of start-times, in ascending order
+    :param et: array of end-times
+    :param npartitions: number of partitions
+    :return: list of [start, end] time-ranges, one for each partition; None for empty partitions
+    """
+    if(len(st) == 0): return [None] * npartitions
+
+    durations = np.maximum(et - st, 0)
+    if(np.sum(durations) <= 0): durations = np.ones(len(st))  # fall back to balancing interval counts
+    cum = np.cumsum(durations)
+
+    # assign each interval by the cumulative duration at its mid-point
+    part = np.minimum(((cum - durations / 2.) / cum[-1] * npartitions).astype(int), npartitions - 1)
+
+    starts = [None] * npartitions
+    for i, j in zip(*np.unique(part, return_index=True)): starts[i] = st[j]
+
+    result = [None] * npartitions
+    nonempty = [i for i in range(npartitions) if starts[i] is not None]
+    for i, j in zip(nonempty, nonempty[1:] + [None]):
+        result[i] = [starts[i], starts[j] if j is not None else np.max(et)]
+    # end for
+
+    return result
+# end func
+
 class _FederatedASDFDataSetImpl():
-    def __init__(self, asdf_source, logger=None, single_item_read_limit_in_mb=1024):
+    def __init__(self, asdf_source, logger=None, single_item_read_limit_in_mb=1024,
+                 cache_size_in_mb=0, prefetch=False, max_open_files=64, build_daily_stats=False):
         """
         :param asdf_source: path to a text file containing a list of ASDF files:
                Entries can be commented out with '#'
         :param logger: logger instance
+        :param single_item_read_limit_in_mb: buffer size for reading a single waveform
+        :param cache_size_in_mb: capacity of the decoded-trace cache; 0 (default) disables caching
+        :param prefetch: load the time window following each request into the cache on a
+               background thread
+        :param max_open_files: maximum number of ASDF files held open at a time; files are
+               opened lazily on first access
+        :param build_daily_stats: record per-channel daily summary statistics in the index, which
+               requires reading all waveform data while the index is built
         """
 
         self.comm = MPI.COMM_WORLD
@@ -90,13 +129,13 @@ class _FederatedASDFDataSetImpl():
         self.rank = self.comm.Get_rank()
 
         self.logger = logger
+        self.build_daily_stats = build_daily_stats
         self.asdf_source = None
         self.asdf_file_names = []
         self.asdf_station_coordinates = []
 
         if isinstance(asdf_source, str):
             self.asdf_source = asdf_source
-            self.source_sha1 = hashlib.sha1(open(self.asdf_source).read().encode('utf-8')).hexdigest()
             fileContents = list(filter(len, open(self.asdf_source).read().splitlines()))
 
             # collate file names
@@ -110,29 +149,95 @@ class _FederatedASDFDataSetImpl():
             raise NameError('Invalid value for asdf_source..')
         # end if
 
-        self.asdf_datasets = []
-        for ifn, fn in enumerate(self.asdf_file_names):
-            if self.logger:self.logger.info('Opening ASDF file %s..'%(fn))
-
-            if(os.path.exists(fn)):
-                ds = pyasdf.ASDFDataSet(fn, mode='r')
-                ds.single_item_read_limit_in_mb = single_item_read_limit_in_mb
-                self.asdf_datasets.append(ds)
-                self.asdf_station_coordinates.append(defaultdict(list))
-            else:
-                raise NameError('File not found: %s..'%fn)
-            # end if
-        # end func
+        for fn in self.asdf_file_names:
+            if(not os.path.exists(fn)): raise NameError('File not found: %s..'%fn)
+            self.asdf_station_coordinates.append(defaultdict(list))
+        # end for
+
+        self.asdf_datasets = ASDFHandlePool(self.asdf_file_names, max_open_files=max_open_files,
+                                            single_item_read_limit_in_mb=single_item_read_limit_in_mb,
+                                            logger=self.logger)
+
+        # Per-file index shards are keyed by file path, modification time and size, so that
+        # only new or modified files need scanning when the source list changes
+        self.shard_dir = os.path.join(os.path.dirname(self.asdf_source), 'asdf_index_shards')
+        self.shard_file_names = self.comm.bcast([self.get_shard_file_name(fn) for fn in self.asdf_file_names]
+                                                if self.rank == 0 else None, root=0)
+        self.source_sha1 = hashlib.sha1('\n'.join([os.path.basename(sfn) for sfn in self.shard_file_names])
+                                        .encode('utf-8')).hexdigest()
 
         # Create database
         self.conn = None
         self.db_fn = os.path.join(os.path.dirname(self.asdf_source),  self.source_sha1 + '.db')
         self.create_database()
 
+        # In-memory interval index for serving waveform queries
+        self.index = IntervalIndex(self.conn)
+        if self.logger: self.logger.info('Loaded %d waveform entries into interval index..'%(len(self.index)))
+
+        # Station coordinates and KD-tree
+        self._station_rows = dict()
+        self.station_index = StationIndex(self.asdf_station_coordinates,
+                                          cache_file_name=os.path.splitext(self.db_fn)[0] + '.kdtree.pkl')
+
+        # Decoded-trace cache and prefetcher
+        self.waveform_cache = None
+        self.prefetcher = None
+        if(cache_size_in_mb > 0):
+            self.waveform_cache = WaveformCache(cache_size_in_mb)
+            if(prefetch):
+                self.prefetcher = WaveformPrefetcher(self.waveform_cache, self._read_full_trace,
+                                                     logger=self.logger)
+            # end if
+        # end if
+
         atexit.register(self.cleanup) # needed for closing asdf files at exit
     # end func
 
-    def create_database(self):
+    def get_shard_file_name(self, fn):
+        """
+        :param fn: ASDF file name
+        :return: name of the index shard for the given ASDF file, which changes with the file's
+                 path, modification time and size, and with whether daily statistics are recorded
+        """
+        stat = os.stat(fn)
+        key = '%s|%d|%d' % (os.path.abspath(fn), stat.st_mtime_ns, stat.st_size)
+        if(self.build_daily_stats): key += '|dailystats'
+
+        return os.path.join(self.shard_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.db')
+    # end func
+
+    @staticmethod
+    def create_tables(conn, daily_stats=False):
+        conn.execute('create table wdb(ds_id smallint, net varchar(6), sta varchar(6), loc varchar(6), '
+                     'cha varchar(6), st double, et double, tag text)')
+        conn.execute('create table netsta(ds_id smallint, net varchar(6), sta varchar(6), lon double, '
+                     'lat double)')
+        if(daily_stats):
+            # summaries for each waveform tag and day, which are aggregated over tags when queried
+            conn.execute('create table dailystats(ds_id smallint, net varchar(6), sta varchar(6), '
+                         'loc varchar(6), cha varchar(6), day double, count integer, duration double, '
+                         'sum double, sumsq double, min double, max double)')
+        # end if
+    # end func
+
+    def _get_tag_daily_stats(self, ds, key, tag):
+        """
+        Computes daily statistics for a waveform tag from the underlying HDF5 dataset, bypassing obspy
+        """
+        dataset = ds._waveform_group[key][tag]
+        starttime = dataset.attrs['starttime'] / 1e9
+        sampling_rate = float(dataset.attrs['sampling_rate'])
+
+        return compute_daily_stats(dataset[()], starttime, sampling_rate)
+    # end func
+
+    def create_shards(self):
+        """
+        Scans waveform tags of ASDF files that lack an index shard. Stations within each such file are
+        split across ranks, each of which streams its rows into a partial database; partial databases
+        are then merged into shards, with files split evenly across ranks.
+        """
         def decode_tag(tag, type='raw_recording'):
             if (type not in tag): return None
             try:
@@ -152,73 +257,133 @@ class _FederatedASDFDataSetImpl():
             # end try
         # end func
 
-        dbFound = os.path.exists(self.db_fn)
-        self.comm.Barrier()
-
-        if(dbFound):
-            print(('Found database: %s'%(self.db_fn)))
-            self.conn = sqlite3.connect(self.db_fn)
-        else:
-            if(self.rank==0):
-                self.conn = sqlite3.connect(self.db_fn)
-                self.conn.execute('create table wdb(ds_id smallint, net varchar(6), sta varchar(6), loc varchar(6), '
-                                  'cha varchar(6), st double, et double, tag text)')
-                self.conn.execute('create table netsta(ds_id smallint, net varchar(6), sta varchar(6), lon double, '
-                                  'lat double)')
-                metadatalist = []
-                for ids, ds in enumerate(self.asdf_datasets):
-                    coords_dict = ds.get_all_coordinates()
-                    for k in list(coords_dict.keys()):
-                        lon = coords_dict[k]['longitude']
-                        lat = coords_dict[k]['latitude']
-                        nc, sc = k.split('.')
-                        metadatalist.append([ids, nc, sc, lon, lat])
-                    # end for
-                # end for
-                self.conn.executemany('insert into netsta(ds_id, net, sta, lon, lat) values '
-                                      '(?, ?, ?, ?, ?)', metadatalist)
-            # end if
+        missing = None
+        if(self.rank==0):
+            if(not os.path.exists(self.shard_dir)): os.makedirs(self.shard_dir)
+            missing = [ids for ids, sfn in enumerate(self.shard_file_names) if not os.path.exists(sfn)]
+            print(('Found index shards for %d of %d ASDF files' % (len(self.shard_file_names) - len(missing),
+                                                                   len(self.shard_file_names))))
+        # end if
+        missing = self.comm.bcast(missing, root=0)
 
-            tagsCount = 0
-            for ids, ds in enumerate(self.asdf_datasets):
-                print(('Creating index for %s..' % (self.asdf_file_names[ids])))
+        for ids in missing:
+            ds = self.asdf_datasets.get(ids)
+            if(self.rank==0): print(('Creating index for %s..' % (self.asdf_file_names[ids])))
 
-                keys = list(ds.get_all_coordinates().keys())
-                keys = split_list(keys, self.nproc)
+            keys = list(ds.get_all_coordinates().keys())
+            keys = split_list(keys, self.nproc)
 
+            part_fn = '%s.%d.part' % (self.shard_file_names[ids], self.rank)
+            if(os.path.exists(part_fn)): os.remove(part_fn)
+            conn = sqlite3.connect(part_fn)
+            self.create_tables(conn, self.build_daily_stats)
+            for key in keys[self.rank]:
                 data = []
-                #print 'Found %d keys'%(len(keys))
-                for ikey, key in enumerate(keys[self.rank]):
-                    sta = ds.waveforms[key]
-                    #print 'Loading key number %d: %s'%(ikey, key)
-                    for tag in sta.list():
-
-                        result = decode_tag(tag)
-                        if (result):
-                            network, station, location, channel, tr_st, tr_et = result
-                            data.append([ids, network, station, location, channel, tr_st, tr_et, tag])
+                stats = []
+                for tag in ds.waveforms[key].list():
+                    result = decode_tag(tag)
+                    if (result):
+                        network, station, location, channel, tr_st, tr_et = result
+                        data.append([ids, network, station, location, channel, tr_st, tr_et, tag])
+
+                        if(self.build_daily_stats):
+                            for row in self._get_tag_daily_stats(ds, key, tag):
+                                stats.append([ids, network, station, location, channel] + [float(v) for v in row])
+                            # end for
                         # end if
-                    # end for
+                    # end if
                 # end for
+                conn.executemany('insert into wdb(ds_id, net, sta, loc, cha, st, et, tag) values '
+                                 '(?, ?, ?, ?, ?, ?, ?, ?)', data)
+                if(self.build_daily_stats):
+                    conn.executemany('insert into dailystats(ds_id, net, sta, loc, cha, day, count, duration, '
+                                     'sum, sumsq, min, max) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', stats)
+                # end if
+            # end for
+            conn.commit()
+            conn.close()
+        # end for
+        self.comm.Barrier()
 
-                data = self.comm.gather(data, root=0)
-                if(self.rank==0):
-                    data = [item for sublist in data for item in sublist]
-                    self.conn.executemany('insert into wdb(ds_id, net, sta, loc, cha, st, et, tag) values '
-                                          '(?, ?, ?, ?, ?, ?, ?, ?)', data)
-                    print(('Inserted %d entries on rank %d'%(len(data), self.rank)))
-                    tagsCount += len(data)
-                    # end if
+        for ids in split_list(missing, self.nproc)[self.rank]:
+            sfn = self.shard_file_names[ids]
+            tmp_fn = '%s.%d.tmp' % (sfn, self.rank)
+            if(os.path.exists(tmp_fn)): os.remove(tmp_fn)
+
+            conn = sqlite3.connect(tmp_fn)
+            self.create_tables(conn, self.build_daily_stats)
+
+            coords_dict = self.asdf_datasets.get(ids).get_all_coordinates()
+            metadatalist = []
+            for k in list(coords_dict.keys()):
+                nc, sc = k.split('.')
+                metadatalist.append([ids, nc, sc, coords_dict[k]['longitude'], coords_dict[k]['latitude']])
             # end for
+            conn.executemany('insert into netsta(ds_id, net, sta, lon, lat) values '
+                             '(?, ?, ?, ?, ?)', metadatalist)
+            conn.commit()
+
+            for iproc in range(self.nproc):
+                part_fn = '%s.%d.part' % (sfn, iproc)
+                conn.execute("attach database '%s' as part" % (part_fn))
+                conn.execute('insert into wdb select * from part.wdb')
+                if(self.build_daily_stats): conn.execute('insert into dailystats select * from part.dailystats')
+                conn.commit()
+                conn.execute('detach database part')
+                os.remove(part_fn)
+            # end for
+            conn.close()
+
+            os.rename(tmp_fn, sfn)
+        # end for
+        self.comm.Barrier()
+    # end func
+
+    def create_database(self):
+        dbFound = os.path.exists(self.db_fn)
+        self.comm.Barrier()
+
+        if(dbFound):
+            print(('Found database: %s'%(self.db_fn)))
+            self.conn = sqlite3.connect(self.db_fn)
+        else:
+            self.create_shards()
 
             if(self.rank==0):
+                # Shards are merged within sqlite, so that rows are never all held in memory. Shards
+                # are keyed independently of a file's position in the source list, so ds_ids are
+                # reassigned during the merge.
+                tmp_fn = self.db_fn + '.tmp'
+                if(os.path.exists(tmp_fn)): os.remove(tmp_fn)
+
+                self.conn = sqlite3.connect(tmp_fn)
+                self.create_tables(self.conn, self.build_daily_stats)
+                for ids, sfn in enumerate(self.shard_file_names):
+                    self.conn.execute("attach database '%s' as shard" % (sfn))
+                    self.conn.execute('insert into wdb select ?, net, sta, loc, cha, st, et, tag '
+                                      'from shard.wdb', (ids,))
+                    self.conn.execute('insert into netsta select ?, net, sta, lon, lat '
+                                      'from shard.netsta', (ids,))
+                    if(self.build_daily_stats):
+                        self.conn.execute('insert into dailystats select ?, net, sta, loc, cha, day, count, '
+                                          'duration, sum, sumsq, min, max from shard.dailystats', (ids,))
+                    # end if
+                    self.conn.commit()
+                    self.conn.execute('detach database shard')
+                # end for
+
                 self.conn.execute('create index allindex on wdb(net, sta, loc, cha, st, et)')
                 self.conn.execute('create index netstaindex on netsta(ds_id, net, sta)')
+                if(self.build_daily_stats):
+                    self.conn.execute('create index dailystatsindex on dailystats(net, sta, loc, cha, day)')
+                # end if
                 self.conn.commit()
+                tagsCount = self.conn.execute('select count(*) from wdb').fetchall()[0][0]
                 print(('Created database on rank %d for %d waveforms (%5.2f MB)' % \
                       (self.rank, tagsCount, round(psutil.Process().memory_info().rss / 1024. / 1024., 2))))
 
                 self.conn.close()
+                os.rename(tmp_fn, self.db_fn)
             # end if
             self.comm.Barrier()
             self.conn = sqlite3.connect(self.db_fn)
@@ -233,52 +398,44 @@ class _FederatedASDFDataSetImpl():
     # end func
 
     def get_global_time_range(self, network, station, location=None, channel=None):
-        query = "select min(st), max(et) from wdb where net='%s' and sta='%s' "%(network, station)
-
-        if (location):
-            query += "and loc='%s' "%(location)
-        if (channel):
-            query += "and cha='%s' "%(channel)
+        mint, maxt = self.index.time_range(network, station, location if location else None,
+                                           channel if channel else None)
 
-        row = self.conn.execute(query).fetchall()[0]
-
-        min = UTCDateTime(row[0]) if row[0] else MAX_DATE
-        max = UTCDateTime(row[1]) if row[1] else MIN_DATE
+        min = UTCDateTime(mint) if mint is not None else MAX_DATE
+        max = UTCDateTime(maxt) if maxt is not None else MIN_DATE
         return min, max
     # end func
 
     def get_stations(self, starttime, endtime, network=None, station=None, location=None, channel=None):
-        starttime = UTCDateTime(starttime).timestamp
-        endtime = UTCDateTime(endtime).timestamp
+        return self.get_stations_bulk([starttime], [endtime], network, station, location, channel)[0]
+    # end func
 
-        query = 'select * from wdb where '
-        if (network): query += " net='%s' "%(network)
-        if (station):
-            if(network): query += "and sta='%s' "%(station)
-            else: query += "sta='%s' "%(station)
-        if (location):
-            if(network or station): query += "and loc='%s' "%(location)
-            else: query += "loc='%s' "%(location)
-        if (channel):
-            if(network or station or location): query += "and cha='%s' "%(channel)
-            else: query += "cha='%s' "%(channel)
-        if (network or station or location or channel): query += ' and '
-        query += ' et>=%f and st<=%f' \
-                 % (starttime, endtime)
-        query += ' group by net, sta, loc, cha'
-
-        rows = self.conn.execute(query).fetchall()
-        results = set()
-        for row in rows:
-            ds_id, net, sta, loc, cha, st, et, tag = row
+    def get_stations_bulk(self, starttimes, endtimes, network=None, station=None, location=None, channel=None):
+        starttimes = np.array([UTCDateTime(t).timestamp for t in starttimes])
+        endtimes = np.array([UTCDateTime(t).timestamp for t in endtimes])
 
-            rv = (net, sta, loc, cha,
-                  self.asdf_station_coordinates[ds_id]['%s.%s' % (net, sta)][0],
-                  self.asdf_station_coordinates[ds_id]['%s.%s' % (net, sta)][1])
-            results.add(rv)
-        # end for
+        gids = self.index.find_groups(network if network else None, station if station else None,
+                                      location if location else None, channel if channel else None)
+
+        overlaps = self.index.groups_overlapping(gids[None, :], starttimes[:, None], endtimes[:, None])
 
-        return list(results)
+        return [[self._get_station_row(gids[i]) for i in np.where(overlap)[0]] for overlap in overlaps]
+    # end func
+
+    def _get_station_row(self, gid):
+        """
+        :return: tuple containing (net, sta, loc, cha, lon, lat) for a group in the interval index;
+                 coordinates are fetched from the ASDF file containing the group's first entry
+        """
+        row = self._station_rows.get(gid)
+        if(row is None):
+            net, sta, loc, cha = self.index.key_codes[gid]
+            ds_id = self.index.ds_id[self.index.key_lo[gid]]
+            lon, lat = self.asdf_station_coordinates[ds_id]['%s.%s' % (net, sta)]
+            row = self._station_rows[gid] = (net, sta, loc, cha, lon, lat)
+        # end if
+
+        return row
     # end func
 
     def get_waveform_count(self, network, station, location, channel, starttime, endtime):
@@ -286,146 +443,462 @@ class _FederatedASDFDataSetImpl():
         starttime = UTCDateTime(starttime).timestamp
         endtime = UTCDateTime(endtime).timestamp
 
-        query = "select count(*) from wdb where net='%s' and sta='%s' and loc='%s' and cha='%s' " \
-                %(network, station, location, channel) + \
-                "and et>=%f and st<=%f" \
-                 % (starttime, endtime)
-
-        num_traces = self.conn.execute(query).fetchall()[0][0]
+        num_traces = self.index.count(network, station, location, channel, starttime, endtime)
 
         return num_traces
     # end func
 
+    def has_daily_stats(self):
+        return self.conn.execute("select count(*) from sqlite_master where type='table' and "
+                                 "name='dailystats'").fetchall()[0][0] > 0
+    # end func
+
+    def get_daily_stats(self, network, station, location, channel, starttime, endtime):
+        """
+        :return: dictionary of arrays, keyed by 'day', 'count', 'coverage', 'mean', 'std', 'min' and 'max',
+                 for days between starttime and endtime containing data, in ascending order of day; None
+                 if daily statistics were not recorded while building the index
+        """
+        if(not self.has_daily_stats()): return None
+
+        day = 24 * 3600.
+        starttime = UTCDateTime(starttime).timestamp
+        endtime = UTCDateTime(endtime).timestamp
+
+        rows = self.conn.execute('select day, sum(count), sum(duration), sum(sum), sum(sumsq), min(min), max(max) '
+                                 'from dailystats where net=? and sta=? and loc=? and cha=? and day>? and day<=? '
+                                 'group by day order by day',
+                                 (network, station, location, channel, starttime - day, endtime)).fetchall()
+        rows = np.array(rows, dtype=np.float64).reshape(-1, 7)
+
+        count = rows[:, 1]
+        mean = rows[:, 3] / np.maximum(count, 1)
+        return {'day': rows[:, 0],
+                'count': count.astype(np.int64),
+                'coverage': np.minimum(rows[:, 2] / day, 1.),
+                'mean': mean,
+                'std': np.sqrt(np.maximum(rows[:, 4] / np.maximum(count, 1) - mean * mean, 0)),
+                'min': rows[:, 5],
+                'max': rows[:, 6]}
+    # end func
+
     def get_waveforms(self, network, station, location, channel, starttime,
                       endtime, trace_count_threshold=200):
 
         starttime = UTCDateTime(starttime)
         endtime = UTCDateTime(endtime)
 
-        query = "select * from wdb where net='%s' and sta='%s' and loc='%s' and cha='%s' " \
-                %(network, station, location, channel) + \
-                "and et>=%f and st<=%f" \
-                 % (starttime.timestamp, endtime.timestamp)
+        rows = self.index.rows(network, station, location, channel, starttime.timestamp, endtime.timestamp)
+
+        # Requests matching more rows than trace_count_threshold, e.g. for heavily fragmented data, are
+        # assembled in batches of trace_count_threshold rows, in order of start-time, with each batch
+        # being merged into the result before the next is read. This keeps the number of traces held
+        # in memory bounded. Merged traces are split at gaps once all batches are read, so that, as for
+        # requests read in one go, traces hold contiguous, unmasked data.
+        batch_size = max(int(trace_count_threshold), 1)
+        fragmented = len(rows) > batch_size
 
-        rows = self.conn.execute(query).fetchall()
         s = Stream()
+        for ib in range(0, len(rows), batch_size):
+            batch = Stream()
+            for row in rows[ib:ib + batch_size]:
+                ds_id, net, sta, loc, cha, st, et, tag = row
+
+                if(self.waveform_cache is not None):
+                    tr = self._get_cached_trace((ds_id, net, sta, tag))
+                    if(tr is not None):
+                        # hand out a copy so that in-place operations by callers do not alter cached data
+                        batch += tr.slice(starttime, endtime).copy()
+                        continue
+                    # end if
+                # end if
 
-        if(len(rows) > trace_count_threshold): return s
+                batch += self._read_trace_slice(ds_id, net, sta, tag, starttime, endtime)
+            # end for
 
-        for row in rows:
-            ds_id, net, sta, loc, cha, st, et, tag = row
-            station_data = self.asdf_datasets[ds_id].waveforms['%s.%s'%(net, sta)]
-
-            '''
-            Obspy currently reads all data for a given 'tag' and then trims them as needed. However,
-            the read operation fails if data for a given 'tag' exceeds 'single_item_read_limit_in_mb',
-            regardless of the timespan indicated by starttime and endtime, if provided. In such 
-            instances, we retry reading the data by expanding the read-buffer in each attempt. The 
-            current max retry attempts is set to 2 and 'single_item_read_limit_in_mb' is finally reset
-            to its original value.
-            '''
-            numAttempts = 0
-            while(1):
-                try:
-                    data_segment = station_data.get_item(tag, starttime, endtime)
-                    s += data_segment
-                    break
-                except Exception as e:
-                    if(isinstance(e, ASDFValueError)): # read failed due to the data buffer being too small
-                        self.asdf_datasets[ds_id].single_item_read_limit_in_mb *= 2
-                        numAttempts += 1
-                        if self.logger:
-                            self.logger.warning("Failed to get data between {} -- {} for {}.{} due to:\n{}. "
-                                                "Retrying with expanded data buffer."
-                                                .format(str(starttime), str(endtime), net, sta, str(e)))
-                        # end if
-                        if(numAttempts > 2):
-                            self.logger.error("Failed to get data between {} -- {} for {}.{} with error:\n{}"
-                                              .format(str(starttime), str(endtime), net, sta, str(e)))
-                            break
-                        # end if
-                    else:
-                        if self.logger:
-                            self.logger.error("Failed to get data between {} -- {} for {}.{} with error:\n{}"
-                                              .format(str(starttime), str(endtime), net, sta, str(e)))
-                        # end if
-                        break
-                    # end if
-                # end try
-            # end while
-            if (numAttempts>0):
-                self.asdf_datasets[ds_id].single_item_read_limit_in_mb /= 2**numAttempts
-            # end if
-        # end for
+            # Trim traces
+            for t in batch:
+                t.trim(starttime=starttime,
+                       endtime=endtime)
+            # end for
 
-        # Trim traces
-        for t in s:
-            t.trim(starttime=starttime,
-                   endtime=endtime)
+            s += batch
+            if(fragmented): s = self._merge(s)
         # end for
+        if(fragmented): s = s.split()
+
+        if(self.prefetcher is not None):
+            self._prefetch(network, station, location, channel, endtime, endtime + (endtime - starttime))
+        # end if
 
         return s
     # end func
 
-    def local_net_sta_list(self):
-        workload = None
-        if(self.rank==0):
-            workload = []
-            for i in np.arange(self.nproc):
-                workload.append(defaultdict(partial(defaultdict, list)))
+    def _merge(self, s):
+        """
+        Merges traces without filling gaps; traces are returned unmerged if merging fails, e.g. due to
+        differing sampling rates
+        """
+        try:
+            s.merge()
+        except Exception as e:
+            if self.logger:
+                self.logger.warning('Failed to merge traces with error:\n{}'.format(str(e)))
+            # end if
+        # end try
+
+        return s
+    # end func
+
+    def get_waveforms_bulk(self, requests, trace_count_threshold=200, merge_gap=60):
+        """
+        Fetches waveforms for many requests at once. Rows matching the requests are grouped by
+        waveform tag and overlapping time-ranges within each tag are merged, so that each range of
+        data is read from the underlying ASDF file only once and sliced thereafter.
+
+        :param requests: list of tuples containing (net, sta, loc, cha, starttime, endtime)
+        :param trace_count_threshold: requests matching more traces than this are assembled incrementally,
+               as in get_waveforms
+        :param merge_gap: time-ranges separated by less than merge_gap seconds are read together
+        :return: list of obspy Streams, one for each request
+        """
+        requests = [(net, sta, loc, cha, UTCDateTime(st), UTCDateTime(et))
+                    for net, sta, loc, cha, st, et in requests]
+
+        # collate requested time-ranges for each tag
+        request_keys = []
+        key_ranges = defaultdict(list)
+        fragmented = []
+        for ireq, (network, station, location, channel, starttime, endtime) in enumerate(requests):
+            rows = self.index.rows(network, station, location, channel, starttime.timestamp, endtime.timestamp)
+            if(len(rows) > trace_count_threshold):
+                # fragmented requests are assembled incrementally by get_waveforms
+                fragmented.append(ireq)
+                rows = []
+            # end if
+
+            keys = []
+            for ds_id, net, sta, loc, cha, st, et, tag in rows:
+                key = (ds_id, net, sta, tag)
+                keys.append(key)
+                key_ranges[key].append((starttime, endtime, ireq))
             # end for
+            request_keys.append(keys)
+        # end for
+
+        # read data for each tag, in file order; slices share data with the traces read, so copies are
+        # handed out where data are shared by several requests or are held in the cache
+        slices = {}
+        for key in sorted(key_ranges.keys()):
+            ds_id, net, sta, tag = key
 
-            nets = self.conn.execute('select distinct net from wdb').fetchall()
-            for net in nets:
-                net = net[0]
-                stas = self.conn.execute("select distinct sta from wdb where net='%s'"%(net)).fetchall()
-                for sta in stas:
-                    sta = sta[0]
-
-                    tbounds = self.conn.execute("select st, et from wdb where net='%s' and sta='%s' order by et"
-                                                %(net, sta)).fetchall()
-
-                    if(len(tbounds)==0): continue
-                    #tbounds = np.array(tbounds)
-                    #tbounds = split_list_by_timespan(tbounds, self.nproc)
-                    tbounds = split_list(tbounds, self.nproc)
-
-                    for iproc in np.arange(self.nproc):
-                        if (len(tbounds[iproc])):
-                            arr = np.array(tbounds[iproc])
-                            workload[iproc][net][sta] = np.array([np.min(arr[:,0]),
-                                                                  np.max(arr[:,1])])
-                        # end for
-                    # end for
+            tr = None
+            if(self.waveform_cache is not None): tr = self._get_cached_trace(key)
+
+            if(tr is not None):
+                for starttime, endtime, ireq in key_ranges[key]:
+                    slices[(key, ireq)] = Stream([tr.slice(starttime, endtime).copy()])
                 # end for
+                continue
+            # end if
+
+            ranges = sorted(key_ranges[key])
+            block = [ranges[0]]
+            for r in ranges[1:] + [None]:
+                if(r is not None and r[0] - max([b[1] for b in block]) < merge_gap):
+                    block.append(r)
+                    continue
+                # end if
+
+                data = self._read_trace_slice(ds_id, net, sta, tag, block[0][0], max([b[1] for b in block]))
+                for starttime, endtime, ireq in block:
+                    s = data.slice(starttime, endtime)
+                    slices[(key, ireq)] = s.copy() if len(block) > 1 else s
+                # end for
+                block = [r]
             # end for
+        # end for
+
+        results = []
+        for ireq, keys in enumerate(request_keys):
+            s = Stream()
+            for key in keys: s += slices[(key, ireq)]
+            results.append(s)
+        # end for
+
+        for ireq in fragmented:
+            results[ireq] = self.get_waveforms(*requests[ireq], trace_count_threshold=trace_count_threshold)
+        # end for
+
+        return results
+    # end func
+
+    def get_waveform_arrays(self, network, station, location, channel, starttime, endtime):
+        """
+        Reads samples within [starttime, endtime] straight from the underlying HDF5 datasets, without
+        constructing obspy Traces. Only the samples requested are read; for uncompressed datasets with
+        a contiguous layout, returned arrays are read-only views into memory-mapped files.
+
+        :return: list of (data, stats) tuples, one for each matching waveform, where stats is a dictionary
+                 containing network, station, location, channel, starttime, sampling_rate and npts
+        """
+        starttime = UTCDateTime(starttime)
+        endtime = UTCDateTime(endtime)
+
+        results = []
+        for ds_id, net, sta, loc, cha, st, et, tag in \
+                self.index.rows(network, station, location, channel, starttime.timestamp, endtime.timestamp):
+            results.append(self._read_array(ds_id, net, sta, tag, starttime, endtime))
+        # end for
+
+        return results
+    # end func
+
+    def _read_array(self, ds_id, net, sta, tag, starttime, endtime):
+        """
+        Reads samples of a waveform tag within [starttime, endtime], with the sample range determined as
+        in obspy's Trace.trim, through HDF5 hyperslab selection or, for uncompressed datasets with a
+        contiguous layout, a memory-map of the underlying file
+
+        :return: tuple of (data, stats)
+        """
+        def round_away(x):
+            return int(np.sign(x) * np.floor(np.abs(x) + 0.5))
+        # end func
+
+        dataset = self.asdf_datasets.get(ds_id)._waveform_group['%s.%s' % (net, sta)][tag]
+        tr_starttime = UTCDateTime(ns=int(dataset.attrs['starttime']))
+        sampling_rate = float(dataset.attrs['sampling_rate'])
+        npts = dataset.shape[0]
+        tr_endtime = tr_starttime + (npts - 1) / sampling_rate
+
+        i0 = min(max(round_away((starttime - tr_starttime) * sampling_rate), 0), npts)
+        i1 = max(npts - max(round_away((tr_endtime - endtime) * sampling_rate), 0), i0)
+
+        offset = dataset.id.get_offset()
+        if(dataset.compression is None and dataset.chunks is None and offset is not None):
+            data = np.memmap(self.asdf_file_names[ds_id], dtype=dataset.dtype, mode='r',
+                             offset=offset, shape=dataset.shape)[i0:i1]
+        else:
+            data = dataset[i0:i1]
         # end if
 
-        workload = self.comm.scatter(workload, root=0)
-        for (nk, nv) in iteritems(workload):
-            for (sk, sv) in iteritems(nv):
-                start_time = None
-                end_time = None
-                try:
-                    start_time = UTCDateTime(workload[nk][sk][0])
-                    end_time = UTCDateTime(workload[nk][sk][1])
-                except Exception:
+        codes = tag.split('__')[0].split('.')
+        stats = {'network': codes[0], 'station': codes[1], 'location': codes[2], 'channel': codes[3],
+                 'starttime': tr_starttime + i0 / sampling_rate, 'sampling_rate': sampling_rate,
+                 'npts': i1 - i0}
+
+        return data, stats
+    # end func
+
+    def _read_trace_slice(self, ds_id, net, sta, tag, starttime, endtime):
+        """
+        Reads data for a waveform tag between starttime and endtime. Uncompressed data are read directly
+        from the HDF5 dataset, over the samples requested only; compressed data are read through pyasdf.
+
+        :return: obspy Stream, which is empty if the read fails
+        """
+        try:
+            dataset = self.asdf_datasets.get(ds_id)._waveform_group['%s.%s' % (net, sta)][tag]
+            if(dataset.compression is not None):
+                return self._read_item(ds_id, net, sta, tag, starttime, endtime)
+            # end if
+
+            data, stats = self._read_array(ds_id, net, sta, tag, starttime, endtime)
+            stats = dict(stats)
+            stats.pop('npts')
+            stats['asdf'] = AttribDict({'tag': tag.split('__')[-1],
+                                        'format_version': getattr(self.asdf_datasets.get(ds_id),
+                                                                  'asdf_format_version', None)})
+
+            # copy samples out of memory-mapped files, so that traces can be altered in place
+            return Stream([Trace(data=np.array(data), header=stats)])
+        except Exception as e:
+            if self.logger:
+                self.logger.warning('Failed to read {} directly with error:\n{}. Reading through pyasdf '
+                                    'instead'.format(tag, str(e)))
+            # end if
+            return self._read_item(ds_id, net, sta, tag, starttime, endtime)
+        # end try
+    # end func
+
+    def _read_item(self, ds_id, net, sta, tag, starttime, endtime):
+        """
+        Reads data for a waveform tag between starttime and endtime
+
+        :return: obspy Stream, which is empty if the read fails
+        """
+        s = Stream()
+        ds = self.asdf_datasets.get(ds_id)
+        station_data = ds.waveforms['%s.%s'%(net, sta)]
+
+        '''
+        Obspy currently reads all data for a given 'tag' and then trims them as needed. However,
+        the read operation fails if data for a given 'tag' exceeds 'single_item_read_limit_in_mb',
+        regardless of the timespan indicated by starttime and endtime, if provided. In such 
+        instances, we retry reading the data by expanding the read-buffer in each attempt. The 
+        current max retry attempts is set to 2 and 'single_item_read_limit_in_mb' is finally reset
+        to its original value.
+        '''
+        numAttempts = 0
+        while(1):
+            try:
+                data_segment = station_data.get_item(tag, starttime, endtime)
+                s += data_segment
+                break
+            except Exception as e:
+                if(isinstance(e, ASDFValueError)): # read failed due to the data buffer being too small
+                    ds.single_item_read_limit_in_mb *= 2
+                    numAttempts += 1
                     if self.logger:
-                        self.logger.warning("Failed to convert start and end times for keys {}, {}".format(nk, sk))
-                    continue
-                # end try
+                        self.logger.warning("Failed to get data between {} -- {} for {}.{} due to:\n{}. "
+                                            "Retrying with expanded data buffer."
+                                            .format(str(starttime), str(endtime), net, sta, str(e)))
+                    # end if
+                    if(numAttempts > 2):
+                        self.logger.error("Failed to get data between {} -- {} for {}.{} with error:\n{}"
+                                          .format(str(starttime), str(endtime), net, sta, str(e)))
+                        break
+                    # end if
+                else:
+                    if self.logger:
+                        self.logger.error("Failed to get data between {} -- {} for {}.{} with error:\n{}"
+                                          .format(str(starttime), str(endtime), net, sta, str(e)))
+                    # end if
+                    break
+                # end if
+            # end try
+        # end while
+        if (numAttempts>0):
+            ds.single_item_read_limit_in_mb /= 2**numAttempts
+        # end if
+
+        return s
+    # end func
+
+    def _get_waveform_nbytes(self, ds_id, net, sta, tag):
+        """
+        Size of the data-array underlying a waveform tag, obtained from HDF5 metadata without reading any data
+        """
+        dataset = self.asdf_datasets.get(ds_id)._waveform_group['%s.%s' % (net, sta)][tag]
+        return dataset.size * dataset.dtype.itemsize
+    # end func
+
+    def _read_full_trace(self, key):
+        """
+        Reads the entire trace for a waveform tag, provided it fits in the cache and within the
+        single-item read-limit of the corresponding ASDF file
+
+        :param key: tuple containing (ds_id, net, sta, tag)
+        :return: obspy Trace or None
+        """
+        ds_id, net, sta, tag = key
+        ds = self.asdf_datasets.get(ds_id)
+
+        nbytes = self._get_waveform_nbytes(ds_id, net, sta, tag)
+        if(not self.waveform_cache.admits(nbytes)): return None
+        if(nbytes > ds.single_item_read_limit_in_mb * 1024 * 1024): return None
+
+        st = ds.waveforms['%s.%s' % (net, sta)][tag]
+        return st[0] if len(st) else None
+    # end func
+
+    def _get_cached_trace(self, key):
+        """
+        Fetches a trace through the cache, reading and caching the entire trace on a miss
+
+        :param key: tuple containing (ds_id, net, sta, tag)
+        :return: obspy Trace or None if the trace cannot be cached
+        """
+        tr = self.waveform_cache.get(key)
+        if(tr is None):
+            try:
+                tr = self._read_full_trace(key)
+            except Exception as e:
+                if self.logger:
+                    self.logger.warning('Failed to read {} into cache with error:\n{}'.format(key, str(e)))
+                # end if
+                return None
+            # end try
+
+            if(tr is not None): self.waveform_cache.put(key, tr)
+        # end if
 
-                yield nk, sk, start_time, end_time
+        return tr
+    # end func
+
+    def _prefetch(self, network, station, location, channel, starttime, endtime):
+        for ds_id, net, sta, _, _, _, _, tag in self.index.rows(network, station, location, channel,
+                                                                 starttime.timestamp, endtime.timestamp):
+            self.prefetcher.request((ds_id, net, sta, tag))
+        # end for
+    # end func
+
+    def get_cache_stats(self):
+        return self.waveform_cache.stats() if self.waveform_cache is not None else None
+    # end func
+
+    def local_net_sta_list(self, dynamic=False, chunk_size_in_days=30):
+        """
+        :param dynamic: when False, data for each station are split into contiguous time-ranges of
+               equal total data-duration, one for each rank. When True, data are split into chunks
+               of chunk_size_in_days, which ranks claim one at a time as they become idle.
+        :param chunk_size_in_days: length of work units in dynamic mode
+        :return: generator of tuples containing (net, sta, start_time, end_time)
+        """
+        if(dynamic):
+            for item in self._dynamic_net_sta_list(chunk_size_in_days * 24 * 3600.):
+                yield item
             # end for
+            return
+        # end if
+
+        for net, sta in self.index.stations():
+            st, et = self.index.station_intervals(net, sta)
+
+            bounds = split_list_by_duration(st, et, self.nproc)[self.rank]
+            if(bounds is None): continue
+
+            yield net, sta, UTCDateTime(bounds[0]), UTCDateTime(bounds[1])
         # end for
     # end func
 
+    def get_work_units(self, chunk_seconds):
+        """
+        :param chunk_seconds: length of work units in seconds
+        :return: list of (net, sta, start_time, end_time) tuples, with times as timestamps, for each
+                 chunk_seconds-long time-range that contains data
+        """
+        return self.index.work_units(chunk_seconds)
+    # end func
+
+    def _dynamic_net_sta_list(self, chunk_seconds):
+        # all ranks derive the same list of work units from their copy of the index, and claim
+        # units through a counter hosted on rank 0
+        units = self.get_work_units(chunk_seconds)
+        counter = SharedCounter(self.comm)
+
+        claimed = 0
+        while(True):
+            i = counter.next()
+            if(i >= len(units)): break
+
+            net, sta, st, et = units[i]
+            claimed += 1
+            yield net, sta, UTCDateTime(st), UTCDateTime(et)
+        # end while
+
+        if self.logger: self.logger.info('Rank %d processed %d of %d work units'%(self.rank, claimed, len(units)))
+        counter.free()
+    # end func
+
     def cleanup(self):
-        for i, ds in enumerate(self.asdf_datasets):
-            # if self.logger:
-            #     self.logger.info('Closing ASDF file %s..'%(self.asdf_file_names[i]))
-            del ds
-        # end for
+        if(self.prefetcher is not None):
+            self.prefetcher.stop()
+            self.prefetcher = None
+        # end if
+
+        self.asdf_datasets.close_all()
 
         self.conn.close()
     # end func
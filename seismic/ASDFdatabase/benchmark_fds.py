@@ -0,0 +1,624 @@
+#!/usr/bin/env python
+"""
+Description:
+    Benchmarks for FederatedASDFDataSet, run against synthetic ASDF files generated on the fly
+
+    Example usage:
+    python benchmark_fds.py cache /tmp/bench --day-count 30
+    python benchmark_fds.py index /tmp/bench/wdb.db --row-count 2000000
+    python benchmark_fds.py index-build /tmp/bench --file-count 8
+    python benchmark_fds.py bulk /tmp/bench --station-count 200
+    python benchmark_fds.py fragmented /tmp/bench --segments-per-day 5000
+    python benchmark_fds.py open-files /tmp/bench --file-count 5000
+    python benchmark_fds.py makespan --nproc 64
+    python benchmark_fds.py daily-stats /tmp/bench --day-count 60
+    python benchmark_fds.py proximity --station-count 5000 --query-count 100000
+    python benchmark_fds.py short-window /tmp/bench --window 10
+
+References:
+
+CreationDate:   18/10/26
+
+Revision History:
+    LastUpdate:     18/10/26
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import os
+import glob
+import shutil
+import time
+import logging
+import sqlite3
+
+import click
+import numpy as np
+import psutil
+import pyasdf
+from obspy import Trace, Stream, UTCDateTime
+from obspy.core.inventory import Inventory, Network, Station, Channel
+from obspy.core.util.attribdict import AttribDict
+
+from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
+from seismic.ASDFdatabase.index import IntervalIndex, StationIndex
+from seismic.ASDFdatabase._FederatedASDFDataSetImpl import split_list, split_list_by_duration
+
+logging.basicConfig()
+
+DAY = 86400
+
+
+def create_synthetic_asdf(output_file, network='XX', station_count=2, channels=('BHZ',),
+                          start_time='2010-01-01T00:00:00', day_count=10, sampling_rate=40.,
+                          segments_per_day=1, compression='gzip-3', seed=0):
+    """
+    Generates an ASDF file containing random-noise waveforms and station metadata
+
+    :param output_file: output ASDF file name
+    :param network: network code
+    :param station_count: number of stations
+    :param channels: channel codes for each station
+    :param start_time: start time of waveform data
+    :param day_count: number of days of waveform data per channel
+    :param sampling_rate: sampling rate (Hz)
+    :param segments_per_day: number of contiguous waveform segments each day is split into
+    :param compression: compression applied to waveform data; None for uncompressed data
+    :param seed: random seed
+    :return: list of 'net.sta' codes generated
+    """
+    rs = np.random.RandomState(seed)
+    start_time = UTCDateTime(start_time)
+
+    ds = pyasdf.ASDFDataSet(output_file, mode='w', compression=compression)
+
+    stations = []
+    netsta_codes = []
+    for ista in range(station_count):
+        sta = 'S%03d' % (ista)
+        lon, lat = 130 + rs.uniform(-10, 10), -25 + rs.uniform(-10, 10)
+        chans = [Channel(code=cha, location_code='', latitude=lat, longitude=lon,
+                         elevation=0, depth=0, sample_rate=sampling_rate) for cha in channels]
+        stations.append(Station(code=sta, latitude=lat, longitude=lon, elevation=0, channels=chans))
+        netsta_codes.append('%s.%s' % (network, sta))
+    # end for
+    ds.add_stationxml(Inventory(networks=[Network(code=network, stations=stations)], source='synthetic'))
+
+    segment_seconds = float(DAY) / segments_per_day
+    segment_npts = int(segment_seconds * sampling_rate)
+    for netsta in netsta_codes:
+        net, sta = netsta.split('.')
+        for cha in channels:
+            for iday in range(day_count):
+                st = Stream()
+                for iseg in range(segments_per_day):
+                    stats = AttribDict({'network': net, 'station': sta, 'location': '', 'channel': cha,
+                                        'sampling_rate': sampling_rate,
+                                        'starttime': start_time + iday * DAY + iseg * segment_seconds})
+                    st += Trace(data=rs.randint(-1000, 1000, segment_npts).astype(np.int32), header=stats)
+                # end for
+                ds.add_waveforms(st, tag='raw_recording')
+            # end for
+        # end for
+    # end for
+
+    del ds
+    return netsta_codes
+# end func
+
+
+def create_synthetic_federation(output_folder, file_count=1, **kwargs):
+    """
+    Generates synthetic ASDF files along with a text file listing them, as consumed by FederatedASDFDataSet
+
+    :param output_folder: output folder
+    :param file_count: number of ASDF files to generate, each containing a distinct network
+    :param kwargs: keyword arguments passed on to create_synthetic_asdf
+    :return: name of text file listing the ASDF files generated
+    """
+    if not os.path.exists(output_folder): os.makedirs(output_folder)
+
+    file_names = []
+    for ifile in range(file_count):
+        fn = os.path.join(output_folder, 'synthetic.%d.h5' % (ifile))
+        if not os.path.exists(fn):
+            create_synthetic_asdf(fn, network='N%d' % (ifile), seed=ifile, **kwargs)
+        # end if
+        file_names.append(fn)
+    # end for
+
+    asdf_source = os.path.join(output_folder, 'asdf_files.%d.txt' % (file_count))
+    with open(asdf_source, 'w') as fh:
+        fh.write('\n'.join(file_names) + '\n')
+    # end with
+
+    return asdf_source
+# end func
+
+
+def day_scan(fds, process=True):
+    """
+    Steps through all channels in a FederatedASDFDataSet day-by-day, in the manner of pick harvesting and
+    data-quality workflows
+
+    :param fds: FederatedASDFDataSet instance
+    :param process: apply a representative amount of processing to each day's data
+    :return: number of traces fetched
+    """
+    trace_count = 0
+    for net, sta, loc, cha, _, _ in sorted(fds.get_stations('1900-01-01', '2100-01-01')):
+        st, et = fds.get_global_time_range(net, sta, loc, cha)
+        ct = st
+        while ct < et:
+            stream = fds.get_waveforms(net, sta, loc, cha, ct, ct + DAY)
+            trace_count += len(stream)
+
+            if process and len(stream):
+                stream.merge()
+                stream.detrend('linear')
+                stream.filter('bandpass', freqmin=0.5, freqmax=5, corners=4, zerophase=True)
+            # end if
+            ct += DAY
+        # end while
+    # end for
+
+    return trace_count
+# end func
+
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+def cli():
+    pass
+# end func
+
+
+@cli.command(name='cache')
+@click.argument('output-folder', required=True, type=click.Path())
+@click.option('--station-count', default=4, help='Number of synthetic stations')
+@click.option('--day-count', default=30, help='Number of days of data per station')
+@click.option('--passes', default=2, help='Number of day-by-day scans over the data set')
+def bench_cache(output_folder, station_count, day_count, passes):
+    """
+    Times sequential day-by-day scans with the decoded-trace cache disabled, enabled, and enabled with
+    prefetching.
+
+    OUTPUT_FOLDER: Folder for synthetic data
+    """
+    asdf_source = create_synthetic_federation(output_folder, station_count=station_count,
+                                              channels=('BHZ', 'BHN', 'BHE'), day_count=day_count)
+
+    for label, kwargs in [('no cache', dict(cache_size_in_mb=0)),
+                          ('cache', dict(cache_size_in_mb=1024)),
+                          ('cache + prefetch', dict(cache_size_in_mb=1024, prefetch=True))]:
+        fds = FederatedASDFDataSet(asdf_source, **kwargs)
+
+        t0 = time.time()
+        for ipass in range(passes): day_scan(fds)
+        elapsed = time.time() - t0
+
+        print('%20s: %8.3f s over %d passes; cache stats: %s' % (label, elapsed, passes, fds.get_cache_stats()))
+        del fds
+    # end for
+# end func
+
+
+@cli.command(name='index')
+@click.argument('db-file', required=True, type=click.Path())
+@click.option('--row-count', default=2000000, help='Number of waveform entries in the synthetic index')
+@click.option('--channel-count', default=1000, help='Number of distinct net.sta.loc.cha combinations')
+@click.option('--query-count', default=2000, help='Number of queries timed')
+def bench_index(db_file, row_count, channel_count, query_count):
+    """
+    Times per-call latency of waveform-index queries issued against sqlite directly and against the
+    in-memory interval index. A synthetic wdb table, laid out as in FederatedASDFDataSet, is generated
+    if DB_FILE does not exist.
+
+    DB_FILE: sqlite database file
+    """
+    rs = np.random.RandomState(0)
+    segment = 3600.
+    t0 = UTCDateTime('2000-01-01').timestamp
+    rows_per_channel = row_count // channel_count
+
+    if not os.path.exists(db_file):
+        conn = sqlite3.connect(db_file)
+        conn.execute('create table wdb(ds_id smallint, net varchar(6), sta varchar(6), loc varchar(6), '
+                     'cha varchar(6), st double, et double, tag text)')
+        for ich in range(channel_count):
+            net, sta, cha = 'N%d' % (ich % 10), 'S%04d' % (ich // 3), ('BHZ', 'BHN', 'BHE')[ich % 3]
+            st = t0 + np.arange(rows_per_channel) * segment
+            data = [(0, net, sta, '', cha, s, s + segment, '%s.%s..%s__%d__raw_recording' % (net, sta, cha, s))
+                    for s in st]
+            conn.executemany('insert into wdb(ds_id, net, sta, loc, cha, st, et, tag) values '
+                             '(?, ?, ?, ?, ?, ?, ?, ?)', data)
+        # end for
+        conn.execute('create index allindex on wdb(net, sta, loc, cha, st, et)')
+        conn.commit()
+        conn.close()
+    # end if
+
+    conn = sqlite3.connect(db_file)
+    t = time.time()
+    index = IntervalIndex(conn)
+    print('Loaded %d entries into interval index in %.3f s' % (len(index), time.time() - t))
+
+    keys = list(index.key_bounds.keys())
+    queries = []
+    for iq in range(query_count):
+        net, sta, loc, cha = keys[rs.randint(len(keys))]
+        st = t0 + rs.uniform(0, rows_per_channel * segment)
+        queries.append((net, sta, loc, cha, st, st + DAY))
+    # end for
+
+    t = time.time()
+    sql_counts = []
+    for net, sta, loc, cha, st, et in queries:
+        query = "select * from wdb where net='%s' and sta='%s' and loc='%s' and cha='%s' " \
+                "and et>=%f and st<=%f" % (net, sta, loc, cha, st, et)
+        sql_counts.append(len(conn.execute(query).fetchall()))
+    # end for
+    sql_elapsed = time.time() - t
+
+    t = time.time()
+    index_counts = [len(index.rows(*q)) for q in queries]
+    index_elapsed = time.time() - t
+
+    assert sql_counts == index_counts
+    print('%20s: %10.2f us per query' % ('sqlite', sql_elapsed / query_count * 1e6))
+    print('%20s: %10.2f us per query' % ('interval index', index_elapsed / query_count * 1e6))
+# end func
+
+
+@cli.command(name='index-build')
+@click.argument('output-folder', required=True, type=click.Path())
+@click.option('--file-count', default=8, help='Number of ASDF files in the initial source list')
+@click.option('--station-count', default=8, help='Number of synthetic stations per file')
+@click.option('--day-count', default=30, help='Number of days of data per station')
+@click.option('--segments-per-day', default=24, help='Number of waveform segments per day')
+def bench_index_build(output_folder, file_count, station_count, day_count, segments_per_day):
+    """
+    Times index creation for a source list of FILE_COUNT ASDF files from scratch, and re-indexing after
+    a file is appended to the list.
+
+    OUTPUT_FOLDER: Folder for synthetic data
+    """
+    kwargs = dict(station_count=station_count, day_count=day_count, segments_per_day=segments_per_day)
+    sources = [create_synthetic_federation(output_folder, file_count=n, **kwargs)
+               for n in [file_count, file_count + 1]]
+
+    # discard indices from previous runs
+    shutil.rmtree(os.path.join(output_folder, 'asdf_index_shards'), ignore_errors=True)
+    for fn in glob.glob(os.path.join(output_folder, '*.db')): os.remove(fn)
+
+    for label, asdf_source in [('%d files' % (file_count), sources[0]),
+                               ('%d + 1 files' % (file_count), sources[1])]:
+        t0 = time.time()
+        fds = FederatedASDFDataSet(asdf_source, cache_size_in_mb=0)
+        print('%20s: indexed in %8.3f s' % (label, time.time() - t0))
+        del fds
+    # end for
+# end func
+
+
+@cli.command(name='bulk')
+@click.argument('output-folder', required=True, type=click.Path())
+@click.option('--station-count', default=200, help='Number of synthetic stations')
+@click.option('--day-count', default=2, help='Number of days of data per station')
+@click.option('--event-count', default=20, help='Number of synthetic events')
+@click.option('--window', default=600., help='Length (s) of time window extracted around each event')
+def bench_bulk(output_folder, station_count, day_count, event_count, window):
+    """
+    Times event-based extraction of all channels of all stations through repeated calls to get_waveforms
+    and through get_waveforms_bulk.
+
+    OUTPUT_FOLDER: Folder for synthetic data
+    """
+    asdf_source = create_synthetic_federation(os.path.join(output_folder, 'bulk'), station_count=station_count,
+                                              channels=('BHZ', 'BHN', 'BHE'), day_count=day_count)
+    fds = FederatedASDFDataSet(asdf_source, cache_size_in_mb=0)
+
+    rs = np.random.RandomState(0)
+    stations = fds.get_stations('1900-01-01', '2100-01-01')
+    st, et = fds.get_global_time_range(*stations[0][:2])
+    origins = [UTCDateTime(t) for t in rs.uniform(st.timestamp, et.timestamp - window, event_count)]
+
+    t0 = time.time()
+    count = 0
+    for origin in origins:
+        for net, sta, loc, cha, _, _ in stations:
+            count += len(fds.get_waveforms(net, sta, loc, cha, origin, origin + window))
+        # end for
+    # end for
+    print('%20s: %8.3f s for %d traces' % ('get_waveforms', time.time() - t0, count))
+
+    t0 = time.time()
+    count = 0
+    for origin in origins:
+        requests = [(net, sta, loc, cha, origin, origin + window) for net, sta, loc, cha, _, _ in stations]
+        count += np.sum([len(s) for s in fds.get_waveforms_bulk(requests)])
+    # end for
+    print('%20s: %8.3f s for %d traces' % ('get_waveforms_bulk', time.time() - t0, count))
+# end func
+
+
+@cli.command(name='fragmented')
+@click.argument('output-folder', required=True, type=click.Path())
+@click.option('--segments-per-day', default=5000, help='Number of waveform segments a day of data is split into')
+@click.option('--trace-count-threshold', default=200, help='Batch size for incremental assembly')
+def bench_fragmented(output_folder, segments_per_day, trace_count_threshold):
+    """
+    Times fetching a day of data from a synthetic station stored as thousands of small segments, along
+    with the peak memory consumed.
+
+    OUTPUT_FOLDER: Folder for synthetic data
+    """
+    import tracemalloc
+
+    asdf_source = create_synthetic_federation(os.path.join(output_folder, 'fragmented'), station_count=1,
+                                              day_count=1, segments_per_day=segments_per_day)
+    fds = FederatedASDFDataSet(asdf_source, cache_size_in_mb=0)
+
+    net, sta, loc, cha, _, _ = fds.get_stations('1900-01-01', '2100-01-01')[0]
+    st, et = fds.get_global_time_range(net, sta, loc, cha)
+
+    for label, threshold in [('unbatched', segments_per_day + 1), ('batched', trace_count_threshold)]:
+        tracemalloc.start()
+        t0 = time.time()
+        stream = fds.get_waveforms(net, sta, loc, cha, st, et, trace_count_threshold=threshold)
+        if(threshold > segments_per_day): stream.merge()
+        elapsed = time.time() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print('%20s: %8.3f s, peak memory %8.2f MB, %d trace(s) of %d samples' %
+              (label, elapsed, peak / 1024. / 1024., len(stream), np.sum([tr.stats.npts for tr in stream])))
+    # end for
+# end func
+
+
+@cli.command(name='open-files')
+@click.argument('output-folder', required=True, type=click.Path())
+@click.option('--file-count', default=5000, help='Number of small ASDF files in the federation')
+@click.option('--max-open-files', default=64, help='Size of the open-file handle pool')
+def bench_open_files(output_folder, file_count, max_open_files):
+    """
+    Times construction of a FederatedASDFDataSet over many small ASDF files, with the increase in resident
+    memory, and compares it against opening every file, as was done prior to lazy opening.
+
+    OUTPUT_FOLDER: Folder for synthetic data
+    """
+    asdf_source = create_synthetic_federation(os.path.join(output_folder, 'open_files'), file_count=file_count,
+                                              station_count=1, day_count=1, sampling_rate=1.)
+    # build the index beforehand, so that only construction costs are timed
+    FederatedASDFDataSet(asdf_source, cache_size_in_mb=0).fds.asdf_datasets.close_all()
+
+    process = psutil.Process()
+    for label, eager in [('lazy', False), ('all files open', True)]:
+        rss0 = process.memory_info().rss
+        t0 = time.time()
+        fds = FederatedASDFDataSet(asdf_source, cache_size_in_mb=0,
+                                   max_open_files=file_count if eager else max_open_files)
+        if(eager):
+            for ids in range(file_count): fds.fds.asdf_datasets.get(ids)
+        # end if
+        elapsed = time.time() - t0
+        print('%20s: constructed in %8.3f s, resident memory +%8.2f MB, open files: %d' %
+              (label, elapsed, (process.memory_info().rss - rss0) / 1024. / 1024., len(fds.fds.asdf_datasets)))
+
+        t0 = time.time()
+        count = day_scan(fds, process=False)
+        print('%20s: day-scan of %d traces in %8.3f s' % (label, count, time.time() - t0))
+        fds.fds.asdf_datasets.close_all()
+        del fds
+    # end for
+# end func
+
+
+def data_duration(st, et, start, end):
+    """
+    :return: total duration of intervals [st, et] that falls within [start, end]
+    """
+    overlap = np.minimum(et, end) - np.maximum(st, start)
+    return np.sum(overlap[overlap > 0])
+# end func
+
+
+@cli.command(name='makespan')
+@click.option('--nproc', default=64, help='Number of simulated MPI ranks')
+@click.option('--station-count', default=200, help='Number of synthetic stations')
+@click.option('--chunk-size-in-days', default=30, help='Length of work units in dynamic mode')
+def bench_makespan(nproc, station_count, chunk_size_in_days):
+    """
+    Simulates the makespan of work partitioned by local_net_sta_list over a deliberately skewed synthetic
+    federation, in which stations differ widely in deployment length, segment length and completeness. The
+    cost of a work unit is taken to be the duration of data it contains; makespan is reported relative to
+    a perfect split.
+    """
+    rs = np.random.RandomState(0)
+    t0 = UTCDateTime('2000-01-01').timestamp
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('create table wdb(ds_id smallint, net varchar(6), sta varchar(6), loc varchar(6), '
+                 'cha varchar(6), st double, et double, tag text)')
+    for ista in range(station_count):
+        # log-normally distributed deployment lengths; segment lengths ranging from minutes to days
+        deployment = min(rs.lognormal(np.log(180), 1.), 3650) * DAY
+        segment = 10 ** rs.uniform(2, 5)
+        start = t0 + rs.uniform(0, 3650 * DAY - deployment)
+        st = start + np.arange(0, deployment, segment)
+        st = st[rs.uniform(size=len(st)) < rs.uniform(0.2, 1)]
+        conn.executemany('insert into wdb values (?, ?, ?, ?, ?, ?, ?, ?)',
+                         [(0, 'XX', 'S%04d' % (ista), '', 'BHZ', s, s + segment, '') for s in st])
+    # end for
+    index = IntervalIndex(conn)
+
+    stations = [index.station_intervals(net, sta) for net, sta in index.stations()]
+    total = np.sum([np.sum(et - st) for st, et in stations])
+
+    # static: rows split by count, as done previously, and by duration
+    for label, splitter in [('static, by count', None), ('static, by duration', split_list_by_duration)]:
+        work = np.zeros(nproc)
+        for st, et in stations:
+            if(splitter is None):
+                order = np.argsort(et)
+                bounds = [[np.min(st[p]), np.max(et[p])] if len(p) else None
+                          for p in split_list(order, nproc)]
+            else:
+                bounds = splitter(st, et, nproc)
+            # end if
+
+            for iproc, b in enumerate(bounds):
+                if(b is not None): work[iproc] += data_duration(st, et, b[0], b[1])
+            # end for
+        # end for
+        print('%25s: makespan %6.2f x ideal' % (label, work.max() / (total / nproc)))
+    # end for
+
+    # dynamic: idle ranks claim the next work unit
+    intervals = dict(zip(index.stations(), stations))
+    finish = np.zeros(nproc)
+    for net, sta, s, e in index.work_units(chunk_size_in_days * DAY):
+        st, et = intervals[(net, sta)]
+        finish[np.argmin(finish)] += data_duration(st, et, s, e)
+    # end for
+    print('%25s: makespan %6.2f x ideal' % ('dynamic', finish.max() / (total / nproc)))
+# end func
+
+
+@cli.command(name='daily-stats')
+@click.argument('output-folder', required=True, type=click.Path())
+@click.option('--station-count', default=4, help='Number of synthetic stations')
+@click.option('--day-count', default=60, help='Number of days of data per station')
+def bench_daily_stats(output_folder, station_count, day_count):
+    """
+    Times computation of daily means for all channels, as done for data-quality reports, from waveform data
+    and from daily summaries recorded in the index.
+
+    OUTPUT_FOLDER: Folder for synthetic data
+    """
+    asdf_source = create_synthetic_federation(os.path.join(output_folder, 'daily_stats'),
+                                              station_count=station_count, channels=('BHZ', 'BHN', 'BHE'),
+                                              day_count=day_count)
+
+    t0 = time.time()
+    fds = FederatedASDFDataSet(asdf_source, cache_size_in_mb=0, build_daily_stats=True)
+    print('%20s: %8.3f s' % ('index build', time.time() - t0))
+
+    stations = sorted(fds.get_stations('1900-01-01', '2100-01-01'))
+
+    t0 = time.time()
+    expected = []
+    for net, sta, loc, cha, _, _ in stations:
+        st, et = fds.get_global_time_range(net, sta, loc, cha)
+        ct = st
+        while ct < et:
+            stream = fds.get_waveforms(net, sta, loc, cha, ct, ct + DAY - 1e-6)
+            expected.append(np.mean(stream.merge()[0].data) if len(stream) else np.nan)
+            ct += DAY
+        # end while
+    # end for
+    print('%20s: %8.3f s' % ('from waveforms', time.time() - t0))
+
+    t0 = time.time()
+    result = []
+    for net, sta, loc, cha, _, _ in stations:
+        st, et = fds.get_global_time_range(net, sta, loc, cha)
+        result += list(fds.get_daily_stats(net, sta, loc, cha, st, et - 1e-6)['mean'])
+    # end for
+    print('%20s: %8.3f s' % ('from daily stats', time.time() - t0))
+
+    assert np.allclose(expected, result)
+# end func
+
+
+@cli.command(name='proximity')
+@click.option('--station-count', default=5000, help='Number of synthetic stations')
+@click.option('--query-count', default=100000, help='Number of proximity queries')
+@click.option('--nn', default=8, help='Number of closest stations fetched')
+def bench_proximity(station_count, query_count, nn):
+    """
+    Times proximity queries against station metadata, issued one at a time, as done previously, and in a
+    single vectorized call.
+    """
+    from scipy.spatial import cKDTree
+    from seismic.ASDFdatabase.utils import rtp2xyz
+
+    rs = np.random.RandomState(0)
+    coordinates = {'XX.S%05d' % (i): [lon, lat] for i, (lon, lat) in
+                   enumerate(zip(rs.uniform(110, 155, station_count), rs.uniform(-45, -10, station_count)))}
+    lons, lats = rs.uniform(110, 155, query_count), rs.uniform(-45, -10, query_count)
+
+    # previous implementation: KD-tree rebuilt from python structures, queried point by point
+    t0 = time.time()
+    keys = np.array(list(coordinates.keys()))
+    lonlat = np.array(list(coordinates.values()))
+    tree = cKDTree(rtp2xyz(np.full(station_count, 6371.), np.radians(90 - lonlat[:, 1]),
+                           np.radians(lonlat[:, 0])))
+    expected = []
+    for lon, lat in zip(lons, lats):
+        xyz = rtp2xyz(np.array([6371.]), np.array([np.radians(90 - lat)]), np.array([np.radians(lon)]))
+        d, l = tree.query(xyz, nn)
+        expected.append(list(keys[l[0]]))
+    # end for
+    print('%20s: %8.3f s' % ('per-point queries', time.time() - t0))
+
+    t0 = time.time()
+    si = StationIndex([coordinates])
+    names, d = si.query(lons, lats, nn)
+    print('%20s: %8.3f s' % ('vectorized query', time.time() - t0))
+
+    assert [list(n) for n in names] == expected
+# end func
+
+
+@cli.command(name='short-window')
+@click.argument('output-folder', required=True, type=click.Path())
+@click.option('--day-count', default=5, help='Number of day-long traces per channel')
+@click.option('--window', default=10., help='Length (s) of windows extracted')
+@click.option('--window-count', default=500, help='Number of windows extracted')
+def bench_short_window(output_folder, day_count, window, window_count):
+    """
+    Times extraction of short windows out of day-long uncompressed traces, along with peak memory, through
+    pyasdf, through direct reads of the samples requested, and as numpy arrays without constructing Traces.
+
+    OUTPUT_FOLDER: Folder for synthetic data
+    """
+    import tracemalloc
+
+    asdf_source = create_synthetic_federation(os.path.join(output_folder, 'short_window'), station_count=1,
+                                              day_count=day_count, sampling_rate=100., compression=None)
+    fds = FederatedASDFDataSet(asdf_source, cache_size_in_mb=0)
+    net, sta, loc, cha, _, _ = fds.get_stations('1900-01-01', '2100-01-01')[0]
+    st, et = fds.get_global_time_range(net, sta, loc, cha)
+
+    rs = np.random.RandomState(0)
+    starts = [st + t for t in rs.uniform(0, et - st - window, window_count)]
+
+    def read_pyasdf(t):
+        rows = fds.fds.index.rows(net, sta, loc, cha, t.timestamp, (t + window).timestamp)
+        stream = Stream()
+        for ds_id, n, s, _, _, _, _, tag in rows: stream += fds.fds._read_item(ds_id, n, s, tag, t, t + window)
+        return stream.trim(t, t + window)
+    # end func
+
+    for label, func in [('pyasdf', read_pyasdf),
+                        ('direct', lambda t: fds.get_waveforms(net, sta, loc, cha, t, t + window)),
+                        ('arrays', lambda t: fds.get_waveform_arrays(net, sta, loc, cha, t, t + window))]:
+        tracemalloc.start()
+        t0 = time.time()
+        for t in starts: func(t)
+        elapsed = time.time() - t0
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print('%20s: %8.3f ms per window, peak memory %8.2f MB' %
+              (label, elapsed / window_count * 1e3, peak / 1024. / 1024.))
+    # end for
+# end func
+
+
+if __name__ == '__main__':
+    cli()
+# end if
@@ -0,0 +1,275 @@
+"""
+Description:
+    Caching utilities used by the FederatedASDFDataSet implementation:
+
+    WaveformCache      : thread-safe, size-bounded (in bytes) LRU cache of decoded traces
+    WaveformPrefetcher : background thread that populates a WaveformCache ahead of the
+                         caller, e.g. while the caller is processing the current time window
+    ASDFHandlePool     : thread-safe, bounded LRU pool of open ASDF files, which are opened
+                         lazily on first access
+
+References:
+
+CreationDate:   18/10/26
+
+Revision History:
+    LastUpdate:     18/10/26
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import threading
+from collections import OrderedDict
+
+import pyasdf
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+# end try
+
+
+class WaveformCache:
+    def __init__(self, size_in_mb=256):
+        """
+        Least-recently-used cache of decoded traces, bounded by the total number of bytes
+        held in trace data-arrays.
+
+        :param size_in_mb: cache capacity in MB; a value of 0 disables caching
+        """
+        self.capacity = int(size_in_mb * 1024 * 1024)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.prefetched = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    # end func
+
+    @staticmethod
+    def _nbytes(trace):
+        return trace.data.nbytes
+    # end func
+
+    def admits(self, nbytes):
+        """
+        :param nbytes: size of a prospective entry in bytes
+        :return: True if an entry of the given size can be held in the cache
+        """
+        return 0 < nbytes <= self.capacity
+    # end func
+
+    def get(self, key):
+        """
+        :param key: cache key
+        :return: cached trace or None; the entry is marked as most recently used
+        """
+        with self._lock:
+            trace = self._entries.get(key)
+            if trace is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            # end if
+
+            return trace
+        # end with
+    # end func
+
+    def put(self, key, trace, prefetched=False):
+        """
+        Adds a trace to the cache, evicting least-recently-used entries as required
+
+        :param key: cache key
+        :param trace: obspy Trace
+        :param prefetched: flags entries added by a prefetcher, for bookkeeping
+        """
+        nbytes = self._nbytes(trace)
+        if not self.admits(nbytes): return
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            # end if
+
+            while self._entries and (self.size + nbytes > self.capacity):
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= self._nbytes(evicted)
+                self.evictions += 1
+            # end while
+
+            self._entries[key] = trace
+            self.size += nbytes
+            if prefetched: self.prefetched += 1
+        # end with
+    # end func
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+        # end with
+    # end func
+
+    def __len__(self):
+        return len(self._entries)
+    # end func
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+        # end with
+    # end func
+
+    def stats(self):
+        """
+        :return: dictionary containing hit/miss counters and current occupancy
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'prefetched': self.prefetched,
+                    'entries': len(self._entries),
+                    'size_in_mb': self.size / 1024. / 1024.,
+                    'capacity_in_mb': self.capacity / 1024. / 1024.}
+        # end with
+    # end func
+# end class
+
+
+class WaveformPrefetcher:
+    def __init__(self, cache, fetch_func, max_pending=64, logger=None):
+        """
+        Loads traces into a WaveformCache on a background thread.
+
+        :param cache: WaveformCache instance to populate
+        :param fetch_func: callable that takes a cache key and returns a decoded trace, or None
+        :param max_pending: maximum number of queued requests; further requests are dropped
+                            until the queue drains
+        :param logger: logger instance
+        """
+        self.cache = cache
+        self.fetch_func = fetch_func
+        self.logger = logger
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='WaveformPrefetcher')
+        self._thread.daemon = True
+        self._thread.start()
+    # end func
+
+    def request(self, key):
+        """
+        Queues a key for prefetching, unless it is already cached or queued
+
+        :param key: cache key
+        """
+        if key in self.cache: return
+
+        with self._lock:
+            if key in self._pending: return
+            try:
+                self._queue.put_nowait(key)
+                self._pending.add(key)
+            except queue.Full:
+                pass
+            # end try
+        # end with
+    # end func
+
+    def _run(self):
+        while True:
+            key = self._queue.get()
+            if key is None: break
+
+            try:
+                if key not in self.cache:
+                    trace = self.fetch_func(key)
+                    if trace is not None: self.cache.put(key, trace, prefetched=True)
+                # end if
+            except Exception as e:
+                if self.logger:
+                    self.logger.warning('Failed to prefetch {} with error:\n{}'.format(key, str(e)))
+                # end if
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+                # end with
+            # end try
+        # end while
+    # end func
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+    # end func
+# end class
+
+
+class ASDFHandlePool:
+    def __init__(self, file_names, max_open_files=64, single_item_read_limit_in_mb=1024, logger=None):
+        """
+        Least-recently-used pool of open ASDF files. Files are opened on first access and the least
+        recently used file is released once the number of open files exceeds max_open_files.
+
+        Released files are closed by pyasdf once the last reference to them goes out of scope, so that
+        a file being read on another thread, e.g. by a WaveformPrefetcher, is not closed under it.
+
+        :param file_names: list of ASDF file names; files are referred to by their position in this list
+        :param max_open_files: maximum number of files held open
+        :param single_item_read_limit_in_mb: buffer size for reading a single waveform, set on each file opened
+        :param logger: logger instance
+        """
+        self.file_names = file_names
+        self.max_open_files = max(int(max_open_files), 1)
+        self.single_item_read_limit_in_mb = single_item_read_limit_in_mb
+        self.logger = logger
+        self.opened = 0
+
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+    # end func
+
+    def get(self, ds_id):
+        """
+        :param ds_id: position of the ASDF file in file_names
+        :return: pyasdf.ASDFDataSet instance
+        """
+        with self._lock:
+            ds = self._handles.get(ds_id)
+            if ds is not None:
+                self._handles.move_to_end(ds_id)
+                return ds
+            # end if
+
+            if self.logger: self.logger.info('Opening ASDF file %s..' % (self.file_names[ds_id]))
+            ds = pyasdf.ASDFDataSet(self.file_names[ds_id], mode='r')
+            ds.single_item_read_limit_in_mb = self.single_item_read_limit_in_mb
+            self.opened += 1
+
+            self._handles[ds_id] = ds
+            while len(self._handles) > self.max_open_files:
+                self._handles.popitem(last=False)
+            # end while
+
+            return ds
+        # end with
+    # end func
+
+    def __len__(self):
+        return len(self._handles)
+    # end func
+
+    def close_all(self):
+        with self._lock:
+            self._handles.clear()
+        # end with
+    # end func
+# end class
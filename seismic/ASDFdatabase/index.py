@@ -0,0 +1,316 @@
+"""
+Description:
+    In-memory indices underpinning FederatedASDFDataSet:
+
+    IntervalIndex : index over the waveform table (wdb) of the sqlite database. Rows are held in
+                    flat numpy arrays, sorted by start-time within each (net, sta, loc, cha) group,
+                    so that overlap queries reduce to binary searches.
+    StationIndex  : columnar station coordinates along with a KD-tree for proximity queries,
+                    which is persisted alongside the sqlite database
+
+References:
+
+CreationDate:   18/10/26
+
+Revision History:
+    LastUpdate:     18/10/26
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import os
+import pickle
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from seismic.ASDFdatabase.utils import rtp2xyz
+
+
+class IntervalIndex:
+    def __init__(self, conn, fetch_size=100000):
+        """
+        Loads the wdb table into memory
+
+        :param conn: sqlite3 connection to a database containing a wdb table
+        :param fetch_size: number of rows fetched from the database at a time
+        """
+        self.key_bounds = dict()            # (net, sta, loc, cha) -> (lo, hi) indices into arrays below
+        self.netsta_keys = dict()           # (net, sta) -> [(net, sta, loc, cha), ...]
+
+        groups = conn.execute('select net, sta, loc, cha, count(*) from wdb '
+                              'group by net, sta, loc, cha order by net, sta, loc, cha').fetchall()
+        nrows = int(np.sum([g[4] for g in groups])) if len(groups) else 0
+        tag_len = conn.execute('select max(length(tag)) from wdb').fetchall()[0][0] or 1
+
+        self.ds_id = np.zeros(nrows, dtype=np.int32)
+        self.st = np.zeros(nrows, dtype=np.float64)
+        self.et = np.zeros(nrows, dtype=np.float64)
+        self.et_cummax = np.zeros(nrows, dtype=np.float64)
+        self.tag = np.zeros(nrows, dtype='S%d' % (tag_len))
+
+        offset = 0
+        for net, sta, loc, cha, count in groups:
+            key = (net, sta, loc, cha)
+            self.key_bounds[key] = (offset, offset + count)
+            self.netsta_keys.setdefault((net, sta), []).append(key)
+            offset += count
+        # end for
+
+        # columnar copies of group codes and bounds, for vectorized queries over groups
+        self.key_codes = [tuple(g[:4]) for g in groups]
+        self.key_net, self.key_sta, self.key_loc, self.key_cha = \
+            [np.array([g[i] for g in groups], dtype=str) for i in range(4)]
+        self.key_lo = np.array([self.key_bounds[k][0] for k in self.key_codes], dtype=np.int64)
+        self.key_hi = np.array([self.key_bounds[k][1] for k in self.key_codes], dtype=np.int64)
+        self._composite = None
+
+        cursor = conn.execute('select ds_id, st, et, tag from wdb order by net, sta, loc, cha, st')
+        offset = 0
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows: break
+
+            n = len(rows)
+            ds_ids, sts, ets, tags = zip(*rows)
+            self.ds_id[offset:offset + n] = ds_ids
+            self.st[offset:offset + n] = sts
+            self.et[offset:offset + n] = ets
+            self.tag[offset:offset + n] = [t.encode('utf-8') for t in tags]
+            offset += n
+        # end while
+
+        # running maximum of end-times within each group; being monotonic, it allows
+        # binary searches for the first row that can overlap a given start-time
+        for lo, hi in self.key_bounds.values():
+            self.et_cummax[lo:hi] = np.maximum.accumulate(self.et[lo:hi])
+        # end for
+    # end func
+
+    def __len__(self):
+        return self.st.shape[0]
+    # end func
+
+    def _first_row_ending_after(self, gids, times):
+        """
+        Vectorized binary search for the first row in each of the given groups with a running-maximum
+        end-time >= the corresponding time. Running-maximum end-times are replaced by their ranks among
+        all such values and offset by group, which yields a single monotonic integer array, so that
+        searches across all groups can be done in one call.
+
+        :param gids: array of group indices
+        :param times: array of timestamps
+        :return: array of row indices; the end of the group where no such row exists
+        """
+        if(self._composite is None):
+            self._cummax_values = np.unique(self.et_cummax)
+            gid_per_row = np.repeat(np.arange(len(self.key_codes), dtype=np.int64), self.key_hi - self.key_lo)
+            self._composite = gid_per_row * (len(self._cummax_values) + 1) + \
+                              np.searchsorted(self._cummax_values, self.et_cummax)
+        # end if
+
+        q = gids * (len(self._cummax_values) + 1) + np.searchsorted(self._cummax_values, times, side='left')
+        return np.searchsorted(self._composite, q, side='left')
+    # end func
+
+    def find_groups(self, network=None, station=None, location=None, channel=None):
+        """
+        :return: indices of groups matching the given codes; codes that are None match all groups
+        """
+        mask = np.ones(len(self.key_codes), dtype=bool)
+        for codes, value in zip([self.key_net, self.key_sta, self.key_loc, self.key_cha],
+                                [network, station, location, channel]):
+            if(value is not None): mask &= codes == value
+        # end for
+
+        return np.where(mask)[0]
+    # end func
+
+    def groups_overlapping(self, gids, starttimes, endtimes):
+        """
+        :param gids: array of group indices
+        :param starttimes: timestamp or array of timestamps, broadcast against gids
+        :param endtimes: timestamp or array of timestamps, broadcast against gids
+        :return: boolean array, True where a group contains a row overlapping [starttime, endtime]
+        """
+        gids, starttimes, endtimes = np.broadcast_arrays(np.atleast_1d(np.asarray(gids, dtype=np.int64)),
+                                                         np.asarray(starttimes, dtype=np.float64),
+                                                         np.asarray(endtimes, dtype=np.float64))
+        if(len(self) == 0): return np.zeros(gids.shape, dtype=bool)
+
+        lo = self._first_row_ending_after(gids.ravel(), starttimes.ravel()).reshape(gids.shape)
+        result = lo < self.key_hi[gids]
+        result[result] &= self.st[lo[result]] <= endtimes[result]
+
+        return result
+    # end func
+
+    def query(self, network, station, location, channel, starttime, endtime):
+        """
+        :param network: network code
+        :param station: station code
+        :param location: location code
+        :param channel: channel code
+        :param starttime: start time as a timestamp
+        :param endtime: end time as a timestamp
+        :return: indices of rows overlapping [starttime, endtime], in ascending order of start-time
+        """
+        bounds = self.key_bounds.get((network, station, location, channel))
+        if bounds is None: return np.zeros(0, dtype=np.int64)
+
+        lo, hi = bounds
+        qlo = lo + np.searchsorted(self.et_cummax[lo:hi], starttime, side='left')
+        qhi = lo + np.searchsorted(self.st[lo:hi], endtime, side='right')
+        if qlo >= qhi: return np.zeros(0, dtype=np.int64)
+
+        indices = np.arange(qlo, qhi)
+        return indices[self.et[qlo:qhi] >= starttime]
+    # end func
+
+    def count(self, network, station, location, channel, starttime, endtime):
+        return self.query(network, station, location, channel, starttime, endtime).shape[0]
+    # end func
+
+    def rows(self, network, station, location, channel, starttime, endtime):
+        """
+        :return: list of rows overlapping [starttime, endtime], each in the layout of the wdb table, i.e.
+                 (ds_id, net, sta, loc, cha, st, et, tag)
+        """
+        indices = self.query(network, station, location, channel, starttime, endtime)
+
+        return [(int(self.ds_id[i]), network, station, location, channel,
+                 float(self.st[i]), float(self.et[i]), self.tag[i].decode('utf-8')) for i in indices]
+    # end func
+
+    def stations(self):
+        """
+        :return: sorted list of (net, sta) tuples
+        """
+        return sorted(self.netsta_keys.keys())
+    # end func
+
+    def station_intervals(self, network, station):
+        """
+        :return: tuple of arrays containing start- and end-times of all rows for a station, across all
+                 location and channel codes, in ascending order of start-time
+        """
+        indices = [np.arange(*self.key_bounds[key]) for key in self.netsta_keys.get((network, station), [])]
+        indices = np.concatenate(indices) if len(indices) else np.zeros(0, dtype=np.int64)
+
+        order = np.argsort(self.st[indices], kind='stable')
+        return self.st[indices][order], self.et[indices][order]
+    # end func
+
+    def work_units(self, chunk_seconds):
+        """
+        :param chunk_seconds: length of work units in seconds
+        :return: list of (net, sta, start_time, end_time) tuples, with times as timestamps, for each
+                 chunk_seconds-long time-range of a station's data that contains data
+        """
+        units = []
+        for net, sta in self.stations():
+            st, et = self.station_intervals(net, sta)
+            if(len(st) == 0): continue
+
+            cs = np.arange(st[0], np.max(et), chunk_seconds)
+            ce = np.minimum(cs + chunk_seconds, np.max(et))
+
+            # a chunk contains data if an interval starting before its end ends after its start
+            hi = np.searchsorted(st, ce, side='right')
+            lo = np.searchsorted(np.maximum.accumulate(et), cs, side='left')
+
+            units += [(net, sta, s, e) for s, e in zip(cs[lo < hi], ce[lo < hi])]
+        # end for
+
+        return units
+    # end func
+
+    def time_range(self, network, station, location=None, channel=None):
+        """
+        :return: tuple containing min start-time and max end-time (timestamps) over all matching rows;
+                 (None, None) if no matching rows are found
+        """
+        mint = None
+        maxt = None
+        for key in self.netsta_keys.get((network, station), []):
+            if location is not None and key[2] != location: continue
+            if channel is not None and key[3] != channel: continue
+
+            lo, hi = self.key_bounds[key]
+            mint = self.st[lo] if mint is None else min(mint, self.st[lo])
+            maxt = self.et_cummax[hi - 1] if maxt is None else max(maxt, self.et_cummax[hi - 1])
+        # end for
+
+        return mint, maxt
+    # end func
+# end class
+
+
+class StationIndex:
+    def __init__(self, station_coordinates, cache_file_name=None, earth_radius=6371):
+        """
+        Columnar station coordinates with a KD-tree over their cartesian locations. The KD-tree is
+        loaded from cache_file_name if it matches the given stations, and written to it otherwise.
+
+        :param station_coordinates: list of dictionaries, one for each ASDF file, containing [lon, lat]
+               coordinates indexed by 'net.sta'; coordinates in later files take precedence
+        :param cache_file_name: file name for persisting the KD-tree; None disables persistence
+        :param earth_radius: radius (km) of the sphere on which cartesian locations are computed
+        """
+        coordinates = dict()
+        for ds_dict in station_coordinates: coordinates.update(ds_dict)
+
+        self.earth_radius = earth_radius
+        self.keys = np.array(list(coordinates.keys()), dtype=str)
+        lonlat = np.array(list(coordinates.values()), dtype=np.float64).reshape(-1, 2)
+        self.lon = lonlat[:, 0]
+        self.lat = lonlat[:, 1]
+        self.xyz = self.to_xyz(self.lon, self.lat)
+
+        self.tree = None
+        if(cache_file_name is not None and os.path.exists(cache_file_name)):
+            try:
+                keys, xyz, tree = pickle.load(open(cache_file_name, 'rb'))
+                if(np.array_equal(keys, self.keys) and np.array_equal(xyz, self.xyz)): self.tree = tree
+            except Exception:
+                self.tree = None
+            # end try
+        # end if
+
+        if(self.tree is None):
+            self.tree = cKDTree(self.xyz)
+
+            if(cache_file_name is not None):
+                tmp_fn = '%s.%d.tmp' % (cache_file_name, os.getpid())
+                pickle.dump((self.keys, self.xyz, self.tree), open(tmp_fn, 'wb'))
+                os.replace(tmp_fn, cache_file_name)
+            # end if
+        # end if
+    # end func
+
+    def __len__(self):
+        return len(self.keys)
+    # end func
+
+    def to_xyz(self, lon, lat):
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+
+        return rtp2xyz(np.full(lon.shape[0], float(self.earth_radius)), np.radians(90 - lat), np.radians(lon))
+    # end func
+
+    def query(self, lon, lat, nn=1):
+        """
+        :param lon: longitude or array of longitudes (degrees)
+        :param lat: latitude or array of latitudes (degrees)
+        :param nn: number of closest stations to fetch for each point
+        :return: tuple of 2D arrays, of shape (number of points, min(nn, number of stations)), containing
+                 'net.sta' names and (cartesian) distances in km of the closest stations, in ascending order
+        """
+        nn = min(nn, len(self))
+        d, l = self.tree.query(self.to_xyz(lon, lat), nn)
+
+        d = np.asarray(d).reshape(-1, nn)
+        l = np.asarray(l).reshape(-1, nn)
+        return self.keys[l], d
+    # end func
+# end class
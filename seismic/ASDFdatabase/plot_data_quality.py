@@ -107,6 +107,13 @@ def process_data(rank, fds, stations, start_time, end_time):
         # align st to day
         st = UTCDateTime(year=st.year, month=st.month, day=st.day)
 
+        # use daily summaries recorded in the index, if available
+        daily_means = None
+        daily_stats = fds.get_daily_stats(s[0], s[1], s[2], s[3], st, et)
+        if daily_stats is not None:
+            daily_means = dict(zip(daily_stats['day'], daily_stats['mean']))
+        # end if
+
         ct = st
         times = []
         means = []
@@ -114,7 +121,10 @@ def process_data(rank, fds, stations, start_time, end_time):
             times.append(ct)
 
             debug = False
-            if not debug:
+            if daily_means is not None:
+                # days without data are marked by nans
+                means.append(daily_means.get(ct.timestamp, np.nan))
+            elif not debug:
                 stream = fds.get_waveforms(s[0], s[1], s[2], s[3],
                                            ct, ct + day,
                                            trace_count_threshold=200)
@@ -351,7 +361,10 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
                 type=str)
 @click.argument('output-basename', required=True,
                 type=str)
-def process(asdf_source, start_time, end_time, net, sta, cha, output_basename):
+@click.option('--daily-stats', is_flag=True, default=False,
+              help='Compute daily means from summaries recorded in the index of the FederatedASDFDataSet, '
+                   'which are built on first use, instead of reading waveform data for each station-day')
+def process(asdf_source, start_time, end_time, net, sta, cha, output_basename, daily_stats):
     """
     ASDF_SOURCE: Text file containing a list of paths to ASDF files\n
     START_TIME: Start time in UTCDateTime format\n
@@ -375,7 +388,9 @@ def process(asdf_source, start_time, end_time, net, sta, cha, output_basename):
     rank = comm.Get_rank()
 
     l = setup_logger(name=output_basename, log_file='%s.log' % output_basename)
-    fds = FederatedASDFDataSet(asdf_source, logger=l)
+    # stations are scanned day by day
+    fds = FederatedASDFDataSet(asdf_source, logger=l, cache_size_in_mb=256, prefetch=True,
+                               build_daily_stats=daily_stats)
 
     stations = []
     if rank == 0:
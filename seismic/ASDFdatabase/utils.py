@@ -1,4 +1,5 @@
 from obspy.core import UTCDateTime
+from mpi4py import MPI
 import numpy as np
 
 MAX_DATE = UTCDateTime(4102444800.0)
@@ -12,3 +13,76 @@ def rtp2xyz(r, theta, phi):
     xout[:, 2] = r * np.cos(theta)
     return xout
 # end func
+
+def compute_daily_stats(data, starttime, sampling_rate):
+    """
+    Computes summary statistics of a contiguous waveform for each UTC day it spans
+
+    :param data: waveform samples
+    :param starttime: timestamp of the first sample
+    :param sampling_rate: sampling rate (Hz)
+    :return: list of tuples containing (day, count, duration, sum, sum of squares, min, max), where day is
+             the timestamp of the start of a day and duration is the time (s) spanned by samples within the day
+    """
+    if(len(data) == 0): return []
+
+    day = 24 * 3600.
+    endtime = starttime + (len(data) - 1) / sampling_rate
+    days = np.arange(np.floor(starttime / day), np.floor(endtime / day) + 1) * day
+
+    # index of the first sample within each day
+    offsets = np.maximum(np.ceil((days - starttime) * sampling_rate - 1e-6), 0).astype(np.int64)
+    counts = np.diff(np.append(offsets, len(data)))
+    keep = counts > 0
+
+    data = np.asarray(data, dtype=np.float64)
+    sums = np.add.reduceat(data, offsets[keep])
+    sumsqs = np.add.reduceat(data * data, offsets[keep])
+    mins = np.minimum.reduceat(data, offsets[keep])
+    maxs = np.maximum.reduceat(data, offsets[keep])
+
+    return list(zip(days[keep], counts[keep], counts[keep] / float(sampling_rate), sums, sumsqs, mins, maxs))
+# end func
+
+class SharedCounter:
+    def __init__(self, comm, start=0):
+        """
+        Counter hosted on rank 0 of an MPI communicator, which other ranks increment atomically through
+        one-sided communication, without rank 0 having to service requests. This allows idle ranks to
+        claim the next unit of work from a common list. Construction and free() are collective.
+
+        :param comm: MPI communicator
+        :param start: initial value
+        """
+        self.comm = comm
+        itemsize = np.dtype(np.int64).itemsize
+
+        # window memory is allocated by MPI, since windows created over user buffers are rejected by some
+        # MPI implementations (e.g. Open MPI 4.1) for single-rank jobs
+        self._win = MPI.Win.Allocate(itemsize if comm.Get_rank() == 0 else 0, disp_unit=itemsize, comm=comm)
+        if(comm.Get_rank() == 0):
+            self._win.Lock(0)
+            self._win.Put(np.array([start], dtype=np.int64), 0)
+            self._win.Unlock(0)
+        # end if
+        comm.Barrier()
+    # end func
+
+    def next(self):
+        """
+        :return: current value of the counter, which is incremented by one
+        """
+        one = np.ones(1, dtype=np.int64)
+        result = np.zeros(1, dtype=np.int64)
+
+        self._win.Lock(0)
+        self._win.Fetch_and_op(one, result, 0, 0, MPI.SUM)
+        self._win.Unlock(0)
+
+        return int(result[0])
+    # end func
+
+    def free(self):
+        self._win.Free()
+    # end func
+# end class
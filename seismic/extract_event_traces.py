@@ -149,9 +149,10 @@ def asdf_get_waveforms(asdf_dataset, network, station, location, channel, startt
                                                   location=location)
     if matching_stations:
         ch_matcher = re.compile(channel)
-        for net, sta, loc, cha, _, _ in matching_stations:
-            if ch_matcher.match(cha):
-                st += asdf_dataset.get_waveforms(net, sta, loc, cha, starttime, endtime)
+        requests = [(net, sta, loc, cha, starttime, endtime)
+                    for net, sta, loc, cha, _, _ in matching_stations if ch_matcher.match(cha)]
+        for s in asdf_dataset.get_waveforms_bulk(requests):
+            st += s
         # end for
     # end if
     if st:
@@ -0,0 +1,211 @@
+"""
+Description:
+    Batched AIC-derivative (AICD) picker. extract_p and extract_s in pick.py try several bandpass bands and
+    several trigger thresholds (nsigma) one after another, through PhasePApy's AICDPicker, which re-filters
+    the trace and recomputes the AIC characteristic function -- at quadratic cost, through a Python loop --
+    for every combination. Here, all bands are filtered into a single 2D array, the AIC and its derivative
+    are computed for all bands at once in linear time through cumulative sums, and triggers are evaluated
+    for all nsigma values at once, since only the threshold scales with nsigma.
+
+    The picking algorithm follows AICDPicker: the characteristic function (CF) is the absolute derivative of
+    the AIC, the dynamic threshold is nsigma times the RMS of the CF over the preceding t_ma seconds, triggers
+    following a previous trigger within t_up seconds are discarded, as are triggers where the standard
+    deviation of the waveform over nr_len seconds after the trigger is less than nr_coeff times that over
+    nr_len seconds before it. The signal-to-noise ratio of a pick is the CF at the pick over the RMS of the
+    CF over the preceding t_ma seconds. Polarities and uncertainties, which the pick harvester does not use,
+    are not computed.
+
+References:
+    https://github.com/austinholland/PhasePApy
+
+CreationDate:   18/10/26
+
+Revision History:
+    LastUpdate:     18/10/26
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import numpy as np
+from obspy.signal.filter import bandpass
+
+
+def filter_bands(data, sampling_rate, freqmins, freqmaxs, corners=4, zerophase=True):
+    """
+    Bandpass-filters a waveform over several bands, as Trace.filter('bandpass', ...) would for each band
+
+    :param data: 1D array of waveform samples
+    :param sampling_rate: sampling rate (Hz)
+    :param freqmins: lower corner frequencies of bands
+    :param freqmaxs: upper corner frequencies of bands
+    :param corners: filter corners
+    :param zerophase: apply filters forwards and backwards
+    :return: 2D array of shape (len(freqmins), len(data))
+    """
+    data = np.asarray(data, dtype=np.float64)
+    result = np.empty((len(freqmins), len(data)))
+    for i, (freqmin, freqmax) in enumerate(zip(freqmins, freqmaxs)):
+        result[i, :] = bandpass(data, freqmin, freqmax, df=sampling_rate, corners=corners, zerophase=zerophase)
+    # end for
+
+    return result
+# end func
+
+
+def _window_sums(data, w):
+    """
+    :param data: 2D array
+    :param w: window length in samples
+    :return: sums and sums of squares of data over windows [j, j + w), for j in [0, n - w]
+    """
+    c = np.zeros((data.shape[0], data.shape[1] + 1))
+    c2 = np.zeros((data.shape[0], data.shape[1] + 1))
+    np.cumsum(data, axis=-1, out=c[:, 1:])
+    np.cumsum(data ** 2, axis=-1, out=c2[:, 1:])
+
+    return c[:, w:] - c[:, :-w], c2[:, w:] - c2[:, :-w]
+# end func
+
+
+def aic(data):
+    """
+    Computes the AIC of each row of data, as AICDPicker does through
+
+        AIC[k] = k log10(var(x[:k])) + (n - k - 1) log10(var(x[k:])), for k in [1, n - 1],
+
+    with AIC[0] = AIC[1] and AIC[n - 1] = AIC[n - 2]. Where a variance vanishes, AIC[k] takes the
+    value of AIC[k + 1].
+
+    :param data: 1D or 2D array of waveform samples, with samples along the last axis
+    :return: 2D array of AIC values
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+    data = data - np.mean(data, axis=-1, keepdims=True)
+    nb, n = data.shape
+    k = np.arange(1, n, dtype=np.float64)
+
+    # sums over x[:k] and x[k:], for k in [1, n - 1]
+    left = np.cumsum(data, axis=-1)[:, :-1]
+    left2 = np.cumsum(data ** 2, axis=-1)[:, :-1]
+    right = np.cumsum(data[:, ::-1], axis=-1)[:, ::-1][:, 1:]
+    right2 = np.cumsum(data[:, ::-1] ** 2, axis=-1)[:, ::-1][:, 1:]
+
+    def log10_var(s, s2, m):
+        var = s2 / m - (s / m) ** 2
+        # guard against round-off in windows of constant samples
+        zero = var <= 1e-12 * (s2 / m)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(zero, -np.inf, np.log10(np.where(zero, 1., var)))
+        # end with
+    # end func
+
+    with np.errstate(invalid='ignore'):
+        a = k * log10_var(left, left2, k) + (n - k - 1) * log10_var(right, right2, n - k)
+    # end with
+
+    # vanishing variances take the value of the next split point
+    idx = np.where(np.isneginf(a), n - 2, np.arange(n - 1))
+    idx = np.minimum.accumulate(idx[:, ::-1], axis=-1)[:, ::-1]
+    a = np.take_along_axis(a, idx, axis=-1)
+
+    result = np.empty((nb, n))
+    result[:, 1:] = a
+    result[:, 0] = result[:, 1]
+    result[:, -1] = result[:, -2]
+
+    return result
+# end func
+
+
+def aic_derivative(aic_values):
+    """
+    :param aic_values: 2D array of AIC values
+    :return: absolute first differences of AIC values, padded with a trailing 0
+    """
+    result = np.zeros(aic_values.shape)
+    result[:, :-1] = np.fabs(np.diff(aic_values, axis=-1))
+
+    return result
+# end func
+
+
+class BatchAICDPicker:
+    def __init__(self, t_ma=3, nsigmas=(6,), t_up=0.2, nr_len=2, nr_coeff=2):
+        """
+        AICD picker that evaluates several bands and trigger thresholds at once; parameters are as for
+        PhasePApy's AICDPicker.
+
+        :param t_ma: length (s) of the moving window over which the dynamic threshold is computed
+        :param nsigmas: sequence of threshold levels (nsigma), in order of preference
+        :param t_up: time (s) following a trigger within which further triggers are discarded
+        :param nr_len: length (s) of windows before and after triggers over which noise ratios are computed
+        :param nr_coeff: minimum ratio of standard deviations after and before a trigger
+        """
+        self.t_ma = t_ma
+        self.nsigmas = np.atleast_1d(np.asarray(nsigmas, dtype=np.float64))
+        self.t_up = t_up
+        self.nr_len = nr_len
+        self.nr_coeff = nr_coeff
+    # end func
+
+    def picks(self, data, starttime, sampling_rate):
+        """
+        :param data: 2D array of waveforms of shape (bands, samples), e.g. as returned by filter_bands
+        :param starttime: UTCDateTime of the first sample
+        :param sampling_rate: sampling rate (Hz)
+        :return: nested list, indexed by band and then by nsigma, of (picks, snr) tuples, where picks is
+                 a list of UTCDateTime pick times and snr a 1D array of corresponding signal-to-noise ratios
+        """
+        data = np.atleast_2d(np.asarray(data, dtype=np.float64))
+        nb, n = data.shape
+        ns = len(self.nsigmas)
+        dt = 1. / sampling_rate
+
+        m = int(round(self.t_ma / dt))
+        u = int(round(self.t_up / dt))
+        w = int(round(self.nr_len / dt))
+
+        if (m < 1 or w < 1 or n <= max(m, 2 * w)):
+            return [[([], np.zeros(0)) for _ in range(ns)] for _ in range(nb)]
+        # end if
+
+        cf = aic_derivative(aic(data))
+
+        # RMS of the CF over [j - m, j), for j in [m, n - 1]
+        _, s2 = _window_sums(cf[:, :-1], m)
+        noise = np.zeros((nb, n))
+        noise[:, m:] = np.sqrt(np.maximum(s2, 0) / m)
+
+        # triggers for all thresholds at once
+        triggers = np.zeros((ns, nb, n), dtype=bool)
+        triggers[:, :, m:] = cf[None, :, m:] > self.nsigmas[:, None, None] * noise[None, :, m:]
+
+        # discard triggers following a previous trigger within u samples
+        if (u > 0):
+            c = np.zeros((ns, nb, n + 1), dtype=np.int64)
+            np.cumsum(triggers, axis=-1, out=c[:, :, 1:])
+            preceding = c[:, :, 1:n] - c[:, :, np.maximum(np.arange(1, n) - u, 0)]
+            triggers[:, :, 1:] &= (preceding == 0)
+        # end if
+
+        # noise-ratio check over windows of w samples before and after each trigger
+        s, s2 = _window_sums(data, w)
+        std = np.sqrt(np.maximum(s2 / w - (s / w) ** 2, 0))
+        nr_ok = np.zeros((nb, n), dtype=bool)
+        nr_ok[:, w:n - w + 1] = std[:, w:] >= self.nr_coeff * std[:, :n - 2 * w + 1]
+        triggers &= nr_ok[None, :, :]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            snr = cf / noise
+        # end with
+
+        result = [[None] * ns for _ in range(nb)]
+        for bi in range(nb):
+            for si in range(ns):
+                indices = np.nonzero(triggers[si, bi, :])[0]
+                result[bi][si] = ([starttime + j * dt for j in indices], snr[bi, indices])
+            # end for
+        # end for
+
+        return result
+    # end func
+# end class
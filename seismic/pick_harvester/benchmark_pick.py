@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+"""
+Description:
+    Benchmarks for the pick-harvesting workflow, run against synthetic inputs generated on the fly
+
+    Example usage:
+    python benchmark_pick.py travel-time /tmp/tt.npz --pair-count 1000000
+    python benchmark_pick.py fetch /tmp/pick_fetch --event-count 200
+    python benchmark_pick.py picker --trace-count 200
+    python benchmark_pick.py quality --pick-count 1000
+
+References:
+
+CreationDate:   18/10/26
+
+Revision History:
+    LastUpdate:     18/10/26
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import os
+import time
+
+import click
+import numpy as np
+from obspy import Stream, Trace, UTCDateTime
+from obspy.taup import TauPyModel
+
+from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
+from seismic.ASDFdatabase.benchmark_fds import create_synthetic_federation
+from seismic.pick_harvester.batch_picker import BatchAICDPicker, filter_bands
+from seismic.pick_harvester.quality import compute_quality_measures, compute_quality_measures_batch
+from seismic.pick_harvester.travel_time import get_travel_time_table
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+def cli():
+    pass
+# end func
+
+
+@cli.command(name='travel-time')
+@click.argument('table-file', required=True, type=click.Path(dir_okay=False))
+@click.option('--pair-count', default=1000000, help='Number of (event, station) pairs')
+@click.option('--direct-count', default=1000, help='Number of pairs evaluated through direct TauP ray-tracing, '
+                                                   'from which the time for all pairs is extrapolated')
+@click.option('--depth-step', default=10., help='Source-depth spacing (km) of the travel-time table')
+@click.option('--distance-step', default=0.5, help='Epicentral-distance spacing (degrees) of the travel-time table')
+def bench_travel_time(table_file, pair_count, direct_count, depth_step, distance_step):
+    """
+    Times prediction of P and S travel-times for random (event, station) pairs through direct TauP
+    ray-tracing (as done previously) and through interpolation from a precomputed table, and reports
+    interpolation errors.
+
+    TABLE_FILE: File where the travel-time table is cached
+    """
+    t0 = time.time()
+    table = get_travel_time_table(table_file, depth_step_km=depth_step, distance_step_deg=distance_step)
+    print('Table loaded/built in %.2f s; validated maximum errors (s): %s' % (time.time() - t0,
+                                                                            str(table.max_errors)))
+
+    rs = np.random.RandomState(0)
+    depths = rs.uniform(0, 700, pair_count)
+    elats, slats = rs.uniform(-90, 90, (2, pair_count))
+    elons, slons = rs.uniform(-180, 180, (2, pair_count))
+
+    t0 = time.time()
+    interpolated = {phase: table.travel_times_geo(phase, depths, elats, elons, slats, slons)
+                    for phase in ['P', 'S']}
+    elapsed_table = time.time() - t0
+
+    model = TauPyModel(model='iasp91')
+    direct = {'P': [], 'S': []}
+    t0 = time.time()
+    for i in range(direct_count):
+        for phase in ['P', 'S']:
+            arrivals = model.get_travel_times_geo(depths[i], elats[i], elons[i], slats[i], slons[i],
+                                                  phase_list=(phase,))
+            direct[phase].append(arrivals[0].time if len(arrivals) else np.nan)
+        # end for
+    # end for
+    elapsed_direct = (time.time() - t0) * pair_count / float(direct_count)
+
+    print('%25s: %10.2f s' % ('direct TauP (estimated)', elapsed_direct))
+    print('%25s: %10.2f s' % ('interpolated', elapsed_table))
+    for phase in ['P', 'S']:
+        errors = np.fabs(interpolated[phase][:direct_count] - np.array(direct[phase]))
+        missing = np.sum(np.isnan(interpolated[phase][:direct_count]) != np.isnan(direct[phase]))
+        print('%s: max error %.3f s, mean error %.3f s, %d/%d pairs with mismatched availability' %
+              (phase, np.nanmax(errors), np.nanmean(errors), missing, direct_count))
+    # end for
+# end func
+
+
+def count_bytes_read(fds):
+    """
+    Instruments the low-level read functions of a FederatedASDFDataSet to tally the number of bytes of
+    waveform data read, including data read into the cache and by the prefetcher
+
+    :param fds: FederatedASDFDataSet instance
+    :return: dictionary whose 'bytes' entry is updated as data are read
+    """
+    counter = {'bytes': 0}
+    impl = fds.fds
+
+    def instrument(func):
+        def wrapper(*args, **kwargs):
+            result = func(*args, **kwargs)
+            traces = result if isinstance(result, Stream) else ([result] if result is not None else [])
+            counter['bytes'] += int(np.sum([tr.data.nbytes for tr in traces]))
+            return result
+        # end func
+        return wrapper
+    # end func
+
+    impl._read_trace_slice = instrument(impl._read_trace_slice)
+    impl._read_full_trace = instrument(impl._read_full_trace)
+
+    return counter
+# end func
+
+
+@cli.command(name='fetch')
+@click.argument('output-folder', required=True, type=click.Path())
+@click.option('--station-count', default=10, help='Number of synthetic stations')
+@click.option('--day-count', default=30, help='Number of days of data per station')
+@click.option('--event-count', default=200, help='Number of synthetic events')
+@click.option('--compressed', default=False, is_flag=True, help='Generate gzip-compressed waveform data')
+@click.option('--event-batch-size', default=200, help='Number of arrival windows read together in the '
+                                                      'event-driven mode')
+@click.option('--window-padding', default=60., help='Half-length (s) of windows read around arrivals, as '
+                                                    'EVENT_WINDOW_PADDING in pick.py')
+def bench_fetch(output_folder, station_count, day_count, event_count, compressed, event_batch_size,
+                window_padding):
+    """
+    Compares the number of bytes of waveform data read and wall time of the day-scan and event-driven
+    fetch modes of the pick harvester, over Z channels of synthetic stations and a synthetic catalogue.
+    The day-scan mode reads each day containing event origins in full, whereas the event-driven mode
+    reads windows around theoretical P arrivals only, sorted by time and batched through get_waveforms_bulk.
+
+    OUTPUT_FOLDER: Folder for synthetic data and the travel-time table
+    """
+    asdf_source = create_synthetic_federation(os.path.join(output_folder, 'compressed' if compressed else 'raw'),
+                                              station_count=station_count, day_count=day_count,
+                                              compression='gzip-3' if compressed else None)
+    table = get_travel_time_table(os.path.join(output_folder, 'travel_times.npz'), depth_step_km=50.,
+                                  distance_step_deg=2.)
+
+    fds = FederatedASDFDataSet(asdf_source, cache_size_in_mb=0)
+    stations = sorted(fds.get_stations('1900-01-01', '2100-01-01'))
+    st, et = fds.get_global_time_range(*stations[0][:2])
+    del fds
+
+    # synthetic catalogue of events within regional to teleseismic distances of the stations
+    rs = np.random.RandomState(0)
+    origins = np.sort(rs.uniform(st.timestamp, et.timestamp - 3600, event_count))
+    elats, elons = rs.uniform(-60, 10, event_count), rs.uniform(100, 180, event_count)
+    edepths = rs.uniform(0, 600, event_count)
+    day = 24 * 3600
+
+    def day_mode():
+        fds = FederatedASDFDataSet(asdf_source, cache_size_in_mb=256, prefetch=True)
+        counter = count_bytes_read(fds)
+        windows = 0
+        for net, sta, loc, cha, _, _ in stations:
+            curr = st
+            while (curr < et):
+                if (np.any((origins >= curr.timestamp) & (origins <= (curr + day).timestamp))):
+                    stream = fds.get_waveforms(net, sta, loc, cha, curr, curr + day, trace_count_threshold=200)
+                    stream.merge(method=-1)
+                    windows += 1
+                # end if
+                curr += day
+            # wend
+        # end for
+        return counter['bytes'], windows
+    # end func
+
+    def event_mode():
+        fds = FederatedASDFDataSet(asdf_source, cache_size_in_mb=0)
+        counter = count_bytes_read(fds)
+        windows = 0
+        for net, sta, loc, cha, slon, slat in stations:
+            tt = table.travel_times_geo('P', edepths, elats, elons, slat, slon)
+            arrivals = np.sort((origins + tt)[np.isfinite(tt)])
+            for ib in range(0, len(arrivals), event_batch_size):
+                requests = [(net, sta, loc, cha, UTCDateTime(ts - window_padding),
+                             UTCDateTime(ts + window_padding)) for ts in arrivals[ib:ib + event_batch_size]]
+                for stream in fds.get_waveforms_bulk(requests, trace_count_threshold=200):
+                    stream.merge(method=-1)
+                # end for
+            # end for
+            windows += len(arrivals)
+        # end for
+        return counter['bytes'], windows
+    # end func
+
+    for label, func in [('day-scan', day_mode), ('event-driven', event_mode)]:
+        t0 = time.time()
+        nbytes, windows = func()
+        print('%15s: %8.3f s, %10.2f MB read over %d day-traces/windows' %
+              (label, time.time() - t0, nbytes / 1024. / 1024., windows))
+    # end for
+# end func
+
+
+@cli.command(name='picker')
+@click.option('--trace-count', default=200, help='Number of synthetic arrivals')
+@click.option('--window', default=100., help='Length (s) of picking windows')
+@click.option('--sampling-rate', default=20., help='Sampling rate (Hz), as resampled to by extract_p')
+def bench_picker(trace_count, window, sampling_rate):
+    """
+    Times picking of synthetic P arrivals over the bands and nsigma values used by extract_p, through
+    PhasePApy's AICDPicker, trying bands and nsigma values one after another until picks are found, and
+    through BatchAICDPicker, evaluating all at once. The PhasePApy timing is skipped if it is not installed.
+    """
+    freqmins, freqmaxs = [0.5, 2., 5.], [5., 10., 10.]
+    sigmas = np.arange(8, 3, -1)
+
+    rs = np.random.RandomState(0)
+    npts = int(window * sampling_rate)
+    traces = []
+    onsets = []
+    for i in range(trace_count):
+        data = rs.normal(0, 1, npts)
+        onset = rs.randint(npts // 4, 3 * npts // 4)
+        data[onset:] *= rs.uniform(2, 20)
+        tr = Trace(data=data, header={'sampling_rate': sampling_rate, 'starttime': UTCDateTime(2010, 1, 1)})
+        tr.taper(max_percentage=0.1, type='hann')
+        traces.append(tr)
+        onsets.append(tr.stats.starttime + onset / sampling_rate)
+    # end for
+
+    def report(label, elapsed, picks):
+        errors = [np.fabs(p - o) for p, o in zip(picks, onsets) if p is not None]
+        print('%15s: %8.1f picks/s, %d/%d arrivals picked, median onset error %.3f s' %
+              (label, len(errors) / elapsed, len(errors), trace_count, np.median(errors) if errors else np.nan))
+    # end func
+
+    batch_picker = BatchAICDPicker(t_ma=5, nsigmas=sigmas, t_up=1, nr_len=5, nr_coeff=2)
+    picks = []
+    t0 = time.time()
+    for tr in traces:
+        bands = filter_bands(tr.data, tr.stats.sampling_rate, freqmins, freqmaxs)
+        result = batch_picker.picks(bands, tr.stats.starttime, tr.stats.sampling_rate)
+        found = [r[0][0] for rb in result for r in rb if len(r[0])]
+        picks.append(found[0] if found else None)
+    # end for
+    report('batched', time.time() - t0, picks)
+
+    try:
+        from PhasePApy.phasepapy.phasepicker import aicdpicker
+    except ImportError:
+        print('PhasePApy is not installed; skipping AICDPicker timings')
+        return
+    # end try
+
+    pickers = [aicdpicker.AICDPicker(t_ma=5, nsigma=sigma, t_up=1, nr_len=5, nr_coeff=2, pol_len=10,
+                                     pol_coeff=10, uncert_coeff=3) for sigma in sigmas]
+    picks = []
+    t0 = time.time()
+    for tr in traces:
+        pick = None
+        for freqmin, freqmax in zip(freqmins, freqmaxs):
+            trc = tr.copy().filter('bandpass', freqmin=freqmin, freqmax=freqmax, corners=4, zerophase=True)
+            for picker in pickers:
+                _, found, _, _, _ = picker.picks(trc)
+                if (len(found)):
+                    pick = found[0]
+                    break
+                # end if
+            # end for
+            if (pick is not None): break
+        # end for
+        picks.append(pick)
+    # end for
+    report('AICDPicker', time.time() - t0, picks)
+# end func
+
+
+@cli.command(name='quality')
+@click.option('--pick-count', default=1000, help='Number of synthetic picks')
+@click.option('--exact-count', default=100, help='Number of picks evaluated through pywt.cwt and curve_fit, '
+                                                 'from which throughput is estimated')
+@click.option('--phase', default='p', type=click.Choice(['p', 's']), help='Phase, which determines CWT scales')
+def bench_quality(pick_count, exact_count, phase):
+    """
+    Compares the throughput of pick quality measures computed through pywt.cwt and curve_fit, one pick at
+    a time through the batched implementation, and for all picks at once, on 6 s windows around synthetic
+    onsets sampled at 20 Hz, and reports maximum deviations from exact values.
+    """
+    scales = np.logspace(0.15, 1.5, 30) if phase == 'p' else np.logspace(0.5, 4, 30)
+
+    rs = np.random.RandomState(0)
+    traces = []
+    for i in range(pick_count):
+        data = rs.normal(0, 1, 121)
+        data[60 + rs.randint(-5, 5):] *= rs.uniform(1, 20)
+        traces.append(Trace(data=data, header={'sampling_rate': 20., 'starttime': UTCDateTime(2010, 1, 1)}))
+    # end for
+    exact_count = min(exact_count, pick_count)
+
+    t0 = time.time()
+    exact = np.array([compute_quality_measures(tr, tr, scales, exact=True) for tr in traces[:exact_count]])
+    print('%15s: %10.1f picks/s' % ('pywt/curve_fit', exact_count / (time.time() - t0)))
+
+    t0 = time.time()
+    single = np.array([compute_quality_measures(tr, tr, scales) for tr in traces])
+    print('%15s: %10.1f picks/s' % ('single', pick_count / (time.time() - t0)))
+
+    t0 = time.time()
+    batch = compute_quality_measures_batch(traces, scales)
+    print('%15s: %10.1f picks/s' % ('batched', pick_count / (time.time() - t0)))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        errors = np.fabs(batch[:exact_count] - exact) / np.fabs(exact)
+    # end with
+    print('Maximum relative deviations (cwtsnr, dom_freq, slope_ratio): %s; single vs batched: %g' %
+          (str(np.nanmax(errors, axis=0)), np.nanmax(np.fabs(single - batch))))
+# end func
+
+
+if __name__ == '__main__':
+    cli()
+# end if
@@ -18,7 +18,7 @@ import os
 
 from ordered_set import OrderedSet as set
 import numpy as np
-from obspy import Trace
+from obspy import Trace, UTCDateTime
 from datetime import datetime
 from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
 
@@ -35,7 +35,12 @@ import psutil
 import gc
 
 from seismic.pick_harvester.quality import compute_quality_measures
+from seismic.pick_harvester.batch_picker import BatchAICDPicker, filter_bands
+from seismic.pick_harvester.travel_time import get_travel_time_table, distance_deg
 
+# Half-length (s) of data windows read around theoretical arrivals in the event-driven fetch mode,
+# spanning win_start + buffer_start through win_end + buffer_end of extract_p and extract_s
+EVENT_WINDOW_PADDING = 60
 
 def extract_p(taupy_model, pickerlist, event, station_longitude, station_latitude,
               st, win_start=-50, win_end=50, resample_hz=20,
@@ -43,22 +48,29 @@ def extract_p(taupy_model, pickerlist, event, station_longitude, station_latitud
               bp_freqmaxs=[5., 10., 10.],
               margin=None,
               max_amplitude=1e8,
-              plot_output_folder=None):
+              plot_output_folder=None,
+              tat=None,
+              batch_picker=None):
     po = event.preferred_origin
     if (not po): return None
 
-    atimes = []
-    try:
-        atimes = taupy_model.get_travel_times_geo(po.depthkm, po.lat,
-                                                  po.lon, station_latitude,
-                                                  station_longitude,
-                                                  phase_list=('P',))
-    except:
+    if (tat is None):
+        atimes = []
+        try:
+            atimes = taupy_model.get_travel_times_geo(po.depthkm, po.lat,
+                                                      po.lon, station_latitude,
+                                                      station_longitude,
+                                                      phase_list=('P',))
+        except:
+            return None
+        # end try
+
+        if (len(atimes) == 0): return None
+        tat = atimes[0].time  # theoretical arrival time
+    elif (np.isnan(tat)):
+        # no arrival found in precomputed travel-time table
         return None
-    # end try
-
-    if (len(atimes) == 0): return None
-    tat = atimes[0].time  # theoretical arrival time
+    # end if
 
     buffer_start = -10
     buffer_end = 10
@@ -77,6 +89,12 @@ def extract_p(taupy_model, pickerlist, event, station_longitude, station_latitud
     if (type(snrtr.data) == np.ndarray):
         if (np.max(snrtr.data) > max_amplitude): return None
 
+        if (batch_picker is not None):
+            return pickBatched(batch_picker, event, 'p', snrtr, tat, win_start, win_end,
+                               float(buffer_end) / float(win_end), bp_freqmins, bp_freqmaxs, margin,
+                               np.logspace(0.15, 1.5, 30), plot_output_folder)
+        # end if
+
         pickslist = []
         snrlist = []
         residuallist = []
@@ -156,22 +174,29 @@ def extract_s(taupy_model, pickerlist, event, station_longitude, station_latitud
               bp_freqmaxs=[1, 2., 5.],
               margin=None,
               max_amplitude=1e8,
-              plot_output_folder=None):
+              plot_output_folder=None,
+              tat=None,
+              batch_picker=None):
     po = event.preferred_origin
     if (not po): return None
 
-    atimes = []
-    try:
-        atimes = taupy_model.get_travel_times_geo(po.depthkm, po.lat,
-                                                  po.lon, station_latitude,
-                                                  station_longitude,
-                                                  phase_list=('S',))
-    except:
+    if (tat is None):
+        atimes = []
+        try:
+            atimes = taupy_model.get_travel_times_geo(po.depthkm, po.lat,
+                                                      po.lon, station_latitude,
+                                                      station_longitude,
+                                                      phase_list=('S',))
+        except:
+            return None
+        # end try
+
+        if (len(atimes) == 0): return None
+        tat = atimes[0].time  # theoretical arrival time
+    elif (np.isnan(tat)):
+        # no arrival found in precomputed travel-time table
         return None
-    # end try
-
-    if (len(atimes) == 0): return None
-    tat = atimes[0].time  # theoretical arrival time
+    # end if
 
     buffer_start = -10
     buffer_end = 10
@@ -200,13 +225,19 @@ def extract_s(taupy_model, pickerlist, event, station_longitude, station_latitud
                 snrtr = stn[0]
             # end if
         # end if
-    except Exception as e:
+    except Exception:
         return None
     # end try
 
     if (type(snrtr.data) == np.ndarray):
         if (np.max(snrtr.data) > max_amplitude): return None
 
+        if (batch_picker is not None):
+            return pickBatched(batch_picker, event, 's', snrtr, tat, win_start, win_end,
+                               float(buffer_end) / float(win_end), bp_freqmins, bp_freqmaxs, margin,
+                               np.logspace(0.5, 4, 30), plot_output_folder)
+        # end if
+
         pickslist = []
         snrlist = []
         residuallist = []
@@ -280,9 +311,111 @@ def extract_s(taupy_model, pickerlist, event, station_longitude, station_latitud
 
 # end func
 
-def getWorkloadEstimate(fds, originTimestamps):
+def pickBatched(batch_picker, event, phase, snrtr, tat, win_start, win_end, taper_percentage,
+                bp_freqmins, bp_freqmaxs, margin, scales, plot_output_folder):
+    """
+    Equivalent of the band and picker loops of extract_p and extract_s, where all bands and nsigma values
+    are evaluated at once through a BatchAICDPicker. Picks are drawn from the first band and nsigma, in
+    order, that yield picks within the margin.
+
+    :param batch_picker: BatchAICDPicker instance
+    :param event: Event instance
+    :param phase: 'p' or 's'
+    :param snrtr: resampled and detrended trace spanning the buffered window
+    :param tat: theoretical travel-time (s)
+    :param win_start: start of picking window (s), relative to the theoretical arrival
+    :param win_end: end of picking window (s), relative to the theoretical arrival
+    :param taper_percentage: taper applied to snrtr before filtering
+    :param bp_freqmins: lower corner frequencies of bands
+    :param bp_freqmaxs: upper corner frequencies of bands
+    :param margin: maximum travel-time residual (s) of picks; None for no limit
+    :param scales: scales for compute_quality_measures
+    :param plot_output_folder: output folder for quality plots; None for no plots
+    :return: as extract_p and extract_s
+    """
+    po = event.preferred_origin
+
+    trc = snrtr.copy()
+    trc.taper(max_percentage=taper_percentage, type='hann')
+    window = trc.slice(po.utctime + tat + win_start, po.utctime + tat + win_end)
+    if (window.stats.npts == 0): return None
+
+    i0 = int(round((window.stats.starttime - trc.stats.starttime) * trc.stats.sampling_rate))
+    bands = filter_bands(trc.data, trc.stats.sampling_rate, bp_freqmins, bp_freqmaxs)
+    bands = bands[:, i0:i0 + window.stats.npts]
+
+    results = batch_picker.picks(bands, window.stats.starttime, window.stats.sampling_rate)
+    for i in range(len(bp_freqmins)):
+        for ipicker in range(len(batch_picker.nsigmas)):
+            picks, snr = results[i][ipicker]
+
+            pickslist = []
+            snrlist = []
+            residuallist = []
+            try:
+                bandtrc = Trace(data=bands[i], header=window.stats.copy())
+                for ipick, pick in enumerate(picks):
+                    residual = (pick - po.utctime) - tat
+
+                    if ((margin and np.fabs(residual) < margin) or (margin == None)):
+                        plotinfo = None
+                        if (plot_output_folder):
+                            plotinfo = {'eventid': event.public_id,
+                                        'origintime': po.utctime,
+                                        'mag': event.preferred_magnitude.magnitude_value,
+                                        'net': bandtrc.stats.network,
+                                        'sta': bandtrc.stats.station,
+                                        'phase': phase,
+                                        'ppsnr': snr[ipick],
+                                        'pickid': ipick,
+                                        'outputfolder': plot_output_folder}
+                        # end if
+
+                        wab = snrtr.slice(pick - 3, pick + 3)
+                        wab_filtered = bandtrc.slice(pick - 3, pick + 3)
+                        cwtsnr, dom_freq, slope_ratio = compute_quality_measures(wab, wab_filtered, scales,
+                                                                                 plotinfo)
+                        pickslist.append(pick)
+                        snrlist.append([snr[ipick], cwtsnr, dom_freq, slope_ratio])
+                        residuallist.append(residual)
+                    # end if
+                # end for
+            except:
+                continue
+            # end try
+
+            if (len(pickslist)):
+                return pickslist, residuallist, np.array(snrlist), i, ipicker
+            # end if
+        # end for
+    # end for
+
+    return None
+
+
+# end func
+
+def getEventIndices(originTimestamps, starttime, endtime):
+    """
+    :param originTimestamps: array of origin timestamps, sorted in ascending order
+    :param starttime: UTCDateTime
+    :param endtime: UTCDateTime
+    :return: indices of events originating between starttime and endtime (inclusive), found through
+             binary search
+    """
+    return np.arange(np.searchsorted(originTimestamps, starttime.timestamp, side='left'),
+                     np.searchsorted(originTimestamps, endtime.timestamp, side='right'))
+
+
+# end func
+
+def getWorkloadEstimate(fds, originTimestamps, fetch_mode='day'):
     totalTraceCount = 0
     for nc, sc, start_time, end_time in fds.local_net_sta_list():
+        if (fetch_mode == 'event'):
+            if (len(getEventIndices(originTimestamps, start_time, end_time))): totalTraceCount += 1
+            continue
+        # end if
 
         day = 24 * 3600
         curr = start_time
@@ -292,8 +425,7 @@ def getWorkloadEstimate(fds, originTimestamps):
                 step = end_time - curr
             # end if
 
-            eventIndices = (np.where((originTimestamps >= curr.timestamp) & \
-                                     (originTimestamps <= (curr + day).timestamp)))[0]
+            eventIndices = getEventIndices(originTimestamps, curr, curr + day)
 
             if (eventIndices.shape[0] > 0): totalTraceCount += 1
             curr += step
@@ -310,6 +442,188 @@ def dropBogusTraces(st, sampling_rate_cutoff=5):
     for tr in badTraces: st.remove(tr)
 
 
+# end func
+
+def getMagnitude(event):
+    mag = None
+    if (event.preferred_magnitude):
+        mag = event.preferred_magnitude.magnitude_value
+    elif (len(event.preferred_origin.magnitude_list)):
+        mag = event.preferred_origin.magnitude_list[0].magnitude_value
+    if (mag == None): mag = np.NaN
+
+    return mag
+
+
+# end func
+
+def splitComponents(stations):
+    """
+    Splits rows returned by FederatedASDFDataSet.get_stations into Z, N and E channels
+
+    :param stations: list of [net, sta, loc, cha, lon, lat] rows
+    :return: lists of rows for Z, N (or 1) and E (or 2) channels
+    """
+    stations_zch = [s for s in stations if 'Z' == s[3][-1].upper()]  # only Z channels
+    stations_nch = [s for s in stations if 'N' == s[3][-1].upper() or '1' == s[3][-1]]  # only N channels
+    stations_ech = [s for s in stations if 'E' == s[3][-1].upper() or '2' == s[3][-1]]  # only E channels
+
+    return stations_zch, stations_nch, stations_ech
+
+
+# end func
+
+def getBackAzimuth(event, slon, slat):
+    """
+    :param event: Event instance
+    :param slon: station longitude
+    :param slat: station latitude
+    :return: geodesic back-azimuth (degrees) of the event as seen from the station, as written out by writePicks
+    """
+    po = event.preferred_origin
+    return gps2dist_azimuth(po.lat, po.lon, slat, slon)[2]
+
+
+# end func
+
+def writePicks(of, event, mag, net, sta, cha, slon, slat, result, sigmalist):
+    """
+    Writes picks returned by extract_p or extract_s to an output file, along with geodesic distance,
+    azimuth and back-azimuth between event and station
+
+    :param of: output file
+    :param event: Event instance
+    :param mag: event magnitude
+    :param net: network code
+    :param sta: station code
+    :param cha: channel code
+    :param slon: station longitude
+    :param slat: station latitude
+    :param result: tuple returned by extract_p or extract_s
+    :param sigmalist: nsigma values of the pickers used
+    """
+    po = event.preferred_origin
+    picklist, residuallist, snrlist, bandindex, pickerindex = result
+
+    da = gps2dist_azimuth(po.lat, po.lon, slat, slon)
+    arcdistance = kilometers2degrees(da[0] / 1e3)
+    for ip, pick in enumerate(picklist):
+        line = '%s %f %f %f %f %f ' \
+               '%s %s %s %f %f %f ' \
+               '%f %f %f ' \
+               '%f %f %f %f %f ' \
+               '%d %d\n' % (
+               event.public_id, po.utctime.timestamp, mag, po.lon, po.lat, po.depthkm,
+               net, sta, cha, pick.timestamp, slon, slat,
+               da[1], da[2], arcdistance,
+               residuallist[ip], snrlist[ip, 0], snrlist[ip, 1], snrlist[ip, 2], snrlist[ip, 3],
+               bandindex, sigmalist[pickerindex])
+        of.write(line)
+    # end for
+    of.flush()
+
+
+# end func
+
+def getChannelGroups(stations):
+    """
+    Groups the channels of a station for the event-driven fetch mode
+
+    :param stations: list of [net, sta, loc, cha, lon, lat] rows, as returned by FederatedASDFDataSet.get_stations
+    :return: list of (rows, phases) tuples: each Z channel, along with phases ['P'], or ['P', 'S'] in the absence
+             of horizontal channels, followed by each pair of N and E channels, along with phases ['S']
+    """
+    stations_zch, stations_nch, stations_ech = splitComponents(stations)
+
+    groups = []
+    for codes in stations_zch:
+        phases = ['P', 'S'] if (len(stations_nch) == 0 and len(stations_ech) == 0) else ['P']
+        groups.append(([codes], phases))
+    # end for
+    if (len(stations_nch) > 0 and len(stations_nch) == len(stations_ech)):
+        for codesn, codese in zip(stations_nch, stations_ech):
+            groups.append(([codesn, codese], ['S']))
+        # end for
+    # end if
+
+    return groups
+
+
+# end func
+
+def getEventWindows(originTimestamps, eventIndices, travelTimes):
+    """
+    :param originTimestamps: array of origin timestamps
+    :param eventIndices: indices of events
+    :param travelTimes: dictionary, keyed by phase, of theoretical travel-times for eventIndices; events
+                        without an arrival have a travel-time of NaN and are skipped
+    :return: list of (theoretical arrival timestamp, phase, position in eventIndices, travel-time) tuples,
+             in time order
+    """
+    windows = []
+    for phase, tt in travelTimes.items():
+        for k in np.where(np.isfinite(tt))[0]:
+            windows.append((originTimestamps[eventIndices[k]] + tt[k], phase, k, tt[k]))
+        # end for
+    # end for
+    windows.sort()
+
+    return windows
+
+
+# end func
+
+def getWindowBatches(chanCodes, windows, batch_size, padding=EVENT_WINDOW_PADDING):
+    """
+    :param chanCodes: list of [net, sta, loc, cha, lon, lat] rows of a channel group
+    :param windows: list of windows, as returned by getEventWindows
+    :param batch_size: number of windows in each batch
+    :param padding: half-length (s) of data windows read around theoretical arrivals
+    :return: list of (windows, requests) tuples for consecutive batches of windows, where requests lists
+             FederatedASDFDataSet.get_waveforms_bulk requests for each window and, in turn, each channel
+    """
+    batches = []
+    for ib in range(0, len(windows), batch_size):
+        batch = windows[ib:ib + batch_size]
+        requests = [(codes[0], codes[1], codes[2], codes[3],
+                     UTCDateTime(ts - padding), UTCDateTime(ts + padding))
+                    for ts, _, _, _ in batch for codes in chanCodes]
+        batches.append((batch, requests))
+    # end for
+
+    return batches
+
+
+# end func
+
+def fetchWindowStreams(fds, chanCodes, requests):
+    """
+    :param fds: FederatedASDFDataSet instance
+    :param chanCodes: list of [net, sta, loc, cha, lon, lat] rows of a channel group
+    :param requests: requests for a batch of windows, as returned by getWindowBatches
+    :return: list of merged streams, one for each channel, for each window in the batch; None for
+             windows that could not be merged or lack data for any of the channels
+    """
+    streams = fds.get_waveforms_bulk(requests, trace_count_threshold=200)
+
+    result = []
+    for iw in range(0, len(streams), len(chanCodes)):
+        sts = streams[iw:iw + len(chanCodes)]
+        try:
+            for st in sts: st.merge(method=-1)
+        except Exception as e:
+            print(e)
+            result.append(None)
+            continue
+        # end try
+
+        for st in sts: dropBogusTraces(st)
+        result.append(None if np.any([len(st) == 0 for st in sts]) else sts)
+    # end for
+
+    return result
+
+
 # end func
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
@@ -328,7 +642,31 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
                                                    'with spurious spikes')
 @click.option('--restart', default=False, is_flag=True, help='Restart job')
 @click.option('--save-quality-plots', default=False, is_flag=True, help='Save plots of quality estimates')
-def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude, restart, save_quality_plots):
+@click.option('--direct-travel-times', default=False, is_flag=True,
+              help='Compute theoretical travel-times through TauP ray-tracing for each event-station pair, rather '
+                   'than interpolating them from a precomputed table')
+@click.option('--travel-time-table', default=None, type=click.Path(dir_okay=False),
+              help='File where the precomputed travel-time table is cached; defaults to '
+                   'OUTPUT_PATH/travel_times.iasp91.npz. The table is built in parallel and cached on first use')
+@click.option('--tt-depth-step', default=10., type=float, show_default=True,
+              help='Source-depth spacing (km) of the travel-time table; interpolation errors decrease with spacing')
+@click.option('--tt-distance-step', default=0.5, type=float, show_default=True,
+              help='Epicentral-distance spacing (degrees) of the travel-time table')
+@click.option('--fetch-mode', default='day', type=click.Choice(['day', 'event']), show_default=True,
+              help="'day': data for each channel are read a day at a time and scanned for arrivals of events "
+                   "originating that day; 'event': only data windows around theoretical arrivals are read, in "
+                   "time order, with adjacent windows merged into single reads. The event-driven mode reads "
+                   "considerably less data for stations with sparse events, especially from uncompressed ASDF "
+                   "files. Note that progress files are not interchangeable between modes in restart mode")
+@click.option('--event-batch-size', default=200, type=int, show_default=True,
+              help='Number of arrival windows read together in the event-driven fetch mode; bounds memory usage')
+@click.option('--picker', default='phasepapy', type=click.Choice(['phasepapy', 'batched']), show_default=True,
+              help="'phasepapy': bands and trigger thresholds are tried one after another through PhasePApy's "
+                   "AICDPicker; 'batched': all bands and thresholds are evaluated at once through a vectorised "
+                   "implementation of the same algorithm, which is considerably faster")
+def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude, restart, save_quality_plots,
+            direct_travel_times, travel_time_table, tt_depth_step, tt_distance_step, fetch_mode,
+            event_batch_size, picker):
     """
     ASDF_SOURCE: Text file containing a list of paths to ASDF files
     EVENT_FOLDER: Path to folder containing event files\n
@@ -336,9 +674,7 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
     """
 
     comm = MPI.COMM_WORLD
-    nproc = comm.Get_size()
     rank = comm.Get_rank()
-    proc_workload = None
 
     if (rank == 0):
         def outputConfigParameters():
@@ -355,6 +691,16 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
             f.write('%25s\t\t: %s\n' % ('MAX_AMPLITUDE', max_amplitude))
             f.write('%25s\t\t: %s\n' % ('RESTART_MODE', 'TRUE' if restart else 'FALSE'))
             f.write('%25s\t\t: %s\n' % ('SAVE_PLOTS', 'TRUE' if save_quality_plots else 'FALSE'))
+            f.write('%25s\t\t: %s\n' % ('DIRECT_TRAVEL_TIMES', 'TRUE' if direct_travel_times else 'FALSE'))
+            if (not direct_travel_times):
+                f.write('%25s\t\t: %s\n' % ('TT_DEPTH_STEP', tt_depth_step))
+                f.write('%25s\t\t: %s\n' % ('TT_DISTANCE_STEP', tt_distance_step))
+            # end if
+            f.write('%25s\t\t: %s\n' % ('PICKER', picker))
+            f.write('%25s\t\t: %s\n' % ('FETCH_MODE', fetch_mode))
+            if (fetch_mode == 'event'):
+                f.write('%25s\t\t: %s\n' % ('EVENT_BATCH_SIZE', event_batch_size))
+            # end if
             f.close()
 
         # end func
@@ -382,6 +728,12 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
     events = cat.get_events()
     originTimestamps = cat.get_preferred_origin_timestamps()
 
+    # sort catalogue by origin time once, so that events originating within a
+    # given time-range are found through binary search
+    order = np.argsort(originTimestamps, kind='stable')
+    events = [events[i] for i in order]
+    originTimestamps = originTimestamps[order]
+
     # ==================================================
     # Create lists of pickers for both p- and s-arrivals
     # ==================================================
@@ -398,14 +750,75 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
         pickerlist_s.append(picker_s)
     # end for
 
+    batch_picker_p = None
+    batch_picker_s = None
+    if (picker == 'batched'):
+        batch_picker_p = BatchAICDPicker(t_ma=5, nsigmas=sigmalist, t_up=1, nr_len=5, nr_coeff=2)
+        batch_picker_s = BatchAICDPicker(t_ma=15, nsigmas=sigmalist, t_up=1, nr_len=5, nr_coeff=2)
+    # end if
+
     # ==================================================
     # Define theoretical model
     # Instantiate data-access object
     # Retrieve estimated workload
     # ==================================================
     taupyModel = TauPyModel(model='iasp91')
-    fds = FederatedASDFDataSet(asdf_source, logger=None)
-    workload = getWorkloadEstimate(fds, originTimestamps)
+
+    # ==================================================
+    # Theoretical travel-times are interpolated from a
+    # table, precomputed in parallel and cached to disk
+    # ==================================================
+    ttTable = None
+    if (not direct_travel_times):
+        if (travel_time_table is None):
+            travel_time_table = os.path.join(output_path, 'travel_times.iasp91.npz')
+        # end if
+        ttTable = get_travel_time_table(travel_time_table, model_name='iasp91', phases=('P', 'S'),
+                                        depth_step_km=tt_depth_step, distance_step_deg=tt_distance_step,
+                                        comm=comm)
+        if (rank == 0):
+            print('Travel-times interpolated from %s; maximum interpolation errors (s): %s' %
+                  (travel_time_table, str(ttTable.max_errors)))
+        # end if
+    # end if
+    originLats = np.array([e.preferred_origin.lat for e in events])
+    originLons = np.array([e.preferred_origin.lon for e in events])
+    originDepths = np.array([e.preferred_origin.depthkm for e in events])
+    magnitudes = np.array([getMagnitude(e) for e in events])
+
+    def eventDistances(eventIndices, slon, slat):
+        # epicentral distances of all events, on a sphere, for predicting travel-times; horizontal
+        # components are rotated through geodesic back-azimuths (getBackAzimuth)
+        return distance_deg(originLats[eventIndices], originLons[eventIndices], slat, slon)
+    # end func
+
+    def predictTravelTimes(phase, eventIndices, dist):
+        if (ttTable is not None):
+            return ttTable.travel_times(phase, originDepths[eventIndices], dist)
+        # end if
+
+        tt = np.full(len(eventIndices), np.nan)
+        for k, ei in enumerate(eventIndices):
+            try:
+                atimes = taupyModel.get_travel_times(source_depth_in_km=originDepths[ei],
+                                                     distance_in_degree=dist[k], phase_list=(phase,))
+                if (len(atimes)): tt[k] = atimes[0].time
+            except:
+                pass
+            # end try
+        # end for
+
+        return tt
+    # end func
+
+    if (fetch_mode == 'event'):
+        # only short windows are read, which are not worth caching or prefetching
+        fds = FederatedASDFDataSet(asdf_source, logger=None)
+    else:
+        # stations are scanned day by day
+        fds = FederatedASDFDataSet(asdf_source, logger=None, cache_size_in_mb=256, prefetch=True)
+    # end if
+    workload = getWorkloadEstimate(fds, originTimestamps, fetch_mode)
 
     # ==================================================
     # Define output header and open output files
@@ -427,6 +840,83 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
     # end if
 
     progTracker = ProgressTracker(output_folder=output_path, restart_mode=restart)
+
+    def harvestEventWindows(nc, sc, start_time, end_time):
+        """
+        Harvests picks for a station by reading data windows around theoretical arrivals only, rather than
+        entire days. Windows are sorted by time and read in batches through get_waveforms_bulk, which merges
+        overlapping and adjacent windows into single reads.
+
+        :return: traceCountP, pickCountP, traceCountS, pickCountS
+        """
+        traceCountP = pickCountP = traceCountS = pickCountS = 0
+
+        eventIndices = getEventIndices(originTimestamps, start_time, end_time)
+        eventIndices = eventIndices[magnitudes[eventIndices] >= min_magnitude]
+        if (eventIndices.shape[0] == 0): return traceCountP, pickCountP, traceCountS, pickCountS
+
+        stations = fds.get_stations(start_time, end_time, network=nc, station=sc)
+
+        for chanCodes, phases in getChannelGroups(stations):
+            slon, slat = chanCodes[0][4], chanCodes[0][5]
+            dist = eventDistances(eventIndices, slon, slat)
+
+            windows = getEventWindows(originTimestamps, eventIndices,
+                                      {phase: predictTravelTimes(phase, eventIndices, dist) for phase in phases})
+
+            for batch, requests in getWindowBatches(chanCodes, windows, event_batch_size):
+                if (progTracker.increment()):
+                    pass
+                else:
+                    continue
+
+                for (ts, phase, k, tat), sts in zip(batch, fetchWindowStreams(fds, chanCodes, requests)):
+                    if (sts is None): continue
+
+                    ei = eventIndices[k]
+                    event = events[ei]
+
+                    if (phase == 'P'):
+                        result = extract_p(taupyModel, pickerlist_p, event, slon, slat, sts[0],
+                                           max_amplitude=max_amplitude,
+                                           plot_output_folder=plot_output_folder, tat=tat,
+                                           batch_picker=batch_picker_p)
+                        if (result):
+                            writePicks(ofp, event, magnitudes[ei], chanCodes[0][0], chanCodes[0][1],
+                                       chanCodes[0][3], slon, slat, result, sigmalist)
+                            pickCountP += 1
+                        # end if
+                        traceCountP += len(sts[0])
+                    elif (len(chanCodes) == 1):
+                        result = extract_s(taupyModel, pickerlist_s, event, slon, slat, sts[0], None,
+                                           getBackAzimuth(event, slon, slat), max_amplitude=max_amplitude,
+                                           plot_output_folder=plot_output_folder, tat=tat,
+                                           batch_picker=batch_picker_s)
+                        if (result):
+                            writePicks(ofs, event, magnitudes[ei], chanCodes[0][0], chanCodes[0][1],
+                                       chanCodes[0][3], slon, slat, result, sigmalist)
+                            pickCountS += 1
+                        # end if
+                        traceCountS += len(sts[0])
+                    else:
+                        result = extract_s(taupyModel, pickerlist_s, event, slon, slat, sts[0], sts[1],
+                                           getBackAzimuth(event, slon, slat),
+                                           plot_output_folder=plot_output_folder, tat=tat,
+                                           batch_picker=batch_picker_s)
+                        if (result):
+                            writePicks(ofs, event, magnitudes[ei], chanCodes[0][0], chanCodes[0][1],
+                                       '00T', slon, slat, result, sigmalist)
+                            pickCountS += 1
+                        # end if
+                        traceCountS += (len(sts[0]) + len(sts[1]))
+                    # end if
+                # end for
+            # end for
+        # end for
+
+        return traceCountP, pickCountP, traceCountS, pickCountS
+    # end func
+
     totalTraceCount = 0
     for nc, sc, start_time, end_time in fds.local_net_sta_list():
         day = 24 * 3600
@@ -438,20 +928,24 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
         pickCountS = 0
         sw_start = datetime.now()
         step = day
-        while (curr < end_time):
+
+        if (fetch_mode == 'event'):
+            if (len(getEventIndices(originTimestamps, start_time, end_time))): totalTraceCount += 1
+            traceCountP, pickCountP, traceCountS, pickCountS = harvestEventWindows(nc, sc, start_time, end_time)
+        # end if
+
+        while (fetch_mode == 'day' and curr < end_time):
             if (curr + step > end_time):
                 step = end_time - curr
             # end if
 
-            eventIndices = (np.where((originTimestamps >= curr.timestamp) & \
-                                     (originTimestamps <= (curr + day).timestamp)))[0]
+            eventIndices = getEventIndices(originTimestamps, curr, curr + day)
 
             if (eventIndices.shape[0] > 0):
                 totalTraceCount += 1
+                eventIndices = eventIndices[magnitudes[eventIndices] >= min_magnitude]
                 stations = fds.get_stations(curr, curr + day, network=nc, station=sc)
-                stations_zch = [s for s in stations if 'Z' == s[3][-1].upper()]  # only Z channels
-                stations_nch = [s for s in stations if 'N' == s[3][-1].upper() or '1' == s[3][-1]]  # only N channels
-                stations_ech = [s for s in stations if 'E' == s[3][-1].upper() or '2' == s[3][-1]]  # only E channels
+                stations_zch, stations_nch, stations_ech = splitComponents(stations)
 
                 for codes in stations_zch:
                     if (progTracker.increment()):
@@ -474,73 +968,39 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
                     if (len(st) == 0): continue
                     dropBogusTraces(st)
 
+                    pickZS = (len(stations_nch) == 0 and len(stations_ech) == 0)
                     slon, slat = codes[4], codes[5]
-                    for ei in eventIndices:
+                    dist = eventDistances(eventIndices, slon, slat)
+                    ttp = predictTravelTimes('P', eventIndices, dist)
+                    tts = predictTravelTimes('S', eventIndices, dist) if pickZS else None
+                    for k, ei in enumerate(eventIndices):
                         event = events[ei]
-                        po = event.preferred_origin
-                        da = gps2dist_azimuth(po.lat, po.lon, slat, slon)
-                        mag = None
-                        if (event.preferred_magnitude):
-                            mag = event.preferred_magnitude.magnitude_value
-                        elif (len(po.magnitude_list)):
-                            mag = po.magnitude_list[0].magnitude_value
-                        if (mag == None): mag = np.NaN
-
-                        if (np.isnan(mag) or mag < min_magnitude): continue
 
                         result = extract_p(taupyModel, pickerlist_p, event, slon, slat, st,
                                            max_amplitude=max_amplitude,
-                                           plot_output_folder=plot_output_folder)
+                                           plot_output_folder=plot_output_folder, tat=ttp[k],
+                                           batch_picker=batch_picker_p)
                         if (result):
-                            picklist, residuallist, snrlist, bandindex, pickerindex = result
-
-                            arcdistance = kilometers2degrees(da[0] / 1e3)
-                            for ip, pick in enumerate(picklist):
-                                line = '%s %f %f %f %f %f ' \
-                                       '%s %s %s %f %f %f ' \
-                                       '%f %f %f ' \
-                                       '%f %f %f %f %f ' \
-                                       '%d %d\n' % (
-                                       event.public_id, po.utctime.timestamp, mag, po.lon, po.lat, po.depthkm,
-                                       codes[0], codes[1], codes[3], pick.timestamp, slon, slat,
-                                       da[1], da[2], arcdistance,
-                                       residuallist[ip], snrlist[ip, 0], snrlist[ip, 1], snrlist[ip, 2], snrlist[ip, 3],
-                                       bandindex, sigmalist[pickerindex])
-                                ofp.write(line)
-                            # end for
-                            ofp.flush()
+                            writePicks(ofp, event, magnitudes[ei], codes[0], codes[1], codes[3], slon, slat,
+                                       result, sigmalist)
                             pickCountP += 1
                         # end if
 
-                        if (len(stations_nch) == 0 and len(stations_ech) == 0):
-                            result = extract_s(taupyModel, pickerlist_s, event, slon, slat, st, None, da[2],
-                                               max_amplitude=max_amplitude,
-                                               plot_output_folder=plot_output_folder)
+                        if (pickZS):
+                            result = extract_s(taupyModel, pickerlist_s, event, slon, slat, st, None,
+                                               getBackAzimuth(event, slon, slat), max_amplitude=max_amplitude,
+                                               plot_output_folder=plot_output_folder, tat=tts[k],
+                                               batch_picker=batch_picker_s)
                             if (result):
-                                picklist, residuallist, snrlist, bandindex, pickerindex = result
-
-                                arcdistance = kilometers2degrees(da[0] / 1e3)
-                                for ip, pick in enumerate(picklist):
-                                    line = '%s %f %f %f %f %f ' \
-                                           '%s %s %s %f %f %f ' \
-                                           '%f %f %f ' \
-                                           '%f %f %f %f %f ' \
-                                           '%d %d\n' % (
-                                           event.public_id, po.utctime.timestamp, mag, po.lon, po.lat, po.depthkm,
-                                           codes[0], codes[1], codes[3], pick.timestamp, slon, slat,
-                                           da[1], da[2], arcdistance,
-                                           residuallist[ip], snrlist[ip, 0], snrlist[ip, 1], snrlist[ip, 2],
-                                           snrlist[ip, 3],
-                                           bandindex, sigmalist[pickerindex])
-                                    ofs.write(line)
-                                # end for
-                                ofs.flush()
+                                writePicks(ofs, event, magnitudes[ei], codes[0], codes[1], codes[3], slon, slat,
+                                           result, sigmalist)
                                 pickCountS += 1
                             # end if
                         # end if
                     # end for
 
                     traceCountP += len(st)
+                    if (pickZS): traceCountS += len(st)
                 # end for
 
                 if (len(stations_nch) > 0 and len(stations_nch) == len(stations_ech)):
@@ -574,42 +1034,19 @@ def process(asdf_source, event_folder, output_path, min_magnitude, max_amplitude
                         if (len(ste) == 0): continue
 
                         slon, slat = codesn[4], codesn[5]
+                        dist = eventDistances(eventIndices, slon, slat)
+                        tts = predictTravelTimes('S', eventIndices, dist)
 
-                        for ei in eventIndices:
+                        for k, ei in enumerate(eventIndices):
                             event = events[ei]
-                            po = event.preferred_origin
-                            da = gps2dist_azimuth(po.lat, po.lon, slat, slon)
-
-                            mag = None
-                            if (event.preferred_magnitude):
-                                mag = event.preferred_magnitude.magnitude_value
-                            elif (len(po.magnitude_list)):
-                                mag = po.magnitude_list[0].magnitude_value
-                            if (mag == None): mag = np.NaN
-
-                            if (np.isnan(mag) or mag < min_magnitude): continue
 
-                            result = extract_s(taupyModel, pickerlist_s, event, slon, slat, stn, ste, da[2],
-                                               plot_output_folder=plot_output_folder)
+                            result = extract_s(taupyModel, pickerlist_s, event, slon, slat, stn, ste,
+                                               getBackAzimuth(event, slon, slat),
+                                               plot_output_folder=plot_output_folder, tat=tts[k],
+                                               batch_picker=batch_picker_s)
                             if (result):
-                                picklist, residuallist, snrlist, bandindex, pickerindex = result
-
-                                arcdistance = kilometers2degrees(da[0] / 1e3)
-                                for ip, pick in enumerate(picklist):
-                                    line = '%s %f %f %f %f %f ' \
-                                           '%s %s %s %f %f %f ' \
-                                           '%f %f %f ' \
-                                           '%f %f %f %f %f ' \
-                                           '%d %d\n' % (
-                                           event.public_id, po.utctime.timestamp, mag, po.lon, po.lat, po.depthkm,
-                                           codesn[0], codesn[1], '00T', pick.timestamp, slon, slat,
-                                           da[1], da[2], arcdistance,
-                                           residuallist[ip], snrlist[ip, 0], snrlist[ip, 1], snrlist[ip, 2],
-                                           snrlist[ip, 3],
-                                           bandindex, sigmalist[pickerindex])
-                                    ofs.write(line)
-                                # end for
-                                ofs.flush()
+                                writePicks(ofs, event, magnitudes[ei], codesn[0], codesn[1], '00T', slon, slat,
+                                           result, sigmalist)
                                 pickCountS += 1
                             # end if
                         # end for
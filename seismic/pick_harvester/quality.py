@@ -10,10 +10,14 @@ Developer:      rakib.hassan@ga.gov.au
 
 Revision History:
     LastUpdate:     24/01/19   RH
+    LastUpdate:     18/10/26   Batched computation of quality measures
     LastUpdate:     dd/mm/yyyy  Who     Optional description
 """
 
 import os
+import inspect
+from collections import defaultdict
+from functools import lru_cache
 
 import pywt
 from scipy.optimize import curve_fit
@@ -24,7 +28,146 @@ import numpy as np
 import heapq
 
 
-def compute_quality_measures(trc, trc_filtered, scales, plotinfo=None):
+def _cwt_precision():
+    """
+    :return: tuple of the precision of the wavelet approximation used by the installed pywt.cwt, and a dict
+             of keyword arguments passing that precision to pywt.cwt explicitly. Recent releases of pywt take
+             a precision argument, whereas older releases hardcode a precision of 10.
+    """
+    try:
+        parameter = inspect.signature(pywt.cwt).parameters['precision']
+        if (isinstance(parameter.default, int)):
+            return parameter.default, {'precision': parameter.default}
+        # end if
+    except (KeyError, ValueError, TypeError):
+        pass
+    # end try
+    return 10, {}
+# end func
+
+# _cwt_operator replicates the internals of pywt.cwt, and the batched quality measures only match those
+# computed through pywt.cwt (exact=True) if both use the same wavelet approximation
+CWT_PRECISION, _CWT_KWARGS = _cwt_precision()
+
+
+@lru_cache(maxsize=64)
+def _cwt_operator(wavelet, scales, npts, delta):
+    """
+    Builds a matrix that maps waveforms of npts samples to their continuous wavelet transforms, as computed
+    by pywt.cwt: for each scale, the waveform is convolved with the integrated wavelet, resampled to the
+    scale, and the central npts samples of the differentiated result are retained. Only the central
+    2 * npts + 1 taps of each resampled wavelet contribute to these, which keeps the matrix small for the
+    short windows around picks, regardless of scale.
+
+    :param wavelet: continuous wavelet name
+    :param scales: tuple of scales
+    :param npts: number of samples in waveforms
+    :param delta: sampling interval (s)
+    :return: matrix of shape (npts, len(scales) * npts) and corresponding frequencies (Hz) of scales
+    """
+    int_psi, x = pywt.integrate_wavelet(wavelet, precision=CWT_PRECISION)
+    int_psi = np.asarray(int_psi, dtype=np.float64)
+    step = x[1] - x[0]
+
+    m = np.arange(npts)[:, None]
+    t = np.arange(npts)[None, :]
+    operator = np.zeros((npts, len(scales), npts))
+    for i, scale in enumerate(scales):
+        j = (np.arange(scale * (x[-1] - x[0]) + 1) / (scale * step)).astype(int)
+        if (j[-1] >= int_psi.size): j = np.extract(j < int_psi.size, j)
+        kernel = int_psi[j][::-1]
+
+        # coef[t] = -sqrt(scale) * (conv[a + t + 1] - conv[a + t]), where conv[q] = sum_m data[m] * kernel[q - m]
+        a = int(np.floor((kernel.size - 2) / 2.))
+        idx = a + t - m
+        padded = np.concatenate([kernel, [0.]])  # out-of-range taps index the trailing 0
+
+        def taps(k):
+            return padded[np.where((k >= 0) & (k < kernel.size), k, kernel.size)]
+        # end func
+
+        operator[:, i, :] = -np.sqrt(scale) * (taps(idx + 1) - taps(idx))
+    # end for
+
+    freqs = np.atleast_1d(pywt.scale2frequency(wavelet, np.array(scales), CWT_PRECISION)) / delta
+    return operator.reshape(npts, -1), freqs
+# end func
+
+
+def compute_quality_measures_batch(traces, scales, wavelet='gaus8'):
+    """
+    Computes the wavelet- and slope-based quality measures of compute_quality_measures for many picks at
+    once. Continuous wavelet transforms of all waveforms of equal length and sampling rate are computed
+    through a single matrix product, and slopes are fitted through closed-form least-squares.
+
+    :param traces: list of raw obspy traces centred on pick-times
+    :param scales: scales for computing continuous wavelet transforms
+    :param wavelet: continuous wavelet name
+    :return: array of shape (len(traces), 3), containing cwtsnr, dom_freq and slope_ratio for each trace, \
+             as returned by compute_quality_measures; -1 where a measure cannot be computed
+    """
+    scales = tuple(np.atleast_1d(np.asarray(scales, dtype=np.float64)))
+    result = -np.ones((len(traces), 3))
+
+    groups = defaultdict(list)
+    for i, tr in enumerate(traces):
+        if (tr.stats.npts >= 2): groups[(tr.stats.npts, tr.stats.delta)].append(i)
+    # end for
+
+    for (npts, delta), indices in groups.items():
+        data = np.array([traces[i].data for i in indices], dtype=np.float64)
+        half = npts // 2
+
+        # =======================================
+        # Wavelets-based quality estimate
+        # =======================================
+        operator, freqs = _cwt_operator(wavelet, scales, npts, delta)
+        ps = np.dot(data, operator).reshape(len(indices), len(scales), npts) ** 2
+
+        # soft-thresholding, as pywt.threshold(ps, np.std(ps), mode='soft', substitute=1) for each trace
+        threshold = np.std(ps.reshape(len(indices), -1), axis=-1)[:, None, None]
+        ps = np.where(ps < threshold, 1., ps - threshold)
+
+        before = np.amax(ps[:, :, :half], axis=1)
+        after = np.amax(ps[:, :, half:], axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            above = after > np.std(after, axis=-1, keepdims=True)
+            result[indices, 0] = np.sum(after * above, axis=-1) / np.sum(above, axis=-1) / \
+                                 np.mean(before, axis=-1)
+        # end with
+
+        # scales of peak power over the top decile of arrival power; ties are resolved as in heapq.nlargest
+        argAfter = np.argmax(ps[:, :, half:], axis=1)
+        topDecile = np.argsort(-after, axis=-1, kind='stable')[:, :after.shape[1] // 10]
+        if (topDecile.shape[1]):
+            result[indices, 1] = np.mean(freqs[np.take_along_axis(argAfter, topDecile, axis=-1)], axis=-1)
+        else:
+            result[indices, 1] = np.nan
+        # end if
+
+        # =======================================
+        # Slope-based quality estimate
+        # =======================================
+        if (half < 2): continue  # too few samples for line fits
+
+        times = np.arange(npts) * delta
+        ab = np.cumsum(np.fabs(data), axis=-1)
+
+        def slopes(t, y):
+            t = t - np.mean(t)
+            return np.dot(y - np.mean(y, axis=-1, keepdims=True), t) / np.dot(t, t)
+        # end func
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            result[indices, 2] = slopes(times[half:], ab[:, half:]) / slopes(times[:half], ab[:, :half])
+        # end with
+    # end for
+
+    return result
+# end func
+
+
+def compute_quality_measures(trc, trc_filtered, scales, plotinfo=None, exact=False):
     """
     Computes quality measures for a given pick based on:
 
@@ -37,11 +180,19 @@ def compute_quality_measures(trc, trc_filtered, scales, plotinfo=None):
     :param plotinfo: dictionary containing required plotting information \
                      (eventid, origintime, mag, net, sta, phase, ppsnr, \
                       pickid, outputfolder)
+    :param exact: compute measures through pywt.cwt and curve_fit, rather than through \
+                  compute_quality_measures_batch, which is considerably faster and agrees to within \
+                  round-off; measures are always computed exactly when plotinfo is provided
     :return: 1. cwtsnr: quality measure based on wavelet analysis
              2. dom_freq: dominant frequency of arrival energy
              3. slope_ratio: quality measure based on waveform \
                              complexity analysis
     """
+    if (not exact and not plotinfo):
+        cwtsnr, dom_freq, slope_ratio = compute_quality_measures_batch([trc], scales)[0]
+        return cwtsnr, dom_freq, slope_ratio
+    # end if
+
     # function for a least-squares line fit
     def function(x, A, B):
         return A * x + B
@@ -54,12 +205,12 @@ def compute_quality_measures(trc, trc_filtered, scales, plotinfo=None):
         # =======================================
         # Compute wavelets-based quality estimate
         # =======================================
-        cwt, freqs = pywt.cwt(trc, scales, 'gaus8', trc.stats.delta)
+        cwt, freqs = pywt.cwt(trc, scales, 'gaus8', trc.stats.delta, **_CWT_KWARGS)
         ps = np.fabs(cwt) ** 2
         ps = pywt.threshold(ps, np.std(ps), mode='soft', substitute=1)
 
-        psbefore   = ps[:, :ps.shape[1] / 2]
-        psafter    = ps[:, ps.shape[1] / 2:]
+        psbefore   = ps[:, :ps.shape[1] // 2]
+        psafter    = ps[:, ps.shape[1] // 2:]
 
         #idx_max_before = unravel_index(psbefore.argmax(), psbefore.shape)
         #idx_max_after  = unravel_index(psafter.argmax(), psafter.shape)
@@ -79,7 +230,7 @@ def compute_quality_measures(trc, trc_filtered, scales, plotinfo=None):
         times = trc.times() - trc.times().max() / 2
         times_filtered = trc_filtered.times() - trc_filtered.times().max() / 2
 
-        mid = len(trc.times()) / 2
+        mid = len(trc.times()) // 2
         timesa = times[mid:]
         timesb = times[:mid]
         ab = np.cumsum(np.fabs(trc.data))
@@ -0,0 +1,281 @@
+"""
+Description:
+    Precomputed first-arrival travel-time tables for the pick harvester. Travel-times of each phase are
+    evaluated through TauP over a regular (source depth, epicentral distance) grid, in parallel across
+    MPI ranks, and cached to disk; theoretical arrival times for (event, station) pairs are then
+    obtained through vectorised bilinear interpolation, rather than by ray-tracing each pair.
+
+    Interpolation errors are governed by the grid spacing, which is configurable. validate_travel_time_table
+    evaluates the maximum error against direct TauP evaluations at random locations within the grid; this
+    maximum is saved alongside the table and reported by the pick harvester. Travel-times are reported as
+    NaN outside the grid and wherever an arrival is absent from any of the surrounding grid nodes, e.g.
+    near the P shadow-zone boundary.
+
+References:
+
+CreationDate:   18/10/26
+
+Revision History:
+    LastUpdate:     18/10/26
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import os
+
+import numpy as np
+from obspy.taup import TauPyModel
+
+from seismic.pick_harvester.utils import split_list
+
+
+def distance_deg(lat1, lon1, lat2, lon2):
+    """
+    Vectorised great-circle (haversine) distance on a sphere, as used by TauPyModel.get_travel_times_geo
+
+    :param lat1: latitude(s) of first point(s) in degrees
+    :param lon1: longitude(s) of first point(s) in degrees
+    :param lat2: latitude(s) of second point(s) in degrees
+    :param lon2: longitude(s) of second point(s) in degrees
+    :return: epicentral distance(s) in degrees; inputs are broadcast against each other
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(v, dtype=np.float64)) for v in [lat1, lon1, lat2, lon2]]
+
+    a = np.sin((lat2 - lat1) / 2.) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.) ** 2
+    return np.degrees(2. * np.arcsin(np.sqrt(np.clip(a, 0., 1.))))
+# end func
+
+
+def first_arrivals(taupy_model, depth_km, dist_deg, phases):
+    """
+    :param taupy_model: TauPyModel instance
+    :param depth_km: source depth (km)
+    :param dist_deg: epicentral distance (degrees)
+    :param phases: list of phase names
+    :return: list of first-arrival travel-times (s) for each phase; NaN where no arrival is found
+    """
+    result = [np.nan] * len(phases)
+    try:
+        arrivals = taupy_model.get_travel_times(source_depth_in_km=depth_km, distance_in_degree=dist_deg,
+                                                phase_list=phases)
+    except Exception:
+        return result
+    # end try
+
+    # arrivals are sorted by time
+    for arrival in arrivals:
+        if arrival.name in phases:
+            i = phases.index(arrival.name)
+            if np.isnan(result[i]): result[i] = arrival.time
+        # end if
+    # end for
+
+    return result
+# end func
+
+
+class TravelTimeTable:
+    def __init__(self, model_name, depths, distances, times, max_errors=None):
+        """
+        Table of first-arrival travel-times over a regular (source depth, epicentral distance) grid. See
+        build_travel_time_table for generating tables.
+
+        :param model_name: name of the velocity model travel-times were computed for
+        :param depths: 1D array of uniformly spaced source depths (km)
+        :param distances: 1D array of uniformly spaced epicentral distances (degrees)
+        :param times: dictionary, keyed by phase name, of 2D arrays of travel-times (s) of shape
+                      (len(depths), len(distances)); NaN where no arrival is found
+        :param max_errors: dictionary, keyed by phase name, of maximum interpolation errors (s) found
+                           through validate_travel_time_table
+        """
+        self.model_name = model_name
+        self.depths = np.asarray(depths, dtype=np.float64)
+        self.distances = np.asarray(distances, dtype=np.float64)
+        self.times = times
+        self.max_errors = max_errors if max_errors is not None else {}
+        self.phases = sorted(times.keys())
+    # end func
+
+    def travel_times(self, phase, depth_km, dist_deg):
+        """
+        Interpolates travel-times bilinearly
+
+        :param phase: phase name
+        :param depth_km: source depth(s) in km
+        :param dist_deg: epicentral distance(s) in degrees
+        :return: travel-time(s) in seconds; NaN outside the grid or where no arrival is found at any of
+                 the surrounding grid nodes
+        """
+        tt = self.times[phase]
+        nd, nx = tt.shape
+        depth_km, dist_deg = np.broadcast_arrays(np.asarray(depth_km, dtype=np.float64),
+                                                 np.asarray(dist_deg, dtype=np.float64))
+
+        fi = (depth_km - self.depths[0]) / (self.depths[1] - self.depths[0])
+        fj = (dist_deg - self.distances[0]) / (self.distances[1] - self.distances[0])
+        valid = (fi >= 0) & (fi <= nd - 1) & (fj >= 0) & (fj <= nx - 1)
+        fi = np.where(valid, fi, 0)
+        fj = np.where(valid, fj, 0)
+
+        i0 = np.minimum(np.floor(fi).astype(int), nd - 2)
+        j0 = np.minimum(np.floor(fj).astype(int), nx - 2)
+        wi = fi - i0
+        wj = fj - j0
+
+        result = (1 - wi) * (1 - wj) * tt[i0, j0] + (1 - wi) * wj * tt[i0, j0 + 1] + \
+                 wi * (1 - wj) * tt[i0 + 1, j0] + wi * wj * tt[i0 + 1, j0 + 1]
+        return np.where(valid, result, np.nan)
+    # end func
+
+    def travel_times_geo(self, phase, depth_km, source_lat, source_lon, station_lat, station_lon):
+        """
+        Interpolates travel-times for source and station coordinates, as TauPyModel.get_travel_times_geo
+
+        :return: travel-time(s) in seconds; see travel_times
+        """
+        return self.travel_times(phase, depth_km, distance_deg(source_lat, source_lon, station_lat, station_lon))
+    # end func
+# end class
+
+
+def build_travel_time_table(model_name='iasp91', phases=('P', 'S'), max_depth_km=800., depth_step_km=10.,
+                            max_distance_deg=180., distance_step_deg=0.5, comm=None):
+    """
+    Evaluates first-arrival travel-times through TauP over a regular grid. Grid nodes are split across
+    ranks of comm, if provided, and gathered on all ranks.
+
+    :param model_name: velocity model name, as understood by TauPyModel
+    :param phases: phase names
+    :param max_depth_km: maximum source depth (km)
+    :param depth_step_km: grid spacing in depth (km)
+    :param max_distance_deg: maximum epicentral distance (degrees)
+    :param distance_step_deg: grid spacing in distance (degrees)
+    :param comm: MPI communicator; None evaluates all grid nodes on the calling process
+    :return: TravelTimeTable
+    """
+    phases = list(phases)
+    depths = np.linspace(0, max_depth_km, int(np.round(max_depth_km / depth_step_km)) + 1)
+    distances = np.linspace(0, max_distance_deg, int(np.round(max_distance_deg / distance_step_deg)) + 1)
+    nodes = [(i, j) for i in range(len(depths)) for j in range(len(distances))]
+
+    nproc = comm.Get_size() if comm else 1
+    rank = comm.Get_rank() if comm else 0
+
+    taupy_model = TauPyModel(model=model_name)
+    local_nodes = split_list(nodes, nproc)[rank]
+    local_times = [first_arrivals(taupy_model, depths[i], distances[j], phases) for i, j in local_nodes]
+
+    if comm:
+        local_times = comm.allgather(local_times)
+        local_times = [t for ts in local_times for t in ts]
+    # end if
+
+    times = np.array(local_times).reshape(len(depths), len(distances), len(phases))
+    return TravelTimeTable(model_name, depths, distances,
+                           {phase: times[:, :, k].copy() for k, phase in enumerate(phases)})
+# end func
+
+
+def validate_travel_time_table(table, sample_count=500, seed=0, comm=None):
+    """
+    Computes maximum interpolation errors against direct TauP evaluations at random (depth, distance)
+    locations within the grid, which are saved in table.max_errors
+
+    :param table: TravelTimeTable
+    :param sample_count: number of random locations evaluated
+    :param seed: random seed
+    :param comm: MPI communicator; None evaluates all locations on the calling process
+    :return: dictionary, keyed by phase name, of maximum absolute errors (s), evaluated over locations
+             where both interpolated and direct travel-times are available
+    """
+    nproc = comm.Get_size() if comm else 1
+    rank = comm.Get_rank() if comm else 0
+
+    rs = np.random.RandomState(seed)
+    depths = rs.uniform(table.depths[0], table.depths[-1], sample_count)
+    distances = rs.uniform(table.distances[0], table.distances[-1], sample_count)
+
+    taupy_model = TauPyModel(model=table.model_name)
+    indices = split_list(list(range(sample_count)), nproc)[rank]
+    local_times = [(k, first_arrivals(taupy_model, depths[k], distances[k], table.phases)) for k in indices]
+    if comm:
+        local_times = [t for ts in comm.allgather(local_times) for t in ts]
+    # end if
+
+    direct = np.array([t for _, t in sorted(local_times)])
+    max_errors = {}
+    for k, phase in enumerate(table.phases):
+        errors = np.fabs(table.travel_times(phase, depths, distances) - direct[:, k])
+        max_errors[phase] = float(np.nanmax(errors)) if np.any(np.isfinite(errors)) else np.nan
+    # end for
+
+    table.max_errors = max_errors
+    return max_errors
+# end func
+
+
+def save_travel_time_table(table, file_name):
+    """
+    :param table: TravelTimeTable
+    :param file_name: name of .npz file
+    """
+    arrays = {'tt_%s' % phase: table.times[phase] for phase in table.phases}
+    arrays.update({'err_%s' % phase: table.max_errors[phase] for phase in table.max_errors})
+
+    tmp_file_name = file_name[:-4] + '.tmp.npz' if file_name.endswith('.npz') else file_name + '.tmp.npz'
+    np.savez(tmp_file_name, model_name=table.model_name, depths=table.depths, distances=table.distances,
+             **arrays)
+    os.replace(tmp_file_name, file_name)
+# end func
+
+
+def load_travel_time_table(file_name):
+    """
+    :param file_name: name of .npz file written by save_travel_time_table
+    :return: TravelTimeTable
+    """
+    with np.load(file_name) as npz:
+        times = {k[3:]: npz[k] for k in npz.files if k.startswith('tt_')}
+        max_errors = {k[4:]: float(npz[k]) for k in npz.files if k.startswith('err_')}
+        return TravelTimeTable(str(npz['model_name']), npz['depths'], npz['distances'], times, max_errors)
+    # end with
+# end func
+
+
+def get_travel_time_table(file_name, model_name='iasp91', phases=('P', 'S'), max_depth_km=800.,
+                          depth_step_km=10., max_distance_deg=180., distance_step_deg=0.5,
+                          validation_sample_count=500, comm=None):
+    """
+    Loads a travel-time table cached in file_name, if one matching the given parameters exists; otherwise
+    builds and validates a table, which is cached in file_name. See build_travel_time_table for a
+    description of the parameters.
+
+    :param validation_sample_count: number of random locations at which interpolation errors are evaluated
+    :return: TravelTimeTable
+    """
+    rank = comm.Get_rank() if comm else 0
+
+    def matches(table):
+        return table.model_name == model_name and sorted(phases) == table.phases and \
+               np.isclose(table.depths[-1], max_depth_km) and \
+               np.isclose(table.depths[1] - table.depths[0], depth_step_km) and \
+               np.isclose(table.distances[-1], max_distance_deg) and \
+               np.isclose(table.distances[1] - table.distances[0], distance_step_deg)
+    # end func
+
+    if file_name and os.path.exists(file_name):
+        table = load_travel_time_table(file_name)
+        if matches(table): return table
+    # end if
+
+    table = build_travel_time_table(model_name=model_name, phases=phases, max_depth_km=max_depth_km,
+                                    depth_step_km=depth_step_km, max_distance_deg=max_distance_deg,
+                                    distance_step_deg=distance_step_deg, comm=comm)
+    if validation_sample_count:
+        validate_travel_time_table(table, sample_count=validation_sample_count, comm=comm)
+    # end if
+
+    if file_name and rank == 0: save_travel_time_table(table, file_name)
+    if comm: comm.Barrier()
+
+    return table
+# end func
@@ -0,0 +1,574 @@
+#!/usr/bin/env python
+"""
+Description:
+    Benchmarks for the cross-correlation workflow, run against synthetic waveforms generated on the fly
+
+    Example usage:
+    python benchmark_xcorr.py spectra-cache --station-count 50 --nn 10
+    python benchmark_xcorr.py batch --sampling-rate 100 --window-seconds 3600
+    python benchmark_xcorr.py response response_inventory.fdsnxml AU.QLP..BHZ 2011-03-11T00:00:00
+    python benchmark_xcorr.py makespan --station-count 200 --nproc 16 --nproc 64
+    python benchmark_xcorr.py store /tmp/store-benchmark --pair-count 10000
+    python benchmark_xcorr.py rss /tmp/rss-benchmark --day-count 7 --day-count 30 --day-count 90
+    python benchmark_xcorr.py prefetch /tmp/prefetch-benchmark --day-count 30
+    python benchmark_xcorr.py transverse /tmp/transverse-benchmark --nn 10
+
+References:
+
+CreationDate:   18/10/26
+
+Revision History:
+    LastUpdate:     18/10/26
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import os
+import time
+import heapq
+import shutil
+import resource
+import multiprocessing
+import random
+import logging
+
+import click
+import numpy as np
+from obspy import Trace, UTCDateTime, read_inventory
+from obspy.core import Stats
+from scipy.spatial import cKDTree
+
+from seismic.xcorqc.xcorqc import xcorr2, preprocess_window, preprocess_windows, zeropad, xcorr_parameters, \
+    write_xcorr_results, combine_xcorr_results, NetCDFXcorrResultsWriter, xcorr_time_range
+from seismic.xcorqc.xcorr_store import XcorrStore, merge_xcorr_stores
+from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
+from seismic.ASDFdatabase.benchmark_fds import create_synthetic_federation
+from netCDF4 import Dataset
+from seismic.xcorqc.fft import rfft
+from seismic.xcorqc.cache import SpectraCache, ResponseCache, NEStreamCache
+from seismic.xcorqc.utils import get_work_units, split_list, get_stream
+
+logging.basicConfig()
+
+DAY = 86400
+
+
+def create_synthetic_network(station_count, day_count=1, sampling_rate=20., seed=0):
+    """
+    Generates random-noise traces and random locations for a synthetic network
+
+    :param station_count: number of stations
+    :param day_count: number of days of data per station
+    :param sampling_rate: sampling rate (Hz)
+    :param seed: random seed
+    :return: tuple containing a list of obspy Traces and a 2D array of [lon, lat] coordinates
+    """
+    rs = np.random.RandomState(seed)
+    npts = int(day_count * DAY * sampling_rate)
+
+    traces = []
+    for ista in range(station_count):
+        header = Stats(header={'network': 'XX', 'station': 'S%04d' % (ista), 'channel': 'BHZ',
+                               'sampling_rate': sampling_rate, 'npts': npts,
+                               'starttime': UTCDateTime('2010-01-01T00:00:00')})
+        traces.append(Trace(data=rs.normal(size=npts).astype(np.float32), header=header))
+    # end for
+
+    coords = np.column_stack([rs.uniform(130, 140, station_count), rs.uniform(-30, -20, station_count)])
+
+    return traces, coords
+# end func
+
+
+def nearest_neighbour_pairs(coords, nn):
+    """
+    :return: sorted list of unique (i, j) station-index pairs, for the nn closest neighbours of each station
+    """
+    _, l = cKDTree(coords).query(coords, nn + 1)
+
+    pairs = set()
+    for i, row in enumerate(l):
+        for j in row:
+            if(i != j): pairs.add((min(i, j), max(i, j)))
+        # end for
+    # end for
+
+    return sorted(pairs)
+# end func
+
+
+def simulate_dynamic_schedule(costs, nproc):
+    """
+    Simulates on-demand scheduling, where each unit of work, in the given order, is claimed by the
+    processor that becomes idle first
+
+    :param costs: list of costs of units of work
+    :param nproc: number of processors
+    :return: 1D array of busy-time for each processor
+    """
+    idle = [(0., irank) for irank in range(nproc)]
+    busy = np.zeros(nproc)
+    for cost in costs:
+        t, irank = heapq.heappop(idle)
+        busy[irank] += cost
+        heapq.heappush(idle, (t + cost, irank))
+    # end for
+
+    return busy
+# end func
+
+
+CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
+
+
+@click.group(context_settings=CONTEXT_SETTINGS)
+def cli():
+    pass
+# end func
+
+
+@cli.command(name='spectra-cache')
+@click.option('--station-count', default=50, help='Number of synthetic stations')
+@click.option('--nn', default=10, help='Number of nearest neighbours correlated against each station')
+@click.option('--day-count', default=1, help='Number of days of data per station')
+@click.option('--sampling-rate', default=20., help='Sampling rate (Hz) of synthetic data')
+@click.option('--window-seconds', default=3600, help='Length of cross-correlation windows (s)')
+@click.option('--whitening', is_flag=True, help='Apply spectral whitening')
+def bench_spectra_cache(station_count, nn, day_count, sampling_rate, window_seconds, whitening):
+    """
+    Correlates all nearest-neighbour station-pairs of a synthetic network, with and without a shared cache
+    of window-spectra. Without the cache, the number of windows preprocessed grows with the number of
+    station-pairs; with the cache, it grows with the number of stations.
+    """
+    traces, coords = create_synthetic_network(station_count, day_count, sampling_rate)
+    pairs = nearest_neighbour_pairs(coords, nn)
+    print('Correlating %d station-pairs over %d stations' % (len(pairs), station_count))
+
+    kwargs = dict(window_seconds=window_seconds, interval_seconds=DAY, resample_rate=sampling_rate / 2.,
+                  flo=0.05, fhi=sampling_rate / 4., whitening=whitening)
+
+    results = {}
+    for label, cache in [('uncached', None), ('cached', SpectraCache(size_in_mb=4096))]:
+        t0 = time.time()
+        results[label] = [xcorr2(traces[i], traces[j], spectra_cache=cache, **kwargs)[0] for i, j in pairs]
+        elapsed = time.time() - t0
+
+        print('%10s: %8.2f s (%.3f s per station-pair)' % (label, elapsed, elapsed / len(pairs)))
+        if(cache is not None):
+            stats = cache.stats()
+            print('%10s  window-spectra computed: %d, reused: %d, memory: %.1f MB' %
+                  ('', stats['misses'], stats['hits'], stats['size_in_mb']))
+        # end if
+    # end for
+
+    maxdiff = np.max([np.max(np.abs(a - b)) for a, b in zip(results['uncached'], results['cached'])])
+    print('Max absolute difference between results: %g' % (maxdiff))
+# end func
+
+
+@cli.command(name='batch')
+@click.option('--sampling-rate', default=100., help='Sampling rate (Hz) of synthetic data')
+@click.option('--window-seconds', default=3600, help='Length of cross-correlation windows (s)')
+@click.option('--window-overlap', default=0.1, help='Window overlap fraction')
+@click.option('--resample-rate', default=None, type=float, help='Resampling rate (Hz)')
+@click.option('--whitening', is_flag=True, help='Apply spectral whitening')
+def bench_batch(sampling_rate, window_seconds, window_overlap, resample_rate, whitening):
+    """
+    Preprocesses and transforms all windows in a synthetic day of data, one window at a time (as done
+    previously) and in a single batch, as rows of a 2D array.
+    """
+    traces, _ = create_synthetic_network(1, 1, sampling_rate)
+    tr = traces[0]
+
+    window_samples = window_seconds * sampling_rate
+    starts = np.arange(0, tr.stats.npts - window_samples + 1, int(window_samples * (1 - window_overlap)),
+                       dtype=np.int64)
+    ends = starts + int(window_samples)
+    sr = resample_rate if resample_rate else sampling_rate
+    xcorlen = int(2 * window_seconds * sr - 1)
+    fftlen = 2 ** (int(np.log2(xcorlen)) + 1)
+    kwargs = dict(resample_rate=resample_rate, flo=0.1, fhi=sr / 4., whitening=whitening)
+    print('Processing %d windows of %d samples' % (len(starts), int(window_samples)))
+
+    t0 = time.time()
+    expected = [rfft(zeropad(preprocess_window(tr, ws, we, sampling_rate, sr, None, window_samples, 0, 0.05,
+                                               **kwargs), fftlen)) for ws, we in zip(starts, ends)]
+    elapsed_loop = time.time() - t0
+
+    t0 = time.time()
+    result = rfft(zeropad(preprocess_windows(tr, starts, ends, sampling_rate, sr, None, window_samples, 0, 0.05,
+                                             **kwargs), fftlen), axis=-1)
+    elapsed_batch = time.time() - t0
+
+    print('%10s: %8.3f s (%.4f s per window)' % ('per-window', elapsed_loop, elapsed_loop / len(starts)))
+    print('%10s: %8.3f s (%.4f s per window)' % ('batched', elapsed_batch, elapsed_batch / len(starts)))
+    print('Max relative difference between spectra: %g' %
+          (np.max(np.abs(result - np.array(expected))) / np.max(np.abs(expected))))
+# end func
+
+
+@cli.command(name='response')
+@click.argument('inventory', required=True, type=click.Path(exists=True))
+@click.argument('seed-id', required=True, type=str)
+@click.argument('start-time', required=True, type=str)
+@click.option('--sampling-rate', default=40., help='Sampling rate (Hz) of synthetic data')
+@click.option('--window-seconds', default=3600, help='Length of data-windows (s)')
+@click.option('--window-count', default=48, help='Number of data-windows')
+def bench_response(inventory, seed_id, start_time, sampling_rate, window_seconds, window_count):
+    """
+    Removes the instrument response of channel SEED_ID (NET.STA.LOC.CHA), as of START_TIME, from windows of
+    random noise: through obspy, one window at a time, and through cached transfer functions.
+    """
+    inv = read_inventory(inventory)
+    net, sta, loc, cha = seed_id.split('.')
+    t0 = UTCDateTime(start_time)
+    data = np.random.normal(size=(window_count, int(window_seconds * sampling_rate)))
+
+    t = time.time()
+    expected = []
+    for i in range(window_count):
+        tr = Trace(data=data[i].copy(), header=Stats(header={'sampling_rate': sampling_rate, 'network': net,
+                                                             'station': sta, 'location': loc, 'channel': cha,
+                                                             'starttime': t0 + i * window_seconds}))
+        tr.remove_response(inventory=inv, output='VEL', water_level=50)
+        expected.append(tr.data)
+    # end for
+    elapsed_obspy = time.time() - t
+
+    t = time.time()
+    cache = ResponseCache()
+    result = cache.remove_response(data, inv, seed_id, t0, sampling_rate, output='VEL', water_level=50)
+    elapsed_cached = time.time() - t
+
+    print('%10s: %8.3f s (%.4f s per window)' % ('obspy', elapsed_obspy, elapsed_obspy / window_count))
+    print('%10s: %8.3f s (%.4f s per window)' % ('cached', elapsed_cached, elapsed_cached / window_count))
+    print('Max relative difference: %g' % (np.max(np.abs(result - np.array(expected))) /
+                                           np.max(np.abs(expected))))
+# end func
+
+
+
+@cli.command(name='makespan')
+@click.option('--station-count', default=200, help='Number of synthetic stations')
+@click.option('--nn', default=10, help='Number of nearest neighbours correlated against each station')
+@click.option('--permanent-fraction', default=0.1, help='Fraction of stations recording over the entire time-range; '
+                                                        'the rest are temporary deployments of 1-12 months')
+@click.option('--year-count', default=10, help='Length of time-range in years')
+@click.option('--chunk-days', default=100, help='Length of time-chunks (days) in work-units')
+@click.option('--unit-overhead', default=0.5, help='Fixed cost (in days of data) of processing a work-unit, '
+                                                   'e.g. for fetching metadata and writing partial results')
+@click.option('--nproc', default=[16, 64, 256], multiple=True, help='Number of processors; can be repeated')
+def bench_makespan(station_count, nn, permanent_fraction, year_count, chunk_days, unit_overhead, nproc):
+    """
+    Simulates the makespan of correlating all nearest-neighbour station-pairs of a synthetic network with
+    skewed data availability, where the cost of a station-pair is proportional to its overlap of data:
+    station-pairs split evenly across processors upfront (static), versus (station-pair, time-chunk) units
+    handed out on demand, in shuffled order (dynamic) and longest-first.
+    """
+    rs = np.random.RandomState(0)
+    start_time = UTCDateTime('2010-01-01T00:00:00')
+    end_time = start_time + year_count * 365 * DAY
+
+    coords = np.column_stack([rs.uniform(130, 140, station_count), rs.uniform(-30, -20, station_count)])
+    permanent = rs.uniform(size=station_count) < permanent_fraction
+    durations = np.where(permanent, end_time - start_time, rs.uniform(30, 365, station_count) * DAY)
+    starts = start_time.timestamp + rs.uniform(size=station_count) * (end_time - start_time - durations)
+    time_ranges = [(s, s + d) for s, d in zip(starts, durations)]
+
+    pairs = nearest_neighbour_pairs(coords, nn)
+    random.Random(0).shuffle(pairs)
+    pair_time_ranges = [(time_ranges[i], time_ranges[j]) for i, j in pairs]
+    pairs = [('XX.S%04d' % i, 'XX.S%04d' % j) for i, j in pairs]
+
+    units = get_work_units(pairs, pair_time_ranges, start_time, end_time, chunk_days * DAY)
+    ordered_units = get_work_units(pairs, pair_time_ranges, start_time, end_time, chunk_days * DAY,
+                                   longest_first=True)
+    pair_costs = {}
+    for u in units: pair_costs[u[:2]] = pair_costs.get(u[:2], unit_overhead) + u[4] / DAY
+    total = np.sum(list(pair_costs.values()))
+
+    print('%d station-pairs (%d with overlapping data), %d work-units, %.0f days of overlapping data' %
+          (len(pairs), len(pair_costs), len(units), total))
+    print('%6s %12s %15s %15s %15s' % ('nproc', 'lower-bound', 'static', 'dynamic', 'longest-first'))
+    for n in nproc:
+        static = np.array([np.sum([pair_costs.get(p, 0) for p in plist])
+                           for plist in split_list(pairs, npartitions=n)])
+        dynamic = simulate_dynamic_schedule([u[4] / DAY + unit_overhead for u in units], n)
+        longest = simulate_dynamic_schedule([u[4] / DAY + unit_overhead for u in ordered_units], n)
+
+        lower_bound = max(np.sum(dynamic) / n, np.max([u[4] / DAY + unit_overhead for u in units]))
+        row = ['%8.1f (%3.0f%%)' % (np.max(b), 100 * np.mean(b) / np.max(b)) for b in [static, dynamic, longest]]
+        print('%6d %12.1f %s' % (n, lower_bound, ' '.join(row)))
+    # end for
+    print('Makespans are in days of data processed; mean processor utilisation is shown in brackets')
+# end func
+
+
+
+@cli.command(name='store')
+@click.argument('output-path', required=True, type=click.Path())
+@click.option('--pair-count', default=10000, help='Number of station-pairs')
+@click.option('--interval-count', default=30, help='Number of intervals per station-pair')
+@click.option('--lag-count', default=2*3600*2-1, help='Number of lag samples in cross-correlations')
+@click.option('--nproc', default=4, help='Number of per-processor stores merged into a single store')
+@click.option('--random-reads', default=1000, help='Number of station-pairs read back in random order')
+def bench_store(output_path, pair_count, interval_count, lag_count, nproc, random_reads):
+    """
+    Writes random cross-correlations for PAIR_COUNT station-pairs to OUTPUT_PATH, as a NETCDF4 file per
+    station-pair and through per-processor HDF5 stores merged into a single store; results for a random
+    subset of station-pairs are then read back
+    """
+    rs = np.random.RandomState(0)
+    pairs = ['XX.S%04d.XX.T%04d' % (i // 100, i % 100) for i in range(pair_count)]
+    x = np.linspace(-1, 1, lag_count)
+    xcorr = rs.normal(size=(interval_count, lag_count))
+    wc = np.ones(interval_count, dtype=np.int64)
+    ist = np.arange(interval_count, dtype=np.int64) * DAY
+    iet = ist + DAY
+    params = xcorr_parameters('BHZ', 'BHZ', None, None, 'vel', 50, None, 0.05, 10 * DAY, DAY, 3600, 0.1, 0,
+                              None, None, False, False, 0, False, False, False)
+    coords = [135., -25.]
+    read_pairs = [pairs[i] for i in rs.randint(0, pair_count, random_reads)]
+
+    nc_path = os.path.join(output_path, 'netcdf')
+    os.makedirs(nc_path, exist_ok=True)
+
+    t0 = time.time()
+    for pair in pairs:
+        write_xcorr_results(os.path.join(nc_path, '%s.nc' % pair), pair, x, xcorr, wc, ist, iet, coords, coords,
+                            False, params)
+    # end for
+    elapsed_nc_write = time.time() - t0
+
+    t0 = time.time()
+    for pair in read_pairs:
+        ds = Dataset(os.path.join(nc_path, '%s.nc' % pair), 'r')
+        _ = ds.variables['xcorr'][:, :]
+        ds.close()
+    # end for
+    elapsed_nc_read = time.time() - t0
+
+    store_fn = os.path.join(output_path, 'xcorr.h5')
+    if(os.path.exists(store_fn)): os.remove(store_fn)
+
+    t0 = time.time()
+    rank_fns = ['%s.rank%d.h5' % (store_fn[:-3], irank) for irank in range(nproc)]
+    for irank, rank_fn in enumerate(rank_fns):
+        with XcorrStore(rank_fn, mode='w') as store:
+            for pair in pairs[irank::nproc]:
+                store.write(pair, x, xcorr, wc, ist, iet, coords, coords, False, params)
+            # end for
+        # end with
+    # end for
+    merge_xcorr_stores(store_fn, rank_fns)
+    elapsed_h5_write = time.time() - t0
+
+    t0 = time.time()
+    with XcorrStore(store_fn) as store:
+        for pair in read_pairs:
+            _ = store.read(pair, variables=['xcorr'])
+        # end for
+    # end with
+    elapsed_h5_read = time.time() - t0
+
+    nc_size = np.sum([os.path.getsize(os.path.join(nc_path, f)) for f in os.listdir(nc_path)])
+    print('%8s: write %8.2f s, read %8.2f s, %d files, %.1f MB' %
+          ('netcdf', elapsed_nc_write, elapsed_nc_read, pair_count, nc_size / 1024. / 1024.))
+    print('%8s: write %8.2f s, read %8.2f s, %d file, %.1f MB' %
+          ('hdf5', elapsed_h5_write, elapsed_h5_read, 1, os.path.getsize(store_fn) / 1024. / 1024.))
+
+    shutil.rmtree(nc_path)
+    os.remove(store_fn)
+# end func
+
+
+
+def _write_results(fn, streaming, day_count, interval_seconds, buffer_intervals, lag_count, sr, ensemble_stack,
+                   queue):
+    """
+    Writes random results for day_count days, buffer by buffer, and reports peak RSS (MB) of the process
+    """
+    rs = np.random.RandomState(0)
+    window_seconds = (lag_count + 1) / 2. / sr
+    params = xcorr_parameters('BHZ', 'BHZ', None, None, 'vel', 50, None, 0.05, buffer_intervals * interval_seconds,
+                              interval_seconds, window_seconds, 0.1, 0, None, None, False, False, 0, False, False,
+                              ensemble_stack)
+    writer = NetCDFXcorrResultsWriter(fn, 'XX.A.XX.B', [], [], window_seconds, ensemble_stack, params) \
+        if streaming else None
+
+    xcl, wcl, istl, ietl = [], [], [], []
+    interval_count = int(day_count * DAY / interval_seconds)
+    for s in range(0, interval_count, buffer_intervals):
+        n = min(buffer_intervals, interval_count - s)
+        xc = rs.normal(size=(n, lag_count))
+        wc = np.ones(n, dtype=np.int64)
+        ist = (np.arange(n) + s) * interval_seconds
+        iet = ist + interval_seconds
+
+        if streaming:
+            writer.append(xc, wc, ist, iet, sr)
+        else:
+            xcl.append(xc)
+            wcl.append(wc)
+            istl.append(ist)
+            ietl.append(iet)
+        # end if
+    # end for
+
+    if streaming:
+        writer.close()
+    else:
+        x, xc, wc, ist, iet = combine_xcorr_results(xcl, wcl, istl, ietl, sr, window_seconds,
+                                                    ensemble_stack=ensemble_stack)
+        write_xcorr_results(fn, 'XX.A.XX.B', x, xc, wc, ist, iet, [], [], ensemble_stack, params)
+    # end if
+
+    queue.put(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.)
+# end func
+
+
+@cli.command(name='rss')
+@click.argument('output-path', required=True, type=click.Path(exists=True))
+@click.option('--day-count', default=[7, 30, 90], multiple=True, help='Time span (days); can be repeated')
+@click.option('--interval-seconds', default=3600, help='Interval length (s)')
+@click.option('--buffer-intervals', default=24, help='Number of intervals per read-buffer')
+@click.option('--window-seconds', default=600, help='Length of cross-correlation windows (s)')
+@click.option('--sampling-rate', default=20., help='Sampling rate (Hz) of cross-correlations')
+@click.option('--ensemble-stack', is_flag=True, help='Output ensemble stacks')
+def bench_rss(output_path, day_count, interval_seconds, buffer_intervals, window_seconds, sampling_rate,
+              ensemble_stack):
+    """
+    Reports peak memory usage (RSS) of writing interval stacks for a station-pair over increasing time spans:
+    accumulating results for all buffers in memory before writing them out (as done previously) and
+    streaming results to output as each buffer is processed. Each run is made in a separate process.
+    """
+    lag_count = int(2 * window_seconds * sampling_rate - 1)
+    fn = os.path.join(output_path, 'rss-benchmark.nc')
+
+    print('%8s %16s %16s' % ('days', 'in-memory (MB)', 'streaming (MB)'))
+    for days in day_count:
+        row = []
+        for streaming in [False, True]:
+            queue = multiprocessing.Queue()
+            p = multiprocessing.Process(target=_write_results,
+                                        args=(fn, streaming, days, interval_seconds, buffer_intervals, lag_count,
+                                              sampling_rate, ensemble_stack, queue))
+            p.start()
+            row.append(queue.get())
+            p.join()
+        # end for
+        print('%8d %16.1f %16.1f' % (days, row[0], row[1]))
+    # end for
+
+    if(os.path.exists(fn)): os.remove(fn)
+# end func
+
+
+
+@cli.command(name='prefetch')
+@click.argument('output-folder', required=True, type=click.Path())
+@click.option('--day-count', default=30, help='Number of days of data per station')
+@click.option('--sampling-rate', default=40., help='Sampling rate (Hz) of synthetic data')
+@click.option('--buffer-days', default=5, help='Length of read-buffers (days)')
+@click.option('--whitening', is_flag=True, help='Apply spectral whitening')
+def bench_prefetch(output_folder, day_count, sampling_rate, buffer_days, whitening):
+    """
+    Cross-correlates a station-pair of a synthetic ASDF dataset, buffer by buffer, with data for each buffer
+    fetched before it is cross-correlated (as done previously) and with data for the next buffer fetched
+    on a background thread while the current buffer is cross-correlated.
+
+    OUTPUT_FOLDER: Folder for synthetic data
+    """
+    asdf_source = create_synthetic_federation(output_folder, station_count=2, day_count=day_count,
+                                              sampling_rate=sampling_rate)
+    start_time = UTCDateTime('2010-01-01T00:00:00')
+    end_time = start_time + day_count * DAY
+
+    results = {}
+    for label, prefetch in [('sequential', False), ('prefetch', True)]:
+        # decoded-trace caching is disabled, so that both runs read data from disk
+        fds = FederatedASDFDataSet(asdf_source, cache_size_in_mb=0)
+
+        t0 = time.time()
+        results[label] = xcorr_time_range(fds, fds, start_time, end_time, 'N0.S000', 'N0.S001', None, None,
+                                          'vel', 50, 'BHZ', 'BHZ', None, None,
+                                          resample_rate=sampling_rate / 2., buffer_seconds=buffer_days * DAY,
+                                          interval_seconds=DAY, window_seconds=3600, flo=0.05,
+                                          fhi=sampling_rate / 8., whitening=whitening, prefetch=prefetch)[0]
+        elapsed = time.time() - t0
+
+        print('%10s: %8.2f s (%.3f s per day)' % (label, elapsed, elapsed / day_count))
+        del fds
+    # end for
+
+    maxdiff = np.max([np.max(np.abs(a - b)) for a, b in zip(results['sequential'], results['prefetch'])])
+    print('Max absolute difference between results: %g' % (maxdiff))
+# end func
+
+
+
+@cli.command(name='transverse')
+@click.argument('output-folder', required=True, type=click.Path())
+@click.option('--nn', default=10, help='Number of neighbours, and thereby back-azimuths, for a station')
+@click.option('--day-count', default=5, help='Number of days of data per station')
+@click.option('--sampling-rate', default=40., help='Sampling rate (Hz) of synthetic data')
+@click.option('--buffer-days', default=5, help='Length of read-buffers (days)')
+def bench_transverse(output_folder, nn, day_count, sampling_rate, buffer_days):
+    """
+    Fetches transverse components of a station of a synthetic ASDF dataset, for the back-azimuths to each of
+    its neighbours, buffer by buffer: N/E data fetched and rotated for each back-azimuth separately (as done
+    previously), fetched once through a cache and rotated for each back-azimuth, and fetched once and rotated
+    for all back-azimuths in a single vectorised operation.
+
+    OUTPUT_FOLDER: Folder for synthetic data
+    """
+    asdf_source = create_synthetic_federation(output_folder, station_count=1, day_count=day_count,
+                                              sampling_rate=sampling_rate, channels=('BHN', 'BHE'))
+    start_time = UTCDateTime('2010-01-01T00:00:00')
+    bazs = np.random.uniform(0, 360, nn)
+    buffers = [(start_time + i * DAY, start_time + min(i + buffer_days, day_count) * DAY)
+               for i in range(0, day_count, buffer_days)]
+
+    def fetch(label, fetch_buffer):
+        # decoded-trace caching is disabled, so that all runs read data from disk
+        fds = FederatedASDFDataSet(asdf_source, cache_size_in_mb=0)
+
+        t0 = time.time()
+        results = []
+        for st, et in buffers:
+            results.append(fetch_buffer(fds.fds, st, et))
+        # end for
+        elapsed = time.time() - t0
+
+        print('%20s: %8.2f s (%.3f s per buffer)' % (label, elapsed, elapsed / len(buffers)))
+        del fds
+        return results
+    # end func
+
+    expected = fetch('per back-azimuth',
+                     lambda fds, st, et: [get_stream(fds, 'N0', 'S000', '00T', st, et, baz=baz)
+                                          for baz in bazs])
+
+    ne_cache = NEStreamCache(size_in_mb=10240)
+    cached = fetch('cached N/E',
+                   lambda fds, st, et: [get_stream(fds, 'N0', 'S000', '00T', st, et, baz=baz, ne_cache=ne_cache)
+                                        for baz in bazs])
+    print('NE-stream-cache stats: %s' % (str(ne_cache.stats())))
+    ne_cache.clear()
+
+    batched = fetch('all back-azimuths',
+                    lambda fds, st, et: get_stream(fds, 'N0', 'S000', '00T', st, et, baz=bazs))
+
+    maxdiff = 0
+    for e, c, b in zip(expected, cached, batched):
+        for est, cst, bst in zip(e, c, b):
+            maxdiff = max(maxdiff, np.max(np.abs(est[0].data - cst[0].data)),
+                          np.max(np.abs(est[0].data - bst[0].data)))
+        # end for
+    # end for
+    print('Max absolute difference between results: %g' % (maxdiff))
+# end func
+
+
+if __name__ == '__main__':
+    cli()
+# end if
@@ -0,0 +1,468 @@
+"""
+Description:
+    Caching utilities used by the cross-correlation workflow:
+
+    SpectraCache  : size-bounded (in bytes) LRU cache of preprocessed window-spectra, with an
+                    optional second tier on local disk, which can be shared by processes on a node
+    ResponseCache : bounded LRU cache of inverted instrument-response transfer functions, used for
+                    removing instrument responses from batches of data-windows
+    NEStreamCache : size-bounded (in bytes) LRU cache of conditioned north and east component data,
+                    which are rotated to the transverse component for each back-azimuth required
+
+References:
+
+CreationDate:   18/10/26
+
+Revision History:
+    LastUpdate:     18/10/26
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import os
+import hashlib
+import threading
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+from obspy import UTCDateTime
+from obspy.signal.invsim import cosine_taper, cosine_sac_taper, invert_spectrum
+from obspy.signal.util import _npts2nfft
+
+
+class SpectraCache:
+    def __init__(self, size_in_mb=1024, cache_folder=None, disk_size_in_mb=10240):
+        """
+        Least-recently-used cache of spectra of preprocessed data-windows, bounded by the total
+        number of bytes held in spectra. Each station-window is thus preprocessed and transformed
+        only once, regardless of the number of station-pairs it features in.
+
+        When a cache_folder is provided, entries evicted from memory are written to disk, from where
+        they are reloaded on subsequent requests. Files are named after their keys, so that processes
+        pointing to the same folder reuse each other's entries; each process bounds the amount of
+        data it writes to disk_size_in_mb.
+
+        :param size_in_mb: in-memory capacity in MB; a value of 0 disables the in-memory tier
+        :param cache_folder: folder on local disk for the second tier; None disables the disk tier
+        :param disk_size_in_mb: capacity in MB of the disk tier
+        """
+        self.capacity = int(size_in_mb * 1024 * 1024)
+        self.disk_capacity = int(disk_size_in_mb * 1024 * 1024)
+        self.cache_folder = cache_folder
+        self.size = 0
+        self.disk_size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._disk_entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if(self.cache_folder is not None):
+            os.makedirs(self.cache_folder, exist_ok=True)
+        # end if
+    # end func
+
+    @staticmethod
+    def _nbytes(value):
+        return value[0].nbytes
+    # end func
+
+    def _file_name(self, key):
+        return os.path.join(self.cache_folder,
+                            hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.npz')
+    # end func
+
+    def _spill(self, key, value):
+        """
+        Writes an entry evicted from memory to disk, discarding the least recently written
+        entries as required
+        """
+        nbytes = self._nbytes(value)
+        if(self.cache_folder is None or nbytes > self.disk_capacity): return
+        if(key in self._disk_entries): return
+
+        while self._disk_entries and (self.disk_size + nbytes > self.disk_capacity):
+            _, (fn, fnbytes) = self._disk_entries.popitem(last=False)
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+            # end try
+            self.disk_size -= fnbytes
+        # end while
+
+        fn = self._file_name(key)
+        if(not os.path.exists(fn)):
+            # write atomically, since the folder may be shared with other processes
+            tmp_fn = '%s.%d.tmp.npz' % (fn[:-4], os.getpid())
+            np.savez(tmp_fn, spectrum=value[0], npts=value[1])
+            os.replace(tmp_fn, fn)
+        # end if
+
+        self._disk_entries[key] = (fn, nbytes)
+        self.disk_size += nbytes
+    # end func
+
+    def _load(self, key):
+        if(self.cache_folder is None): return None
+
+        fn = self._file_name(key)
+        if(not os.path.exists(fn)): return None
+
+        try:
+            with np.load(fn) as npz:
+                return npz['spectrum'], int(npz['npts'])
+            # end with
+        except Exception:
+            # entry removed or being replaced by another process
+            return None
+        # end try
+    # end func
+
+    def get(self, key):
+        """
+        :param key: cache key
+        :return: cached (spectrum, npts) tuple or None
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            # end if
+
+            value = self._load(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.disk_hits += 1
+                self._insert(key, value)
+            # end if
+
+            return value
+        # end with
+    # end func
+
+    def _insert(self, key, value):
+        nbytes = self._nbytes(value)
+        if not (0 < nbytes <= self.capacity):
+            self._spill(key, value)
+            return
+        # end if
+
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        # end if
+
+        while self._entries and (self.size + nbytes > self.capacity):
+            ekey, evicted = self._entries.popitem(last=False)
+            self.size -= self._nbytes(evicted)
+            self.evictions += 1
+            self._spill(ekey, evicted)
+        # end while
+
+        self._entries[key] = value
+        self.size += nbytes
+    # end func
+
+    def put(self, key, spectrum, npts):
+        """
+        Adds a spectrum to the cache, evicting least-recently-used entries as required
+
+        :param key: cache key
+        :param spectrum: 1D numpy array
+        :param npts: number of samples in the window the spectrum was computed from
+        """
+        with self._lock:
+            self._insert(key, (spectrum, npts))
+        # end with
+    # end func
+
+    def __len__(self):
+        return len(self._entries)
+    # end func
+
+    def clear(self):
+        """
+        Empties the cache and removes files written to disk by this instance
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+            for fn, _ in self._disk_entries.values():
+                try:
+                    os.remove(fn)
+                except OSError:
+                    pass
+                # end try
+            # end for
+            self._disk_entries.clear()
+            self.disk_size = 0
+        # end with
+    # end func
+
+    def stats(self):
+        """
+        :return: dictionary containing hit/miss counters and current occupancy
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'size_in_mb': self.size / 1024. / 1024.,
+                    'capacity_in_mb': self.capacity / 1024. / 1024.,
+                    'disk_entries': len(self._disk_entries),
+                    'disk_size_in_mb': self.disk_size / 1024. / 1024.}
+        # end with
+    # end func
+# end class
+
+
+class ResponseCache:
+    def __init__(self, max_entries=64):
+        """
+        Least-recently-used cache of inverted instrument-response transfer functions. Responses are
+        constant within a channel epoch, so that a transfer function is evaluated once for each
+        (channel epoch, npts, sampling rate, output, water-level, pre-filter) combination and then
+        applied to data-windows through a spectral multiplication, as done in
+        obspy.Trace.remove_response.
+
+        :param max_entries: maximum number of transfer functions held
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._epochs = dict()
+        self._lock = threading.Lock()
+    # end func
+
+    def get_epoch(self, inventory, seed_id, time):
+        """
+        :return: tuple containing the start-time (timestamp) of the channel epoch in inventory, \
+                 covering the given time, and the corresponding response. As in obspy, the first \
+                 matching epoch is returned when several match
+        """
+        key = (id(inventory), seed_id)
+        if key not in self._epochs:
+            net, sta, loc, cha = seed_id.split('.')
+            epochs = []
+            for n in inventory.select(network=net, station=sta, location=loc, channel=cha):
+                for s in n:
+                    for c in s:
+                        epochs.append((c.start_date.timestamp if c.start_date else -np.inf,
+                                       c.end_date.timestamp if c.end_date else np.inf,
+                                       c.response))
+                    # end for
+                # end for
+            # end for
+
+            # hold a reference to the inventory, so that its id is not reused
+            self._epochs[key] = (inventory, epochs)
+        # end if
+
+        t = UTCDateTime(time).timestamp
+        matches = [(st, response) for st, et, response in self._epochs[key][1]
+                   if st <= t <= et and response is not None]
+        if len(matches) == 0:
+            raise Exception('No matching response information found for %s at %s.' % (seed_id, UTCDateTime(t)))
+        elif len(matches) > 1:
+            # as in obspy.Inventory.get_response
+            warnings.warn('Found more than one matching response. Returning first.')
+        # end if
+
+        return matches[0]
+    # end func
+
+    def get_transfer_function(self, inventory, seed_id, time, npts, sampling_rate, output='VEL',
+                              water_level=60, pre_filt=None):
+        """
+        :param inventory: obspy Inventory
+        :param seed_id: NET.STA.LOC.CHA
+        :param time: time within the channel epoch
+        :param npts: number of samples in data-windows
+        :param sampling_rate: sampling rate of data-windows
+        :param output: one of 'DISP', 'VEL' or 'ACC'
+        :param water_level: water-level (dB) used in inverting the response; None skips the water-level
+        :param pre_filt: corner frequencies of a frequency-domain cosine taper, as in obspy
+        :return: inverted transfer function, for the frequencies of an rfft of length _npts2nfft(npts)
+        """
+        epoch_start, response = self.get_epoch(inventory, seed_id, time)
+        key = (id(inventory), seed_id, epoch_start, npts, sampling_rate, output,
+               water_level, None if pre_filt is None else tuple(pre_filt))
+
+        with self._lock:
+            transfer = self._entries.get(key)
+            if transfer is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return transfer
+            # end if
+            self.misses += 1
+        # end with
+
+        nfft = _npts2nfft(npts)
+        transfer, freqs = response.get_evalresp_response(1. / sampling_rate, nfft, output=output)
+        if water_level is None:
+            transfer[0] = 0.0
+            transfer[1:] = 1.0 / transfer[1:]
+        else:
+            invert_spectrum(transfer, water_level)
+        # end if
+        if pre_filt:
+            transfer *= cosine_sac_taper(freqs, flimit=pre_filt)
+        # end if
+
+        with self._lock:
+            self._entries[key] = transfer
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            # end while
+        # end with
+
+        return transfer
+    # end func
+
+    def remove_response(self, data, inventory, seed_id, time, sampling_rate, output='VEL',
+                        water_level=60, pre_filt=None, taper_fraction=0.05):
+        """
+        Removes instrument response from data-windows within a channel epoch, as done in
+        obspy.Trace.remove_response, i.e. windows are demeaned, tapered and deconvolved in
+        the frequency domain
+
+        :param data: 2D array of samples, with a row for each window
+        :param time: time within the channel epoch the windows belong to
+        :return: 2D array of samples with instrument response removed
+        """
+        npts = data.shape[-1]
+        transfer = self.get_transfer_function(inventory, seed_id, time, npts, sampling_rate, output=output,
+                                              water_level=water_level, pre_filt=pre_filt)
+
+        data = np.array(data, dtype=np.float64)
+        data -= np.mean(data, axis=-1, keepdims=True)
+        data *= cosine_taper(npts, taper_fraction, sactaper=True, halfcosine=False)
+
+        spectra = np.fft.rfft(data, n=_npts2nfft(npts), axis=-1) * transfer
+        spectra[..., -1] = np.abs(spectra[..., -1]) + 0.0j
+
+        return np.fft.irfft(spectra, axis=-1)[..., 0:npts]
+    # end func
+
+    def stats(self):
+        """
+        :return: dictionary containing hit/miss counters and current occupancy
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self._entries)}
+        # end with
+    # end func
+# end class
+
+
+class NEStreamCache:
+    def __init__(self, size_in_mb=1024):
+        """
+        Least-recently-used cache of conditioned north and east component data, i.e. merged and trimmed
+        to a common time-range, bounded by the total number of bytes held. Data for a station and read-buffer
+        are thus fetched and conditioned once, regardless of the number of station-pairs, and thereby
+        back-azimuths, the transverse component is required for.
+
+        :param size_in_mb: capacity in MB
+        """
+        self.capacity = int(size_in_mb * 1024 * 1024)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    # end func
+
+    @staticmethod
+    def _nbytes(segments):
+        return int(np.sum([n.nbytes + e.nbytes for _, n, e in segments]))
+    # end func
+
+    def get(self, key):
+        """
+        :param key: cache key
+        :return: cached list of (stats, n, e) tuples or None
+        """
+        with self._lock:
+            segments = self._entries.get(key)
+            if segments is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            # end if
+
+            return segments
+        # end with
+    # end func
+
+    def put(self, key, segments):
+        """
+        Adds conditioned data to the cache, evicting least-recently-used entries as required
+
+        :param key: cache key
+        :param segments: list of (stats, n, e) tuples, where n and e are arrays of north and east component \
+                         samples, spanning the time-range described by stats
+        """
+        nbytes = self._nbytes(segments)
+        if nbytes > self.capacity: return
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            # end if
+
+            while self._entries and (self.size + nbytes > self.capacity):
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= self._nbytes(evicted)
+                self.evictions += 1
+            # end while
+
+            self._entries[key] = segments
+            self.size += nbytes
+        # end with
+    # end func
+
+    def __len__(self):
+        return len(self._entries)
+    # end func
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+        # end with
+    # end func
+
+    def stats(self):
+        """
+        :return: dictionary containing hit/miss counters and current occupancy
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'entries': len(self._entries),
+                    'size_in_mb': self.size / 1024. / 1024.,
+                    'capacity_in_mb': self.capacity / 1024. / 1024.}
+        # end with
+    # end func
+# end class
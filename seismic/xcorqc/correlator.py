@@ -16,6 +16,8 @@ Revision History:
 
 import os
 import glob
+import json
+import time
 from collections import defaultdict
 from math import sqrt
 
@@ -30,8 +32,13 @@ from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
 from obspy import UTCDateTime, read_inventory, Inventory
 from obspy.geodetics.base import gps2dist_azimuth
 
-from seismic.xcorqc.xcorqc import IntervalStackXCorr
-from seismic.xcorqc.utils import ProgressTracker, getStationInventory, rtp2xyz, split_list
+from seismic.xcorqc.xcorqc import IntervalStackXCorr, xcorr_time_range, combine_xcorr_results, \
+    xcorr_parameters, NetCDFXcorrResultsWriter, setup_logger
+from seismic.xcorqc.cache import SpectraCache, ResponseCache, NEStreamCache
+from seismic.xcorqc.xcorr_store import XcorrStore, merge_xcorr_stores, rank_store_file_name, \
+    rank_store_file_names, recover_rank_stores
+from seismic.xcorqc.utils import XcorrCheckpoint, getStationInventory, rtp2xyz, split_list, get_work_units
+from seismic.ASDFdatabase.utils import SharedCounter
 
 class Dataset:
     def __init__(self, asdf_file_name, netsta_list='*'):
@@ -93,16 +100,23 @@ class Dataset:
 
     def get_unique_station_pairs(self, other_dataset, nn=1):
         pairs = set()
-        for st1 in self.netsta_list:
+
+        # query neighbours of all stations at once
+        neighbours = None
+        if (nn != -1):
+            d, l = other_dataset._tree.query(np.array([self._cart_location[st1] for st1 in self.netsta_list]),
+                                             nn + 1 if self == other_dataset else nn)
+            neighbours = np.array(l).reshape(len(self.netsta_list), -1)
+        # end if
+
+        for ist1, st1 in enumerate(self.netsta_list):
             st2list = None
             if (nn != -1):
+                st2list = [other_dataset.netsta_list[i] for i in neighbours[ist1]
+                           if i < len(other_dataset.netsta_list)]
                 if self == other_dataset:
-                    st2list = set(self.get_closest_stations(st1, other_dataset, nn=nn + 1))
-                    if st1 in st2list:
-                        st2list.remove(st1)
-                    st2list = list(st2list)
-                else:
-                    st2list = self.get_closest_stations(st1, other_dataset, nn=nn)
+                    st2list = [st2 for st2 in st2list if st2 != st1]
+                # end if
             else:
                 st2list = other_dataset.netsta_list
             # end if
@@ -137,7 +151,9 @@ def process(data_source1, data_source2, output_path,
             ds1_zchan=None, ds1_nchan=None, ds1_echan=None,
             ds2_zchan=None, ds2_nchan=None, ds2_echan=None, corr_chan=None,
             envelope_normalize=False, ensemble_stack=False, restart=False, dry_run=False,
-            no_tracking_tag=False):
+            no_tracking_tag=False, spectra_cache_size=1024, spectra_cache_folder=None,
+            scheduler='static', longest_first=False, work_unit_size=10, output_format='netcdf',
+            ne_cache_size=1024):
     """
     :param data_source1: Text file containing paths to ASDF files
     :param data_source2: Text file containing paths to ASDF files
@@ -145,6 +161,18 @@ def process(data_source1, data_source2, output_path,
     :param interval_seconds: Length of time window (s) over which to compute cross-correlations; e.g. 86400 for 1 day
     :param window_seconds: Length of stacking window (s); e.g 3600 for an hour. interval_seconds must be a multiple of \
                     window_seconds; no stacking is performed if they are of the same size.
+    :param spectra_cache_size: Capacity (MB) of the in-memory cache of preprocessed window-spectra on each processor; \
+                    0 disables the in-memory cache
+    :param spectra_cache_folder: Folder on local disk where window-spectra evicted from memory are kept; None \
+                    disables the disk cache
+    :param scheduler: 'static' splits station-pairs evenly across processors upfront; 'dynamic' hands out \
+                    (station-pair, time-chunk) units to processors on demand
+    :param longest_first: for the 'dynamic' scheduler, hand out units with the longest overlap of data first
+    :param work_unit_size: length of time-chunks, as a multiple of read_buffer_size
+    :param output_format: 'netcdf' writes a NETCDF4 file for each station-pair; 'hdf5' writes results for all \
+                    station-pairs to a single HDF5 store
+    :param ne_cache_size: Capacity (MB) of the cache of conditioned north and east component data on each \
+                    processor, used when correlating transverse components; 0 disables the cache
     """
     read_buffer_size *= interval_seconds
     if(os.path.exists(netsta_list1)):
@@ -162,6 +190,7 @@ def process(data_source1, data_source2, output_path,
     ds2 = Dataset(data_source2, netsta_list2)
 
     proc_stations = []
+    work_units = []
     time_tag = None
     if (rank == 0):
         # Register time tag with high resolution, since queued jobs can readily
@@ -210,6 +239,11 @@ def process(data_source1, data_source2, output_path,
             f.write('%25s\t\t\t: %s\n' % ('--ensemble-stack', ensemble_stack))
             f.write('%25s\t\t\t: %s\n' % ('--restart', 'TRUE' if restart else 'FALSE'))
             f.write('%25s\t\t\t: %s\n' % ('--no-tracking-tag', 'TRUE' if no_tracking_tag else 'FALSE'))
+            f.write('%25s\t\t\t: %s\n' % ('--scheduler', scheduler))
+            if(scheduler == 'dynamic'):
+                f.write('%25s\t\t\t: %s\n' % ('--longest-first', 'TRUE' if longest_first else 'FALSE'))
+                f.write('%25s\t\t\t: %s\n' % ('--work-unit-size', work_unit_size))
+            f.write('%25s\t\t\t: %s\n' % ('--output-format', output_format))
 
             f.close()
         # end func
@@ -256,7 +290,26 @@ def process(data_source1, data_source2, output_path,
 
         random.Random(nproc).shuffle(pairs) # using nproc as seed so that shuffle produces the same
                                             # ordering when jobs are restarted.
-        proc_stations = split_list(pairs, npartitions=nproc)
+        if(scheduler == 'static'):
+            proc_stations = split_list(pairs, npartitions=nproc)
+        else:
+            # split time-ranges of station-pairs into chunks, based on time-ranges of available data
+            time_range_cache = {}
+            def get_time_range(ds, netsta):
+                if((ds, netsta) not in time_range_cache):
+                    net, sta = netsta.split('.')
+                    time_range_cache[(ds, netsta)] = ds.fds.get_global_time_range(net, sta)
+                # end if
+                return time_range_cache[(ds, netsta)]
+            # end func
+
+            time_ranges = [(get_time_range(ds1, netsta1), get_time_range(ds2, netsta2))
+                           for netsta1, netsta2 in pairs]
+            work_units = get_work_units(pairs, time_ranges, start_time, end_time,
+                                        read_buffer_size * work_unit_size, longest_first=longest_first)
+
+            print('Scheduling %d work-units over %d station-pairs' % (len(work_units), len(pairs)))
+        # end if
     # end if
 
     if(dry_run):
@@ -266,6 +319,7 @@ def process(data_source1, data_source2, output_path,
 
     # broadcast workload to all procs
     proc_stations = comm.bcast(proc_stations, root=0)
+    work_units = comm.bcast(work_units, root=0)
     time_tag = comm.bcast(time_tag, root=0)
 
     # read inventory
@@ -279,21 +333,32 @@ def process(data_source1, data_source2, output_path,
         # end try
     # end if
 
-    # Progress tracker
-    progTracker = ProgressTracker(output_folder=output_path, restart_mode=restart)
+    # Spectra of preprocessed data-windows are shared across station-pairs. Pairs are processed
+    # in sorted order, so that pairs sharing a station are processed consecutively
+    spectra_cache = None
+    if(spectra_cache_size > 0 or spectra_cache_folder):
+        spectra_cache = SpectraCache(size_in_mb=spectra_cache_size,
+                                     cache_folder=spectra_cache_folder)
+        if(scheduler == 'static'): proc_stations[rank] = sorted(proc_stations[rank])
+    # end if
 
-    startTime = UTCDateTime(start_time)
-    endTime = UTCDateTime(end_time)
-    for pair in proc_stations[rank]:
-        netsta1, netsta2 = pair
+    # instrument-response transfer functions are evaluated once per channel epoch
+    response_cache = ResponseCache()
 
-        if (progTracker.increment()):
-            pass
-        else:
-            print (('Found results for station-pair: %s.%s. Moving along..'%(netsta1, netsta2)))
-            continue
-        # end if
+    # north and east component data of a station are fetched once per read-buffer and rotated for the
+    # back-azimuth of each station-pair the station features in
+    ne_cache = None
+    if(corr_chan == 't' and ne_cache_size > 0):
+        ne_cache = NEStreamCache(size_in_mb=ne_cache_size)
+        if(scheduler == 'static'): proc_stations[rank] = sorted(proc_stations[rank])
+    # end if
 
+    def setup_pair(netsta1, netsta2):
+        """
+        :return: tuple containing inventories, channels to be correlated and back-azimuths for a
+                 station-pair, or None if the station-pair cannot be processed
+        """
+        nonlocal stationInvCache
         netsta1inv, stationInvCache = getStationInventory(inv, stationInvCache, netsta1)
         netsta2inv, stationInvCache = getStationInventory(inv, stationInvCache, netsta2)
 
@@ -329,7 +394,7 @@ def process(data_source1, data_source2, output_path,
         if(len(corr_chans)<2):
             print(('Either required channels are not found for station %s or %s, '
                    'or no overlapping data exists..')%(netsta1, netsta2))
-            continue
+            return None
         # end if
 
         baz_netsta1 = None
@@ -342,21 +407,236 @@ def process(data_source1, data_source2, output_path,
             except Exception as e:
                 print (e)
                 print (('Failed to compute back-azimuth for station-pairs; skipping %s.%s; '%(netsta1, netsta2)))
-                continue
+                return None
             # end try
         # end if
 
-        x, xCorrResDict, wcResDict = IntervalStackXCorr(ds1.fds, ds2.fds, startTime,
-                                                        endTime, netsta1, netsta2, netsta1inv, netsta2inv,
+        return netsta1inv, netsta2inv, corr_chans, baz_netsta1, baz_netsta2
+    # end func
+
+    # results are checkpointed for each (station-pair, read-buffer), independent of the number of
+    # processors and the order in which station-pairs are processed
+    checkpoint = XcorrCheckpoint(output_folder=output_path, restart_mode=restart)
+
+    # each processor writes to its own store; stores are merged at the end
+    xcorr_store = None
+    store_fn = os.path.join(output_path, 'xcorr.%s.h5' % (time_tag) if time_tag else 'xcorr.h5')
+    if(output_format == 'hdf5'):
+        if(rank == 0):
+            # stores left behind by an interrupted run, which may have used a different number of
+            # processors, hold results for completed station-pairs, which are skipped in this run, and
+            # partial results for others, which are recomputed
+            if(restart):
+                recover_rank_stores(store_fn, output_path, checkpoint)
+            else:
+                for fn in rank_store_file_names(output_path): os.remove(fn)
+            # end if
+        # end if
+        comm.Barrier()
+
+        xcorr_store = XcorrStore(rank_store_file_name(output_path, rank), mode='w')
+    # end if
+
+    startTime = UTCDateTime(start_time)
+    endTime = UTCDateTime(end_time)
+    if(scheduler == 'static'):
+        for pair in proc_stations[rank]:
+            netsta1, netsta2 = pair
+
+            if (checkpoint.is_done('%s.%s'%(netsta1, netsta2))):
+                print (('Found results for station-pair: %s.%s. Moving along..'%(netsta1, netsta2)))
+                continue
+            # end if
+
+            setup = setup_pair(netsta1, netsta2)
+            if(setup is None): continue
+            netsta1inv, netsta2inv, corr_chans, baz_netsta1, baz_netsta2 = setup
+
+            x, xCorrResDict, wcResDict = IntervalStackXCorr(ds1.fds, ds2.fds, startTime,
+                                                            endTime, netsta1, netsta2, netsta1inv, netsta2inv,
+                                                            instrument_response_output, water_level,
+                                                            corr_chans[0], corr_chans[1],
+                                                            baz_netsta1, baz_netsta2,
+                                                            resample_rate, taper_length, read_buffer_size,
+                                                            interval_seconds,
+                                                            window_seconds, window_overlap, window_buffer_length,
+                                                            fmin, fmax, clip_to_2std, whitening,
+                                                            whitening_window_frequency,
+                                                            one_bit_normalize, envelope_normalize, ensemble_stack,
+                                                            output_path, 2, time_tag, spectra_cache,
+                                                            response_cache, xcorr_store, checkpoint,
+                                                            return_results=False, ne_cache=ne_cache)
+        # end for
+    else:
+        #######################################
+        # Process (station-pair, time-chunk) units on demand; idle ranks claim the next unit
+        # through a shared counter, so that no rank waits on others holding long-overlap pairs
+        #######################################
+        partials_path = os.path.join(output_path, 'partials')
+        if(rank == 0): os.makedirs(partials_path, exist_ok=True)
+        comm.Barrier()
+
+        def partial_file_name(netsta1, netsta2, chunk_start):
+            return os.path.join(partials_path, '%s.%s.%d.npz' % (netsta1, netsta2, int(chunk_start)))
+        # end func
+
+        log_fn = 'correlator.rank%d.%s.log' % (rank, time_tag) if time_tag else 'correlator.rank%d.log' % (rank)
+        logger = setup_logger('correlator.rank%d' % (rank), os.path.join(output_path, log_fn))
+
+        t0 = time.time()
+        busy_time = 0
+        unit_count = 0
+        pair_setups = {}
+        counter = SharedCounter(comm)
+        while True:
+            iunit = counter.next()
+            if(iunit >= len(work_units)): break
+
+            netsta1, netsta2, chunk_start, chunk_end, _ = work_units[iunit]
+            fn = partial_file_name(netsta1, netsta2, chunk_start)
+            if(checkpoint.is_done('%s.%s'%(netsta1, netsta2)) or (restart and os.path.exists(fn))):
+                print (('Found results for work-unit: %s.%s [%s - %s]. Moving along..' %
+                        (netsta1, netsta2, UTCDateTime(chunk_start), UTCDateTime(chunk_end))))
+                continue
+            # end if
+
+            tu = time.time()
+            if((netsta1, netsta2) not in pair_setups):
+                pair_setups[(netsta1, netsta2)] = setup_pair(netsta1, netsta2)
+            # end if
+            setup = pair_setups[(netsta1, netsta2)]
+            if(setup is None): continue
+            netsta1inv, netsta2inv, corr_chans, baz_netsta1, baz_netsta2 = setup
+
+            xcl, wcl, istl, ietl, sr = xcorr_time_range(ds1.fds, ds2.fds, UTCDateTime(chunk_start),
+                                                        UTCDateTime(chunk_end), netsta1, netsta2,
+                                                        netsta1inv, netsta2inv,
                                                         instrument_response_output, water_level,
                                                         corr_chans[0], corr_chans[1],
                                                         baz_netsta1, baz_netsta2,
-                                                        resample_rate, taper_length, read_buffer_size, interval_seconds,
-                                                        window_seconds, window_overlap, window_buffer_length,
-                                                        fmin, fmax, clip_to_2std, whitening, whitening_window_frequency,
-                                                        one_bit_normalize, envelope_normalize, ensemble_stack,
-                                                        output_path, 2, time_tag)
-    # end for
+                                                        resample_rate=resample_rate, taper_length=taper_length,
+                                                        buffer_seconds=read_buffer_size,
+                                                        interval_seconds=interval_seconds,
+                                                        window_seconds=window_seconds,
+                                                        window_overlap=window_overlap,
+                                                        window_buffer_length=window_buffer_length,
+                                                        flo=fmin, fhi=fmax, clip_to_2std=clip_to_2std,
+                                                        whitening=whitening,
+                                                        whitening_window_frequency=whitening_window_frequency,
+                                                        one_bit_normalize=one_bit_normalize,
+                                                        envelope_normalize=envelope_normalize,
+                                                        verbose=2, logger=logger, spectra_cache=spectra_cache,
+                                                        response_cache=response_cache, checkpoint=checkpoint,
+                                                        ne_cache=ne_cache)
+
+            params = xcorr_parameters(corr_chans[0], corr_chans[1], netsta1inv, netsta2inv,
+                                      instrument_response_output, water_level, resample_rate, taper_length,
+                                      read_buffer_size, interval_seconds, window_seconds, window_overlap,
+                                      window_buffer_length, fmin, fmax, clip_to_2std, whitening,
+                                      whitening_window_frequency, one_bit_normalize, envelope_normalize,
+                                      ensemble_stack)
+
+            # save partial results, written atomically
+            tmp_fn = fn[:-4] + '.tmp.npz'
+            if(len(xcl)):
+                _, xc, wc, ist, iet = combine_xcorr_results(xcl, wcl, istl, ietl, sr, window_seconds,
+                                                            ensemble_stack=ensemble_stack, logger=logger)
+                np.savez(tmp_fn, xcorr=xc, window_counts=wc, interval_start_times=ist,
+                         interval_end_times=iet, sr=sr, params=json.dumps(params))
+            else:
+                np.savez(tmp_fn, xcorr=np.zeros((0, 0)), params=json.dumps(params))
+            # end if
+            os.replace(tmp_fn, fn)
+
+            busy_time += time.time() - tu
+            unit_count += 1
+        # wend
+        elapsed = time.time() - t0
+
+        comm.Barrier()
+        counter.free()
+
+        # report per-rank utilisation
+        utilisation = comm.gather((unit_count, busy_time, elapsed), root=0)
+        if(rank == 0):
+            makespan = np.max([u[2] for u in utilisation])
+            print('%6s %10s %12s %12s' % ('Rank', 'Work-units', 'Busy (s)', 'Utilisation'))
+            for irank, (uc, bt, _) in enumerate(utilisation):
+                print('%6d %10d %12.1f %11.1f%%' % (irank, uc, bt, 100 * bt / makespan if makespan else 0))
+            # end for
+            print('Makespan: %.1f s, mean utilisation: %.1f%%' %
+                  (makespan, 100 * np.mean([u[1] for u in utilisation]) / makespan if makespan else 0))
+        # end if
+
+        #######################################
+        # Merge partial results for each station-pair, in time order
+        #######################################
+        pair_units = defaultdict(list)
+        for netsta1, netsta2, chunk_start, _, _ in work_units:
+            pair_units[(netsta1, netsta2)].append(chunk_start)
+        # end for
+
+        for pair in split_list(sorted(pair_units.keys()), npartitions=nproc)[rank]:
+            netsta1, netsta2 = pair
+            stationPair = '%s.%s' % (netsta1, netsta2)
+            fns = [partial_file_name(netsta1, netsta2, cst) for cst in sorted(pair_units[pair])]
+
+            # partial results are streamed to the output, one work-unit at a time
+            writer = None
+            params = None
+            for fn in fns:
+                if(not os.path.exists(fn)): continue
+
+                with np.load(fn) as npz:
+                    params = json.loads(str(npz['params']))
+                    if(npz['xcorr'].size == 0): continue
+
+                    if(writer is None):
+                        coords1 = ds1.fds.unique_coordinates[netsta1]
+                        coords2 = ds2.fds.unique_coordinates[netsta2]
+                        if(xcorr_store is not None):
+                            writer = xcorr_store.writer(stationPair, coords1, coords2, window_seconds,
+                                                        ensemble_stack, params, logger=logger)
+                        else:
+                            ofn = os.path.join(output_path, '%s.nc' % (stationPair if not time_tag else
+                                                                       '.'.join([stationPair, time_tag])))
+                            writer = NetCDFXcorrResultsWriter(ofn, stationPair, coords1, coords2, window_seconds,
+                                                              ensemble_stack, params, logger=logger)
+                        # end if
+                    # end if
+
+                    writer.append(npz['xcorr'], npz['window_counts'], npz['interval_start_times'],
+                                  npz['interval_end_times'], float(npz['sr']))
+                # end with
+            # end for
+            if(writer is not None): writer.close()
+
+            if(params is not None): checkpoint.mark_done(stationPair, has_results=writer is not None)
+            for fn in fns:
+                if(os.path.exists(fn)): os.remove(fn)
+            # end for
+        # end for
+    # end if
+
+    if(spectra_cache is not None):
+        print('Rank %d: spectra-cache stats: %s' % (rank, str(spectra_cache.stats())))
+        spectra_cache.clear()
+    # end if
+
+    if(ne_cache is not None):
+        print('Rank %d: NE-stream-cache stats: %s' % (rank, str(ne_cache.stats())))
+        ne_cache.clear()
+    # end if
+
+    if(xcorr_store is not None):
+        xcorr_store.close()
+        comm.Barrier()
+
+        if(rank == 0):
+            npairs = merge_xcorr_stores(store_fn, rank_store_file_names(output_path))
+            print('Results for %d station-pairs written to %s' % (npairs, store_fn))
+        # end if
+    # end if
 # end func
 
 
@@ -468,16 +748,52 @@ CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
                                                      "'interval-seconds' are in turn stacked to produce a "
                                                      "single CC function, aimed at producing empirical Greens "
                                                      "functions for surface wave tomography.")
-@click.option('--restart', default=False, is_flag=True, help='Restart job')
+@click.option('--restart', default=False, is_flag=True,
+              help='Restart job. Results are checkpointed for each station-pair and read-buffer, so that station-pairs '
+                   'completed in a previous run are skipped, and those in progress resume from the last completed '
+                   'read-buffer; the number of processors and the scheduler can differ from those of the previous run, '
+                   'but other parameters must be the same')
 @click.option('--dry-run', default=False, is_flag=True, help='Dry run for printing out station-pairs and '
                                                              'additional stats.')
 @click.option('--no-tracking-tag', default=False, is_flag=True, help='Do not tag output file names with a time-tag')
+@click.option('--spectra-cache-size', default=1024, type=float,
+              help="Capacity (MB) of the in-memory cache of preprocessed window-spectra on each processor, which "
+                   "ensures that data-windows of a station are preprocessed only once, regardless of the number of "
+                   "station-pairs the station features in; 0 disables the in-memory cache")
+@click.option('--spectra-cache-folder', default=None, type=click.Path(),
+              help="Folder on local disk (e.g. node-local scratch) where window-spectra evicted from memory are kept "
+                   "for the duration of the job. Processors pointing to the same folder reuse each other's entries. "
+                   "Recommended when correlating long time-ranges, for which spectra do not fit in memory")
+@click.option('--scheduler', type=click.Choice(['static', 'dynamic']), default='static', show_default=True,
+              help="'static' splits station-pairs evenly across processors upfront. 'dynamic' splits the time-range "
+                   "of each station-pair into chunks, based on the time-ranges of data available, and hands out "
+                   "(station-pair, time-chunk) units to processors as they become idle; partial results are "
+                   "merged at the end")
+@click.option('--longest-first', default=False, is_flag=True,
+              help="Hand out work-units with the longest overlap of data first; only applies to the 'dynamic' "
+                   "scheduler")
+@click.option('--output-format', type=click.Choice(['netcdf', 'hdf5']), default='netcdf', show_default=True,
+              help="'netcdf' writes a NETCDF4 file for each station-pair. 'hdf5' writes results for all station-pairs "
+                   "to a single HDF5 store (xcorr[.<time-tag>].h5) in OUTPUT_PATH, with a group for each station-pair "
+                   "(NET.STA.NET.STA) holding the same variables as NETCDF4 files; recommended for large networks. "
+                   "Each processor writes to its own store (xcorr.rank<N>.h5), and stores are merged at the end; "
+                   "on restart, results for completed station-pairs in stores left behind by the interrupted run "
+                   "are merged as well")
+@click.option('--work-unit-size', default=10, type=int,
+              help="Length of time-chunks in work-units, as a multiple of 'read-buffer-size'; only applies to the "
+                   "'dynamic' scheduler")
+@click.option('--ne-cache-size', default=1024, type=float,
+              help="Capacity (MB) of the cache of conditioned north and east component data on each processor, "
+                   "used when correlating transverse components (--corr-chan t), so that data for a station are "
+                   "fetched once per read-buffer, regardless of the number of station-pairs the station features "
+                   "in; 0 disables the cache")
 def main(data_source1, data_source2, output_path, interval_seconds, window_seconds, window_overlap,
          window_buffer_length, resample_rate, taper_length, nearest_neighbours, fmin, fmax, station_names1,
          station_names2, pairs_to_compute, start_time, end_time, instrument_response_inventory, instrument_response_output,
          water_level, clip_to_2std, whitening, whitening_window_frequency, one_bit_normalize, read_buffer_size,
          ds1_zchan, ds1_nchan, ds1_echan, ds2_zchan, ds2_nchan, ds2_echan, corr_chan, envelope_normalize,
-         ensemble_stack, restart, dry_run, no_tracking_tag):
+         ensemble_stack, restart, dry_run, no_tracking_tag, spectra_cache_size, spectra_cache_folder,
+         scheduler, longest_first, work_unit_size, output_format, ne_cache_size):
     """
     :param data_source1: Text file containing paths to ASDF files
     :param data_source2: Text file containing paths to ASDF files
@@ -497,7 +813,8 @@ def main(data_source1, data_source2, output_path, interval_seconds, window_secon
             station_names2, pairs_to_compute, start_time, end_time, instrument_response_inventory, instrument_response_output,
             water_level, clip_to_2std, whitening, whitening_window_frequency, one_bit_normalize, read_buffer_size,
             ds1_zchan, ds1_nchan, ds1_echan, ds2_zchan, ds2_nchan, ds2_echan, corr_chan, envelope_normalize,
-            ensemble_stack, restart, dry_run, no_tracking_tag)
+            ensemble_stack, restart, dry_run, no_tracking_tag, spectra_cache_size, spectra_cache_folder,
+            scheduler, longest_first, work_unit_size, output_format, ne_cache_size)
 # end func
 
 if __name__ == '__main__':
@@ -1,9 +1,8 @@
-from mpi4py import MPI
 import os
 import numpy as np
 from scipy.spatial import cKDTree
 from collections import defaultdict
-from obspy import UTCDateTime, read_inventory, Inventory, Stream
+from obspy import UTCDateTime, read_inventory, Inventory, Stream, Trace
 from obspy.geodetics.base import gps2dist_azimuth
 
 # define utility functions
@@ -51,6 +50,51 @@ def split_list(lst, npartitions):
     return [lst[i * k + min(i, m):(i + 1) * k + min(i + 1, m)] for i in range(npartitions)]
 # end func
 
+def get_work_units(pairs, time_ranges, start_time, end_time, chunk_seconds, longest_first=False):
+    """
+    Splits the time-range of each station-pair into chunks, which are handed out as independent units of
+    work. Chunks are aligned to start_time, so that chunk boundaries coincide with those of read-buffers,
+    given chunk_seconds is a multiple of the read-buffer size.
+
+    :param pairs: list of (netsta1, netsta2) tuples
+    :param time_ranges: list of ((start1, end1), (start2, end2)) tuples, containing time-ranges of data
+                        available for each station in a pair
+    :param start_time: start of time-range to be processed
+    :param end_time: end of time-range to be processed
+    :param chunk_seconds: length of chunks in seconds
+    :param longest_first: sort units by expected cost, in descending order
+    :return: list of (netsta1, netsta2, chunk_start, chunk_end, cost) tuples, where chunk_start and
+             chunk_end are timestamps and cost is the overlap (s) of data available within the chunk.
+             Chunks without overlapping data are omitted
+    """
+    start_time = UTCDateTime(start_time).timestamp
+    end_time = UTCDateTime(end_time).timestamp
+
+    units = []
+    for (netsta1, netsta2), ((st1, et1), (st2, et2)) in zip(pairs, time_ranges):
+        ost = max(UTCDateTime(st1).timestamp, UTCDateTime(st2).timestamp, start_time)
+        oet = min(UTCDateTime(et1).timestamp, UTCDateTime(et2).timestamp, end_time)
+        if(ost >= oet): continue
+
+        k = np.floor((ost - start_time) / chunk_seconds)
+        while True:
+            cst = start_time + k * chunk_seconds
+            if(cst >= oet): break
+            cet = min(cst + chunk_seconds, end_time)
+
+            cost = min(cet, oet) - max(cst, ost)
+            if(cost > 0): units.append((netsta1, netsta2, cst, cet, cost))
+            k += 1
+        # wend
+    # end for
+
+    if(longest_first):
+        units = sorted(units, key=lambda u: -u[4])
+    # end if
+
+    return units
+# end func
+
 def drop_bogus_traces(st, sampling_rate_cutoff=1):
     """
     Removes spurious traces with suspect sampling rates.
@@ -63,27 +107,42 @@ def drop_bogus_traces(st, sampling_rate_cutoff=1):
     for tr in badTraces: st.remove(tr)
 # end func
 
-def _get_stream_00T(fds, net, sta, cha, start_time, end_time,
-                      baz=None, trace_count_threshold=200,
-                      logger=None, verbose=1):
+def rotate_ne_to_transverse(n, e, baz):
+    """
+    Rotates north and east component data to the transverse component, for one or more back-azimuths,
+    as a single vectorised linear combination
+
+    :param n: 1D array of north component samples; masked arrays are supported
+    :param e: 1D array of east component samples
+    :param baz: back-azimuth in degrees, or a sequence of back-azimuths
+    :return: 1D array of transverse component samples if baz is a scalar; otherwise a 2D array, with a
+             row for each back-azimuth
+    """
+    bazr = np.radians(baz)
+    if (np.ndim(bazr) == 0): return -e * np.cos(bazr) + n * np.sin(bazr)
 
+    return -e[np.newaxis, :] * np.cos(bazr)[:, np.newaxis] + n[np.newaxis, :] * np.sin(bazr)[:, np.newaxis]
+# end func
+
+def _get_ne_segments(fds, net, sta, start_time, end_time, trace_count_threshold=200, logger=None):
+    """
+    Fetches north and east component data for a station, merged and trimmed to a common time-range
+
+    :return: list of (stats, n, e) tuples, one for each pair of N/E channels, where stats are those of
+             the east component and n and e are arrays of samples
+    """
     stations = fds.get_stations(start_time, end_time, network=net, station=sta)
 
     stations_nch = [s for s in stations if 'N' == s[3][-1].upper() or '1' == s[3][-1]]  # only N channels
     stations_ech = [s for s in stations if 'E' == s[3][-1].upper() or '2' == s[3][-1]]  # only E channels
 
-    stt = Stream()
+    segments = []
     if (len(stations_nch) > 0 and len(stations_nch) == len(stations_ech)):
         for codesn, codese in zip(stations_nch, stations_ech):
 
-            stn = fds.get_waveforms(codesn[0], codesn[1], codesn[2], codesn[3],
-                                    start_time,
-                                    end_time,
-                                    trace_count_threshold=trace_count_threshold)
-            ste = fds.get_waveforms(codese[0], codese[1], codese[2], codese[3],
-                                    start_time,
-                                    end_time,
-                                    trace_count_threshold=trace_count_threshold)
+            stn, ste = fds.get_waveforms_bulk([(codesn[0], codesn[1], codesn[2], codesn[3], start_time, end_time),
+                                               (codese[0], codese[1], codese[2], codese[3], start_time, end_time)],
+                                              trace_count_threshold=trace_count_threshold)
 
             if (len(stn) == 0): continue
             if (len(ste) == 0): continue
@@ -103,39 +162,66 @@ def _get_stream_00T(fds, net, sta, cha, start_time, end_time,
 
                 stn = stn.slice(starttime = max_start_time, endtime= min_end_time)
                 ste = ste.slice(starttime=max_start_time, endtime=min_end_time)
-            except Exception as e:
+            except Exception:
                 if logger: logger.warning('\tFailed to merge traces..')
-                st = None
                 raise
             # end try
 
-            bazr = np.radians(baz)
-            tdata = -ste[0].data * np.cos(bazr) + stn[0].data * np.sin(bazr)
+            segments.append((ste[0].stats, stn[0].data, ste[0].data))
+        # end for
+    # end if
+
+    return segments
+# end func
 
-            stt_curr = ste.copy()
-            stt_curr[0].data = tdata
-            #stt_curr[0].stats.channel = '00T'
+def _get_stream_00T(fds, net, sta, cha, start_time, end_time,
+                      baz=None, trace_count_threshold=200,
+                      logger=None, verbose=1, ne_cache=None):
+    """
+    Fetches the transverse component for a station, for one or more back-azimuths. Conditioned north
+    and east component data are fetched through ne_cache, if provided, so that they are read and merged
+    once for each station and time-range.
 
-            stt += stt_curr
-        # end for
+    :return: Stream if baz is a scalar; otherwise a list of Streams, one for each back-azimuth
+    """
+    segments = None
+    if (ne_cache is not None):
+        key = (fds.asdf_source, net, sta, UTCDateTime(start_time).timestamp, UTCDateTime(end_time).timestamp,
+               trace_count_threshold)
+        segments = ne_cache.get(key)
+    # end if
+
+    if (segments is None):
+        segments = _get_ne_segments(fds, net, sta, start_time, end_time,
+                                    trace_count_threshold=trace_count_threshold, logger=logger)
+        if (ne_cache is not None): ne_cache.put(key, segments)
     # end if
 
-    return stt
+    bazs = np.atleast_1d(baz)
+    streams = [Stream() for _ in bazs]
+    for stats, n, e in segments:
+        tdata = rotate_ne_to_transverse(n, e, bazs)
+        for stt, td in zip(streams, tdata):
+            stt += Trace(data=td, header=stats.copy())
+        # end for
+    # end for
+
+    return streams[0] if (np.ndim(baz) == 0) else streams
 # end func
 
 def get_stream(fds, net, sta, cha, start_time, end_time,
                baz=None, trace_count_threshold=200,
-               logger=None, verbose=1):
+               logger=None, verbose=1, ne_cache=None):
 
     if (cha == '00T'): return _get_stream_00T(fds, net, sta, cha, start_time, end_time,
                                               baz=baz, trace_count_threshold=trace_count_threshold,
-                                              logger=logger, verbose=verbose)
+                                              logger=logger, verbose=verbose, ne_cache=ne_cache)
     st = Stream()
     stations = fds.get_stations(start_time, end_time, network=net, station=sta)
-    for codes in stations:
-        if (cha != codes[3]): continue
-        st += fds.get_waveforms(codes[0], codes[1], codes[2], codes[3], start_time,
-                               end_time, trace_count_threshold=trace_count_threshold)
+    requests = [(codes[0], codes[1], codes[2], codes[3], start_time, end_time)
+                for codes in stations if cha == codes[3]]
+    for s in fds.get_waveforms_bulk(requests, trace_count_threshold=trace_count_threshold):
+        st += s
     # end for
 
     drop_bogus_traces(st)
@@ -151,7 +237,7 @@ def get_stream(fds, net, sta, cha, start_time, end_time,
     # to detect and ignore windows that have gaps in their data.
     try:
         st.merge()
-    except Exception as e:
+    except Exception:
         if logger: logger.warning('\tFailed to merge traces..')
         st = None
         raise
@@ -160,40 +246,131 @@ def get_stream(fds, net, sta, cha, start_time, end_time,
     return st
 # end func
 
-class ProgressTracker:
+class XcorrCheckpoint:
     def __init__(self, output_folder, restart_mode=False):
-        self.output_folder = output_folder
+        """
+        Checkpoints cross-correlation results for each (station-pair, read-buffer), so that interrupted
+        runs can be resumed without losing more than a buffer's worth of work. Checkpoints are keyed by
+        station-pair and buffer start-time, and are thus independent of the number of processors and of
+        the order in which station-pairs are processed. Note that resumed runs must use the same
+        parameters as the interrupted run.
+
+        Results for each buffer are saved in checkpoints/NET.STA.NET.STA/<buffer-start-timestamp>.npz
+        and station-pairs whose results have been written out are marked by checkpoints/NET.STA.NET.STA.done,
+        at which point checkpoints for individual buffers are removed.
+
+        :param output_folder: output folder
+        :param restart_mode: load checkpoints saved by a previous run; otherwise checkpoints are only saved
+        """
         self.restart_mode = restart_mode
+        self.checkpoint_folder = os.path.join(output_folder, 'checkpoints')
+        os.makedirs(self.checkpoint_folder, exist_ok=True)
+    # end func
 
-        self.comm = MPI.COMM_WORLD
-        self.nproc = self.comm.Get_size()
-        self.rank = self.comm.Get_rank()
-
-        self.prev_progress = 0 # progress from a previous run
-        self.progress = 0
-        self.proc_fn = os.path.join(output_folder, 'prog.%d.txt' % (self.rank))
+    def _pair_folder(self, station_pair):
+        return os.path.join(self.checkpoint_folder, station_pair)
+    # end func
 
-        if(self.restart_mode):
-            if(not os.path.exists(self.proc_fn)):
-                raise Exception('Progress file (%s) not found'%(self.proc_fn))
-            # end if
+    def _file_name(self, station_pair, buffer_start):
+        return os.path.join(self._pair_folder(station_pair), '%d.npz' % (int(UTCDateTime(buffer_start).timestamp)))
+    # end func
 
-            self.prev_progress = int(open(self.proc_fn).read())
+    def save(self, station_pair, buffer_start, result):
+        """
+        :param station_pair: NET.STA.NET.STA
+        :param buffer_start: start-time of buffer
+        :param result: tuple of results returned by xcorr2 for the buffer; elements are None if no
+                       results were produced
+        """
+        os.makedirs(self._pair_folder(station_pair), exist_ok=True)
+
+        fn = self._file_name(station_pair, buffer_start)
+        tmpfn = fn[:-4] + '.tmp.npz'
+        xcl, wins, ist, iet, sr = result
+        if(xcl is None):
+            np.savez(tmpfn, sr=-1 if sr is None else sr)
+        else:
+            np.savez(tmpfn, xcorr=xcl, window_counts=wins, interval_start_times=ist, interval_end_times=iet, sr=sr)
         # end if
+        os.replace(tmpfn, fn)
     # end func
 
-    def increment(self):
-        self.progress += 1
-        if(self.restart_mode and (self.prev_progress > 0) and (self.progress < self.prev_progress)):
-            return False
-        else:
-            tmpfn = self.proc_fn + '.tmp'
-            f = open(tmpfn, 'w+')
-            f.write(str(self.progress))
-            f.close()
-            os.rename(tmpfn, self.proc_fn)
+    def is_saved(self, station_pair, buffer_start):
+        """
+        :return: True if results for the buffer can be loaded from a checkpoint
+        """
+        return self.restart_mode and os.path.exists(self._file_name(station_pair, buffer_start))
+    # end func
+
+    def load(self, station_pair, buffer_start):
+        """
+        :param station_pair: NET.STA.NET.STA
+        :param buffer_start: start-time of buffer
+        :return: tuple of results saved for the buffer, as passed to save, or None if none were saved
+        """
+        if(not self.restart_mode): return None
+
+        fn = self._file_name(station_pair, buffer_start)
+        if(not os.path.exists(fn)): return None
+
+        with np.load(fn) as npz:
+            sr = float(npz['sr'])
+            sr = None if sr < 0 else sr
+            if('xcorr' not in npz): return None, None, None, None, sr
+
+            return npz['xcorr'], npz['window_counts'], npz['interval_start_times'], \
+                   npz['interval_end_times'], sr
+        # end with
+    # end func
+
+    def is_done(self, station_pair):
+        """
+        :return: True if results for the station-pair were written out in a previous run
+        """
+        return self.restart_mode and os.path.exists(self._pair_folder(station_pair) + '.done')
+    # end func
 
-            return True
+    def mark_done(self, station_pair, has_results=True):
+        """
+        Marks a station-pair as completed and removes checkpoints saved for its buffers
+
+        :param station_pair: NET.STA.NET.STA
+        :param has_results: False if no results were produced for the station-pair, and thus none were
+                            written out
+        """
+        with open(self._pair_folder(station_pair) + '.done', 'w') as fh:
+            if(not has_results): fh.write('no-results')
+        # end with
+
+        folder = self._pair_folder(station_pair)
+        if(os.path.exists(folder)):
+            for fn in os.listdir(folder): os.remove(os.path.join(folder, fn))
+            os.rmdir(folder)
         # end if
     # end func
+
+    def done_station_pairs(self):
+        """
+        :return: list of station-pairs marked as completed
+        """
+        return sorted([fn[:-5] for fn in os.listdir(self.checkpoint_folder) if fn.endswith('.done')])
+    # end func
+
+    def has_results(self, station_pair):
+        """
+        :return: True if results were written out for a station-pair marked as completed
+        """
+        with open(self._pair_folder(station_pair) + '.done', 'r') as fh:
+            return fh.read().strip() != 'no-results'
+        # end with
+    # end func
+
+    def unmark_done(self, station_pair):
+        """
+        Removes the completion mark of a station-pair, e.g. when its results were lost, so that the
+        station-pair is processed afresh
+        """
+        fn = self._pair_folder(station_pair) + '.done'
+        if(os.path.exists(fn)): os.remove(fn)
+    # end func
 # end class
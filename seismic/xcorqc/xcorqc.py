@@ -22,7 +22,9 @@ Revision History:
 import os
 import logging
 import math
+import warnings
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import scipy
@@ -32,12 +34,13 @@ from obspy import Trace
 from obspy.signal.filter import bandpass, highpass, lowpass
 from obspy.geodetics.base import gps2dist_azimuth
 from scipy import signal
+from scipy.ndimage import uniform_filter1d
 
 from seismic.xcorqc.fft import *
 from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
 from seismic.xcorqc.utils import get_stream
+from seismic.xcorqc.cache import ResponseCache
 from netCDF4 import Dataset
-from functools import reduce
 
 logging.basicConfig()
 
@@ -59,25 +62,34 @@ def setup_logger(name, log_file, level=logging.INFO):
 
 
 def zeropad(tr, padlen):
-    assert (tr.shape[0] < padlen)
-    padded = np.zeros(padlen)
-    padded[0:tr.shape[0]] = tr
+    """
+    Zero-pads samples, along the last axis, to padlen
+    """
+    assert (tr.shape[-1] < padlen)
+    padded = np.zeros(tr.shape[:-1] + (padlen,))
+    padded[..., 0:tr.shape[-1]] = tr
     return padded
 # end func
 
 
 def zeropad_ba(tr, padlen):
-    assert (tr.shape[0] < padlen)
-    padded = np.zeros(padlen, dtype=np.complex_)
-    s = int((padlen - tr.shape[0]) / 2)
-    padded[s:(s + tr.shape[0])] = scipy.fftpack.fftshift(tr)
-    return scipy.fftpack.ifftshift(padded)
+    """
+    Zero-pads a spectrum, along the last axis, symmetrically about the zero-frequency bin
+    """
+    assert (tr.shape[-1] < padlen)
+    padded = np.zeros(tr.shape[:-1] + (padlen,), dtype=np.complex_)
+    s = int((padlen - tr.shape[-1]) / 2)
+    padded[..., s:(s + tr.shape[-1])] = scipy.fftpack.fftshift(tr, axes=-1)
+    return scipy.fftpack.ifftshift(padded, axes=-1)
 # end func
 
 
 def taper(tr, taperlen):
-    tr[0:taperlen] *= 0.5 * (1 + np.cos(np.linspace(-math.pi, 0, taperlen)))
-    tr[-taperlen:] *= 0.5 * (1 + np.cos(np.linspace(0, math.pi, taperlen)))
+    """
+    Applies a cosine taper of taperlen samples to either end of the samples, along the last axis
+    """
+    tr[..., 0:taperlen] *= 0.5 * (1 + np.cos(np.linspace(-math.pi, 0, taperlen)))
+    tr[..., -taperlen:] *= 0.5 * (1 + np.cos(np.linspace(0, math.pi, taperlen)))
     return tr
 # end func
 
@@ -89,41 +101,427 @@ def whiten(a, sampling_rate, window_freq=0):
     nonzero, a smoothed amplitude spectrum (smoothing window length is as computed below) is used
     to normalize the frequency bins.
 
-    :param a: trace samples
+    :param a: trace samples; for 2D arrays, each row is whitened independently
     :param sampling_rate: sampling rate
     :param window_freq: smoothing window length (Hz)
     :return: spectrally whitened samples
     """
     # frequency step
-    npts = a.shape[0]
+    npts = a.shape[-1]
     deltaf = sampling_rate / npts
 
-    ffta = np.fft.rfft(a)
+    ffta = rfft(a, axis=-1)
 
     # smooth amplitude spectrum
     halfwindow = int(round(window_freq / deltaf / 2.0))
 
     if halfwindow > 0:
         # moving average
-        weight = np.convolve(np.abs(ffta), np.ones(halfwindow * 2 + 1) / (halfwindow * 2 + 1), mode='same')
+        weight = uniform_filter1d(np.abs(ffta), halfwindow * 2 + 1, axis=-1, mode='constant')
     else:
         weight = np.abs(ffta)
 
     ss = ffta / weight
 
-    a = np.fft.irfft(ss)
+    a = irfft(ss, axis=-1)
 
     return a
 # end func
 
 
+def _sosfilt_2d(data, sos, zerophase):
+    """
+    Applies a filter in second-order sections along the last axis, as done in obspy.signal.filter
+    """
+    if zerophase:
+        firstpass = signal.sosfilt(sos, data, axis=-1)
+        return signal.sosfilt(sos, firstpass[..., ::-1], axis=-1)[..., ::-1]
+    else:
+        return signal.sosfilt(sos, data, axis=-1)
+    # end if
+# end func
+
+
+def lowpass_2d(data, freq, df, corners=4, zerophase=False):
+    """
+    Equivalent to obspy.signal.filter.lowpass, applied to each row of a 2D array
+    """
+    f = freq / (0.5 * df)
+    if f > 1:
+        f = 1.0
+        warnings.warn('Selected corner frequency is above Nyquist. Setting Nyquist as high corner.')
+    # end if
+
+    z, p, k = signal.iirfilter(corners, f, btype='lowpass', ftype='butter', output='zpk')
+    return _sosfilt_2d(data, signal.zpk2sos(z, p, k), zerophase)
+# end func
+
+
+def highpass_2d(data, freq, df, corners=4, zerophase=False):
+    """
+    Equivalent to obspy.signal.filter.highpass, applied to each row of a 2D array
+    """
+    f = freq / (0.5 * df)
+    if f > 1:
+        raise ValueError('Selected corner frequency is above Nyquist.')
+    # end if
+
+    z, p, k = signal.iirfilter(corners, f, btype='highpass', ftype='butter', output='zpk')
+    return _sosfilt_2d(data, signal.zpk2sos(z, p, k), zerophase)
+# end func
+
+
+def bandpass_2d(data, freqmin, freqmax, df, corners=4, zerophase=False):
+    """
+    Equivalent to obspy.signal.filter.bandpass, applied to each row of a 2D array
+    """
+    fe = 0.5 * df
+    low = freqmin / fe
+    high = freqmax / fe
+    if high - 1.0 > -1e-6:
+        warnings.warn('Selected high corner frequency ({}) of bandpass is at or above Nyquist ({}). '
+                      'Applying a high-pass instead.'.format(freqmax, fe))
+        return highpass_2d(data, freq=freqmin, df=df, corners=corners, zerophase=zerophase)
+    # end if
+    if low > 1:
+        raise ValueError('Selected low corner frequency is above Nyquist.')
+    # end if
+
+    z, p, k = signal.iirfilter(corners, [low, high], btype='band', ftype='butter', output='zpk')
+    return _sosfilt_2d(data, signal.zpk2sos(z, p, k), zerophase)
+# end func
+
+
+def resample_2d(data, sampling_rate, new_sampling_rate):
+    """
+    Equivalent to obspy.Trace.resample (with window='hann' and no_filter=True), applied to each
+    row of a 2D array: spectra are windowed and linearly interpolated onto the frequencies of the
+    resampled signal.
+
+    :param data: 2D array of samples
+    :param sampling_rate: sampling rate of data
+    :param new_sampling_rate: sampling rate after resampling
+    :return: 2D array of resampled samples
+    """
+    npts = data.shape[-1]
+    factor = sampling_rate / float(new_sampling_rate)
+    num = int(npts / factor)
+
+    x = rfft(data, axis=-1)
+    x = x * np.fft.ifftshift(signal.get_window('hann', npts))[:npts // 2 + 1]
+
+    # interpolate real and imaginary parts onto the new frequencies
+    f = sampling_rate / float(npts) * np.arange(0, npts // 2 + 1, dtype=np.int32)
+    large_f = 1.0 / num * new_sampling_rate * np.arange(0, num // 2 + 1, dtype=np.int32)
+    # all rows share the same frequencies, so that interpolation indices and weights, matching those of
+    # np.interp, are computed once and applied to all rows at once
+    if(f.shape[0] > 1):
+        idx = np.clip(np.searchsorted(f, large_f, side='right') - 1, 0, f.shape[0] - 2)
+        w = np.clip((large_f - f[idx]) / (f[idx + 1] - f[idx]), 0., 1.)
+        large_y = x[..., idx] * (1. - w) + x[..., idx + 1] * w
+    else:
+        large_y = np.repeat(x[..., :1], large_f.shape[0], axis=-1)
+    # end if
+
+    return irfft(large_y, n=num, axis=-1) * (float(num) / float(npts))
+# end func
+
+
+def preprocess_window(tr, ws, we, sr_orig, sr, inv, window_samples, window_buffer_seconds,
+                      taper_length, instrument_response_output='vel', water_level=50.,
+                      resample_rate=None, flo=None, fhi=None, clip_to_2std=False, whitening=False,
+                      whitening_window_frequency=0, one_bit_normalize=False, logger=None):
+    """
+    Applies the preprocessing steps preceding cross-correlation to a window of trace samples. This is
+    the reference, per-window implementation; xcorr2 uses the batched equivalent, preprocess_windows
+
+    :param tr: obspy Trace
+    :param ws: index of first sample of the window
+    :param we: index past the last sample of the window
+    :param sr_orig: sampling rate of tr
+    :param sr: sampling rate after resampling; equals sr_orig if no resampling is performed
+    :param inv: Inventory containing instrument response for the station; None skips response removal
+    :param window_samples: number of samples in a (buffered) window
+    :param window_buffer_seconds: length (s) of buffers around the window of interest
+    :param taper_length: taper length as a fraction of window length, adjusted for buffers
+    :return: preprocessed samples of the window of interest
+    """
+    tr_d = np.array(tr.data[ws:we], dtype=np.float32)
+
+    # STEP 1: detrend
+    tr_d = signal.detrend(tr_d)
+
+    # STEP 2: demean
+    tr_d -= np.mean(tr_d)
+
+    # STEP 3: remove response
+    if inv:
+        resp_tr = Trace(data=tr_d,
+                        header=Stats(header={'sampling_rate': sr_orig,
+                                             'npts': len(tr_d),
+                                             'network': tr.stats.network,
+                                             'station': tr.stats.station,
+                                             'location': tr.stats.location,
+                                             'channel': tr.stats.channel,
+                                             'starttime': tr.stats.starttime + float(ws)/sr_orig,
+                                             'endtime': tr.stats.starttime + float(we)/sr_orig}))
+        try:
+            resp_tr.remove_response(inventory=inv, output=instrument_response_output.upper(),
+                                    water_level=water_level)
+        except Exception as e:
+            if logger: logger.error(str(e))
+        # end try
+
+        tr_d = resp_tr.data
+    # end if
+
+    # STEPS 4, 5: resample after lowpass @ resample_rate/2 Hz
+    if resample_rate:
+        tr_d = lowpass(tr_d, resample_rate/2., sr_orig, corners=2, zerophase=True)
+
+        tr_d = Trace(data=tr_d,
+                     header=Stats(header={'sampling_rate': sr_orig,
+                                          'npts': window_samples})).resample(resample_rate,
+                                                                             no_filter=True).data
+    # end if
+
+    # STEP 6: Bandpass
+    if flo and fhi:
+        tr_d = bandpass(tr_d, flo, fhi, sr, corners=2, zerophase=True)
+    # end if
+
+    # STEP 7: time-domain normalization
+    # clip to +/- 2*std
+    if clip_to_2std:
+        std_tr = np.std(tr_d)
+        clip_indices_tr = np.fabs(tr_d) > 2 * std_tr
+
+        tr_d[clip_indices_tr] = 2 * std_tr * np.sign(tr_d[clip_indices_tr])
+    # end if
+
+    # 1-bit normalization
+    if one_bit_normalize:
+        tr_d = np.sign(tr_d)
+    # end if
+
+    # Apply Rhys Hawkins-style default time domain normalization
+    if (clip_to_2std == 0) and (one_bit_normalize == 0):
+        # 0-mean
+        tr_d -= np.mean(tr_d)
+
+        # unit-std
+        tr_d /= np.std(tr_d)
+    # end if
+
+    # STEP 8: taper
+    if taper_length > 0:
+        tr_d = taper(tr_d, int(np.round(taper_length*tr_d.shape[0])))
+    # end if
+
+    # STEP 9: spectral whitening
+    if whitening:
+        tr_d = whiten(tr_d, sr, window_freq=whitening_window_frequency)
+
+        # STEP 10: taper
+        if taper_length > 0:
+            tr_d = taper(tr_d, int(np.round(taper_length*tr_d.shape[0])))
+        # end if
+    # end if
+
+    # STEP 11: Final bandpass
+    # apply zero-phase bandpass
+    if flo and fhi:
+        tr_d = bandpass(tr_d, flo, fhi, sr, corners=2, zerophase=True)
+    # end if
+
+    if window_buffer_seconds:
+        # extract window of interest from buffered window
+        tr_d = tr_d[int(window_buffer_seconds*sr):-int(window_buffer_seconds*sr)]
+    # end if
+
+    return tr_d
+# end func
+
+
+def preprocess_windows(tr, starts, ends, sr_orig, sr, inv, window_samples, window_buffer_seconds,
+                       taper_length, instrument_response_output='vel', water_level=50.,
+                       resample_rate=None, flo=None, fhi=None, clip_to_2std=False, whitening=False,
+                       whitening_window_frequency=0, one_bit_normalize=False, logger=None,
+                       response_cache=None):
+    """
+    Batched equivalent of preprocess_window: windows of equal length are processed together, as rows
+    of a 2D array
+
+    :param starts: indices of first samples of windows
+    :param ends: indices past the last samples of windows
+    :param response_cache: ResponseCache instance; when provided, instrument responses are removed through \
+           cached transfer functions, applied to all windows within a channel epoch at once. Responses \
+           are otherwise removed from each window through obspy
+    :return: 2D array of preprocessed samples, with a row for each window
+    """
+    tr_d = np.array([tr.data[ws:we] for ws, we in zip(starts, ends)], dtype=np.float32)
+
+    # STEP 1: detrend
+    tr_d = signal.detrend(tr_d, axis=-1)
+
+    # STEP 2: demean
+    tr_d -= np.mean(tr_d, axis=-1, keepdims=True)
+
+    # STEP 3: remove response
+    if inv and response_cache is not None:
+        # windows within a channel epoch share a transfer function
+        epochs = defaultdict(list)
+        for i, ws in enumerate(starts):
+            try:
+                epoch_start, _ = response_cache.get_epoch(inv, tr.id, tr.stats.starttime + float(ws)/sr_orig)
+                epochs[epoch_start].append(i)
+            except Exception as e:
+                if logger: logger.error(str(e))
+            # end try
+        # end for
+
+        tr_d = np.array(tr_d, dtype=np.float64)
+        for rows in epochs.values():
+            tr_d[rows] = response_cache.remove_response(tr_d[rows], inv, tr.id,
+                                                        tr.stats.starttime + float(starts[rows[0]])/sr_orig,
+                                                        sr_orig, output=instrument_response_output.upper(),
+                                                        water_level=water_level)
+        # end for
+    elif inv:
+        rows = []
+        for i, (ws, we) in enumerate(zip(starts, ends)):
+            resp_tr = Trace(data=tr_d[i],
+                            header=Stats(header={'sampling_rate': sr_orig,
+                                                 'npts': tr_d.shape[1],
+                                                 'network': tr.stats.network,
+                                                 'station': tr.stats.station,
+                                                 'location': tr.stats.location,
+                                                 'channel': tr.stats.channel,
+                                                 'starttime': tr.stats.starttime + float(ws)/sr_orig,
+                                                 'endtime': tr.stats.starttime + float(we)/sr_orig}))
+            try:
+                resp_tr.remove_response(inventory=inv, output=instrument_response_output.upper(),
+                                        water_level=water_level)
+            except Exception as e:
+                if logger: logger.error(str(e))
+            # end try
+
+            rows.append(resp_tr.data)
+        # end for
+        tr_d = np.array(rows)
+    # end if
+
+    # STEPS 4, 5: resample after lowpass @ resample_rate/2 Hz
+    if resample_rate:
+        tr_d = lowpass_2d(tr_d, resample_rate/2., sr_orig, corners=2, zerophase=True)
+        tr_d = resample_2d(tr_d, sr_orig, resample_rate)
+    # end if
+
+    # STEP 6: Bandpass
+    if flo and fhi:
+        tr_d = bandpass_2d(tr_d, flo, fhi, sr, corners=2, zerophase=True)
+    # end if
+
+    # STEP 7: time-domain normalization
+    # clip to +/- 2*std
+    if clip_to_2std:
+        clip = 2 * np.std(tr_d, axis=-1, keepdims=True)
+        tr_d = np.where(np.fabs(tr_d) > clip, clip * np.sign(tr_d), tr_d)
+    # end if
+
+    # 1-bit normalization
+    if one_bit_normalize:
+        tr_d = np.sign(tr_d)
+    # end if
+
+    # Apply Rhys Hawkins-style default time domain normalization
+    if (clip_to_2std == 0) and (one_bit_normalize == 0):
+        # 0-mean
+        tr_d -= np.mean(tr_d, axis=-1, keepdims=True)
+
+        # unit-std
+        tr_d /= np.std(tr_d, axis=-1, keepdims=True)
+    # end if
+
+    # STEP 8: taper
+    if taper_length > 0:
+        tr_d = taper(tr_d, int(np.round(taper_length*tr_d.shape[-1])))
+    # end if
+
+    # STEP 9: spectral whitening
+    if whitening:
+        tr_d = whiten(tr_d, sr, window_freq=whitening_window_frequency)
+
+        # STEP 10: taper
+        if taper_length > 0:
+            tr_d = taper(tr_d, int(np.round(taper_length*tr_d.shape[-1])))
+        # end if
+    # end if
+
+    # STEP 11: Final bandpass
+    # apply zero-phase bandpass
+    if flo and fhi:
+        tr_d = bandpass_2d(tr_d, flo, fhi, sr, corners=2, zerophase=True)
+    # end if
+
+    if window_buffer_seconds:
+        # extract window of interest from buffered window
+        tr_d = tr_d[:, int(window_buffer_seconds*sr):-int(window_buffer_seconds*sr)]
+    # end if
+
+    return tr_d
+# end func
+
+
+def full_spectrum(half_spectrum, fftlen, flip_npts=None):
+    """
+    Expands the spectrum of a real signal, as returned by rfft, to the full spectrum as returned by fftn
+
+    :param half_spectrum: output of rfft for a signal zero-padded to fftlen samples; for 2D arrays, each \
+           row is expanded independently
+    :param fftlen: length of the transform
+    :param flip_npts: when provided, the spectrum of the time-reversed signal, i.e. of the first flip_npts \
+           samples in reverse order followed by zeros, is returned instead
+    :return: spectrum of length fftlen
+    """
+    result = np.concatenate((half_spectrum, np.conj(half_spectrum[..., 1:fftlen - fftlen // 2][..., ::-1])),
+                            axis=-1)
+
+    if flip_npts is not None:
+        # for a real signal, reversal in time amounts to conjugation and a phase-shift
+        k = np.arange(fftlen, dtype=np.int64) * (flip_npts - 1) % fftlen
+        result = np.conj(result) * np.exp(-2j * np.pi * k / float(fftlen))
+    # end if
+
+    return result
+# end func
+
+
 def xcorr2(tr1, tr2, sta1_inv=None, sta2_inv=None,
            instrument_response_output='vel', water_level=50.,
            window_seconds=3600, window_overlap=0.1, window_buffer_length=0,
            interval_seconds=86400, taper_length=0.05, resample_rate=None,
            flo=None, fhi=None, clip_to_2std=False, whitening=False,
            whitening_window_frequency=0, one_bit_normalize=False, envelope_normalize=False,
-           verbose=1, logger=None):
+           verbose=1, logger=None, spectra_cache=None, tr1_cache_tag=None, tr2_cache_tag=None,
+           window_batch_size_in_mb=128, response_cache=None):
+    """
+    Cross-correlates two traces over windows, stacked over intervals. See IntervalStackXCorr for
+    a description of the processing parameters.
+
+    :param spectra_cache: SpectraCache instance, from which spectra of preprocessed windows are fetched, \
+           if available, and to which they are added otherwise. A cache shared across station-pairs \
+           ensures that each station-window is preprocessed only once
+    :param tr1_cache_tag: additional component of cache keys for windows of tr1, which must be provided \
+           when the data in tr1 depend on more than its id, e.g. the back-azimuth for rotated components
+    :param tr2_cache_tag: as above, for windows of tr2
+    :param window_batch_size_in_mb: windows within an interval are processed together, as rows of 2D arrays, \
+           in batches whose spectra occupy up to this amount of memory (MB)
+    :param response_cache: ResponseCache instance, holding instrument-response transfer functions. A cache \
+           shared across station-pairs ensures that each response is evaluated only once
+    :return: tuple containing a 2D array of stacked cross-correlations (one row per interval), windows \
+             processed per interval, interval start- and end-times and the sampling rate of the results
+    """
 
     # Length of window_buffer in seconds
     window_buffer_seconds = window_buffer_length * window_seconds
@@ -162,6 +560,62 @@ def xcorr2(tr1, tr2, sta1_inv=None, sta2_inv=None,
     sr = max(sr1, sr2)
     xcorlen = int(2 * window_seconds * sr - 1)
     fftlen = 2 ** (int(np.log2(xcorlen)) + 1)
+    if sr1 < sr2:
+        fftlen2 = fftlen
+        fftlen1 = int((fftlen2 * 1.0 * sr1) / sr)
+    elif sr1 > sr2:
+        fftlen1 = fftlen
+        fftlen2 = int((fftlen1 * 1.0 * sr2) / sr)
+    else:
+        fftlen1 = fftlen2 = fftlen
+    # end if
+
+    # processing parameters that determine the spectrum of a given data-window
+    params = (instrument_response_output, water_level, window_seconds, window_buffer_length,
+              taper_length, resample_rate, flo, fhi, clip_to_2std, whitening,
+              whitening_window_frequency, one_bit_normalize)
+
+    if response_cache is None and (sta1_inv or sta2_inv): response_cache = ResponseCache()
+
+    # windows are processed in batches of up to batch_size, as rows of 2D arrays
+    batch_size = max(1, int(window_batch_size_in_mb * 1024 * 1024 / (fftlen * 16.)))
+
+    def window_spectra(tr, windows, sr_orig, sr_new, inv, window_samples, fftlen_i, cache_tag):
+        """
+        :return: tuple containing a 2D array of rfft spectra of preprocessed windows, one row for
+                 each window, and the number of samples in each preprocessed window
+        """
+        keys = [None] * len(windows)
+        values = [None] * len(windows)
+        if spectra_cache is not None:
+            for i, (ws, we) in enumerate(windows):
+                keys[i] = (tr.id, cache_tag, (tr.stats.starttime + float(ws) / sr_orig).ns, we - ws,
+                           sr_orig, inv is not None, params, fftlen_i)
+                values[i] = spectra_cache.get(keys[i])
+            # end for
+        # end if
+
+        missing = [i for i, v in enumerate(values) if v is None]
+        if len(missing):
+            tr_d = preprocess_windows(tr, [windows[i][0] for i in missing], [windows[i][1] for i in missing],
+                                      sr_orig, sr_new, inv, window_samples,
+                                      window_buffer_seconds, adjusted_taper_length,
+                                      instrument_response_output=instrument_response_output,
+                                      water_level=water_level, resample_rate=resample_rate,
+                                      flo=flo, fhi=fhi, clip_to_2std=clip_to_2std, whitening=whitening,
+                                      whitening_window_frequency=whitening_window_frequency,
+                                      one_bit_normalize=one_bit_normalize, logger=logger,
+                                      response_cache=response_cache)
+            spectra = rfft(zeropad(tr_d, fftlen_i), axis=-1)
+
+            for j, i in enumerate(missing):
+                values[i] = (spectra[j].copy(), tr_d.shape[-1])
+                if spectra_cache is not None: spectra_cache.put(keys[i], *values[i])
+            # end for
+        # end if
+
+        return np.array([v[0] for v in values]), values[0][1]
+    # end func
 
     intervalCount = 0
     windowsPerInterval = []  # Stores the number of windows processed per interval
@@ -188,10 +642,10 @@ def xcorr2(tr1, tr2, sta1_inv=None, sta2_inv=None,
             if logger:
                 logger.warning('Detected misaligned traces..')
 
-        windowCount = 0
         wtr1s = int(itr1s)
         wtr2s = int(itr2s)
-        resl = []
+        windows1 = []
+        windows2 = []
 
         while wtr1s < itr1e and wtr2s < itr2e:
             wtr1e = int(min(itr1e, wtr1s + window_samples_1))
@@ -210,164 +664,8 @@ def xcorr2(tr1, tr2, sta1_inv=None, sta2_inv=None,
                      np.ma.is_masked(tr2_d_all[wtr2s:wtr2e]) or
                      np.sum(tr1_d_all[wtr1s:wtr1e]) == 0 or
                      np.sum(tr2_d_all[wtr2s:wtr2e]) == 0)):
-
-                # logger.info('%s, %s' % (tr1.stats.starttime + wtr1s / 200., tr1.stats.starttime + wtr1e / sr1_orig))
-                # logger.info('%s, %s' % (tr2.stats.starttime + wtr2s / 200., tr2.stats.starttime + wtr2e / sr2_orig))
-
-                tr1_d = np.array(tr1_d_all[wtr1s:wtr1e], dtype=np.float32)
-                tr2_d = np.array(tr2_d_all[wtr2s:wtr2e], dtype=np.float32)
-
-                # STEP 1: detrend
-                tr1_d = signal.detrend(tr1_d)
-                tr2_d = signal.detrend(tr2_d)
-
-                # STEP 2: demean
-                tr1_d -= np.mean(tr1_d)
-                tr2_d -= np.mean(tr2_d)
-
-                # STEP 3: remove response
-                if sta1_inv:
-                    resp_tr1 = Trace(data=tr1_d,
-                                     header=Stats(header={'sampling_rate': sr1_orig,
-                                                          'npts': len(tr1_d),
-                                                          'network': tr1.stats.network,
-                                                          'station': tr1.stats.station,
-                                                          'location': tr1.stats.location,
-                                                          'channel': tr1.stats.channel,
-                                                          'starttime': tr1.stats.starttime + float(wtr1s)/sr1_orig,
-                                                          'endtime': tr1.stats.starttime + float(wtr1e)/sr1_orig}))
-                    try:
-                        resp_tr1.remove_response(inventory=sta1_inv, output=instrument_response_output.upper(),
-                                                 water_level=water_level)
-                    except Exception as e:
-                        logger.error(str(e))
-                    # end try
-
-                    tr1_d = resp_tr1.data
-                # end if
-
-                # remove response
-                if sta2_inv:
-                    resp_tr2 = Trace(data=tr2_d,
-                                     header=Stats(header={'sampling_rate': sr2_orig,
-                                                          'npts': len(tr2_d),
-                                                          'network': tr2.stats.network,
-                                                          'station': tr2.stats.station,
-                                                          'location': tr2.stats.location,
-                                                          'channel': tr2.stats.channel,
-                                                          'starttime': tr2.stats.starttime + float(wtr2s)/sr2_orig,
-                                                          'endtime': tr2.stats.starttime + float(wtr2e)/sr2_orig}))
-                    try:
-                        resp_tr2.remove_response(inventory=sta2_inv, output=instrument_response_output.upper(),
-                                                 water_level=water_level)
-                    except Exception as e:
-                        logger.error(str(e))
-                    # end try
-
-                    tr2_d = resp_tr2.data
-                # end if
-
-                # STEPS 4, 5: resample after lowpass @ resample_rate/2 Hz
-                if resample_rate:
-                    tr1_d = lowpass(tr1_d, resample_rate/2., sr1_orig, corners=2, zerophase=True)
-                    tr2_d = lowpass(tr2_d, resample_rate/2., sr2_orig, corners=2, zerophase=True)
-
-                    tr1_d = Trace(data=tr1_d,
-                                  header=Stats(header={'sampling_rate': sr1_orig,
-                                                       'npts': window_samples_1})).resample(resample_rate,
-                                                                                           no_filter=True).data
-                    tr2_d = Trace(data=tr2_d,
-                                  header=Stats(header={'sampling_rate': sr2_orig,
-                                                       'npts': window_samples_2})).resample(resample_rate,
-                                                                                           no_filter=True).data
-                # end if
-
-                # STEP 6: Bandpass
-                if flo and fhi:
-                    tr1_d = bandpass(tr1_d, flo, fhi, sr1, corners=2, zerophase=True)
-                    tr2_d = bandpass(tr2_d, flo, fhi, sr2, corners=2, zerophase=True)
-                # end if
-
-                # STEP 7: time-domain normalization
-                # clip to +/- 2*std
-                if clip_to_2std:
-                    std_tr1 = np.std(tr1_d)
-                    std_tr2 = np.std(tr2_d)
-                    clip_indices_tr1 = np.fabs(tr1_d) > 2 * std_tr1
-                    clip_indices_tr2 = np.fabs(tr2_d) > 2 * std_tr2
-
-                    tr1_d[clip_indices_tr1] = 2 * std_tr1 * np.sign(tr1_d[clip_indices_tr1])
-                    tr2_d[clip_indices_tr2] = 2 * std_tr2 * np.sign(tr2_d[clip_indices_tr2])
-                # end if
-
-                # 1-bit normalization
-                if one_bit_normalize:
-                    tr1_d = np.sign(tr1_d)
-                    tr2_d = np.sign(tr2_d)
-                # end if
-
-                # Apply Rhys Hawkins-style default time domain normalization
-                if (clip_to_2std == 0) and (one_bit_normalize == 0):
-                    # 0-mean
-                    tr1_d -= np.mean(tr1_d)
-                    tr2_d -= np.mean(tr2_d)
-
-                    # unit-std
-                    tr1_d /= np.std(tr1_d)
-                    tr2_d /= np.std(tr2_d)
-                # end if
-
-                # STEP 8: taper
-                if adjusted_taper_length > 0:
-                    tr1_d = taper(tr1_d, int(np.round(adjusted_taper_length*tr1_d.shape[0])))
-                    tr2_d = taper(tr2_d, int(np.round(adjusted_taper_length*tr2_d.shape[0])))
-                # end if
-
-                # STEP 9: spectral whitening
-                if whitening:
-                    tr1_d = whiten(tr1_d, sr1, window_freq=whitening_window_frequency)
-                    tr2_d = whiten(tr2_d, sr2, window_freq=whitening_window_frequency)
-
-                    # STEP 10: taper
-                    if adjusted_taper_length > 0:
-                        tr1_d = taper(tr1_d, int(np.round(adjusted_taper_length*tr1_d.shape[0])))
-                        tr2_d = taper(tr2_d, int(np.round(adjusted_taper_length*tr2_d.shape[0])))
-                    # end if
-                # end if
-
-                # STEP 11: Final bandpass
-                # apply zero-phase bandpass
-                if flo and fhi:
-                    tr1_d = bandpass(tr1_d, flo, fhi, sr1, corners=2, zerophase=True)
-                    tr2_d = bandpass(tr2_d, flo, fhi, sr2, corners=2, zerophase=True)
-                # end if
-
-                if window_buffer_seconds:
-                    # extract window of interest from buffered window
-                    tr1_d = tr1_d[int(window_buffer_seconds*sr1):-int(window_buffer_seconds*sr1)]
-                    tr2_d = tr2_d[int(window_buffer_seconds*sr2):-int(window_buffer_seconds*sr2)]
-                # end if
-
-                # cross-correlate waveforms
-                if sr1 < sr2:
-                    fftlen2 = fftlen
-                    fftlen1 = int((fftlen2 * 1.0 * sr1) / sr)
-                    rf = zeropad_ba(fftn(zeropad(tr1_d, fftlen1), shape=[fftlen1]), fftlen2) * fftn(
-                        zeropad(ndflip(tr2_d), fftlen2), shape=[fftlen2])
-                elif sr1 > sr2:
-                    fftlen1 = fftlen
-                    fftlen2 = int((fftlen1 * 1.0 * sr2) / sr)
-                    rf = fftn(zeropad(tr1_d, fftlen1), shape=[fftlen1]) * zeropad_ba(
-                        fftn(zeropad(ndflip(tr2_d), fftlen2), shape=[fftlen2]), fftlen1)
-                else:
-                    rf = fftn(zeropad(tr1_d, fftlen), shape=[fftlen]) * fftn(zeropad(ndflip(tr2_d), fftlen),
-                                                                             shape=[fftlen])
-                # end if
-
-                if not np.isnan(rf).any():
-                    resl.append(rf)
-                    windowCount += 1
-                # end if
+                windows1.append((wtr1s, wtr1e))
+                windows2.append((wtr2s, wtr2e))
             # end if
 
             wtr1s += int((window_samples_1 - 2*window_buffer_seconds*sr1_orig) -
@@ -376,6 +674,33 @@ def xcorr2(tr1, tr2, sta1_inv=None, sta2_inv=None,
                          (window_samples_2 - 2*window_buffer_seconds*sr2_orig) * window_overlap)
         # end while (windows within interval)
 
+        # process windows in batches
+        windowCount = 0
+        rfsum = np.zeros(fftlen, dtype=np.complex_)
+        for b in np.arange(0, len(windows1), batch_size):
+            X1, n1 = window_spectra(tr1, windows1[b:b + batch_size], sr1_orig, sr1, sta1_inv,
+                                    window_samples_1, fftlen1, tr1_cache_tag)
+            X2, n2 = window_spectra(tr2, windows2[b:b + batch_size], sr2_orig, sr2, sta2_inv,
+                                    window_samples_2, fftlen2, tr2_cache_tag)
+
+            # cross-correlate waveforms: the spectrum of the time-reversed window of tr2 is
+            # obtained from its cached spectrum through a conjugation and a phase-shift
+            S1 = full_spectrum(X1, fftlen1)
+            S2 = full_spectrum(X2, fftlen2, flip_npts=n2)
+            if sr1 < sr2:
+                rf = zeropad_ba(S1, fftlen2) * S2
+            elif sr1 > sr2:
+                rf = S1 * zeropad_ba(S2, fftlen1)
+            else:
+                rf = S1 * S2
+            # end if
+
+            # discard windows with nans
+            valid = ~np.isnan(rf).any(axis=-1)
+            rfsum += np.sum(rf[valid], axis=0)
+            windowCount += int(np.sum(valid))
+        # end for
+
         if verbose > 1:
             if logger:
                 logger.info('\tProcessed %d windows in interval %d' % (windowCount, intervalCount))
@@ -387,23 +712,19 @@ def xcorr2(tr1, tr2, sta1_inv=None, sta2_inv=None,
         itr2s = itr2e
         intervalCount += 1
 
-        # Append an array of zeros if no windows were processed for the current interval
+        # Stack an array of zeros if no windows were processed for the current interval
         if windowCount == 0:
-            resl.append(np.zeros(fftlen))
+            mean = np.zeros(fftlen)
             if verbose > 1:
                 if logger:
                     logger.info('\tWarning: No windows processed due to gaps in data in current interval')
             # end if
+        else:
+            mean = rfsum / float(windowCount)
         # end if
 
         windowsPerInterval.append(windowCount)
 
-        if windowCount > 0:
-            mean = reduce((lambda tx, ty: tx + ty), resl) / float(windowCount)
-        else:
-            mean = reduce((lambda tx, ty: tx + ty), resl)
-        # end if
-
         if envelope_normalize:
             step = np.sign(np.fft.fftfreq(fftlen, 1.0 / sr))
             mean = mean + step * mean  # compute analytic
@@ -454,7 +775,9 @@ def IntervalStackXCorr(refds, tempds,
                        clip_to_2std=False, whitening=False, whitening_window_frequency=0,
                        one_bit_normalize=False, envelope_normalize=False,
                        ensemble_stack=False,
-                       outputPath='/tmp', verbose=1, tracking_tag=''):
+                       outputPath='/tmp', verbose=1, tracking_tag='', spectra_cache=None,
+                       response_cache=None, xcorr_store=None, checkpoint=None, return_results=True,
+                       prefetch=True, ne_cache=None):
     """
     This function rolls through two ASDF data sets, over a given time-range and cross-correlates
     waveforms from all possible station-pairs from the two data sets. To allow efficient, random
@@ -541,10 +864,34 @@ def IntervalStackXCorr(refds, tempds,
     :param tracking_tag: File tag to be added to output file names so runtime settings can be tracked
     :type outputPath: str
     :param outputPath: Folder to write results to
+    :type spectra_cache: SpectraCache
+    :param spectra_cache: Cache of spectra of preprocessed data-windows. When the same instance is passed in \
+                          for all station-pairs, each station-window is preprocessed only once
+    :type response_cache: ResponseCache
+    :param response_cache: Cache of instrument-response transfer functions, which can be shared across \
+                           station-pairs
+    :type xcorr_store: XcorrStore
+    :param xcorr_store: Consolidated HDF5 store that results are written to, instead of a NETCDF4 file \
+                        for each station-pair
+    :type checkpoint: XcorrCheckpoint
+    :param checkpoint: Checkpoint that results for each buffer are saved to, allowing interrupted runs to \
+                       be resumed. The station-pair is marked as completed once results are written
+    :type return_results: bool
+    :param return_results: Results are written out incrementally, so that memory usage does not grow with \
+                           the time-range processed. When True, results written are read back and returned; \
+                           otherwise, empty dictionaries are returned
+    :type prefetch: bool
+    :param prefetch: Fetch data for the next buffer on a background thread, while the current buffer is \
+                     cross-correlated. Note that data for two buffers is then held in memory
+    :type ne_cache: NEStreamCache
+    :param ne_cache: Cache of conditioned north and east component data, used for transverse components \
+                     ('00T'). When the same instance is passed in for all station-pairs, data for a station \
+                     and read-buffer are fetched once and rotated for the back-azimuth of each station-pair
     :return: 1: 1d np.array with time samples spanning [-window_samples+dt:window_samples-dt]
              2: A dictionary of 2d np.arrays containing cross-correlation results for each station-pair. \
                 Rows in each 2d array represent number of interval_seconds processed and columns \
-                represent stacked samples of length window_seconds.
+                represent stacked samples of length window_seconds. Ensemble stacks are returned as a \
+                single row.
              3: A dictionary of 1d np.arrays containing number of windows processed, within each \
                 interval_seconds period, for each station-pair. These Window-counts could be helpful \
                 in assessing robustness of results.
@@ -567,6 +914,105 @@ def IntervalStackXCorr(refds, tempds,
                                               '.'.join([stationPair, tracking_tag])))
     logger = setup_logger('%s.%s' % (ref_net_sta, temp_net_sta), fn)
 
+    #######################################
+    # Cross-correlate over time range
+    #######################################
+    params = xcorr_parameters(ref_cha, temp_cha, ref_sta_inv, temp_sta_inv, instrument_response_output,
+                              water_level, resample_rate, taper_length, buffer_seconds, interval_seconds,
+                              window_seconds, window_overlap, window_buffer_length, flo, fhi,
+                              clip_to_2std, whitening, whitening_window_frequency, one_bit_normalize,
+                              envelope_normalize, ensemble_stack)
+
+    # results are written out as they become available
+    fn = None
+    if(xcorr_store is not None):
+        writer = xcorr_store.writer(stationPair, refds.unique_coordinates[ref_net_sta],
+                                    tempds.unique_coordinates[temp_net_sta], window_seconds,
+                                    ensemble_stack, params, logger=logger)
+    else:
+        fn = os.path.join(outputPath, '%s.nc' % (stationPair if not tracking_tag else
+                                                 '.'.join([stationPair, tracking_tag])))
+        writer = NetCDFXcorrResultsWriter(fn, stationPair, refds.unique_coordinates[ref_net_sta],
+                                          tempds.unique_coordinates[temp_net_sta], window_seconds,
+                                          ensemble_stack, params, logger=logger)
+    # end if
+
+    xcorr_time_range(refds, tempds, start_time, end_time, ref_net_sta, temp_net_sta,
+                     ref_sta_inv, temp_sta_inv, instrument_response_output, water_level,
+                     ref_cha, temp_cha, baz_ref_net_sta, baz_temp_net_sta,
+                     resample_rate=resample_rate, taper_length=taper_length,
+                     buffer_seconds=buffer_seconds, interval_seconds=interval_seconds,
+                     window_seconds=window_seconds, window_overlap=window_overlap,
+                     window_buffer_length=window_buffer_length, flo=flo, fhi=fhi,
+                     clip_to_2std=clip_to_2std, whitening=whitening,
+                     whitening_window_frequency=whitening_window_frequency,
+                     one_bit_normalize=one_bit_normalize, envelope_normalize=envelope_normalize,
+                     verbose=verbose, logger=logger, spectra_cache=spectra_cache,
+                     response_cache=response_cache, checkpoint=checkpoint, writer=writer,
+                     prefetch=prefetch, ne_cache=ne_cache)
+
+    #######################################
+    # Finalize results
+    #######################################
+    x = writer.close()
+
+    xcorrResultsDict = defaultdict(list)  # Results dictionary indexed by station-pair string
+    windowCountResultsDict = defaultdict(list)  # Window-count dictionary indexed by station-pair string
+    if x is not None and return_results:
+        # read back results written
+        if(xcorr_store is not None):
+            results = xcorr_store.read(stationPair, variables=['xcorr', 'NumStackedWindows'])
+            xcorrResultsDict[stationPair] = np.atleast_2d(results['xcorr'])
+            windowCountResultsDict[stationPair] = np.atleast_1d(results['NumStackedWindows'])
+        else:
+            ds = Dataset(fn, 'r')
+            xcorrResultsDict[stationPair] = np.atleast_2d(ds.variables['xcorr'][:])
+            windowCountResultsDict[stationPair] = np.atleast_1d(ds.variables['NumStackedWindows'][:])
+            ds.close()
+        # end if
+    # end if
+
+    if checkpoint is not None: checkpoint.mark_done(stationPair, has_results=x is not None)
+
+    return x, xcorrResultsDict, windowCountResultsDict
+# end func
+
+
+def xcorr_time_range(refds, tempds,
+                     start_time, end_time,
+                     ref_net_sta, temp_net_sta,
+                     ref_sta_inv, temp_sta_inv,
+                     instrument_response_output,
+                     water_level,
+                     ref_cha,
+                     temp_cha,
+                     baz_ref_net_sta,
+                     baz_temp_net_sta,
+                     resample_rate=None,
+                     taper_length=0.05,
+                     buffer_seconds=864000, interval_seconds=86400,
+                     window_seconds=3600, window_overlap=0.1, window_buffer_length=0,
+                     flo=None, fhi=None,
+                     clip_to_2std=False, whitening=False, whitening_window_frequency=0,
+                     one_bit_normalize=False, envelope_normalize=False,
+                     verbose=1, logger=None, spectra_cache=None, response_cache=None, checkpoint=None,
+                     writer=None, prefetch=True, ne_cache=None):
+    """
+    Rolls through data for a station-pair, over a given time-range, in steps of buffer_seconds, and
+    cross-correlates data fetched for each step through xcorr2. See IntervalStackXCorr for a description
+    of the parameters. When a checkpoint is provided, results of each step are saved as they become
+    available and results saved in a previous run are loaded, rather than recomputed. When a writer
+    (XcorrResultsWriter) is provided, results of each step are appended to it, rather than being
+    accumulated in memory, and the lists returned are empty. When prefetch is True, data for the next
+    step is fetched on a background thread, while data for the current step is cross-correlated.
+
+    :return: tuple containing lists of results returned by xcorr2 for each step, i.e. stacked
+             cross-correlations, window-counts per interval, interval start-times and interval end-times,
+             followed by the sampling rate of the cross-correlations
+    """
+    stationPair = '%s.%s' % (ref_net_sta, temp_net_sta)
+    if logger is None: logger = logging.getLogger(stationPair)
+
     #######################################
     # Initialize variables for main loop
     #######################################
@@ -575,17 +1021,16 @@ def IntervalStackXCorr(refds, tempds,
 
     cTime = startTime
 
-    xcorrResultsDict = defaultdict(list)  # Results dictionary indexed by station-pair string
-    windowCountResultsDict = defaultdict(list)  # Window-count dictionary indexed by station-pair string
-    intervalStartTimesDict = defaultdict(list)
-    intervalEndTimesDict = defaultdict(list)
-    sr = 0
-    while cTime < endTime:
-        cStep = buffer_seconds
-
-        if (cTime + cStep) > endTime:
-            cStep = endTime - cTime
+    xcorrResults = []
+    windowCountResults = []
+    intervalStartTimes = []
+    intervalEndTimes = []
+    def fetch_buffer(cTime, cStep):
+        """
+        Fetches data for both stations for the time range [cTime, cTime + cStep]
 
+        :return: tuple containing streams for both stations, or None if data could not be fetched
+        """
         logger.info('====Time range  [%s - %s]====' % (str(cTime), str(cTime + cStep)))
         logger.info('Fetching data for station %s..' % ref_net_sta)
 
@@ -593,19 +1038,17 @@ def IntervalStackXCorr(refds, tempds,
         try:
             rnc, rsc = ref_net_sta.split('.')
             refSt = get_stream(refds, rnc, rsc, ref_cha, cTime, cTime + cStep, baz=baz_ref_net_sta,
-                               logger=logger, verbose=verbose)
+                               logger=logger, verbose=verbose, ne_cache=ne_cache)
         except Exception as e:
             logger.error('\t'+str(e))
             logger.warning('\tError encountered while fetching data. Skipping along..')
 
         if refSt is None:
             logger.info('Failed to fetch data..')
-            cTime += cStep
-            continue
+            return None
         elif len(refSt) == 0:
             logger.info('Data source exhausted. Skipping time interval [%s - %s]' % (str(cTime), str(cTime + cStep)))
-            cTime += cStep
-            continue
+            return None
         else:
             pass
             # print refSt
@@ -617,7 +1060,7 @@ def IntervalStackXCorr(refds, tempds,
         try:
             tnc, tsc = temp_net_sta.split('.')
             tempSt = get_stream(tempds, tnc, tsc, temp_cha, cTime, cTime + cStep, baz=baz_temp_net_sta,
-                                logger=logger, verbose=verbose)
+                                logger=logger, verbose=verbose, ne_cache=ne_cache)
         except Exception as e:
             logger.error('\t'+str(e))
             logger.warning('\tError encountered while fetching data. Skipping along..')
@@ -625,17 +1068,24 @@ def IntervalStackXCorr(refds, tempds,
 
         if tempSt is None:
             logger.info('Failed to fetch data..')
-            cTime += cStep
-            continue
+            return None
         elif len(tempSt) == 0:
             logger.info('Data source exhausted. Skipping time interval [%s - %s]' % (str(cTime), str(cTime + cStep)))
-            cTime += cStep
-            continue
+            return None
         else:
             pass
             # print tempSt
         # end if
 
+        return refSt, tempSt
+    # end func
+
+    def correlate_buffer(refSt, tempSt):
+        """
+        Cross-correlates data fetched for a buffer
+
+        :return: results returned by xcorr2
+        """
         if verbose > 2:
             logger.debug('\t\tData Gaps:')
             tempSt.print_gaps() # output sent to stdout; fix this
@@ -659,104 +1109,344 @@ def IntervalStackXCorr(refds, tempds,
                    whitening_window_frequency=whitening_window_frequency,
                    one_bit_normalize=one_bit_normalize,
                    envelope_normalize=envelope_normalize,
-                   verbose=verbose, logger=logger)
+                   verbose=verbose, logger=logger,
+                   spectra_cache=spectra_cache,
+                   tr1_cache_tag=(refds.asdf_source, baz_ref_net_sta),
+                   tr2_cache_tag=(tempds.asdf_source, baz_temp_net_sta),
+                   response_cache=response_cache)
 
-        # Continue if no results were returned due to data-gaps
+        # Warn if no results were returned due to data-gaps
         if xcl is None:
             logger.warning("\t\tWarning: no cross-correlation results returned for station-pair %s, " %
                   stationPair + " due to gaps in data.")
-            cTime += cStep
-            continue
         # end if
 
-        xcorrResultsDict[stationPair].append(xcl)
-        windowCountResultsDict[stationPair].append(winsPerInterval)
+        return xcl, winsPerInterval, intervalStartSeconds, intervalEndSeconds, sr
+    # end func
+
+    buffers = []
+    while cTime < endTime:
+        cStep = buffer_seconds
 
-        intervalStartTimesDict[stationPair].append(intervalStartSeconds)
-        intervalEndTimesDict[stationPair].append(intervalEndSeconds)
+        if (cTime + cStep) > endTime:
+            cStep = endTime - cTime
 
+        buffers.append((cTime, cStep))
         cTime += cStep
-    # wend (loop over time range)
+    # wend
 
-    x = None
-    # skippedCount = 0
-    # Concatenate results
-    for k in list(xcorrResultsDict.keys()):
-        combinedXcorrResults = None
-        combinedWindowCountResults = None
-        combinedIntervalStartTimes = None
-        combinedIntervalEndTimes = None
-        for i in np.arange(len(xcorrResultsDict[k])):
-            if i == 0:
-                combinedXcorrResults = xcorrResultsDict[k][0]
-                combinedWindowCountResults = windowCountResultsDict[k][0]
-                combinedIntervalStartTimes = intervalStartTimesDict[k][0]
-                combinedIntervalEndTimes = intervalEndTimesDict[k][0]
-
-                # Generate time samples (only needs to be done once)
-                if x is None:
-                    dt = 1./sr
-                    x = np.linspace(-window_seconds + dt, window_seconds - dt,
-                                    xcorrResultsDict[k][0].shape[1])
+    # Data for the next buffer to be processed is fetched on a background thread, while the
+    # current buffer is cross-correlated. Buffers saved in checkpoints are not fetched.
+    pending = [(cTime, cStep) for cTime, cStep in buffers
+               if checkpoint is None or not checkpoint.is_saved(stationPair, cTime)]
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch and len(pending) > 1 else None
+
+    def fetch_next(ipending):
+        if ipending >= len(pending): return None
+        if executor is None: return None
+
+        return executor.submit(fetch_buffer, *pending[ipending])
+    # end func
+
+    sr = 0
+    ipending = 0
+    nextFetch = fetch_next(ipending)
+    try:
+        for cTime, cStep in buffers:
+            # results of buffers processed in a previous run are loaded from checkpoints
+            result = checkpoint.load(stationPair, cTime) if checkpoint is not None else None
+            if result is not None:
+                logger.info('====Time range  [%s - %s]: loaded from checkpoint====' %
+                            (str(cTime), str(cTime + cStep)))
+            else:
+                if nextFetch is not None and pending[ipending][0] == cTime:
+                    streams = nextFetch.result()
+                else:
+                    streams = fetch_buffer(cTime, cStep)
                 # end if
 
+                # queue fetching of the following buffer
+                ipending += 1
+                nextFetch = fetch_next(ipending)
+
+                result = (None, None, None, None, None) if streams is None else correlate_buffer(*streams)
+                if checkpoint is not None: checkpoint.save(stationPair, cTime, result)
+            # end if
+
+            xcl, winsPerInterval, intervalStartSeconds, intervalEndSeconds, bufferSr = result
+            if bufferSr is not None: sr = bufferSr
+
+            if xcl is not None and writer is not None:
+                writer.append(xcl, winsPerInterval, intervalStartSeconds, intervalEndSeconds, bufferSr)
+            elif xcl is not None:
+                xcorrResults.append(xcl)
+                windowCountResults.append(winsPerInterval)
+
+                intervalStartTimes.append(intervalStartSeconds)
+                intervalEndTimes.append(intervalEndSeconds)
+            # end if
+        # end for
+    finally:
+        if executor is not None: executor.shutdown(wait=True)
+    # end try
+
+    return xcorrResults, windowCountResults, intervalStartTimes, intervalEndTimes, sr
+# end func
+
+
+def combine_xcorr_results(xcorr_list, window_count_list, interval_start_list, interval_end_list, sr,
+                          window_seconds, ensemble_stack=False, logger=None):
+    """
+    Concatenates lists of results, as returned by xcorr_time_range, in the given order
+
+    :param sr: sampling rate of cross-correlations
+    :param window_seconds: length of cross-correlation windows in seconds
+    :param ensemble_stack: when True, cross-correlations are summed, rather than concatenated
+    :return: tuple containing 1: time samples (lags), 2: 2d array of cross-correlations (a single row \
+             for ensemble stacks), 3, 4, 5: 1d arrays of window-counts, start- and end-times of intervals
+    """
+    x = None
+    combinedXcorrResults = None
+    combinedWindowCountResults = None
+    combinedIntervalStartTimes = None
+    combinedIntervalEndTimes = None
+    for i in np.arange(len(xcorr_list)):
+        if i == 0:
+            combinedXcorrResults = xcorr_list[0]
+            combinedWindowCountResults = window_count_list[0]
+            combinedIntervalStartTimes = interval_start_list[0]
+            combinedIntervalEndTimes = interval_end_list[0]
+
+            # Generate time samples
+            dt = 1./sr
+            x = np.linspace(-window_seconds + dt, window_seconds - dt, xcorr_list[0].shape[1])
+
+            if ensemble_stack:
+                if combinedXcorrResults.shape[0] > 1:
+                    combinedXcorrResults = np.expand_dims(np.sum(combinedXcorrResults,
+                                                                 axis=0), axis=0)
+                # end if
+            # end if
+        else:
+            if combinedXcorrResults.shape[1] == xcorr_list[i].shape[1]:
                 if ensemble_stack:
-                    if combinedXcorrResults.shape[0] > 1:
-                        combinedXcorrResults = np.expand_dims(np.sum(combinedXcorrResults,
-                                                                     axis=0), axis=0)
+                    if xcorr_list[i].shape[0] > 1:
+                        combinedXcorrResults += np.expand_dims(np.sum(xcorr_list[i],
+                                                                      axis=0), axis=0)
+                    else:
+                        combinedXcorrResults += xcorr_list[i]
                     # end if
+                else:
+                    combinedXcorrResults = np.concatenate((combinedXcorrResults,
+                                                           xcorr_list[i]))
                 # end if
             else:
-                if combinedXcorrResults.shape[1] == xcorrResultsDict[k][i].shape[1]:
-                    if ensemble_stack:
-                        if xcorrResultsDict[k][i].shape[0] > 1:
-                            combinedXcorrResults += np.expand_dims(np.sum(xcorrResultsDict[k][i],
-                                                                          axis=0), axis=0)
-                        else:
-                            combinedXcorrResults += xcorrResultsDict[k][i]
-                        # end if
-                    else:
-                        combinedXcorrResults = np.concatenate((combinedXcorrResults,
-                                                               xcorrResultsDict[k][i]))
-                    # end if
+                if ensemble_stack:
+                    pass
                 else:
-                    if ensemble_stack:
-                        pass
-                    else:
-                        combinedXcorrResults = np.concatenate((combinedXcorrResults,
-                                                               np.zeros((xcorrResultsDict[k][i].shape[0],
-                                                                         combinedXcorrResults.shape[1]))))
-                    # end if
-                    logger.warning("\t\tVariable sample rates detected. Current station-pair: %s" % k)
+                    combinedXcorrResults = np.concatenate((combinedXcorrResults,
+                                                           np.zeros((xcorr_list[i].shape[0],
+                                                                     combinedXcorrResults.shape[1]))))
                 # end if
-                combinedWindowCountResults = np.concatenate((combinedWindowCountResults,
-                                                             windowCountResultsDict[k][i]))
-                combinedIntervalStartTimes = np.concatenate((combinedIntervalStartTimes,
-                                                             intervalStartTimesDict[k][i]))
-                combinedIntervalEndTimes = np.concatenate((combinedIntervalEndTimes,
-                                                           intervalEndTimesDict[k][i]))
+                if logger: logger.warning("\t\tVariable sample rates detected.")
             # end if
-        # end for
-
-        # Replace lists with combined results
-        xcorrResultsDict[k] = combinedXcorrResults
-        windowCountResultsDict[k] = combinedWindowCountResults
-        intervalStartTimesDict[k] = combinedIntervalStartTimes
-        intervalEndTimesDict[k] = combinedIntervalEndTimes
+            combinedWindowCountResults = np.concatenate((combinedWindowCountResults,
+                                                         window_count_list[i]))
+            combinedIntervalStartTimes = np.concatenate((combinedIntervalStartTimes,
+                                                         interval_start_list[i]))
+            combinedIntervalEndTimes = np.concatenate((combinedIntervalEndTimes,
+                                                       interval_end_list[i]))
+        # end if
     # end for
 
-    # Save Results
-    for i, k in enumerate(list(xcorrResultsDict.keys())):
-        fn = os.path.join(outputPath, '%s.nc' % (k if not tracking_tag else '.'.join([k, tracking_tag])))
+    return x, combinedXcorrResults, combinedWindowCountResults, \
+           combinedIntervalStartTimes, combinedIntervalEndTimes
+# end func
+
+
+def xcorr_parameters(ref_cha, temp_cha, ref_sta_inv, temp_sta_inv, instrument_response_output,
+                     water_level, resample_rate, taper_length, buffer_seconds, interval_seconds,
+                     window_seconds, window_overlap, window_buffer_length, flo, fhi,
+                     clip_to_2std, whitening, whitening_window_frequency, one_bit_normalize,
+                     envelope_normalize, ensemble_stack):
+    """
+    :return: dictionary of parameters used, as recorded in the Parameters group of output files
+    """
+    params = {'corr_chans': '%s.%s' % (ref_cha, temp_cha),
+              'instr_corr_applied_1': 1 if ref_sta_inv else 0,
+              'instr_corr_applied_2': 1 if temp_sta_inv else 0,
+              'instr_corr_output': instrument_response_output,
+              'instr_corr_water_level_db': water_level,
+              'resample_rate': resample_rate if resample_rate else -999,
+              'taper_length': taper_length,
+              'buffer_seconds': buffer_seconds,
+              'interval_seconds': interval_seconds,
+              'window_seconds': window_seconds,
+              'window_overlap': window_overlap,
+              'window_buffer_length': window_buffer_length,
+              'bandpass_fmin': flo if flo else -999,
+              'bandpass_fmax': fhi if fhi else -999,
+              'clip_to_2std': int(clip_to_2std),
+              'one_bit_normalize': int(one_bit_normalize),
+              'zero_mean_1std_normalize': int(clip_to_2std is False and one_bit_normalize is False),
+              'spectral_whitening': int(whitening),
+              'envelope_normalize': int(envelope_normalize),
+              'ensemble_stack': int(ensemble_stack)}
+
+    if whitening:
+        params['whitening_window_frequency'] = whitening_window_frequency
+
+    return params
+# end func
+
+
+class XcorrResultsWriter:
+    def __init__(self, station_pair, ref_sta_coords, temp_sta_coords, window_seconds, ensemble_stack, params,
+                 logger=None):
+        """
+        Writes cross-correlation results for a station-pair incrementally, as they become available, so that
+        memory usage does not grow with the time-range processed. Interval stacks are appended to the output
+        as they are received, while ensemble stacks are accumulated as running sums and written out on close.
+        Subclasses implement the output format.
+
+        :param station_pair: NET.STA.NET.STA
+        :param ref_sta_coords: [lon, lat] of reference station; an empty list if unknown
+        :param temp_sta_coords: [lon, lat] of temporary station; an empty list if unknown
+        :param window_seconds: length of cross-correlation windows in seconds
+        :param ensemble_stack: output a single stack over all intervals
+        :param params: dictionary of parameters, as returned by xcorr_parameters
+        """
+        self.station_pair = station_pair
+        self.ref_sta_coords = ref_sta_coords
+        self.temp_sta_coords = temp_sta_coords
+        self.window_seconds = window_seconds
+        self.ensemble_stack = ensemble_stack
+        self.params = params
+        self.logger = logger
+
+        self.lag_count = None
+        self.interval_count = 0
+        self.sr = None
+
+        # running statistics for ensemble stacks
+        self.xcorr_sum = None
+        self.window_count = 0
+        self.active_interval_count = 0
+        self.active_interval_window_count = 0
+        self.interval_start_time = None
+        self.interval_end_time = None
+    # end func
+
+    def _lonlat(self):
+        lon1 = self.ref_sta_coords[0] if len(self.ref_sta_coords) == 2 else -999
+        lat1 = self.ref_sta_coords[1] if len(self.ref_sta_coords) == 2 else -999
+        lon2 = self.temp_sta_coords[0] if len(self.temp_sta_coords) == 2 else -999
+        lat2 = self.temp_sta_coords[1] if len(self.temp_sta_coords) == 2 else -999
+
+        return lon1, lat1, lon2, lat2
+    # end func
+
+    def _create(self):
+        raise NotImplementedError
+    # end func
+
+    def _append(self, xcorr, window_counts, interval_start_times, interval_end_times):
+        raise NotImplementedError
+    # end func
+
+    def _finalize(self, x):
+        raise NotImplementedError
+    # end func
+
+    def append(self, xcorr, window_counts, interval_start_times, interval_end_times, sr):
+        """
+        Appends results, as returned by xcorr2, for a number of intervals
+
+        :param xcorr: 2d array of cross-correlations, with a row for each interval
+        :param window_counts: 1d array of window-counts for each interval
+        :param interval_start_times: 1d array of interval start-times
+        :param interval_end_times: 1d array of interval end-times
+        :param sr: sampling rate of cross-correlations
+        """
+        self.sr = sr
+        if self.lag_count is None:
+            self.lag_count = xcorr.shape[1]
+            self._create()
+        # end if
+
+        consistent = xcorr.shape[1] == self.lag_count
+        if not consistent and self.logger: self.logger.warning("\t\tVariable sample rates detected.")
+
+        window_counts = np.array(window_counts)
+        if self.ensemble_stack:
+            if consistent:
+                if self.xcorr_sum is None: self.xcorr_sum = np.sum(xcorr, axis=0)
+                else: self.xcorr_sum += np.sum(xcorr, axis=0)
+            # end if
+
+            active = window_counts > 0
+            self.window_count += int(np.sum(window_counts))
+            self.active_interval_count += int(np.sum(active))
+            self.active_interval_window_count += np.sum(window_counts[active])
+
+            ist, iet = np.min(interval_start_times), np.max(interval_end_times)
+            self.interval_start_time = ist if self.interval_start_time is None else \
+                min(self.interval_start_time, ist)
+            self.interval_end_time = iet if self.interval_end_time is None else \
+                max(self.interval_end_time, iet)
+        else:
+            if not consistent: xcorr = np.zeros((xcorr.shape[0], self.lag_count))
+            self._append(xcorr, window_counts, interval_start_times, interval_end_times)
+        # end if
+
+        self.interval_count += xcorr.shape[0]
+    # end func
+
+    def close(self, x=None):
+        """
+        Finalizes output
+
+        :param x: time samples (lags); generated from the sampling rate of the last results appended, if not given
+        :return: time samples (lags), or None if no results were appended
+        """
+        if self.lag_count is None: return None
+
+        if x is None:
+            dt = 1. / self.sr
+            x = np.linspace(-self.window_seconds + dt, self.window_seconds - dt, self.lag_count)
+        # end if
+
+        self._finalize(x)
+
+        return x
+    # end func
+# end class
+
+
+class NetCDFXcorrResultsWriter(XcorrResultsWriter):
+    def __init__(self, fn, station_pair, ref_sta_coords, temp_sta_coords, window_seconds, ensemble_stack,
+                 params, logger=None):
+        """
+        Writes cross-correlation results for a station-pair to a NETCDF4 file, along an unlimited
+        'interval' dimension. The file is created once results are first appended.
 
-        root_grp = Dataset(fn, 'w', format='NETCDF4')
-        root_grp.description = 'Cross-correlation results for station-pair: %s' % k
+        :param fn: output file name
+        """
+        super().__init__(station_pair, ref_sta_coords, temp_sta_coords, window_seconds, ensemble_stack, params,
+                         logger=logger)
+        self.fn = fn
+        self.root_grp = None
+    # end func
+
+    def _create(self):
+        root_grp = Dataset(self.fn, 'w', format='NETCDF4')
+        root_grp.description = 'Cross-correlation results for station-pair: %s' % self.station_pair
 
         # Dimensions
-        root_grp.createDimension('lag', xcorrResultsDict[k].shape[1])
+        root_grp.createDimension('lag', self.lag_count)
         root_grp.createDimension('nchar', 10)
 
-        lag = root_grp.createVariable('lag', 'f4', ('lag',))
+        root_grp.createVariable('lag', 'f4', ('lag',))
 
         # Add metadata
         lon1 = root_grp.createVariable('Lon1', 'f4')
@@ -765,87 +1455,92 @@ def IntervalStackXCorr(refds, tempds,
         lat2 = root_grp.createVariable('Lat2', 'f4')
         distance = root_grp.createVariable('Distance', 'f4')
 
-        ref_sta_coords = refds.unique_coordinates[ref_net_sta]
-        temp_sta_coords = tempds.unique_coordinates[temp_net_sta]
-        lon1[:] = ref_sta_coords[0] if len(ref_sta_coords) == 2 else -999
-        lat1[:] = ref_sta_coords[1] if len(ref_sta_coords) == 2 else -999
-        lon2[:] = temp_sta_coords[0] if len(temp_sta_coords) == 2 else -999
-        lat2[:] = temp_sta_coords[1] if len(temp_sta_coords) == 2 else -999
+        lon1[:], lat1[:], lon2[:], lat2[:] = self._lonlat()
         if np.min([v != -999 for v in [lon1[:], lat1[:], lon2[:], lat2[:]]]):
             distance[:], _, _ = gps2dist_azimuth(lat1[:], lon1[:], lat2[:], lon2[:])
         # end if
 
-        # Add data
-        if ensemble_stack:
+        if not self.ensemble_stack:
+            root_grp.createDimension('interval', None)
+            # Variables
+            root_grp.createVariable('interval', 'f4', ('interval',))
+            root_grp.createVariable('NumStackedWindows', 'f4', ('interval',))
+            root_grp.createVariable('IntervalStartTimes', 'i8', ('interval',))
+            root_grp.createVariable('IntervalEndTimes', 'i8', ('interval',))
+            root_grp.createVariable('xcorr', 'f4', ('interval', 'lag',))
+        # end if
+
+        # Add and populate a new group for parameters used
+        pg = root_grp.createGroup('Parameters')
+
+        for _k, _v in self.params.items():
+            setattr(pg, _k, _v)
+        # end for
+
+        self.root_grp = root_grp
+    # end func
+
+    def _append(self, xcorr, window_counts, interval_start_times, interval_end_times):
+        s, e = self.interval_count, self.interval_count + xcorr.shape[0]
+        v = self.root_grp.variables
+
+        v['interval'][s:e] = np.arange(s, e)
+        v['NumStackedWindows'][s:e] = window_counts
+        v['IntervalStartTimes'][s:e] = interval_start_times
+        v['IntervalEndTimes'][s:e] = interval_end_times
+        v['xcorr'][s:e, :] = xcorr.real
+    # end func
+
+    def _finalize(self, x):
+        root_grp = self.root_grp
+
+        if self.ensemble_stack:
             nsw = root_grp.createVariable('NumStackedWindows', 'i8')
             avgnsw = root_grp.createVariable('AvgNumStackedWindowsPerInterval', 'f4')
             ist = root_grp.createVariable('IntervalStartTime', 'i8')
             iet = root_grp.createVariable('IntervalEndTime', 'i8')
             xc = root_grp.createVariable('xcorr', 'f4', ('lag',))
 
-            totalIntervalCount = int(np.sum(windowCountResultsDict[k] > 0))
-            totalWindowCount = int(np.sum(windowCountResultsDict[k]))
-            nsw[:] = totalWindowCount
-            avgnsw[:] = np.mean(windowCountResultsDict[k][windowCountResultsDict[k]>0])
-            ist[:] = int(np.min(intervalStartTimesDict[k]))
-            iet[:] = int(np.max(intervalEndTimesDict[k]))
-            if totalIntervalCount > 0:
-                xc[:] = xcorrResultsDict[k].real / float(totalIntervalCount)
+            nsw[:] = self.window_count
+            avgnsw[:] = self.active_interval_window_count / float(self.active_interval_count) \
+                if self.active_interval_count else np.nan
+            ist[:] = int(self.interval_start_time)
+            iet[:] = int(self.interval_end_time)
+            if self.xcorr_sum is None:
+                xc[:] = np.zeros(self.lag_count)
+            elif self.active_interval_count > 0:
+                xc[:] = self.xcorr_sum.real / float(self.active_interval_count)
             else:
-                xc[:] = xcorrResultsDict[k].real
+                xc[:] = self.xcorr_sum.real
             # end if
-        else:
-            root_grp.createDimension('interval', xcorrResultsDict[k].shape[0])
-            # Variables
-            interval = root_grp.createVariable('interval', 'f4', ('interval',))
-            nsw = root_grp.createVariable('NumStackedWindows', 'f4', ('interval',))
-            ist = root_grp.createVariable('IntervalStartTimes', 'i8', ('interval',))
-            iet = root_grp.createVariable('IntervalEndTimes', 'i8', ('interval',))
-            xc = root_grp.createVariable('xcorr', 'f4', ('interval', 'lag',))
-
-            # Populate variables
-            interval[:] = np.arange(xcorrResultsDict[k].shape[0])
-            nsw[:] = windowCountResultsDict[k]
-            ist[:] = intervalStartTimesDict[k]
-            iet[:] = intervalEndTimesDict[k]
-            xc[:, :] = xcorrResultsDict[k].real
         # end if
 
-        lag[:] = x
-
-        # Add and populate a new group for parameters used
-        pg = root_grp.createGroup('Parameters')
-
-        params = {'corr_chans': '%s.%s' % (ref_cha, temp_cha),
-                  'instr_corr_applied_1': 1 if ref_sta_inv else 0,
-                  'instr_corr_applied_2': 1 if temp_sta_inv else 0,
-                  'instr_corr_output': instrument_response_output,
-                  'instr_corr_water_level_db': water_level,
-                  'resample_rate': resample_rate if resample_rate else -999,
-                  'taper_length': taper_length,
-                  'buffer_seconds': buffer_seconds,
-                  'interval_seconds': interval_seconds,
-                  'window_seconds': window_seconds,
-                  'window_overlap': window_overlap,
-                  'window_buffer_length': window_buffer_length,
-                  'bandpass_fmin': flo if flo else -999,
-                  'bandpass_fmax': fhi if fhi else -999,
-                  'clip_to_2std': int(clip_to_2std),
-                  'one_bit_normalize': int(one_bit_normalize),
-                  'zero_mean_1std_normalize': int(clip_to_2std is False and one_bit_normalize is False),
-                  'spectral_whitening': int(whitening),
-                  'envelope_normalize': int(envelope_normalize),
-                  'ensemble_stack': int(ensemble_stack)}
-
-        if whitening:
-            params['whitening_window_frequency'] = whitening_window_frequency
-
-        for _k, _v in params.items():
-            setattr(pg, _k, _v)
-        # end for
-
+        root_grp.variables['lag'][:] = x
         root_grp.close()
-    # end for
+        self.root_grp = None
+    # end func
+# end class
 
-    return x, xcorrResultsDict, windowCountResultsDict
+
+def write_xcorr_results(fn, station_pair, x, xcorr, window_counts, interval_start_times, interval_end_times,
+                        ref_sta_coords, temp_sta_coords, ensemble_stack, params):
+    """
+    Writes cross-correlation results for a station-pair to a NETCDF4 file
+
+    :param fn: output file name
+    :param station_pair: NET.STA.NET.STA
+    :param x: time samples (lags)
+    :param xcorr: 2d array of cross-correlations, as returned by combine_xcorr_results
+    :param window_counts: 1d array of window-counts for each interval
+    :param interval_start_times: 1d array of interval start-times
+    :param interval_end_times: 1d array of interval end-times
+    :param ref_sta_coords: [lon, lat] of reference station; an empty list if unknown
+    :param temp_sta_coords: [lon, lat] of temporary station; an empty list if unknown
+    :param ensemble_stack: whether xcorr is an ensemble stack
+    :param params: dictionary of parameters, as returned by xcorr_parameters
+    """
+    writer = NetCDFXcorrResultsWriter(fn, station_pair, ref_sta_coords, temp_sta_coords, None, ensemble_stack,
+                                      params)
+    writer.append(xcorr, window_counts, interval_start_times, interval_end_times, None)
+    writer.close(x)
 # end func
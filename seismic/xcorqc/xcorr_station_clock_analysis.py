@@ -15,12 +15,13 @@ import time
 import math
 import gc
 import glob
+import hashlib
+import multiprocessing
 
 from textwrap import wrap
 
 import numpy as np
-import scipy
-from scipy import signal
+from scipy.signal import medfilt
 import pandas as pd
 import matplotlib.dates
 import matplotlib.pyplot as plt
@@ -36,6 +37,52 @@ from tqdm.auto import tqdm
 
 from seismic.ASDFdatabase import FederatedASDFDataSet
 from seismic.xcorqc.analytic_plot_utils import distance, timestamps_to_plottable_datetimes
+from seismic.xcorqc.fft import rfft, irfft
+
+
+def batch_correlate_same(a, rows):
+    """
+    Cross-correlate a 1D array against each row of a 2D array using a single batched FFT. Each row
+    of the result matches scipy.signal.correlate(a, row, mode='same').
+
+    :param a: 1D array of length n
+    :type a: numpy.array
+    :param rows: 2D array of shape (m, n)
+    :type rows: numpy.array
+    :return: 2D array of shape (m, n), containing the cross-correlation of a with each row
+    :rtype: numpy.array
+    """
+    a = np.asarray(np.ma.getdata(a), dtype=np.float64)
+    rows = np.atleast_2d(np.asarray(np.ma.getdata(rows), dtype=np.float64))
+    n = a.shape[0]
+    nfft = 1 << int(np.ceil(np.log2(max(2 * n - 1, 1))))
+    # Correlation is computed as a convolution with time-reversed rows
+    full = irfft(rfft(a, nfft)[np.newaxis, :] * rfft(rows[:, ::-1], nfft, axis=1), nfft, axis=1)
+    # Extract the central part of the full correlation, as done for mode='same'
+    start = (n - 1) // 2
+    return full[:, start:start + n]
+
+
+def batch_pearsonr(a, rows):
+    """
+    Compute Pearson correlation coefficients between a 1D array and each row of a 2D array. Each element
+    of the result matches the coefficient returned by scipy.stats.pearsonr(a, row); rows with zero
+    variance produce NaN.
+
+    :param a: 1D array of length n
+    :type a: numpy.array
+    :param rows: 2D array of shape (m, n)
+    :type rows: numpy.array
+    :return: 1D array of m Pearson correlation coefficients
+    :rtype: numpy.array
+    """
+    a = np.asarray(np.ma.getdata(a), dtype=np.float64)
+    rows = np.atleast_2d(np.asarray(np.ma.getdata(rows), dtype=np.float64))
+    am = a - np.mean(a)
+    rm = rows - np.mean(rows, axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.dot(rm, am) / (np.linalg.norm(rm, axis=1) * np.linalg.norm(am))
+    return np.clip(r, -1.0, 1.0)
 
 
 class XcorrClockAnalyzer:
@@ -43,7 +90,7 @@ class XcorrClockAnalyzer:
     Helper class for bundling of preprocessed cross-correlation data before plotting
     or subsequent processing.
     """
-    def __init__(self, src_file, time_window, snr_threshold, pcf_cutoff_threshold):
+    def __init__(self, src_file, time_window, snr_threshold, pcf_cutoff_threshold, cache_folder=None):
         """Constructor
 
         :param src_file: Source .nc file
@@ -55,6 +102,10 @@ class XcorrClockAnalyzer:
         :param pcf_cutoff_threshold: Minimum Pearson correlation factor (RCF * CCF) to accept for generating a time
             shift estimate for a given day, between 0.0 and 1.0.
         :type pcf_cutoff_threshold: float
+        :param cache_folder: Folder in which preprocessed results are cached, keyed by source file and analysis
+            parameters, so that subsequent analyses of an unchanged source file with the same parameters skip
+            recomputation. Caching is disabled if None.
+        :type cache_folder: str
         """
         # INPUTS
         # Input file
@@ -89,9 +140,11 @@ class XcorrClockAnalyzer:
         # Number of stacked windows per sample
         self.nsw = None
 
-        # Generate outputs
-        self._preprocess()
-        self._compute_estimated_clock_corrections()
+        # Generate outputs, unless cached from a previous run with the same parameters
+        if not self._load_cache(cache_folder):
+            self._preprocess()
+            self._compute_estimated_clock_corrections()
+            self._save_cache(cache_folder)
 
         # Get analytical time series usable for clustering
         nan_mask = np.isnan(self.raw_correction)
@@ -103,7 +156,7 @@ class XcorrClockAnalyzer:
             grad = np.gradient(self.corrections_clean, self.correction_times_clean, edge_order=1)
         else:
             grad = np.array([])
-        grad_med5 = signal.medfilt(grad, 5)
+        grad_med5 = medfilt(grad, 5)
         self.corrections_slope = grad_med5
     # end func
 
@@ -225,73 +278,136 @@ class XcorrClockAnalyzer:
         """
         Compute the estimated GPS clock corrections given series of cross-correlation functions
         and an overall reference correlation function (rcf, the mean of valid samples of the
-        cross-correlation time series).
+        cross-correlation time series). Correlations against the RCF are computed for all rows
+        in batched FFT operations.
 
         :return: Corrected RCF after first order corrections; raw estimated clock corrections;
                  final per-sample cross-correlation between corrected RCF and each sample
         :rtype: numpy.array [1D]
         """
+        nrows, ncols = self.ccf_masked.shape
+        raw_correction = np.full(nrows, np.nan)
+        ccf_shifted = np.full((nrows, ncols), np.nan)
+        row_rcf_crosscorr = np.full((nrows, ncols), np.nan)
+
+        # Rows containing masked samples are not corrected
+        if self.rcf is None:
+            valid_indices = np.array([], dtype=int)
+        else:
+            valid_indices = np.flatnonzero(~np.any(np.ma.getmaskarray(self.ccf_masked), axis=1))
+        rows = np.ma.getdata(self.ccf_masked)[valid_indices, :]
+
         # Make an initial estimate of the shift, and only mask out a row if the Pearson coefficient
         # is less than the threshold AFTER applying the shift. Otherwise we will be masking out
         # some of the most interesting regions where shifts occur.
-        raw_correction = []
-        ccf_shifted = []
-        for row in self.ccf_masked:
-            if np.ma.is_masked(row) or self.rcf is None:
-                raw_correction.append(np.nan)
-                ccf_shifted.append(np.array([np.nan] * self.ccf_masked.shape[1]))
-                continue
-
+        if len(valid_indices):
             # The logic here needs to be expanded to allow for possible mirroring of the CCF
             # as well as a shift.
-            c3 = scipy.signal.correlate(self.rcf, row, mode='same')
-            c3 /= np.max(c3)
-            peak_index = np.argmax(c3)
-            shift_size = int(peak_index - len(c3) / 2)
-            row_shifted = np.roll(row, shift_size)
-            # Zero the rolled in values
-            if shift_size > 0:
-                row_shifted[0:shift_size] = 0
-            elif shift_size < 0:
-                row_shifted[shift_size:] = 0
-            ccf_shifted.append(row_shifted)
+            c3 = batch_correlate_same(self.rcf, rows)
+            c3 /= np.max(c3, axis=1, keepdims=True)
+            peak_index = np.argmax(c3, axis=1)
+            shift_size = np.trunc(peak_index - ncols / 2).astype(int)
+            # Shift rows, zeroing the rolled in values
+            src_index = np.arange(ncols)[np.newaxis, :] - shift_size[:, np.newaxis]
+            in_range = (src_index >= 0) & (src_index < ncols)
+            ccf_shifted[valid_indices, :] = np.where(
+                in_range, np.take_along_axis(rows, np.clip(src_index, 0, ncols - 1), axis=1), 0)
             # Store first order corrections.
-            peak_lag = self.lag[peak_index]
-            raw_correction.append(peak_lag)
-        # end for
-        raw_correction = np.array(raw_correction)
-        ccf_shifted = np.array(ccf_shifted)
+            raw_correction[valid_indices] = self.lag[peak_index]
+        # end if
         # Recompute the RCF with first order clock corrections.
         rcf_corrected = np.nanmean(ccf_shifted[self.snr_mask, :], axis=0)
 
         # For the Pearson coeff threshold, apply it against the CORRECTED RCF after the application
         # of estimated clock corrections.
-        row_rcf_crosscorr = []
-        for i, row in enumerate(self.ccf_masked):
-            if np.ma.is_masked(row) or self.rcf is None:
-                row_rcf_crosscorr.append([np.nan] * self.ccf_masked.shape[1])
-                continue
-
-            pcf_corrected, _ = scipy.stats.pearsonr(rcf_corrected, ccf_shifted[i, :])
-            if pcf_corrected < self.pcf_cutoff_threshold:
-                raw_correction[i] = np.nan
-                row_rcf_crosscorr.append([np.nan] * self.ccf_masked.shape[1])
-                continue
+        if len(valid_indices):
+            pcf_corrected = batch_pearsonr(rcf_corrected, ccf_shifted[valid_indices, :])
+            rejected = pcf_corrected < self.pcf_cutoff_threshold
+            raw_correction[valid_indices[rejected]] = np.nan
+            accepted = valid_indices[~rejected]
+
             # Compute second order corrections based on first order corrected RCF
-            c3 = scipy.signal.correlate(rcf_corrected, row, mode='same')
-            c3 /= np.max(c3)
-            peak_index = np.argmax(c3)
-            peak_lag = self.lag[peak_index]
-            raw_correction[i] = peak_lag
-            row_rcf_crosscorr.append(c3)
-        # end for
-        row_rcf_crosscorr = np.array(row_rcf_crosscorr)
+            if len(accepted):
+                c3 = batch_correlate_same(rcf_corrected, np.ma.getdata(self.ccf_masked)[accepted, :])
+                c3 /= np.max(c3, axis=1, keepdims=True)
+                raw_correction[accepted] = self.lag[np.argmax(c3, axis=1)]
+                row_rcf_crosscorr[accepted, :] = c3
+            # end if
+        # end if
 
         self.raw_correction = raw_correction
         self.rcf_corrected = rcf_corrected
         self.row_rcf_crosscorr = row_rcf_crosscorr
     # end func
 
+    def _cache_file_name(self, cache_folder):
+        """
+        :param cache_folder: Cache folder
+        :return: Name of cache file, keyed by the name, modification time and size of the source file and
+            by the analysis parameters
+        """
+        src_stat = os.stat(self.src_file)
+        key = repr((os.path.abspath(self.src_file), src_stat.st_mtime, src_stat.st_size,
+                    self.time_window, self.snr_threshold, self.pcf_cutoff_threshold))
+        _, base_file = os.path.split(self.src_file)
+        return os.path.join(cache_folder, '{}.{}.npz'.format(os.path.splitext(base_file)[0],
+                                                            hashlib.md5(key.encode()).hexdigest()))
+    # end func
+
+    def _save_cache(self, cache_folder):
+        if cache_folder is None:
+            return
+
+        os.makedirs(cache_folder, exist_ok=True)
+        cache_file = self._cache_file_name(cache_folder)
+        tmp_file = cache_file[:-4] + '.tmp.npz'
+        arrays = dict(start_times=np.ma.getdata(self.start_times), lag=np.ma.getdata(self.lag),
+                      ccf=np.ma.getdata(self.ccf), nsw=np.ma.getdata(self.nsw),
+                      snr=np.ma.getdata(self.snr), snr_masked=np.ma.getmaskarray(self.snr),
+                      raw_correction=self.raw_correction, rcf_corrected=self.rcf_corrected,
+                      row_rcf_crosscorr=self.row_rcf_crosscorr)
+        if self.rcf is not None:
+            arrays.update(rcf=np.ma.getdata(self.rcf), snr_mask=self.snr_mask)
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, cache_file)
+    # end func
+
+    def _load_cache(self, cache_folder):
+        """
+        Load preprocessed results cached by a previous analysis with the same parameters
+
+        :param cache_folder: Cache folder
+        :return: True if results were loaded from cache
+        """
+        if cache_folder is None:
+            return False
+
+        cache_file = self._cache_file_name(cache_folder)
+        if not os.path.exists(cache_file):
+            return False
+
+        with np.load(cache_file) as npz:
+            self.start_times = npz['start_times']
+            self.lag = npz['lag']
+            self.ccf = npz['ccf']
+            self.nsw = npz['nsw']
+            self.snr = np.ma.masked_array(npz['snr'], mask=npz['snr_masked'])
+            if 'rcf' in npz:
+                self.rcf = npz['rcf']
+                self.snr_mask = npz['snr_mask']
+            self.raw_correction = npz['raw_correction']
+            self.rcf_corrected = npz['rcf_corrected']
+            self.row_rcf_crosscorr = npz['row_rcf_crosscorr']
+
+        # Derived quantities that are cheap to recompute
+        zero_row_mask = (np.all(self.ccf == 0, axis=1))
+        valid_mask = np.ones_like(self.ccf)
+        valid_mask[zero_row_mask, :] = 0
+        self.ccf_masked = np.ma.masked_array(self.ccf, mask=~(valid_mask > 0))
+        self.float_start_times = np.array([float(v) for v in self.start_times])
+        return True
+    # end func
+
     def plot_clusters(self, ax, ids, coeffs, stn_code=''):
         """Plot the distinct clusters color coded by cluster ID, with underlying corrections shown in gray.
 
@@ -488,15 +604,11 @@ def plot_snr_histogram(ax, snr, time_window, nbins=10):
 
 
 def plot_pearson_corr_coeff(ax, rcf, ccf_masked, y_times):
-    cc = []
-    for row in ccf_masked:
-        if np.ma.is_masked(row) or rcf is None:
-            cc.append(np.nan)
-        else:
-            pcf, _ = scipy.stats.pearsonr(rcf, row)
-            cc.append(pcf)
-    # end for
-    pcf = np.array(cc)
+    pcf = np.full(ccf_masked.shape[0], np.nan)
+    if rcf is not None:
+        valid = ~np.any(np.ma.getmaskarray(ccf_masked), axis=1)
+        if np.any(valid):
+            pcf[valid] = batch_pearsonr(rcf, np.ma.getdata(ccf_masked)[valid, :])
     # Compute CC mean
     ccav = np.mean(np.ma.masked_array(pcf, mask=np.isnan(pcf)))
 
@@ -554,9 +666,10 @@ def plot_estimated_timeshift(ax, x_lag, y_times, correction, annotation=None, ro
 def plot_xcorr_file_clock_analysis(src_file, asdf_dataset, time_window, snr_threshold, pearson_correlation_factor,
                                    show=True, underlay_rcf_xcorr=False,
                                    pdf_file=None, png_file=None, title_tag='',
-                                   settings=None):
+                                   settings=None, cache_folder=None):
     # Read and preprocess xcorr data
-    xcorr_ca = XcorrClockAnalyzer(src_file, time_window, snr_threshold, pearson_correlation_factor)
+    xcorr_ca = XcorrClockAnalyzer(src_file, time_window, snr_threshold, pearson_correlation_factor,
+                                  cache_folder=cache_folder)
     raw_correction = xcorr_ca.raw_correction
     rcf_corrected = xcorr_ca.rcf_corrected
     row_rcf_crosscorr = xcorr_ca.row_rcf_crosscorr
@@ -683,8 +796,63 @@ def read_correlator_config(nc_file):
     return settings_df, title_tag
 
 
+# Dataset used by worker processes of batch_process_xcorr; inherited by forked workers so that
+# it need not be pickled.
+_worker_dataset = None
+
+
+def _process_xcorr_file(src_file, dataset, time_window, snr_threshold, pearson_cutoff_factor, save_plots,
+                        underlay_rcf_xcorr, force_save, cache_folder):
+    """
+    Process a single .nc file for batch_process_xcorr.
+
+    :return: Tuple of status ('success', 'skipped' or 'failed') and message
+    :rtype: tuple(str, str)
+    """
+    if dataset is None:
+        dataset = _worker_dataset
+
+    if not os.path.exists(src_file):
+        return 'failed', "File not found!"
+
+    # Extract timestamp from nc filename if available
+    settings, title_tag = read_correlator_config(src_file)
+
+    try:
+        if save_plots:
+            basename, _ = os.path.splitext(src_file)
+            png_file = basename + ".png"
+            # If png file already exists and has later timestamp than src_file, then skip it.
+            if os.path.exists(png_file):
+                src_file_time = os.path.getmtime(src_file)
+                png_file_time = os.path.getmtime(png_file)
+                png_file_size = os.stat(png_file).st_size
+                if not force_save and (png_file_time > src_file_time) and (png_file_size > 0):
+                    return 'skipped', "PNG file {} is more recent than source file {}, skipping!".format(
+                        os.path.split(png_file)[1], os.path.split(src_file)[1])
+            plot_xcorr_file_clock_analysis(src_file, dataset, time_window, snr_threshold, pearson_cutoff_factor,
+                                           png_file=png_file, show=False, underlay_rcf_xcorr=underlay_rcf_xcorr,
+                                           title_tag=title_tag, settings=settings, cache_folder=cache_folder)
+        else:
+            plot_xcorr_file_clock_analysis(src_file, dataset, time_window, snr_threshold, pearson_cutoff_factor,
+                                           underlay_rcf_xcorr=underlay_rcf_xcorr, title_tag=title_tag,
+                                           settings=settings, cache_folder=cache_folder)
+    except Exception as e:
+        return 'failed', str(e)
+
+    # Python 2 does not handle circular references, so it helps to explicitly clean up.
+    if sys.version_info[0] == 2:
+        gc.collect()
+
+    return 'success', ''
+
+
+def _process_xcorr_file_star(args):
+    return args[0], _process_xcorr_file(*args)
+
+
 def batch_process_xcorr(src_files, dataset, time_window, snr_threshold, pearson_cutoff_factor=0.5, save_plots=True,
-                        underlay_rcf_xcorr=False, force_save=False):
+                        underlay_rcf_xcorr=False, force_save=False, nproc=1, cache_folder=None):
     """
     Process a batch of .nc files to generate standard visualization graphics. PNG files are output alongside the
     source .nc file. To suppress file output, set save_plots=False.
@@ -702,10 +870,16 @@ def batch_process_xcorr(src_files, dataset, time_window, snr_threshold, pearson_
     :param underlay_rcf_xcorr: Show the individual correlation of row sample with RCF beneath the computed time lag,
         defaults to False
     :param underlay_rcf_xcorr: bool, optional
+    :param nproc: Number of worker processes over which files are distributed, defaults to 1. Workers are
+        forked, and are therefore only available on platforms supporting fork.
+    :type nproc: int, optional
+    :param cache_folder: Folder in which preprocessed results are cached, so that re-running with different
+        plot settings skips recomputation. Caching is disabled if None.
+    :type cache_folder: str, optional
     :return: List of files for which processing failed, and associated error.
     :rtype: list(tuple(str, str))
     """
-    PY2 = (sys.version_info[0] == 2)
+    global _worker_dataset
 
     register_matplotlib_converters()
 
@@ -714,53 +888,49 @@ def batch_process_xcorr(src_files, dataset, time_window, snr_threshold, pearson_
     failed_files = []
     skipped_count = 0
     success_count = 0
-    for src_file in src_files:
-        _, base_file = os.path.split(src_file)
-        pbar.set_description(base_file)
-        # Sleep to ensure progress bar is refreshed
-        time.sleep(0.2)
-
-        if not os.path.exists(src_file):
-            tqdm.write("ERROR! File {} not found!".format(src_file))
-            failed_files.append((src_file, "File not found!"))
-            continue
 
-        # Extract timestamp from nc filename if available
-        settings, title_tag = read_correlator_config(src_file)
-
-        try:
-            if save_plots:
-                basename, _ = os.path.splitext(src_file)
-                png_file = basename + ".png"
-                # If png file already exists and has later timestamp than src_file, then skip it.
-                if os.path.exists(png_file):
-                    src_file_time = os.path.getmtime(src_file)
-                    png_file_time = os.path.getmtime(png_file)
-                    png_file_size = os.stat(png_file).st_size
-                    if not force_save and (png_file_time > src_file_time) and (png_file_size > 0):
-                        tqdm.write("PNG file {} is more recent than source file {}, skipping!".format(
-                            os.path.split(png_file)[1], os.path.split(src_file)[1]))
-                        found_preexisting = True
-                        skipped_count += 1
-                        pbar.update()
-                        continue
-                plot_xcorr_file_clock_analysis(src_file, dataset, time_window, snr_threshold, pearson_cutoff_factor,
-                                               png_file=png_file, show=False, underlay_rcf_xcorr=underlay_rcf_xcorr,
-                                               title_tag=title_tag, settings=settings)
+    def update(src_file, status, message):
+        nonlocal found_preexisting, skipped_count, success_count
+        if status == 'failed':
+            if message == "File not found!":
+                tqdm.write("ERROR! File {} not found!".format(src_file))
             else:
-                plot_xcorr_file_clock_analysis(src_file, dataset, time_window, snr_threshold, pearson_cutoff_factor,
-                                               underlay_rcf_xcorr=underlay_rcf_xcorr, title_tag=title_tag,
-                                               settings=settings)
+                tqdm.write("ERROR processing file {}".format(src_file))
+            failed_files.append((src_file, message))
+        elif status == 'skipped':
+            tqdm.write(message)
+            found_preexisting = True
+            skipped_count += 1
+            pbar.update()
+        else:
             success_count += 1
             pbar.update()
 
-        except Exception as e:
-            tqdm.write("ERROR processing file {}".format(src_file))
-            failed_files.append((src_file, str(e)))
+    if nproc > 1 and len(src_files) > 1:
+        # Materialise station coordinates before forking, so that workers share them
+        _ = dataset.unique_coordinates
+        _worker_dataset = dataset
+        args = [(src_file, None, time_window, snr_threshold, pearson_cutoff_factor, save_plots,
+                 underlay_rcf_xcorr, force_save, cache_folder) for src_file in src_files]
+        pool = multiprocessing.get_context('fork').Pool(min(nproc, len(src_files)))
+        try:
+            for src_file, (status, message) in pool.imap_unordered(_process_xcorr_file_star, args):
+                pbar.set_description(os.path.split(src_file)[1])
+                update(src_file, status, message)
+        finally:
+            pool.close()
+            pool.join()
+            _worker_dataset = None
+    else:
+        for src_file in src_files:
+            _, base_file = os.path.split(src_file)
+            pbar.set_description(base_file)
+            # Sleep to ensure progress bar is refreshed
+            time.sleep(0.2)
 
-        # Python 2 does not handle circular references, so it helps to explicitly clean up.
-        if PY2:
-            gc.collect()
+            update(src_file, *_process_xcorr_file(src_file, dataset, time_window, snr_threshold,
+                                                  pearson_cutoff_factor, save_plots, underlay_rcf_xcorr,
+                                                  force_save, cache_folder))
 
     pbar.close()
 
@@ -773,7 +943,8 @@ def batch_process_xcorr(src_files, dataset, time_window, snr_threshold, pearson_
     return failed_files
 
 
-def batch_process_folder(folder_name, dataset, time_window, snr_threshold, pearson_cutoff_factor=0.5, save_plots=True):
+def batch_process_folder(folder_name, dataset, time_window, snr_threshold, pearson_cutoff_factor=0.5, save_plots=True,
+                         nproc=1, cache_folder=None):
     """
     Process all the .nc files in a given folder into graphical visualizations.
 
@@ -787,12 +958,17 @@ def batch_process_folder(folder_name, dataset, time_window, snr_threshold, pears
     :type snr_threshold: float
     :param save_plots: Whether to save plots to file, defaults to True
     :param save_plots: bool, optional
+    :param nproc: Number of worker processes over which files are distributed, defaults to 1
+    :type nproc: int, optional
+    :param cache_folder: Folder in which preprocessed results are cached; caching is disabled if None
+    :type cache_folder: str, optional
     """
     src_files = glob.glob(os.path.join(folder_name, '*.nc'))
     print("Found {} .nc files in {}".format(len(src_files), folder_name))
 
     failed_files = batch_process_xcorr(src_files, dataset, time_window=time_window, snr_threshold=snr_threshold,
-                                       pearson_cutoff_factor=pearson_cutoff_factor, save_plots=save_plots)
+                                       pearson_cutoff_factor=pearson_cutoff_factor, save_plots=save_plots,
+                                       nproc=nproc, cache_folder=cache_folder)
     _report_failed_files(failed_files)
 
 
@@ -811,7 +987,12 @@ def _report_failed_files(failed_files):
 @click.option('--time-window', default=300, type=int, show_default=True, help='Duration of time lag window to consider')
 @click.option('--snr-threshold', default=6, type=float, show_default=True,
               help='Minimum sample SNR to include in clock correction estimate')
-def main(paths, dataset, time_window, snr_threshold):
+@click.option('--nproc', default=1, type=int, show_default=True,
+              help='Number of worker processes over which .nc files are distributed')
+@click.option('--cache-folder', default=None, type=click.Path(file_okay=False),
+              help='Folder in which preprocessed results are cached, keyed by source file and analysis '
+                   'parameters, so that re-running with different plot settings skips recomputation')
+def main(paths, dataset, time_window, snr_threshold, nproc, cache_folder):
     """
     Main entry point for running clock analysis and CCF visualization on batch of station
     cross-correlation results.
@@ -824,6 +1005,10 @@ def main(paths, dataset, time_window, snr_threshold):
     :type time_window: int
     :param snr_threshold: Minimum sample SNR to include in clock correction estimate
     :type snr_threshold: float
+    :param nproc: Number of worker processes over which .nc files are distributed
+    :type nproc: int
+    :param cache_folder: Folder in which preprocessed results are cached
+    :type cache_folder: str or path
     """
 
     # Hardwired default path for now for GA application.
@@ -847,10 +1032,11 @@ def main(paths, dataset, time_window, snr_threshold):
             sys.exit(1)
 
     ds = FederatedASDFDataSet.FederatedASDFDataSet(dataset)
-    failed_files = batch_process_xcorr(files, ds, time_window, snr_threshold)
+    failed_files = batch_process_xcorr(files, ds, time_window, snr_threshold, nproc=nproc,
+                                       cache_folder=cache_folder)
     _report_failed_files(failed_files)
     for d in dirs:
-        batch_process_folder(d, ds, time_window, snr_threshold)
+        batch_process_folder(d, ds, time_window, snr_threshold, nproc=nproc, cache_folder=cache_folder)
 
 
 if __name__ == "__main__":
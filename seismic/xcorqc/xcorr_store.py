@@ -0,0 +1,353 @@
+"""
+Description:
+    Consolidated HDF5 store for cross-correlation results. Results for each station-pair are kept in a
+    group, named after the station-pair (NET.STA.NET.STA), which holds the same variables and
+    Parameters as the NETCDF4 files written by IntervalStackXCorr; cross-correlations are kept in
+    chunked, compressed datasets.
+
+    Since parallel HDF5 requires an MPI-enabled build of h5py, each processor writes to its own
+    container, and containers are merged into a single store once all processors are done.
+
+References:
+
+CreationDate:   18/10/26
+
+Revision History:
+    LastUpdate:     18/10/26
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import os
+import glob
+
+import h5py
+import numpy as np
+from obspy.geodetics.base import gps2dist_azimuth
+
+from seismic.xcorqc.xcorqc import XcorrResultsWriter
+
+
+class XcorrStore:
+    def __init__(self, file_name, mode='r', compression='gzip', compression_opts=4, chunk_rows=64):
+        """
+        :param file_name: name of HDF5 file
+        :param mode: 'r' for reading, 'w' to create a new store (truncating existing files) and 'a' for appending
+        :param compression: compression filter applied to cross-correlations; None disables compression
+        :param compression_opts: compression level
+        :param chunk_rows: number of intervals per chunk of cross-correlations
+        """
+        self.file_name = file_name
+        self.compression = compression
+        self.compression_opts = compression_opts if compression == 'gzip' else None
+        self.chunk_rows = chunk_rows
+
+        self._h5 = h5py.File(file_name, mode)
+    # end func
+
+    def __enter__(self):
+        return self
+    # end func
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    # end func
+
+    def close(self):
+        if(self._h5):
+            self._h5.close()
+            self._h5 = None
+        # end if
+    # end func
+
+    def flush(self):
+        """
+        Flushes buffered writes to disk
+        """
+        if(self._h5): self._h5.flush()
+    # end func
+
+    def keys(self):
+        """
+        :return: list of station-pairs in the store
+        """
+        return list(self._h5.keys())
+    # end func
+
+    def __contains__(self, station_pair):
+        return station_pair in self._h5
+    # end func
+
+    def __len__(self):
+        return len(self._h5)
+    # end func
+
+    def writer(self, station_pair, ref_sta_coords, temp_sta_coords, window_seconds, ensemble_stack, params,
+               logger=None):
+        """
+        :return: HDF5XcorrResultsWriter for writing results for a station-pair incrementally. See
+                 XcorrResultsWriter for a description of the parameters; existing results for the
+                 station-pair are replaced.
+        """
+        return HDF5XcorrResultsWriter(self, station_pair, ref_sta_coords, temp_sta_coords, window_seconds,
+                                      ensemble_stack, params, logger=logger)
+    # end func
+
+    def write(self, station_pair, x, xcorr, window_counts, interval_start_times, interval_end_times,
+              ref_sta_coords, temp_sta_coords, ensemble_stack, params):
+        """
+        Writes cross-correlation results for a station-pair. See write_xcorr_results for a description
+        of the parameters; existing results for the station-pair are replaced.
+        """
+        writer = self.writer(station_pair, ref_sta_coords, temp_sta_coords, None, ensemble_stack, params)
+        writer.append(xcorr, window_counts, interval_start_times, interval_end_times, None)
+        writer.close(x)
+    # end func
+
+    def read(self, station_pair, variables=None):
+        """
+        :param station_pair: NET.STA.NET.STA
+        :param variables: list of variable names to read; None reads all variables
+        :return: dictionary of variables, named as in output NETCDF4 files, and a 'Parameters' dictionary
+        """
+        if(station_pair not in self._h5): raise KeyError('Station-pair %s not found in %s' %
+                                                          (station_pair, self.file_name))
+        grp = self._h5[station_pair]
+
+        result = {}
+        for k in (variables if variables else grp.keys()):
+            if(k == 'Parameters'): continue
+            result[k] = grp[k][()]
+        # end for
+
+        if(variables is None or 'Parameters' in variables):
+            result['Parameters'] = {k: v.decode() if isinstance(v, bytes) else v
+                                    for k, v in grp['Parameters'].attrs.items()}
+        # end if
+
+        return result
+    # end func
+# end class
+
+
+class HDF5XcorrResultsWriter(XcorrResultsWriter):
+    def __init__(self, store, station_pair, ref_sta_coords, temp_sta_coords, window_seconds, ensemble_stack,
+                 params, logger=None):
+        """
+        Writes cross-correlation results for a station-pair to a group in an XcorrStore; interval stacks
+        are appended to resizable datasets.
+
+        :param store: XcorrStore opened for writing
+        """
+        super().__init__(station_pair, ref_sta_coords, temp_sta_coords, window_seconds, ensemble_stack, params,
+                         logger=logger)
+        self.store = store
+        self.grp = None
+    # end func
+
+    def _create(self):
+        h5 = self.store._h5
+        if(self.station_pair in h5): del h5[self.station_pair]
+
+        grp = h5.create_group(self.station_pair)
+        grp.attrs['description'] = 'Cross-correlation results for station-pair: %s' % self.station_pair
+
+        # Add metadata
+        lon1, lat1, lon2, lat2 = self._lonlat()
+        grp.create_dataset('Lon1', data=np.float32(lon1))
+        grp.create_dataset('Lat1', data=np.float32(lat1))
+        grp.create_dataset('Lon2', data=np.float32(lon2))
+        grp.create_dataset('Lat2', data=np.float32(lat2))
+        if np.min([v != -999 for v in [lon1, lat1, lon2, lat2]]):
+            # evaluated at single precision, as in output NETCDF4 files
+            distance, _, _ = gps2dist_azimuth(np.float32(lat1), np.float32(lon1),
+                                              np.float32(lat2), np.float32(lon2))
+            grp.create_dataset('Distance', data=np.float32(distance))
+        # end if
+
+        if not self.ensemble_stack:
+            grp.create_dataset('interval', (0,), maxshape=(None,), dtype=np.float32)
+            grp.create_dataset('NumStackedWindows', (0,), maxshape=(None,), dtype=np.float32)
+            grp.create_dataset('IntervalStartTimes', (0,), maxshape=(None,), dtype=np.int64)
+            grp.create_dataset('IntervalEndTimes', (0,), maxshape=(None,), dtype=np.int64)
+            grp.create_dataset('xcorr', (0, self.lag_count), maxshape=(None, self.lag_count), dtype=np.float32,
+                               chunks=(self.store.chunk_rows, self.lag_count),
+                               compression=self.store.compression, compression_opts=self.store.compression_opts,
+                               shuffle=self.store.compression is not None)
+        # end if
+
+        # Add and populate a new group for parameters used
+        pg = grp.create_group('Parameters')
+        for _k, _v in self.params.items():
+            pg.attrs[_k] = _v
+        # end for
+
+        self.grp = grp
+    # end func
+
+    def _append(self, xcorr, window_counts, interval_start_times, interval_end_times):
+        s, e = self.interval_count, self.interval_count + xcorr.shape[0]
+
+        for name, values in [('interval', np.arange(s, e)), ('NumStackedWindows', window_counts),
+                             ('IntervalStartTimes', interval_start_times),
+                             ('IntervalEndTimes', interval_end_times), ('xcorr', xcorr.real)]:
+            ds = self.grp[name]
+            ds.resize(e, axis=0)
+            ds[s:e] = values
+        # end for
+    # end func
+
+    def _finalize(self, x):
+        grp = self.grp
+
+        if self.ensemble_stack:
+            grp.create_dataset('NumStackedWindows', data=np.int64(self.window_count))
+            grp.create_dataset('AvgNumStackedWindowsPerInterval',
+                               data=np.float32(self.active_interval_window_count / float(self.active_interval_count)
+                                               if self.active_interval_count else np.nan))
+            grp.create_dataset('IntervalStartTime', data=np.int64(self.interval_start_time))
+            grp.create_dataset('IntervalEndTime', data=np.int64(self.interval_end_time))
+
+            if self.xcorr_sum is None:
+                xc = np.zeros(self.lag_count)
+            elif self.active_interval_count > 0:
+                xc = self.xcorr_sum.real / float(self.active_interval_count)
+            else:
+                xc = self.xcorr_sum.real
+            # end if
+            grp.create_dataset('xcorr', data=xc.astype(np.float32), compression=self.store.compression,
+                               compression_opts=self.store.compression_opts,
+                               shuffle=self.store.compression is not None)
+        # end if
+
+        grp.create_dataset('lag', data=np.array(x, dtype=np.float32))
+        self.grp = None
+
+        # results must be on disk before the station-pair is marked as completed
+        self.store.flush()
+    # end func
+# end class
+
+
+def rank_store_file_name(output_folder, rank):
+    """
+    :param output_folder: output folder
+    :param rank: rank of processor
+    :return: name of the store written by a processor. Stores are not tagged with the time-tag of a run,
+             so that stores left behind by an interrupted run are found on restart
+    """
+    return os.path.join(output_folder, 'xcorr.rank%d.h5' % (rank))
+# end func
+
+
+def rank_store_file_names(output_folder):
+    """
+    :param output_folder: output folder
+    :return: names of all stores written by processors in output_folder, regardless of the number of
+             processors used by the runs that wrote them
+    """
+    return sorted(glob.glob(os.path.join(output_folder, 'xcorr.rank*.h5')))
+# end func
+
+
+def merged_store_file_names(output_folder):
+    """
+    :param output_folder: output folder
+    :return: names of all merged stores in output_folder, including those of previous runs
+    """
+    rank_fns = set(rank_store_file_names(output_folder))
+    return sorted([fn for fn in glob.glob(os.path.join(output_folder, 'xcorr*.h5')) if fn not in rank_fns])
+# end func
+
+
+def station_pairs_in_stores(file_names):
+    """
+    :param file_names: list of names of stores
+    :return: set of station-pairs found in stores; stores that cannot be read are ignored
+    """
+    result = set()
+    for fn in file_names:
+        try:
+            with h5py.File(fn, 'r') as h5:
+                result.update(h5.keys())
+            # end with
+        except Exception as e:
+            print('Failed to read %s: %s' % (fn, str(e)))
+        # end try
+    # end for
+
+    return result
+# end func
+
+
+def merge_xcorr_stores(output_file_name, input_file_names, remove_inputs=True, station_pair_filter=None):
+    """
+    Merges stores written by individual processors into a single store. Stores left behind by interrupted
+    runs may be corrupt: those that cannot be read are renamed with a '.corrupt' suffix, and station-pairs
+    that cannot be copied are skipped.
+
+    :param output_file_name: name of merged store
+    :param input_file_names: list of names of stores to be merged
+    :param remove_inputs: remove input stores once merged
+    :param station_pair_filter: callable taking a station-pair (NET.STA.NET.STA); only station-pairs for
+                                which it returns True are merged. None merges all station-pairs
+    :return: number of station-pairs in merged store
+    """
+    with h5py.File(output_file_name, 'a') as oh5:
+        for ifn in input_file_names:
+            if(not os.path.exists(ifn)): continue
+
+            try:
+                ih5 = h5py.File(ifn, 'r')
+            except Exception as e:
+                print('Failed to read %s: %s' % (ifn, str(e)))
+                if(remove_inputs): os.replace(ifn, ifn + '.corrupt')
+                continue
+            # end try
+
+            with ih5:
+                for station_pair in ih5.keys():
+                    if(station_pair_filter is not None and not station_pair_filter(station_pair)): continue
+
+                    if(station_pair in oh5): del oh5[station_pair]
+                    try:
+                        ih5.copy(ih5[station_pair], oh5, name=station_pair)
+                    except Exception as e:
+                        print('Failed to copy %s from %s: %s' % (station_pair, ifn, str(e)))
+                        if(station_pair in oh5): del oh5[station_pair]
+                    # end try
+                # end for
+            # end with
+
+            if(remove_inputs): os.remove(ifn)
+        # end for
+
+        return len(oh5)
+    # end with
+# end func
+
+
+def recover_rank_stores(output_file_name, output_folder, checkpoint):
+    """
+    Recovers results from stores left behind by an interrupted run, which may have used a different number
+    of processors. Results of station-pairs marked as completed are merged into output_file_name, while
+    partial results of others, which are recomputed, are discarded. Station-pairs marked as completed, but
+    whose results are not found in any store, e.g. because a store was corrupted by the interruption, are
+    unmarked, so that they are recomputed.
+
+    :param output_file_name: name of merged store
+    :param output_folder: output folder
+    :param checkpoint: XcorrCheckpoint instance in restart-mode
+    """
+    stale_fns = rank_store_file_names(output_folder)
+    if(len(stale_fns)):
+        merge_xcorr_stores(output_file_name, stale_fns, station_pair_filter=checkpoint.is_done)
+    # end if
+
+    found = station_pairs_in_stores(merged_store_file_names(output_folder))
+    for station_pair in checkpoint.done_station_pairs():
+        if(checkpoint.has_results(station_pair) and station_pair not in found):
+            print('Results for station-pair %s not found; recomputing..' % (station_pair))
+            checkpoint.unmark_done(station_pair)
+        # end if
+    # end for
+# end func
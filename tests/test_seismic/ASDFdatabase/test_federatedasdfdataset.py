@@ -169,3 +169,281 @@ def test_get_waveform(buffer_mb):
     # end for
 # end func
 
+
+def test_waveform_cache():
+    fds_uncached = FederatedASDFDataSet(asdf_file_list, cache_size_in_mb=0)
+    fds = FederatedASDFDataSet(asdf_file_list, cache_size_in_mb=64)
+
+    rows = np.array(fds.get_stations('1900-01-01T00:00:00', '2100-01-01T00:00:00'))
+
+    for n, s, l, c in rows[:, 0:4]:
+        expected = fds_uncached.get_waveforms(n, s, l, c, '1900-01-01T00:00:00', '2100-01-01T00:00:00',
+                                              trace_count_threshold=1e4)
+
+        # the first pass populates the cache, the second is served from it
+        for i in range(2):
+            stream = fds.get_waveforms(n, s, l, c, '1900-01-01T00:00:00', '2100-01-01T00:00:00',
+                                       trace_count_threshold=1e4)
+
+            # cached reads must be identical to reads from the underlying ASDF files
+            assert len(expected) == len(stream)
+            for te, tr in zip(expected, stream):
+                assert te.stats.starttime == tr.stats.starttime
+                assert np.array_equal(te.data, tr.data)
+            # end for
+        # end for
+    # end for
+
+    stats = fds.get_cache_stats()
+    assert stats['hits'] > 0
+    assert stats['size_in_mb'] <= stats['capacity_in_mb']
+    assert fds_uncached.get_cache_stats() is None
+# end func
+
+def test_interval_index():
+    fds = FederatedASDFDataSet(asdf_file_list)
+    conn = sqlite3.connect(fds.fds.db_fn)
+
+    rows = np.array(fds.get_stations('1900-01-01T00:00:00', '2100-01-01T00:00:00'))
+    gmin, gmax = conn.execute('select min(st), max(et) from wdb').fetchall()[0]
+
+    rs = np.random.RandomState(0)
+    for n, s, l, c in rows[:, 0:4]:
+        # query windows of varying lengths, including ones extending beyond the data
+        for st in rs.uniform(gmin - 86400, gmax, 20):
+            et = st + rs.uniform(0, 30 * 86400)
+
+            query = "select ds_id, tag from wdb where net='%s' and sta='%s' and loc='%s' and cha='%s' " \
+                    "and et>=? and st<=?" % (n, s, l, c)
+            expected = sorted(conn.execute(query, (st, et)).fetchall())
+            result = sorted([(row[0], row[7]) for row in fds.fds.index.rows(n, s, l, c, st, et)])
+
+            assert expected == result
+            assert fds.fds.index.count(n, s, l, c, st, et) == len(expected)
+        # end for
+    # end for
+# end func
+
+def test_index_shards():
+    fds = FederatedASDFDataSet(asdf_file_list)
+
+    # each ASDF file should have an index shard, which together account for all entries in the db
+    shard_count = 0
+    for sfn in fds.fds.shard_file_names:
+        assert os.path.exists(sfn)
+        shard_count += sqlite3.connect(sfn).execute('select count(*) from wdb').fetchall()[0][0]
+    # end for
+
+    conn = sqlite3.connect(fds.fds.db_fn)
+    assert shard_count == conn.execute('select count(*) from wdb').fetchall()[0][0]
+# end func
+
+def test_get_waveforms_bulk():
+    fds = FederatedASDFDataSet(asdf_file_list, cache_size_in_mb=0)
+
+    rows = np.array(fds.get_stations('1900-01-01T00:00:00', '2100-01-01T00:00:00'))
+
+    # overlapping windows for all channels, as requested in event-based extraction
+    requests = []
+    for n, s, l, c in rows[:, 0:4]:
+        st, et = fds.get_global_time_range(n, s, l, c)
+        for t in np.linspace(st.timestamp, et.timestamp, 5):
+            requests.append((n, s, l, c, UTCDateTime(t), UTCDateTime(t) + 3600))
+        # end for
+    # end for
+
+    results = fds.get_waveforms_bulk(requests, trace_count_threshold=1e4)
+    assert len(results) == len(requests)
+
+    for request, stream in zip(requests, results):
+        expected = fds.get_waveforms(*request, trace_count_threshold=1e4)
+
+        assert len(expected) == len(stream)
+        for te, tr in zip(expected, stream):
+            assert te.stats.starttime == tr.stats.starttime
+            assert np.array_equal(te.data, tr.data)
+        # end for
+    # end for
+# end func
+
+def test_get_waveforms_fragmented():
+    fds = FederatedASDFDataSet(asdf_file_list, cache_size_in_mb=0)
+
+    rows = np.array(fds.get_stations('1900-01-01T00:00:00', '2100-01-01T00:00:00'))
+
+    for n, s, l, c in rows[:, 0:4]:
+        unbatched = fds.get_waveforms(n, s, l, c, '1900-01-01T00:00:00', '2100-01-01T00:00:00',
+                                      trace_count_threshold=1e4)
+        expected = unbatched.copy().merge().split()
+
+        # requests exceeding the threshold are assembled in batches, rather than being refused
+        stream = fds.get_waveforms(n, s, l, c, '1900-01-01T00:00:00', '2100-01-01T00:00:00',
+                                   trace_count_threshold=2)
+
+        # traces hold contiguous, unmasked data, as for requests read in one go, regardless of gaps
+        assert not any([np.ma.isMaskedArray(tr.data) for tr in unbatched])
+        assert not any([np.ma.isMaskedArray(tr.data) for tr in stream])
+        assert sum([tr.stats.npts for tr in stream]) == sum([tr.stats.npts for tr in expected])
+
+        assert len(expected) == len(stream)
+        for te, tr in zip(expected, stream):
+            assert te.stats.starttime == tr.stats.starttime
+            assert te.stats.npts == tr.stats.npts
+            assert np.array_equal(te.data, tr.data)
+        # end for
+
+    # end for
+# end func
+
+def test_handle_pool():
+    fds = FederatedASDFDataSet(asdf_file_list, cache_size_in_mb=0)
+    fds_pooled = FederatedASDFDataSet(asdf_file_list, cache_size_in_mb=0, max_open_files=1)
+
+    rows = np.array(fds.get_stations('1900-01-01T00:00:00', '2100-01-01T00:00:00'))
+
+    for n, s, l, c in rows[:, 0:4]:
+        expected = fds.get_waveforms(n, s, l, c, '1900-01-01T00:00:00', '2100-01-01T00:00:00',
+                                     trace_count_threshold=1e4)
+        stream = fds_pooled.get_waveforms(n, s, l, c, '1900-01-01T00:00:00', '2100-01-01T00:00:00',
+                                          trace_count_threshold=1e4)
+
+        assert len(expected) == len(stream)
+        for te, tr in zip(expected, stream):
+            assert np.array_equal(te.data, tr.data)
+        # end for
+    # end for
+
+    # files are opened lazily and the number of files held open is bounded
+    assert len(fds_pooled.fds.asdf_datasets) <= 1
+# end func
+
+def test_split_list_by_duration():
+    from seismic.ASDFdatabase._FederatedASDFDataSetImpl import split_list_by_duration
+
+    # a few long intervals followed by many short ones
+    st = np.concatenate([np.arange(10) * 1e4, 1e5 + np.arange(1000) * 10.])
+    et = np.concatenate([st[:10] + 1e4, st[10:] + 10.])
+
+    nproc = 4
+    bounds = split_list_by_duration(st, et, nproc)
+
+    # time-ranges are contiguous and span all intervals
+    assert bounds[0][0] == st[0] and bounds[-1][1] == et.max()
+    for a, b in zip(bounds[:-1], bounds[1:]): assert a[1] == b[0]
+
+    # each partition spans an approximately equal share of data
+    total = np.sum(et - st)
+    for s, e in bounds:
+        duration = np.sum(np.minimum(et, e) - np.maximum(st, s), where=(et > s) & (st < e))
+        assert abs(duration - total / nproc) <= 1e4
+    # end for
+# end func
+
+def test_get_work_units():
+    fds = FederatedASDFDataSet(asdf_file_list)
+
+    chunk_seconds = 10 * 86400.
+    units = fds.fds.get_work_units(chunk_seconds)
+
+    # every work unit contains data, and the set of work units covers all data
+    for net, sta, st, et in units:
+        assert et - st <= chunk_seconds
+        assert np.sum([fds.get_waveform_count(net, sta, l, c, st, et)
+                       for n, s, l, c, _, _ in fds.get_stations(st, et, network=net, station=sta)]) > 0
+    # end for
+
+    for net, sta in fds.fds.index.stations():
+        st, et = fds.fds.index.station_intervals(net, sta)
+        t = (st + et) / 2.
+        covered = np.zeros(len(t), dtype=bool)
+        for n, s, cs, ce in units:
+            if (n, s) == (net, sta): covered |= (t >= cs) & (t <= ce)
+        # end for
+        assert np.all(covered)
+    # end for
+# end func
+
+def test_daily_stats():
+    fds = FederatedASDFDataSet(asdf_file_list, cache_size_in_mb=0, build_daily_stats=True)
+    assert FederatedASDFDataSet(asdf_file_list).get_daily_stats('', '', '', '', 0, 0) is None
+
+    day = 24 * 3600
+    rows = np.array(fds.get_stations('1900-01-01T00:00:00', '2100-01-01T00:00:00'))
+    for n, s, l, c in rows[:, 0:4]:
+        st, et = fds.get_global_time_range(n, s, l, c)
+        st = UTCDateTime(year=st.year, month=st.month, day=st.day)
+
+        stats = fds.get_daily_stats(n, s, l, c, st, et)
+        assert len(stats['day'])
+
+        # compare summaries for a few days against waveform data
+        for i in np.linspace(0, len(stats['day']) - 1, 3).astype(int):
+            t = UTCDateTime(stats['day'][i])
+            stream = fds.get_waveforms(n, s, l, c, t, t + day - 1e-6, trace_count_threshold=1e4)
+            data = np.concatenate([tr.data for tr in stream]).astype(np.float64)
+
+            assert stats['count'][i] == len(data)
+            assert np.isclose(stats['mean'][i], np.mean(data))
+            assert np.isclose(stats['std'][i], np.std(data))
+            assert stats['min'][i] == np.min(data) and stats['max'][i] == np.max(data)
+            assert 0 < stats['coverage'][i] <= 1
+        # end for
+    # end for
+# end func
+
+def test_get_stations_from_index():
+    fds = FederatedASDFDataSet(asdf_file_list)
+    conn = sqlite3.connect(fds.fds.db_fn)
+
+    gmin, gmax = conn.execute('select min(st), max(et) from wdb').fetchall()[0]
+    rs = np.random.RandomState(0)
+    starttimes = rs.uniform(gmin - 86400, gmax, 50)
+    endtimes = starttimes + rs.uniform(0, 30 * 86400, 50)
+
+    results = fds.get_stations_bulk([UTCDateTime(t) for t in starttimes], [UTCDateTime(t) for t in endtimes])
+    for st, et, result in zip(starttimes, endtimes, results):
+        expected = conn.execute('select distinct net, sta, loc, cha from wdb where et>=? and st<=?',
+                                (st, et)).fetchall()
+        assert sorted(expected) == sorted([tuple(row[:4]) for row in result])
+        assert sorted(result) == sorted(fds.get_stations(UTCDateTime(st), UTCDateTime(et)))
+    # end for
+# end func
+
+def test_get_closest_stations_vectorized(num_neighbours):
+    fds = FederatedASDFDataSet(asdf_file_list)
+
+    rs = np.random.RandomState(0)
+    lons = rs.uniform(-180, 180, 20)
+    lats = rs.uniform(-90, 90, 20)
+
+    names, dists = fds.get_closest_stations(lons, lats, num_neighbours)
+    assert names.shape == dists.shape and names.shape[0] == len(lons)
+
+    for lon, lat, n, d in zip(lons, lats, names, dists):
+        netsta, dist = fds.get_closest_stations(lon, lat, num_neighbours)
+        assert list(n) == netsta
+        assert np.allclose(d, dist)
+    # end for
+# end func
+
+def test_get_waveform_arrays():
+    fds = FederatedASDFDataSet(asdf_file_list, cache_size_in_mb=0)
+
+    rows = np.array(fds.get_stations('1900-01-01T00:00:00', '2100-01-01T00:00:00'))
+    for n, s, l, c in rows[:, 0:4]:
+        st, et = fds.get_global_time_range(n, s, l, c)
+
+        # short windows out of long traces, along with the full time-range
+        for t1, t2 in [(st + 3600.3, st + 3660.7), ((st + (et - st) / 2), (st + (et - st) / 2) + 10), (st, et)]:
+            expected = fds.get_waveforms(n, s, l, c, t1, t2, trace_count_threshold=1e4)
+            arrays = fds.get_waveform_arrays(n, s, l, c, t1, t2)
+
+            assert len(expected) == len(arrays)
+            for tr, (data, stats) in zip(expected, arrays):
+                assert tr.stats.starttime == stats['starttime']
+                assert tr.stats.npts == stats['npts']
+                assert np.array_equal(tr.data, data)
+            # end for
+        # end for
+    # end for
+# end func
@@ -0,0 +1,147 @@
+#!/bin/env python
+"""
+Description:
+    Tests the batched AICD picker used by the pick harvester
+
+References:
+
+CreationDate:   18/10/26
+
+Revision History:
+    LastUpdate:     18/10/26
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import numpy as np
+import pytest
+from obspy import Trace, UTCDateTime
+from seismic.pick_harvester.batch_picker import BatchAICDPicker, aic, aic_derivative, filter_bands
+
+SAMPLING_RATE = 20.
+ONSET = 50.
+
+
+def synthetic_arrival(seed=0, npts=2000, amplitude=20.):
+    """
+    Gaussian noise of unit variance, with noise of the given amplitude following ONSET seconds
+    """
+    rs = np.random.RandomState(seed)
+    data = rs.normal(0, 1, npts)
+    onset = int(ONSET * SAMPLING_RATE)
+    data[onset:] *= amplitude
+    return Trace(data=data, header={'sampling_rate': SAMPLING_RATE, 'starttime': UTCDateTime(2010, 1, 1),
+                                    'network': 'XX', 'station': 'S0', 'channel': 'BHZ'})
+# end func
+
+
+def reference_aic(x):
+    """
+    AIC computed through an explicit loop over split points
+    """
+    n = len(x)
+    result = np.zeros(n)
+    for k in range(n - 1, 0, -1):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a = k * np.log10(np.std(x[:k]) ** 2) + (n - k - 1) * np.log10(np.std(x[k:]) ** 2)
+        # end with
+        if (a == -np.inf): a = result[k + 1]
+        result[k] = a
+    # end for
+    result[0] = result[1]
+    result[-1] = result[-2]
+    return result
+# end func
+
+
+def test_aic():
+    rs = np.random.RandomState(0)
+    data = rs.normal(0, 1, (3, 400)) * np.array([[1.], [10.], [100.]])
+    data[:, 200:] *= 5
+
+    result = aic(data)
+    for i in range(data.shape[0]):
+        assert np.allclose(result[i], reference_aic(data[i]), rtol=1e-8, atol=1e-8)
+    # end for
+
+    cf = aic_derivative(result)
+    assert np.allclose(cf[:, :-1], np.fabs(np.diff(result, axis=-1)))
+    assert np.all(cf[:, -1] == 0)
+# end func
+
+
+def test_filter_bands():
+    tr = synthetic_arrival()
+    freqmins, freqmaxs = [0.5, 2., 5.], [5., 10., 10.]
+
+    bands = filter_bands(tr.data, tr.stats.sampling_rate, freqmins, freqmaxs)
+    for i, (freqmin, freqmax) in enumerate(zip(freqmins, freqmaxs)):
+        expected = tr.copy().filter('bandpass', freqmin=freqmin, freqmax=freqmax, corners=4, zerophase=True)
+        assert np.allclose(bands[i], expected.data)
+    # end for
+# end func
+
+
+def test_batch_picker():
+    tr = synthetic_arrival()
+    picker = BatchAICDPicker(t_ma=5, nsigmas=np.arange(8, 3, -1), t_up=1, nr_len=5, nr_coeff=2)
+
+    result = picker.picks(np.stack([tr.data, tr.data]), tr.stats.starttime, tr.stats.sampling_rate)
+    assert len(result) == 2 and all(len(r) == 5 for r in result)
+
+    onset = tr.stats.starttime + ONSET
+    for bi in range(2):
+        for si in range(5):
+            picks, snr = result[bi][si]
+            assert len(picks) == len(snr)
+        # end for
+
+        picks, snr = result[bi][0]
+        assert len(picks) > 0
+        assert np.fabs(picks[0] - onset) < 0.5
+        assert snr[0] > 8
+    # end for
+
+    # traces shorter than the threshold window yield no picks
+    result = picker.picks(tr.data[None, :50], tr.stats.starttime, tr.stats.sampling_rate)
+    assert all(len(picks) == 0 for picks, _ in result[0])
+# end func
+
+
+def test_batch_picker_matches_phasepapy():
+    aicdpicker = pytest.importorskip('PhasePApy.phasepapy.phasepicker.aicdpicker')
+
+    sigmas = np.arange(8, 3, -1)
+    freqmins, freqmaxs = [0.5, 2., 5.], [5., 10., 10.]
+    batch_picker = BatchAICDPicker(t_ma=5, nsigmas=sigmas, t_up=1, nr_len=5, nr_coeff=2)
+
+    dt = 1. / SAMPLING_RATE
+    for seed in range(5):
+        tr = synthetic_arrival(seed=seed, amplitude=10.)
+        tr.taper(max_percentage=0.1, type='hann')
+        bands = filter_bands(tr.data, tr.stats.sampling_rate, freqmins, freqmaxs)
+        result = batch_picker.picks(bands, tr.stats.starttime, tr.stats.sampling_rate)
+
+        compared = 0
+        for bi in range(len(freqmins)):
+            trc = tr.copy().filter('bandpass', freqmin=freqmins[bi], freqmax=freqmaxs[bi], corners=4,
+                                   zerophase=True)
+            for si, sigma in enumerate(sigmas):
+                picker = aicdpicker.AICDPicker(t_ma=5, nsigma=sigma, t_up=1, nr_len=5, nr_coeff=2,
+                                               pol_len=10, pol_coeff=10, uncert_coeff=3)
+                _, picks, _, snr, _ = picker.picks(trc)
+                batch_picks, batch_snr = result[bi][si]
+
+                assert len(batch_picks) == len(picks), (seed, bi, sigma)
+                assert len(batch_snr) == len(snr), (seed, bi, sigma)
+                for bp, p in zip(batch_picks, picks):
+                    assert np.fabs(bp - p) < 0.5 * dt, (seed, bi, sigma)
+                # end for
+                assert np.allclose(batch_snr, snr, rtol=1e-4), (seed, bi, sigma)
+                compared += len(picks)
+            # end for
+        # end for
+
+        # the arrival must be picked, so that the comparison is not vacuous
+        assert compared > 0, seed
+    # end for
+# end func
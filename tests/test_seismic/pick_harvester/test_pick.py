@@ -0,0 +1,191 @@
+#!/bin/env python
+"""
+Description:
+    Tests the event-driven fetch mode of the pick harvester against the day-by-day fetch mode, on a
+    synthetic federation
+
+References:
+
+CreationDate:   18/10/26
+
+Revision History:
+    LastUpdate:     18/10/26
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import io
+import numpy as np
+import pytest
+from obspy import UTCDateTime
+
+pytest.importorskip('pywt')
+pytest.importorskip('pyasdf')
+pytest.importorskip('PhasePApy.phasepapy.phasepicker.aicdpicker')
+from seismic.ASDFdatabase.FederatedASDFDataSet import FederatedASDFDataSet
+from seismic.ASDFdatabase.benchmark_fds import create_synthetic_federation
+from seismic.pick_harvester.batch_picker import BatchAICDPicker
+from seismic.pick_harvester.utils import Event, Origin, Magnitude
+from seismic.pick_harvester.pick import EVENT_WINDOW_PADDING, extract_p, extract_s, dropBogusTraces, \
+    getChannelGroups, getEventWindows, getWindowBatches, fetchWindowStreams, getBackAzimuth, writePicks
+
+DAY = 86400
+START_TIME = UTCDateTime('2010-01-01T00:00:00')
+TT = {'P': 300., 'S': 550.}
+
+
+@pytest.fixture(scope='module')
+def fds(tmpdir_factory):
+    asdf_source = create_synthetic_federation(str(tmpdir_factory.mktemp('federation')), station_count=1,
+                                              channels=('BHE', 'BHN', 'BHZ'), day_count=2, sampling_rate=20.)
+    return FederatedASDFDataSet(asdf_source)
+# end func
+
+
+def synthetic_events():
+    """
+    Events originating every 4 hours, such that data windows around arrivals are away from day boundaries;
+    origin times are returned in reverse order
+    """
+    events = []
+    for i in range(12):
+        event = Event()
+        event.public_id = i
+        event.preferred_origin = Origin(START_TIME + 3600 + i * 4 * 3600, -20., 140., 10.)
+        event.preferred_magnitude = Magnitude(5., 'mw')
+        events.append(event)
+    # end for
+    events = events[::-1]
+
+    return events, np.array([e.preferred_origin.utctime.timestamp for e in events])
+# end func
+
+
+def assert_same_result(a, b):
+    assert (a is None) == (b is None)
+    if (a is None): return
+
+    picks_a, residuals_a, snr_a, band_a, picker_a = a
+    picks_b, residuals_b, snr_b, band_b, picker_b = b
+    assert [p.timestamp for p in picks_a] == pytest.approx([p.timestamp for p in picks_b])
+    assert np.allclose(residuals_a, residuals_b)
+    assert np.allclose(snr_a, snr_b, equal_nan=True)
+    assert band_a == band_b and picker_a == picker_b
+# end func
+
+
+def test_channel_groups(fds):
+    stations = fds.get_stations(START_TIME, START_TIME + 2 * DAY)
+    zrow = [s for s in stations if s[3] == 'BHZ'][0]
+
+    groups = getChannelGroups(stations)
+    assert len(groups) == 2
+    assert groups[0] == ([zrow], ['P'])
+    assert [codes[3] for codes in groups[1][0]] == ['BHN', 'BHE'] and groups[1][1] == ['S']
+
+    # s-arrivals are picked on Z channels in the absence of horizontal channels
+    assert getChannelGroups([zrow]) == [([zrow], ['P', 'S'])]
+# end func
+
+
+def test_event_windows(fds):
+    events, originTimestamps = synthetic_events()
+    eventIndices = np.arange(len(events))
+    ttp = np.full(len(events), TT['P'])
+    tts = np.full(len(events), TT['S'])
+    tts[3] = np.nan
+
+    windows = getEventWindows(originTimestamps, eventIndices, {'P': ttp, 'S': tts})
+    assert len(windows) == 2 * len(events) - 1
+    assert [w[0] for w in windows] == sorted([w[0] for w in windows])
+    for ts, phase, k, tt in windows:
+        assert ts == originTimestamps[eventIndices[k]] + TT[phase] and tt == TT[phase]
+    # end for
+    assert (3, 'S') not in [(k, phase) for _, phase, k, _ in windows]
+
+    stations = fds.get_stations(START_TIME, START_TIME + 2 * DAY)
+    chanCodes = getChannelGroups(stations)[1][0]
+    batches = getWindowBatches(chanCodes, windows, 5)
+    assert [len(batch) for batch, _ in batches] == [5, 5, 5, 5, 3]
+    assert sum([batch for batch, _ in batches], []) == windows
+    for batch, requests in batches:
+        assert len(requests) == 2 * len(batch)
+        for iw, (ts, _, _, _) in enumerate(batch):
+            for ic, codes in enumerate(chanCodes):
+                net, sta, loc, cha, st, et = requests[2 * iw + ic]
+                assert (net, sta, loc, cha) == tuple(codes[:4])
+                assert st == UTCDateTime(ts - EVENT_WINDOW_PADDING)
+                assert et == UTCDateTime(ts + EVENT_WINDOW_PADDING)
+            # end for
+        # end for
+    # end for
+# end func
+
+
+def test_event_mode_matches_day_mode(fds):
+    """
+    Picks on data windows read in the event-driven fetch mode must match those on entire days of data
+    """
+    events, originTimestamps = synthetic_events()
+    eventIndices = np.arange(len(events))
+    stations = fds.get_stations(START_TIME, START_TIME + 2 * DAY)
+
+    # low trigger thresholds, so that picks are found on random noise
+    pickers = {'P': BatchAICDPicker(t_ma=5, nsigmas=(3, 2), t_up=1, nr_len=5, nr_coeff=0),
+               'S': BatchAICDPicker(t_ma=15, nsigmas=(3, 2), t_up=1, nr_len=5, nr_coeff=0)}
+    baz = 45.
+
+    def extract(phase, event, sts):
+        slon, slat = 140., -20.
+        if (phase == 'P'):
+            return extract_p(None, [], event, slon, slat, sts[0], tat=TT[phase], batch_picker=pickers[phase])
+        else:
+            return extract_s(None, [], event, slon, slat, sts[0], sts[1], baz, tat=TT[phase],
+                             batch_picker=pickers[phase])
+        # end if
+    # end func
+
+    picked = 0
+    for chanCodes, phases in getChannelGroups(stations):
+        windows = getEventWindows(originTimestamps, eventIndices,
+                                  {phase: np.full(len(events), TT[phase]) for phase in phases})
+
+        for batch, requests in getWindowBatches(chanCodes, windows, 5):
+            for (ts, phase, k, tat), sts in zip(batch, fetchWindowStreams(fds, chanCodes, requests)):
+                assert sts is not None
+                event = events[eventIndices[k]]
+
+                day = START_TIME + DAY * int((ts - START_TIME.timestamp) // DAY)
+                dsts = []
+                for codes in chanCodes:
+                    st = fds.get_waveforms(codes[0], codes[1], codes[2], codes[3], day, day + DAY,
+                                           trace_count_threshold=200)
+                    st.merge(method=-1)
+                    dropBogusTraces(st)
+                    dsts.append(st)
+                # end for
+
+                result = extract(phase, event, sts)
+                assert_same_result(result, extract(phase, event, dsts))
+                if (result): picked += 1
+            # end for
+        # end for
+    # end for
+    assert picked > 0
+# end func
+
+
+def test_back_azimuth():
+    """
+    Horizontal components must be rotated through the back-azimuths written out along with picks
+    """
+    events, _ = synthetic_events()
+    event = events[0]
+    po = event.preferred_origin
+    result = ([po.utctime + TT['S']], [0.], np.array([[10., 1., 2., 3.]]), 0, 0)
+
+    for slon, slat in [(130., -25.), (140., 60.), (-170., -20.)]:
+        of = io.StringIO()
+        writePicks(of, event, 5., 'N0', 'S000', '00T', slon, slat, result, [8])
+        assert float(of.getvalue().split()[13]) == pytest.approx(getBackAzimuth(event, slon, slat), abs=1e-6)
+    # end for
+# end func
@@ -0,0 +1,93 @@
+#!/bin/env python
+"""
+Description:
+    Tests pick quality measures
+
+References:
+
+CreationDate:   18/10/26
+
+Revision History:
+    LastUpdate:     18/10/26
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import numpy as np
+import pytest
+from obspy import Trace, UTCDateTime
+
+pytest.importorskip('pywt')
+import pywt
+from seismic.pick_harvester.quality import compute_quality_measures, compute_quality_measures_batch, \
+    _cwt_operator, _CWT_KWARGS
+
+P_SCALES = np.logspace(0.15, 1.5, 30)
+S_SCALES = np.logspace(0.5, 4, 30)
+
+
+def reference_traces(count=20, sampling_rate=20.):
+    """
+    Windows of 6 s around synthetic onsets of varying amplitude, with a few windows of other lengths,
+    as found near data gaps
+    """
+    rs = np.random.RandomState(0)
+    traces = []
+    for i in range(count):
+        npts = int(6 * sampling_rate) + 1 if i % 5 else rs.randint(20, 121)
+        data = rs.normal(0, 1, npts)
+        data[npts // 2 + rs.randint(-5, 5):] *= rs.uniform(1, 20)
+        traces.append(Trace(data=data, header={'sampling_rate': sampling_rate,
+                                               'starttime': UTCDateTime(2010, 1, 1)}))
+    # end for
+    return traces
+# end func
+
+
+@pytest.mark.parametrize('scales', [P_SCALES, S_SCALES])
+def test_quality_measures_batch(scales):
+    traces = reference_traces()
+
+    expected = np.array([compute_quality_measures(tr, tr, scales, exact=True) for tr in traces])
+    result = compute_quality_measures_batch(traces, scales)
+
+    # measures were not computed at all under python 3 previously
+    assert np.all(expected[:, 0] != -1) and np.all(expected[:, 2] != -1)
+
+    assert np.allclose(result[:, 0], expected[:, 0], rtol=1e-6, equal_nan=True)
+    assert np.allclose(result[:, 2], expected[:, 2], rtol=1e-4)
+
+    # dominant frequencies are averages over scales of peak power, which can flip between scales of
+    # near-identical power through round-off
+    assert np.mean(np.isclose(result[:, 1], expected[:, 1], rtol=1e-6)) >= 0.9
+    assert np.allclose(result[:, 1], expected[:, 1], rtol=0.1)
+
+    # single traces are computed through the batched implementation by default
+    assert np.allclose(compute_quality_measures(traces[1], traces[1], scales), result[1], rtol=1e-12,
+                       equal_nan=True)
+# end func
+
+
+def test_quality_measures_batch_short_traces():
+    traces = [Trace(data=np.ones(1)), Trace(data=np.arange(3.))]
+    for tr in traces: tr.stats.sampling_rate = 20.
+
+    result = compute_quality_measures_batch(traces, P_SCALES)
+    assert np.all(result[0] == -1)
+    assert result[1, 2] == -1
+# end func
+
+
+@pytest.mark.parametrize('scales', [P_SCALES, S_SCALES])
+def test_cwt_operator(scales):
+    """
+    The batched operator must use the same wavelet approximation as the installed pywt.cwt
+    """
+    tr = reference_traces(1)[0]
+
+    expected, expected_freqs = pywt.cwt(tr.data, scales, 'gaus8', tr.stats.delta, **_CWT_KWARGS)
+    operator, freqs = _cwt_operator('gaus8', tuple(np.asarray(scales, dtype=np.float64)), tr.stats.npts, tr.stats.delta)
+    result = np.dot(tr.data, operator).reshape(len(scales), tr.stats.npts)
+
+    assert np.allclose(freqs, expected_freqs, rtol=1e-12)
+    assert np.allclose(result, np.real(expected), rtol=1e-8, atol=1e-8 * np.max(np.fabs(expected)))
+# end func
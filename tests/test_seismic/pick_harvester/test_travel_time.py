@@ -0,0 +1,85 @@
+#!/bin/env python
+"""
+Description:
+    Tests precomputed travel-time tables used by the pick harvester
+
+References:
+
+CreationDate:   18/10/26
+
+Revision History:
+    LastUpdate:     18/10/26
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import os
+import numpy as np
+import pytest
+from obspy.taup import TauPyModel
+from obspy.geodetics import locations2degrees
+from seismic.pick_harvester.travel_time import distance_deg, first_arrivals, build_travel_time_table, \
+    validate_travel_time_table, get_travel_time_table, load_travel_time_table
+
+
+@pytest.fixture(scope='module')
+def table():
+    return build_travel_time_table(max_depth_km=100., depth_step_km=20., max_distance_deg=30.,
+                                   distance_step_deg=2.)
+
+
+def test_distance_deg():
+    rs = np.random.RandomState(0)
+    lat1, lat2 = rs.uniform(-90, 90, (2, 100))
+    lon1, lon2 = rs.uniform(-180, 180, (2, 100))
+
+    expected = [locations2degrees(*args) for args in zip(lat1, lon1, lat2, lon2)]
+    assert np.allclose(distance_deg(lat1, lon1, lat2, lon2), expected)
+# end func
+
+
+def test_travel_time_table(table):
+    """
+    Travel-times at grid nodes must match those computed through TauP, and those interpolated between
+    nodes must be within the validated error bounds
+    """
+    model = TauPyModel(model='iasp91')
+    for depth, dist in [(20., 10.), (60., 24.), (100., 30.)]:
+        expected = first_arrivals(model, depth, dist, table.phases)
+        for phase, tt in zip(table.phases, expected):
+            assert np.isclose(table.travel_times(phase, depth, dist), tt)
+        # end for
+    # end for
+
+    max_errors = validate_travel_time_table(table, sample_count=50)
+    assert set(max_errors.keys()) == {'P', 'S'}
+
+    rs = np.random.RandomState(1)
+    depths, dists = rs.uniform(0, 100, 20), rs.uniform(1, 30, 20)
+    for phase in table.phases:
+        interpolated = table.travel_times(phase, depths, dists)
+        direct = np.array([first_arrivals(model, d, x, [phase])[0] for d, x in zip(depths, dists)])
+        assert np.nanmax(np.fabs(interpolated - direct)) < 5. # coarse grid
+    # end for
+
+    # outside the grid
+    assert np.all(np.isnan(table.travel_times('P', [150., 10., -1.], [10., 40., 10.])))
+# end func
+
+
+def test_travel_time_table_cache(tmpdir, table):
+    fn = str(tmpdir.join('tt.npz'))
+    kwargs = dict(max_depth_km=100., depth_step_km=20., max_distance_deg=30., distance_step_deg=2.,
+                  validation_sample_count=10)
+    cached = get_travel_time_table(fn, **kwargs)
+    assert os.path.exists(fn)
+
+    loaded = load_travel_time_table(fn)
+    for phase in table.phases:
+        assert np.allclose(loaded.times[phase], table.times[phase], equal_nan=True)
+        assert np.isclose(loaded.max_errors[phase], cached.max_errors[phase], equal_nan=True)
+    # end for
+
+    # tables are rebuilt when the grid changes
+    kwargs['depth_step_km'] = 50.
+    assert len(get_travel_time_table(fn, **kwargs).depths) == 3
+# end func
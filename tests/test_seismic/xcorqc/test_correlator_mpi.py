@@ -0,0 +1,93 @@
+#!/bin/env python
+"""
+Description:
+    Runs correlator.py under mpirun on a synthetic federation and checks that the dynamic scheduler
+    produces the same cross-correlations as the static scheduler, for one and two processors.
+
+    The correlator, and the generation of synthetic data, are run in subprocesses, so that MPI is not
+    initialised within the test process.
+
+References:
+
+CreationDate:   18/10/26
+
+Revision History:
+    LastUpdate:     18/10/26
+    LastUpdate:     dd/mm/yyyy  Who     Optional description
+"""
+
+import os
+import sys
+import glob
+import shutil
+from subprocess import check_call, check_output
+import numpy as np
+import pytest
+
+pytest.importorskip('mpi4py')
+pytest.importorskip('pyasdf')
+netCDF4 = pytest.importorskip('netCDF4')
+
+path = os.path.dirname(os.path.abspath(__file__))
+root = os.path.abspath(os.path.join(path, '..', '..', '..'))
+correlator = os.path.join(root, 'seismic', 'xcorqc', 'correlator.py')
+
+pytestmark = pytest.mark.skipif(shutil.which('mpirun') is None, reason='mpirun not found')
+
+
+def environment():
+    env = {k: v for k, v in os.environ.items() if not k.startswith(('OMPI_', 'PMIX_'))}
+    env['PYTHONPATH'] = os.pathsep.join([root] + ([env['PYTHONPATH']] if 'PYTHONPATH' in env else []))
+    return env
+# end func
+
+
+@pytest.fixture(scope='module')
+def asdf_source(tmpdir_factory):
+    folder = str(tmpdir_factory.mktemp('federation'))
+    cmd = [sys.executable, '-c',
+           'from seismic.ASDFdatabase.benchmark_fds import create_synthetic_federation; '
+           'print(create_synthetic_federation(%r, station_count=3, channels=("BHZ",), day_count=3, '
+           'sampling_rate=10., compression=None))' % folder]
+    return check_output(cmd, env=environment()).decode().strip().splitlines()[-1]
+# end func
+
+
+def run_correlator(asdf_source, output_path, nproc, scheduler):
+    os.makedirs(output_path)
+    cmd = ['mpirun', '--allow-run-as-root', '--oversubscribe', '-n', str(nproc),
+           sys.executable, correlator, asdf_source, asdf_source, output_path, '86400', '3600', '0.1',
+           '--start-time', '2010-01-01T00:00:00', '--end-time', '2010-01-04T00:00:00',
+           '--fmin', '0.1', '--fmax', '1', '--read-buffer-size', '1', '--work-unit-size', '1',
+           '--no-tracking-tag', '--scheduler', scheduler]
+    check_call(cmd, env=environment())
+
+    results = {}
+    for fn in sorted(glob.glob(os.path.join(output_path, '*.nc'))):
+        ds = netCDF4.Dataset(fn, 'r')
+        results[os.path.basename(fn)] = {k: np.array(ds.variables[k][:])
+                                         for k in ['xcorr', 'NumStackedWindows', 'IntervalStartTimes',
+                                                   'IntervalEndTimes', 'lag']}
+        ds.close()
+    # end for
+
+    return results
+# end func
+
+
+@pytest.mark.parametrize('nproc', [1, 2])
+def test_dynamic_scheduler(tmpdir, asdf_source, nproc):
+    expected = run_correlator(asdf_source, str(tmpdir.join('static')), nproc, 'static')
+    result = run_correlator(asdf_source, str(tmpdir.join('dynamic')), nproc, 'dynamic')
+
+    assert len(expected) > 0
+    assert sorted(result.keys()) == sorted(expected.keys())
+    for fn in expected.keys():
+        for k in expected[fn].keys():
+            assert np.allclose(result[fn][k], expected[fn][k]), (fn, k)
+        # end for
+    # end for
+
+    # work-units are merged and removed
+    assert len(glob.glob(os.path.join(str(tmpdir.join('dynamic')), 'partials', '*'))) == 0
+# end func
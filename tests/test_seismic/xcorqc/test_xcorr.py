@@ -15,8 +15,22 @@ Revision History:
     LastUpdate:     dd/mm/yyyy  Who     Optional description
 """
 
-from obspy.core import Trace, Stats
-from seismic.xcorqc.xcorqc import taper, whiten, zeropad_ba, xcorr2
+from obspy.core import Trace, Stats, UTCDateTime, Stream
+from obspy import read_inventory
+import os
+from seismic.xcorqc.xcorqc import taper, whiten, zeropad, zeropad_ba, full_spectrum, xcorr2, \
+    preprocess_window, preprocess_windows, lowpass_2d, bandpass_2d, resample_2d, combine_xcorr_results, \
+    xcorr_parameters, write_xcorr_results, NetCDFXcorrResultsWriter
+from seismic.xcorqc.xcorr_store import XcorrStore, merge_xcorr_stores, rank_store_file_name, \
+    rank_store_file_names, recover_rank_stores
+from netCDF4 import Dataset
+from seismic.xcorqc.utils import get_work_units, XcorrCheckpoint, get_stream, rotate_ne_to_transverse
+from obspy.signal.filter import bandpass, lowpass
+from seismic.xcorqc.cache import SpectraCache, ResponseCache, NEStreamCache
+from seismic.xcorqc.fft import rfft, ndflip
+from seismic.xcorqc.xcorr_station_clock_analysis import batch_correlate_same, batch_pearsonr, XcorrClockAnalyzer
+import scipy.signal
+import scipy.stats
 import pytest
 import numpy as np
 
@@ -98,3 +112,596 @@ def test_xcorr(trace_length, sampling_rate, other_sampling_rate):
     # Mean of the x-correlation function should be close to zero
     assert np.allclose(np.abs(np.mean(arr)), 0, atol=1e-2)
 # end func
+
+
+def test_full_spectrum(trace_length, pad_length_factor):
+    trc = np.random.random(trace_length)
+    fftlen = int(trace_length*pad_length_factor)
+
+    half = rfft(zeropad(trc, fftlen))
+
+    assert np.allclose(full_spectrum(half, fftlen), np.fft.fft(zeropad(trc, fftlen)))
+
+    # spectrum of the time-reversed trace
+    assert np.allclose(full_spectrum(half, fftlen, flip_npts=trace_length),
+                       np.fft.fft(zeropad(ndflip(trc), fftlen)))
+# end func
+
+
+def test_spectra_cache(tmpdir):
+    cache = SpectraCache(size_in_mb=1, cache_folder=str(tmpdir))
+
+    spectra = [np.random.random(2**14) + 1j*np.random.random(2**14) for i in range(8)] # 256 KB each
+    for i, sp in enumerate(spectra): cache.put(i, sp, i)
+
+    # entries evicted from memory are reloaded from disk
+    assert len(cache) == 4
+    for i, sp in enumerate(spectra):
+        value = cache.get(i)
+        assert np.array_equal(value[0], sp) and value[1] == i
+    # end for
+
+    stats = cache.stats()
+    assert stats['misses'] == 0 and stats['disk_hits'] > 0
+    assert cache.get('missing') is None
+
+    cache.clear()
+    assert len(tmpdir.listdir()) == 0
+# end func
+
+
+def test_xcorr_spectra_cache():
+    sr = 10
+    header = {'sampling_rate': sr, 'npts': 3*86400*sr, 'network': 'AU', 'starttime': '2011-03-11T00:00:00'}
+
+    np.random.seed(42)
+    traces = []
+    for sta in ['A', 'B', 'C']:
+        traces.append(Trace(data=np.random.normal(size=header['npts']),
+                            header=Stats(header=dict(header, station=sta))))
+    # end for
+
+    kwargs = dict(window_seconds=3600, interval_seconds=86400, flo=0.1, fhi=1, resample_rate=4)
+    cache = SpectraCache()
+    for tr1, tr2 in [(traces[0], traces[1]), (traces[0], traces[2]), (traces[1], traces[2])]:
+        expected = xcorr2(tr1, tr2, **kwargs)
+        result = xcorr2(tr1, tr2, spectra_cache=cache, **kwargs)
+
+        assert np.allclose(result[0], expected[0])
+        assert np.array_equal(result[1], expected[1])
+    # end for
+
+    # each station-window is preprocessed only once
+    windows_per_station = cache.stats()['misses'] / 3
+    assert cache.stats()['hits'] == 3 * windows_per_station
+# end func
+
+
+def test_filters_2d(sampling_rate):
+    data = np.random.normal(size=(4, 1000))
+
+    lp = lowpass_2d(data, sampling_rate/4., sampling_rate, corners=2, zerophase=True)
+    bp = bandpass_2d(data, sampling_rate/20., sampling_rate/4., sampling_rate, corners=2, zerophase=True)
+    for i in range(data.shape[0]):
+        assert np.allclose(lp[i], lowpass(data[i], sampling_rate/4., sampling_rate, corners=2, zerophase=True))
+        assert np.allclose(bp[i], bandpass(data[i], sampling_rate/20., sampling_rate/4., sampling_rate,
+                                           corners=2, zerophase=True))
+    # end for
+# end func
+
+
+def test_resample_2d(trace_length, sampling_rate):
+    data = np.random.normal(size=(3, trace_length*sampling_rate))
+
+    result = resample_2d(data, sampling_rate, sampling_rate/2.5)
+    for i in range(data.shape[0]):
+        # a plain dictionary header, unlike Stats, picks up npts from data
+        expected = Trace(data=data[i].copy(), header={'sampling_rate': sampling_rate}).\
+            resample(sampling_rate/2.5, no_filter=True).data
+        assert expected.shape == result[i].shape
+        assert np.allclose(result[i], expected)
+    # end for
+# end func
+
+
+@pytest.mark.parametrize('shape, factor', [((3, 1000), 2.5), ((2, 3, 999), 3.), ((4, 1001), 0.8), ((2, 7), 2.)])
+def test_resample_2d_interpolation(shape, factor):
+    """
+    Spectra of all rows must be interpolated as through np.interp applied to each row
+    """
+    sampling_rate = 10.
+    data = np.random.normal(size=shape)
+    npts = shape[-1]
+    num = int(npts / factor)
+
+    x = rfft(data, axis=-1) * np.fft.ifftshift(scipy.signal.get_window('hann', npts))[:npts // 2 + 1]
+    f = sampling_rate / float(npts) * np.arange(0, npts // 2 + 1)
+    large_f = 1.0 / num * (sampling_rate / factor) * np.arange(0, num // 2 + 1)
+    expected = np.zeros(shape[:-1] + (num // 2 + 1,), dtype=np.complex128)
+    for i in np.ndindex(shape[:-1]):
+        expected[i] = np.interp(large_f, f, x[i].real) + 1j * np.interp(large_f, f, x[i].imag)
+    # end for
+    expected = np.fft.irfft(expected, n=num, axis=-1) * (float(num) / float(npts))
+
+    assert np.allclose(resample_2d(data, sampling_rate, sampling_rate / factor), expected)
+# end func
+
+
+@pytest.mark.parametrize('resample_rate', [None, 4])
+@pytest.mark.parametrize('window_buffer_length', [0, 0.1])
+@pytest.mark.parametrize('normalization', ['default', 'clip_to_2std', 'one_bit_normalize'])
+@pytest.mark.parametrize('whitening', [False, True])
+def test_preprocess_windows(resample_rate, window_buffer_length, normalization, whitening):
+    sr = 20
+    window_seconds = 600
+    tr = Trace(data=np.random.normal(size=86400*sr).astype(np.float32),
+               header=Stats(header={'sampling_rate': sr, 'npts': 86400*sr, 'network': 'AU', 'station': 'A'}))
+
+    window_buffer_seconds = window_buffer_length * window_seconds
+    window_samples = (window_seconds + 2*window_buffer_seconds) * sr
+    starts = np.arange(0, 10) * int(window_samples * 0.9)
+    ends = starts + int(window_samples)
+    kwargs = dict(resample_rate=resample_rate, flo=0.05, fhi=1, whitening=whitening,
+                  whitening_window_frequency=0.02,
+                  clip_to_2std=normalization == 'clip_to_2std',
+                  one_bit_normalize=normalization == 'one_bit_normalize')
+    sr_new = resample_rate if resample_rate else sr
+    taper_length = 0.05 / (1. + window_buffer_length * 2.)
+
+    result = preprocess_windows(tr, starts, ends, sr, sr_new, None, window_samples, window_buffer_seconds,
+                                taper_length, **kwargs)
+    for i, (ws, we) in enumerate(zip(starts, ends)):
+        expected = preprocess_window(tr, ws, we, sr, sr_new, None, window_samples, window_buffer_seconds,
+                                     taper_length, **kwargs)
+        assert np.allclose(result[i], expected, atol=1e-6)
+    # end for
+# end func
+
+
+def test_whiten_2d(sampling_rate):
+    data = np.random.normal(size=(3, 1000))
+    window_freq = sampling_rate / 50.
+
+    result = whiten(data, float(sampling_rate), window_freq=window_freq)
+    for i in range(data.shape[0]):
+        # moving-average of amplitude spectrum, as a direct convolution
+        ffta = np.fft.rfft(data[i])
+        halfwindow = int(round(window_freq / (sampling_rate / 1000.) / 2.0))
+        weight = np.convolve(np.abs(ffta), np.ones(halfwindow * 2 + 1) / (halfwindow * 2 + 1), mode='same')
+
+        assert np.allclose(result[i], np.fft.irfft(ffta / weight))
+    # end for
+# end func
+
+
+@pytest.mark.parametrize('output', ['vel', 'disp'])
+@pytest.mark.parametrize('water_level', [None, 50])
+def test_response_cache(output, water_level):
+    inv = read_inventory(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                      'data', 'response_inventory.fdsnxml'))
+    sr = 40
+    header = {'sampling_rate': sr, 'network': 'AU', 'station': 'QLP', 'channel': 'BHZ',
+              'starttime': UTCDateTime('2011-03-11T00:00:00')}
+    data = np.random.normal(size=(4, 3600*sr))
+
+    cache = ResponseCache()
+    result = cache.remove_response(data, inv, 'AU.QLP..BHZ', header['starttime'], sr,
+                                   output=output.upper(), water_level=water_level)
+    for i in range(data.shape[0]):
+        tr = Trace(data=data[i].copy(), header=Stats(header=header))
+        tr.remove_response(inventory=inv, output=output.upper(), water_level=water_level)
+
+        assert np.allclose(result[i], tr.data, rtol=1e-6, atol=1e-6 * np.max(np.abs(tr.data)))
+    # end for
+
+    # transfer functions are evaluated once per channel epoch
+    cache.remove_response(data, inv, 'AU.QLP..BHZ', header['starttime'] + 86400, sr,
+                          output=output.upper(), water_level=water_level)
+    assert cache.stats()['misses'] == 1 and cache.stats()['hits'] == 1
+# end func
+
+
+def test_work_units():
+    st = UTCDateTime('2010-01-01T00:00:00')
+    day = 86400
+    pairs = [('AU.A', 'AU.B'), ('AU.A', 'AU.C'), ('AU.B', 'AU.C')]
+    time_ranges = [((st, st + 25*day), (st + 5*day, st + 100*day)),
+                   ((st - day, st + 100*day), (st + 35*day, st + 60*day)),
+                   ((st, st + 5*day), (st + 5*day, st + 10*day))]
+
+    units = get_work_units(pairs, time_ranges, st, st + 50*day, 10*day)
+
+    # chunks are aligned to start-time and clipped to the overlap of data
+    assert [u[:4] for u in units] == [('AU.A', 'AU.B', st.timestamp + 0*day, st.timestamp + 10*day),
+                                      ('AU.A', 'AU.B', st.timestamp + 10*day, st.timestamp + 20*day),
+                                      ('AU.A', 'AU.B', st.timestamp + 20*day, st.timestamp + 30*day),
+                                      ('AU.A', 'AU.C', st.timestamp + 30*day, st.timestamp + 40*day),
+                                      ('AU.A', 'AU.C', st.timestamp + 40*day, st.timestamp + 50*day)]
+    assert np.allclose([u[4] for u in units], np.array([5, 10, 5, 5, 10]) * day)
+
+    units = get_work_units(pairs, time_ranges, st, st + 50*day, 10*day, longest_first=True)
+    assert np.allclose([u[4] for u in units], np.array([10, 10, 5, 5, 5]) * day)
+# end func
+
+
+@pytest.mark.parametrize('ensemble_stack', [False, True])
+def test_combine_xcorr_results(ensemble_stack):
+    """
+    Results combined in chunks, and then across chunks, must match those combined in one go
+    """
+    sr = 10
+    window_seconds = 100
+    xcl = [np.random.normal(size=(n, 2*window_seconds*sr - 1)) for n in [3, 1, 2, 4]]
+    wcl = [np.random.randint(0, 5, x.shape[0]) for x in xcl]
+    istl = [np.arange(x.shape[0]) + i*10 for i, x in enumerate(xcl)]
+    ietl = [ist + 1 for ist in istl]
+
+    expected = combine_xcorr_results([x.copy() for x in xcl], wcl, istl, ietl, sr, window_seconds,
+                                     ensemble_stack=ensemble_stack)
+
+    chunks = [combine_xcorr_results([x.copy() for x in xcl[s:e]], wcl[s:e], istl[s:e], ietl[s:e], sr,
+                                    window_seconds, ensemble_stack=ensemble_stack) for s, e in [(0, 2), (2, 4)]]
+    result = combine_xcorr_results([c[1] for c in chunks], [c[2] for c in chunks], [c[3] for c in chunks],
+                                   [c[4] for c in chunks], sr, window_seconds, ensemble_stack=ensemble_stack)
+
+    for a, b in zip(expected, result):
+        assert np.allclose(a, b)
+    # end for
+    assert result[1].shape[0] == (1 if ensemble_stack else 10)
+# end func
+
+
+@pytest.mark.parametrize('ensemble_stack', [False, True])
+def test_xcorr_store(tmpdir, ensemble_stack):
+    """
+    Results read back from a merged store must match those written to NETCDF4 files
+    """
+    x = np.linspace(-10, 10, 199)
+    params = xcorr_parameters('BHZ', 'BHZ', None, None, 'vel', 50, None, 0.05, 864000, 86400, 3600, 0.1, 0,
+                              0.1, 1., False, True, 0.02, False, False, ensemble_stack)
+
+    pairs = ['AU.A.AU.B', 'AU.A.AU.C', 'AU.B.AU.C']
+    rank_fns = [str(tmpdir.join('xcorr.rank%d.h5' % i)) for i in range(2)]
+    stores = [XcorrStore(fn, mode='w') for fn in rank_fns]
+    for i, pair in enumerate(pairs):
+        xcorr = np.random.normal(size=(1 if ensemble_stack else 5, x.shape[0]))
+        wc = np.random.randint(1, 5, 5)
+        ist = np.arange(5) * 86400
+        iet = ist + 86400
+
+        write_xcorr_results(str(tmpdir.join('%s.nc' % pair)), pair, x, xcorr, wc, ist, iet,
+                            [130., -20.], [131., -21.], ensemble_stack, params)
+        stores[i % 2].write(pair, x, xcorr, wc, ist, iet, [130., -20.], [131., -21.], ensemble_stack, params)
+    # end for
+    for store in stores: store.close()
+
+    store_fn = str(tmpdir.join('xcorr.h5'))
+    assert merge_xcorr_stores(store_fn, rank_fns) == len(pairs)
+    assert not np.any([os.path.exists(fn) for fn in rank_fns])
+
+    with XcorrStore(store_fn) as store:
+        assert sorted(store.keys()) == pairs
+        for pair in pairs:
+            result = store.read(pair)
+            ds = Dataset(str(tmpdir.join('%s.nc' % pair)), 'r')
+            for k, v in ds.variables.items():
+                assert np.allclose(result[k], v[:]), k
+            # end for
+            for k in ds.groups['Parameters'].ncattrs():
+                assert result['Parameters'][k] == getattr(ds.groups['Parameters'], k), k
+            # end for
+            ds.close()
+        # end for
+    # end with
+# end func
+
+
+def test_xcorr_store_restart(tmpdir):
+    """
+    Results written to stores by an interrupted run must be merged on restart, even if the restarted
+    run uses a different number of processors, while partial results of incomplete station-pairs
+    must be superseded, and station-pairs whose results were lost with a corrupt store recomputed
+    """
+    output_path = str(tmpdir)
+    x = np.linspace(-10, 10, 199)
+    params = xcorr_parameters('BHZ', 'BHZ', None, None, 'vel', 50, None, 0.05, 864000, 86400, 3600, 0.1, 0,
+                              0.1, 1., False, True, 0.02, False, False, False)
+    pairs = ['AU.A.AU.B', 'AU.A.AU.C', 'AU.B.AU.C', 'AU.B.AU.D']
+    empty_pair = 'AU.C.AU.D'
+
+    def write(store, pair, nintervals):
+        xcorr = np.ones((nintervals, x.shape[0])) * nintervals
+        ist = np.arange(nintervals) * 86400
+        store.write(pair, x, xcorr, np.ones(nintervals), ist, ist + 86400, [130., -20.], [131., -21.],
+                    False, params)
+    # end func
+
+    # interrupted run on 3 processors: the last station-pair is incomplete, no results were produced
+    # for another and the store holding the third station-pair is corrupt
+    checkpoint = XcorrCheckpoint(output_path, restart_mode=False)
+    stores = [XcorrStore(rank_store_file_name(output_path, i), mode='w') for i in range(3)]
+    for i, pair in enumerate(pairs[:3]):
+        write(stores[i], pair, 5)
+        checkpoint.mark_done(pair)
+    # end for
+    write(stores[0], pairs[3], 2)
+    checkpoint.mark_done(empty_pair, has_results=False)
+    for store in stores: store.close()
+
+    with open(rank_store_file_name(output_path, 2), 'r+b') as fh:
+        fh.write(b'\0' * 64)
+    # end with
+
+    # restart on 2 processors, as done by correlator.process
+    checkpoint = XcorrCheckpoint(output_path, restart_mode=True)
+    store_fn = os.path.join(output_path, 'xcorr.h5')
+    assert len(rank_store_file_names(output_path)) == 3
+    recover_rank_stores(store_fn, output_path, checkpoint)
+
+    assert len(rank_store_file_names(output_path)) == 0
+    assert os.path.exists(rank_store_file_name(output_path, 2) + '.corrupt')
+    assert [checkpoint.is_done(pair) for pair in pairs] == [True, True, False, False]
+    assert checkpoint.is_done(empty_pair) and not checkpoint.has_results(empty_pair)
+
+    stores = [XcorrStore(rank_store_file_name(output_path, i), mode='w') for i in range(2)]
+    for pair in pairs:
+        if(checkpoint.is_done(pair)): continue
+        write(stores[1], pair, 5)
+        checkpoint.mark_done(pair)
+    # end for
+    for store in stores: store.close()
+
+    assert merge_xcorr_stores(store_fn, rank_store_file_names(output_path)) == len(pairs)
+    assert len(rank_store_file_names(output_path)) == 0
+
+    with XcorrStore(store_fn) as store:
+        assert sorted(store.keys()) == pairs
+        for pair in pairs:
+            assert np.all(store.read(pair, variables=['xcorr'])['xcorr'] == 5)
+        # end for
+    # end with
+
+    # a further restart finds all results
+    recover_rank_stores(store_fn, output_path, checkpoint)
+    assert all([checkpoint.is_done(pair) for pair in pairs])
+# end func
+
+
+def test_xcorr_checkpoint(tmpdir):
+    pair = 'AU.A.AU.B'
+    st = UTCDateTime('2010-01-01T00:00:00')
+    result = (np.random.normal(size=(3, 99)), np.array([1, 2, 3]), np.arange(3), np.arange(3) + 1, 10.)
+
+    checkpoint = XcorrCheckpoint(str(tmpdir), restart_mode=False)
+    checkpoint.save(pair, st, result)
+    checkpoint.save(pair, st + 864000, (None, None, None, None, None))
+
+    # checkpoints are only loaded in restart-mode
+    assert checkpoint.load(pair, st) is None
+    assert not checkpoint.is_saved(pair, st)
+
+    # a new instance, e.g. with a different number of processors, resumes from saved checkpoints
+    checkpoint = XcorrCheckpoint(str(tmpdir), restart_mode=True)
+    for a, b in zip(checkpoint.load(pair, st), result):
+        assert np.allclose(a, b)
+    # end for
+    assert checkpoint.load(pair, st + 864000) == (None, None, None, None, None)
+    assert checkpoint.load(pair, st + 2*864000) is None
+    assert checkpoint.is_saved(pair, st) and not checkpoint.is_saved(pair, st + 2*864000)
+    assert not checkpoint.is_done(pair)
+
+    checkpoint.mark_done(pair)
+    assert checkpoint.is_done(pair)
+    assert checkpoint.load(pair, st) is None
+# end func
+
+
+@pytest.mark.parametrize('ensemble_stack', [False, True])
+def test_streaming_writer(tmpdir, ensemble_stack):
+    """
+    Results streamed to a writer, one buffer at a time, must match those combined in memory and written
+    in one go
+    """
+    sr = 10
+    window_seconds = 100
+    xcl = [np.random.normal(size=(n, 2*window_seconds*sr - 1)) for n in [3, 1, 2, 4]]
+    wcl = [np.random.randint(0, 5, x.shape[0]) for x in xcl]
+    istl = [np.arange(x.shape[0]) + i*10 for i, x in enumerate(xcl)]
+    ietl = [ist + 1 for ist in istl]
+    params = xcorr_parameters('BHZ', 'BHZ', None, None, 'vel', 50, None, 0.05, 864000, 86400, 3600, 0.1, 0,
+                              0.1, 1., False, False, 0, False, False, ensemble_stack)
+
+    x, xc, wc, ist, iet = combine_xcorr_results([x.copy() for x in xcl], wcl, istl, ietl, sr, window_seconds,
+                                                ensemble_stack=ensemble_stack)
+    expected_fn = str(tmpdir.join('expected.nc'))
+    write_xcorr_results(expected_fn, 'AU.A.AU.B', x, xc, wc, ist, iet, [130., -20.], [131., -21.],
+                        ensemble_stack, params)
+
+    result_fn = str(tmpdir.join('result.nc'))
+    writer = NetCDFXcorrResultsWriter(result_fn, 'AU.A.AU.B', [130., -20.], [131., -21.], window_seconds,
+                                      ensemble_stack, params)
+    for args in zip(xcl, wcl, istl, ietl):
+        writer.append(*args, sr)
+    # end for
+    assert np.allclose(writer.close(), x)
+
+    de = Dataset(expected_fn, 'r')
+    dr = Dataset(result_fn, 'r')
+    assert sorted(de.variables.keys()) == sorted(dr.variables.keys())
+    for k in de.variables.keys():
+        assert np.allclose(de.variables[k][:], dr.variables[k][:], equal_nan=True), k
+    # end for
+    if not ensemble_stack:
+        assert dr.dimensions['interval'].isunlimited()
+    # end if
+    de.close()
+    dr.close()
+# end func
+
+
+@pytest.mark.parametrize('n', [1, 2, 101, 400])
+def test_batch_correlate_same(n):
+    """
+    Batched cross-correlations must match those computed row by row with scipy
+    """
+    a = np.random.normal(size=n)
+    rows = np.random.normal(size=(5, n))
+
+    result = batch_correlate_same(a, rows)
+    for row, r in zip(rows, result):
+        assert np.allclose(r, scipy.signal.correlate(a, row, mode='same'))
+    # end for
+# end func
+
+
+def test_batch_pearsonr():
+    """
+    Batched Pearson coefficients must match those computed row by row with scipy
+    """
+    a = np.random.normal(size=300)
+    rows = np.random.normal(size=(6, 300)) + np.linspace(0, 2, 6)[:, np.newaxis] * a
+
+    result = batch_pearsonr(a, rows)
+    expected = [scipy.stats.pearsonr(a, row)[0] for row in rows]
+    assert np.allclose(result, expected)
+# end func
+
+
+def test_clock_analyzer(tmpdir):
+    """
+    Clock corrections estimated by XcorrClockAnalyzer must match those computed row by row, and must be
+    reproduced when loaded from cache
+    """
+    sr = 10
+    window_seconds = 100
+    x = np.linspace(-window_seconds, window_seconds, 2*window_seconds*sr - 1)
+    shifts = np.array([0, 0, 2.5, -3, 0, 1, 0, 0, -1.5, 0])
+    xc = np.exp(-((x[np.newaxis, :] - shifts[:, np.newaxis]) / 2.) ** 2) + \
+         np.random.normal(scale=0.02, size=(len(shifts), len(x)))
+    xc[4, :] = 0 # a row without data
+    params = xcorr_parameters('BHZ', 'BHZ', None, None, 'vel', 50, None, 0.05, 864000, 86400, 3600, 0.1, 0,
+                              0.1, 1., False, False, 0, False, False, False)
+    fn = str(tmpdir.join('AU.A.AU.B.nc'))
+    ist = np.arange(len(shifts)) * 86400
+    write_xcorr_results(fn, 'AU.A.AU.B', x, xc, np.ones(len(shifts)), ist, ist + 86400,
+                        [130., -20.], [131., -21.], False, params)
+
+    cache_folder = str(tmpdir.join('cache'))
+    ca = XcorrClockAnalyzer(fn, 20, 2, 0.5, cache_folder=cache_folder)
+
+    # Reference computation, row by row
+    expected = np.full(len(shifts), np.nan)
+    ccf_shifted = []
+    for row in ca.ccf_masked:
+        if np.ma.is_masked(row):
+            ccf_shifted.append(np.full(row.shape, np.nan))
+            continue
+        c3 = scipy.signal.correlate(ca.rcf, row, mode='same')
+        shift_size = int(np.argmax(c3 / np.max(c3)) - len(c3) / 2)
+        row_shifted = np.roll(row, shift_size)
+        if shift_size > 0:
+            row_shifted[0:shift_size] = 0
+        elif shift_size < 0:
+            row_shifted[shift_size:] = 0
+        ccf_shifted.append(row_shifted)
+    # end for
+    ccf_shifted = np.array(ccf_shifted)
+    rcf_corrected = np.nanmean(ccf_shifted[ca.snr_mask, :], axis=0)
+    assert np.allclose(ca.rcf_corrected, rcf_corrected)
+    for i, row in enumerate(ca.ccf_masked):
+        if np.ma.is_masked(row): continue
+        if scipy.stats.pearsonr(rcf_corrected, ccf_shifted[i, :])[0] < 0.5: continue
+        expected[i] = ca.lag[np.argmax(scipy.signal.correlate(rcf_corrected, row, mode='same'))]
+    # end for
+    assert np.allclose(ca.raw_correction, expected, equal_nan=True)
+    assert np.isnan(ca.raw_correction[4])
+
+    # Results must be loaded from cache
+    assert len(os.listdir(cache_folder)) == 1
+    cached = XcorrClockAnalyzer(fn, 20, 2, 0.5, cache_folder=cache_folder)
+    for k in ['lag', 'ccf', 'rcf', 'snr_mask', 'raw_correction', 'rcf_corrected', 'row_rcf_crosscorr',
+              'corrections_clean', 'float_start_times']:
+        assert np.allclose(getattr(ca, k), getattr(cached, k), equal_nan=True), k
+    # end for
+    assert np.array_equal(np.ma.getmaskarray(ca.ccf_masked), np.ma.getmaskarray(cached.ccf_masked))
+
+    # Different analysis parameters must not be served from cache
+    XcorrClockAnalyzer(fn, 20, 2, 0.6, cache_folder=cache_folder)
+    assert len(os.listdir(cache_folder)) == 2
+# end func
+
+
+def test_rotate_ne_to_transverse():
+    """
+    Rotations for several back-azimuths at once must match those computed for each back-azimuth, and
+    masks of gappy data must be retained
+    """
+    n = np.ma.masked_array(np.random.normal(size=1000), mask=np.zeros(1000, dtype=bool))
+    e = np.ma.masked_array(np.random.normal(size=1000), mask=np.zeros(1000, dtype=bool))
+    n.mask[100:200] = True
+    bazs = [0., 45., 123.4, 270.]
+
+    result = rotate_ne_to_transverse(n, e, bazs)
+    assert result.shape == (len(bazs), len(n))
+    for baz, t in zip(bazs, result):
+        expected = -e * np.cos(np.radians(baz)) + n * np.sin(np.radians(baz))
+        assert np.allclose(t.compressed(), expected.compressed())
+        assert np.array_equal(np.ma.getmaskarray(t), np.ma.getmaskarray(expected))
+        assert np.array_equal(rotate_ne_to_transverse(n, e, baz), expected)
+    # end for
+# end func
+
+
+def test_ne_stream_cache():
+    """
+    Transverse components fetched through a cache of north and east component data must match those
+    fetched directly, with data fetched once for all back-azimuths
+    """
+    class MockDataSet:
+        asdf_source = 'mock'
+        fetch_count = 0
+
+        def __init__(self):
+            self.data = {cha: np.random.normal(size=4000) for cha in ['BHN', 'BHE']}
+        # end func
+
+        def get_stations(self, st, et, network=None, station=None):
+            return [(network, station, '', cha) for cha in ['BHZ', 'BHN', 'BHE']]
+        # end func
+
+        def get_waveforms_bulk(self, requests, trace_count_threshold=200):
+            self.fetch_count += 1
+            return [Stream([Trace(data=self.data[cha].copy(),
+                                  header={'network': net, 'station': sta, 'location': loc, 'channel': cha,
+                                          'sampling_rate': 10., 'starttime': st})])
+                    for net, sta, loc, cha, st, et in requests]
+        # end func
+    # end class
+
+    fds = MockDataSet()
+    t0 = UTCDateTime('2010-01-01T00:00:00')
+    bazs = [10., 200., 300.]
+    expected = [get_stream(fds, 'AU', 'A', '00T', t0, t0 + 400, baz=baz) for baz in bazs]
+    assert fds.fetch_count == len(bazs)
+
+    cache = NEStreamCache(size_in_mb=1)
+    for baz, est in zip(bazs, expected):
+        st = get_stream(fds, 'AU', 'A', '00T', t0, t0 + 400, baz=baz, ne_cache=cache)
+        assert np.allclose(st[0].data, est[0].data)
+        assert st[0].stats.starttime == est[0].stats.starttime
+    # end for
+    assert fds.fetch_count == len(bazs) + 1
+    assert cache.stats()['hits'] == len(bazs) - 1
+
+    streams = get_stream(fds, 'AU', 'A', '00T', t0, t0 + 400, baz=bazs, ne_cache=cache)
+    assert fds.fetch_count == len(bazs) + 1
+    for st, est in zip(streams, expected):
+        assert np.allclose(st[0].data, est[0].data)
+    # end for
+
+    # least-recently-used entries are evicted once capacity is exceeded (64 KB per entry)
+    for i in range(20):
+        get_stream(fds, 'AU', 'S%d' % i, '00T', t0, t0 + 400, baz=0., ne_cache=cache)
+    # end for
+    assert cache.size <= cache.capacity and cache.stats()['evictions'] > 0
+# end func